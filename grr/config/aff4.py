@@ -17,7 +17,58 @@ config_lib.DEFINE_integer(
 config_lib.DEFINE_integer("AFF4.intermediate_cache_max_size", 2000,
                           "Maximum size of the AFF4 index cache.")
 
+config_lib.DEFINE_integer(
+    "AFF4.object_cache_max_size", 0,
+    "Maximum number of objects opened under lock whose attributes are kept "
+    "in memory between uses. 0 disables the cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.write_batch_max_size", 1000,
+    "Number of pending mutations after which the writes collected by "
+    "aff4.FACTORY.BatchWrites() are sent to the data store.")
+
 config_lib.DEFINE_string(
     "AFF4.change_email", None,
     "Email used by AFF4NotificationEmailListener to notify "
     "about AFF4 changes.")
+
+config_lib.DEFINE_bool(
+    "AFF4.readahead", False,
+    "If set, AFF4 images opened for reading detect sequential access and "
+    "prefetch the following chunks in the background.")
+
+config_lib.DEFINE_integer(
+    "AFF4.readahead_min_chunks", 4,
+    "The smallest number of chunks prefetched by a sequential reader.")
+
+config_lib.DEFINE_integer(
+    "AFF4.readahead_max_chunks", 48,
+    "The largest number of chunks prefetched by a sequential reader. This is "
+    "capped to half the size of the image chunk cache.")
+
+config_lib.DEFINE_integer("AFF4.readahead_threadpool_size", 10,
+                          "Number of threads prefetching AFF4 image chunks.")
+
+config_lib.DEFINE_integer(
+    "AFF4.list_children_batch_size", 1000,
+    "Maximum number of urns listed by a single data store call when walking "
+    "AFF4 subtrees recursively.")
+
+config_lib.DEFINE_integer(
+    "AFF4.list_children_threadpool_size", 10,
+    "Number of threads listing AFF4 subtrees in the background. Every "
+    "recursive listing uses one thread at a time, so this is the number of "
+    "recursive listings which can run concurrently.")
+
+config_lib.DEFINE_integer(
+    "AFF4.deletion_batch_size", 1000,
+    "Number of subjects deleted at once when deleting large AFF4 subtrees.")
+
+config_lib.DEFINE_integer(
+    "AFF4.deletion_threadpool_size", 5,
+    "Number of threads deleting batches of subjects of large AFF4 subtrees.")
+
+config_lib.DEFINE_integer(
+    "AFF4.deletion_max_subjects_per_second", 0,
+    "If set, deletion of large AFF4 subtrees is throttled to this many "
+    "subjects per second.")
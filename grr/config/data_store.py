@@ -17,11 +17,78 @@ config_lib.DEFINE_string("Datastore.implementation", "FakeDataStore",
 config_lib.DEFINE_string("Blobstore.implementation", "MemoryStreamBlobstore",
                          "Blob storage subsystem to use.")
 
+config_lib.DEFINE_choice(
+    "Blobstore.compression",
+    default="none",
+    choices=["none", "zlib", "snappy"],
+    help=("Codec new blobs are compressed with. Blobs are only stored "
+          "compressed when that saves space and blobs stored with any codec "
+          "stay readable. Servers older than the codec support can not read "
+          "compressed blobs."))
+
+config_lib.DEFINE_integer(
+    "Blobstore.compression_level",
+    default=6,
+    help="zlib compression level from 1 (fastest) to 9 (smallest).")
+
+# Filesystem blob store.
+config_lib.DEFINE_string(
+    "FilesystemBlobstore.location",
+    default="%(Datastore.location)/blobs",
+    help="Directory the filesystem blob store keeps its blobs in.")
+
+config_lib.DEFINE_integer(
+    "FilesystemBlobstore.shard_depth",
+    default=2,
+    help=("Number of directory levels, named after two hex digits of the blob "
+          "digest each, blobs are sharded into."))
+
+config_lib.DEFINE_integer(
+    "FilesystemBlobstore.threadpool_size",
+    default=10,
+    help="Number of threads reading blobs for a single ReadBlobs call.")
+
+config_lib.DEFINE_integer(
+    "FilesystemBlobstore.read_batch_size",
+    default=10,
+    help="Number of blobs read by each thread pool task.")
+
+config_lib.DEFINE_integer(
+    "FilesystemBlobstore.mmap_threshold",
+    default=0,
+    help=("Blobs of at least this many bytes are read through mmap instead of "
+          "read(). 0 disables mmap reads."))
+
 config_lib.DEFINE_integer(
     "Datastore.transaction_timeout",
     default=600,
     help="How long do we wait for a transaction lock.")
 
+config_lib.DEFINE_integer(
+    "Datastore.attribute_cache_size",
+    default=0,
+    help=("Number of subjects whose attributes each process caches in memory. "
+          "0 disables the attribute cache."))
+
+config_lib.DEFINE_list(
+    "Datastore.attribute_cache_ttls", ["aff4:/foreman=60", "aff4:/config=60"],
+    ("Subject prefixes whose attributes may be cached and for how long, as "
+     "prefix=seconds. Only writes made by the same process invalidate the "
+     "cache, so the TTL bounds how stale other processes' reads can be."))
+
+config_lib.DEFINE_float(
+    "Datastore.slow_query_threshold",
+    default=0,
+    help=("Data store calls taking at least this many seconds are logged with "
+          "their subject, attribute count, row count and caller. 0 disables "
+          "the slow query log."))
+
+config_lib.DEFINE_bool(
+    "Datastore.lock_free_leasing",
+    default=False,
+    help=("Lease client tasks and claim queue records with per record "
+          "compare-and-set operations instead of locking the whole queue."))
+
 DATASTORE_PATHING = [
     r"%{(?P<path>files/hash/generic/sha256/...).*}",
     r"%{(?P<path>files/hash/generic/sha1/...).*}",
@@ -76,6 +143,24 @@ config_lib.DEFINE_integer(
     help=("Number of file handles kept in the SQLite "
           "data_store cache."))
 
+config_lib.DEFINE_bool(
+    "SqliteDatastore.high_throughput",
+    default=False,
+    help=("Use WAL journaling and a separate connection per thread for each "
+          "SQLite file so that readers run concurrently with the writer."))
+
+# LMDB data store.
+config_lib.DEFINE_integer(
+    "LmdbDatastore.map_size",
+    default=1024**4,
+    help=("Maximum size in bytes the LMDB database may grow to. The memory "
+          "map is reserved up front but only written pages use disk."))
+
+config_lib.DEFINE_integer(
+    "LmdbDatastore.max_readers",
+    default=1024,
+    help="Maximum number of threads that may read the LMDB database at once.")
+
 # MySQLAdvanced data store.
 config_lib.DEFINE_string("Mysql.host", "localhost",
                          "The MySQL server hostname.")
@@ -53,7 +53,56 @@ config_lib.DEFINE_bool("Worker.enable_packed_versioned_collection_journaling",
 
 config_lib.DEFINE_integer("Worker.queue_shards", 5,
                           "Queue notifications will be sharded across "
-                          "this number of datastore subjects.")
+                          "this number of datastore subjects, unless the "
+                          "queue has a shard count set with grr_config_updater "
+                          "set_queue_shards.")
+
+config_lib.DEFINE_integer("Worker.queue_shard_layout_cache_time", 60,
+                          "How long, in seconds, processes cache the "
+                          "notification shard layout of a queue. Shard count "
+                          "changes take this long to reach all processes.")
+
+config_lib.DEFINE_integer("Worker.processes", 1,
+                          "Number of worker processes grr_worker runs. With "
+                          "more than one, a supervisor process forks them and "
+                          "splits the queue notification shards between "
+                          "them. Each process serves its stats on "
+                          "Monitoring.http_port plus its index and writes "
+                          "them to the stats store as StatsStore.process_id "
+                          "(or worker) followed by _ and its index.")
+
+config_lib.DEFINE_integer(
+    "Worker.fair_share_hunt_weight", 1,
+    "Share of the worker given to flows belonging to hunts, relative to "
+    "Worker.fair_share_interactive_weight, when both are waiting at the same "
+    "priority.")
+
+config_lib.DEFINE_integer(
+    "Worker.fair_share_interactive_weight", 1,
+    "Share of the worker given to flows not belonging to hunts, relative to "
+    "Worker.fair_share_hunt_weight, when both are waiting at the same "
+    "priority.")
+
+config_lib.DEFINE_list(
+    "Worker.fair_share_creator_weights", [],
+    "Shares of the interactive flows of some creators as creator:weight "
+    "entries. Creators not listed have weight 1.")
+
+config_lib.DEFINE_float(
+    "Worker.fair_share_interactive_slice", 0.2,
+    "Fraction of the flows a worker picks up which is reserved for "
+    "interactive flows while any are waiting, whatever their priority. 0 "
+    "disables the reservation.")
+
+config_lib.DEFINE_integer(
+    "Worker.prefetch_batch_size", 100,
+    "Workers read the requests and responses of this many flows at once "
+    "before handing them to the thread pool. 0 disables prefetching.")
+
+config_lib.DEFINE_integer(
+    "Worker.prefetch_max_responses", 10000,
+    "The most responses prefetched for one batch of flows. Flows which do not "
+    "fit read their responses themselves.")
 
 config_lib.DEFINE_integer("Worker.notification_expiry_time", 600,
                           "The queue manager expires stale notifications "
@@ -63,6 +112,29 @@ config_lib.DEFINE_integer("Worker.notification_retry_interval", 30,
                           "The queue manager retries to work on requests it "
                           "could not complete after this many seconds.")
 
+config_lib.DEFINE_string(
+    "Worker.notification_channel", "PollingNotificationChannel",
+    "How processes writing notifications wake up idle workers. One of "
+    "PollingNotificationChannel (no wakeups, workers poll), "
+    "UnixSocketNotificationChannel (workers on the same host) or "
+    "DataStoreNotificationChannel (workers on any host).")
+
+config_lib.DEFINE_string(
+    "Worker.notification_channel_socket_dir", "/tmp/grr-worker-wakeup",
+    "Directory holding the sockets of the workers waiting for wakeups when "
+    "UnixSocketNotificationChannel is used.")
+
+config_lib.DEFINE_float(
+    "Worker.notification_channel_poll_interval", 0.1,
+    "How often, in seconds, waiting workers check for wakeups when "
+    "DataStoreNotificationChannel is used.")
+
+config_lib.DEFINE_integer(
+    "Worker.notification_channel_max_wait", 10,
+    "When the notification channel delivers wakeups, idle workers scan their "
+    "queues at least this often, in seconds, to pick up notifications which "
+    "were not published.")
+
 # We write a journal entry for the flow when it's about to be processed.
 # If the journal entry is there after this time, the flow will get terminated.
 config_lib.DEFINE_integer(
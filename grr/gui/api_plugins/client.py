@@ -219,13 +219,11 @@ class ApiGetClientVersionTimesHandler(api_call_handler_base.ApiCallHandler):
   result_type = ApiGetClientVersionTimesResult
 
   def Handle(self, args, token=None):
-    fd = aff4.FACTORY.Open(
-        args.client_id, mode="r", age=aff4.ALL_TIMES, token=token)
-
-    type_values = list(fd.GetValuesForAttribute(fd.Schema.TYPE))
-    times = sorted([t.age for t in type_values], reverse=True)
+    history = aff4.FACTORY.GetVersionHistory(
+        args.client_id, attributes=[aff4.AFF4Object.SchemaCls.TYPE],
+        token=token)
 
-    return ApiGetClientVersionTimesResult(times=times)
+    return ApiGetClientVersionTimesResult(times=history.GetVersionTimes())
 
 
 class ApiInterrogateClientArgs(rdf_structs.RDFProtoStruct):
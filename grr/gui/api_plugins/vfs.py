@@ -398,12 +398,10 @@ class ApiGetFileBlobHandler(api_call_handler_base.ApiCallHandler,
   """Retrieves the byte content for a given file."""
 
   args_type = ApiGetFileBlobArgs
-  CHUNK_SIZE = 1024 * 1024 * 4
 
   def _GenerateFile(self, aff4_stream, offset, length):
     aff4_stream.Seek(offset)
-    for start in range(offset, offset + length, self.CHUNK_SIZE):
-      yield aff4_stream.Read(min(self.CHUNK_SIZE, offset + length - start))
+    return aff4_stream.GenerateContent(length)
 
   def Handle(self, args, token=None):
     ValidateVfsPath(args.file_path)
@@ -463,16 +461,12 @@ class ApiGetFileVersionTimesHandler(api_call_handler_base.ApiCallHandler):
   def Handle(self, args, token=None):
     ValidateVfsPath(args.file_path)
 
-    fd = aff4.FACTORY.Open(
+    history = aff4.FACTORY.GetVersionHistory(
         args.client_id.Add(args.file_path),
-        mode="r",
-        age=aff4.ALL_TIMES,
+        attributes=[aff4.AFF4Object.SchemaCls.TYPE],
         token=token)
 
-    type_values = list(fd.GetValuesForAttribute(fd.Schema.TYPE))
-
-    return ApiGetFileVersionTimesResult(times=sorted(
-        [t.age for t in type_values], reverse=True))
+    return ApiGetFileVersionTimesResult(times=history.GetVersionTimes())
 
 
 class ApiGetFileDownloadCommandArgs(rdf_structs.RDFProtoStruct):
@@ -629,33 +623,21 @@ class ApiGetVfsTimelineHandler(api_call_handler_base.ApiCallHandler):
     items = self.GetTimelineItems(folder_urn, token=token)
     return ApiGetVfsTimelineResult(items=items)
 
-  @staticmethod
-  def GetTimelineItems(folder_urn, token=None):
-    """Retrieves the timeline items for a given folder.
-
-    The timeline consists of items indicating a state change of a file. To
-    construct the timeline, MAC times are used. Whenever a timestamp on a
-    file changes, a corresponding timeline item is created.
-
-    Args:
-      folder_urn: The urn of the target folder.
-      token: The user token.
+  # Number of urns whose stat entries are fetched at once.
+  BATCH_SIZE = 1000
 
-    Returns:
-      A list of timeline items, each consisting of a file path, a timestamp
-      and an action describing the nature of the file change.
-    """
-    child_urns = []
-    for _, children in aff4.FACTORY.RecursiveMultiListChildren(
-        folder_urn, token=token):
-      child_urns.extend(children)
+  @staticmethod
+  def _GetTimelineItemsForUrns(urns, token=None):
+    """Returns the timeline items of the given urns."""
+    if not urns:
+      return []
 
     # Get the stats attributes for all clients.
     attribute = aff4.Attribute.GetAttributeByName("stat")
 
     items = []
     for subject, values in data_store.DB.MultiResolvePrefix(
-        child_urns, attribute.predicate, token=token):
+        urns, attribute.predicate, token=token):
       for _, serialized, _ in values:
         stat = rdf_client.StatEntry.FromSerializedString(serialized)
 
@@ -678,6 +660,41 @@ class ApiGetVfsTimelineHandler(api_call_handler_base.ApiCallHandler):
 
             items.append(item)
 
+    return items
+
+  @staticmethod
+  def GetTimelineItems(folder_urn, token=None):
+    """Retrieves the timeline items for a given folder.
+
+    The timeline consists of items indicating a state change of a file. To
+    construct the timeline, MAC times are used. Whenever a timestamp on a
+    file changes, a corresponding timeline item is created.
+
+    Args:
+      folder_urn: The urn of the target folder.
+      token: The user token.
+
+    Returns:
+      A list of timeline items, each consisting of a file path, a timestamp
+      and an action describing the nature of the file change.
+    """
+    items = []
+    child_urns = []
+    for _, children in aff4.FACTORY.RecursiveMultiListChildren(
+        [folder_urn], token=token):
+      child_urns.extend(children)
+      # Stat entries are resolved batch by batch so we never hold the urns of
+      # the whole subtree.
+      if len(child_urns) >= ApiGetVfsTimelineHandler.BATCH_SIZE:
+        items.extend(
+            ApiGetVfsTimelineHandler._GetTimelineItemsForUrns(
+                child_urns, token=token))
+        child_urns = []
+
+    items.extend(
+        ApiGetVfsTimelineHandler._GetTimelineItemsForUrns(
+            child_urns, token=token))
+
     return sorted(items, key=lambda x: x.timestamp, reverse=True)
 
 
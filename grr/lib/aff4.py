@@ -6,8 +6,11 @@ This contains an AFF4 data model implementation.
 
 import __builtin__
 import abc
+import contextlib
 import itertools
+import math
 import StringIO
+import sys
 import threading
 import time
 import zlib
@@ -22,6 +25,7 @@ from grr.lib import lexer
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
+from grr.lib import threadpool
 from grr.lib import type_info
 from grr.lib import utils
 from grr.lib.rdfvalues import aff4_rdfvalues
@@ -259,6 +263,230 @@ class DeletionPool(object):
     return self._urns_for_deletion
 
 
+class DeletionProgress(object):
+  """Progress of a StreamingDeletion."""
+
+  def __init__(self, roots):
+    self.roots = roots
+    self.roots_deleted = 0
+    self.subjects_scanned = 0
+    self.subjects_deleted = 0
+    # (root, subject) such that everything below root up to and including
+    # subject has been deleted. Passing it back to StreamingDeletion.Delete()
+    # skips that part of the scan.
+    self.checkpoint = None
+
+  def __str__(self):
+    return ("%d/%d roots deleted, %d subjects scanned, %d subjects deleted" %
+            (self.roots_deleted, len(self.roots), self.subjects_scanned,
+             self.subjects_deleted))
+
+
+class StreamingDeletion(object):
+  """Deletes large object hierarchies without holding them in memory.
+
+  The subjects below each root are scanned in data store order and deleted in
+  batches on a thread pool, optionally rate limited so the deletion does not
+  starve the live workload. Each root is deleted last, together with its entry
+  in its parent's index. An interrupted deletion therefore leaves the root in
+  place and deleting it again finishes the job.
+  """
+
+  THREAD_POOL_NAME = "AFF4Deletion"
+
+  def __init__(self,
+               token=None,
+               batch_size=None,
+               threadpool_size=None,
+               max_subjects_per_second=None,
+               progress_callback=None):
+    """Constructor.
+
+    Args:
+      token: The Security Token to use.
+      batch_size: Number of subjects deleted at once. Defaults to
+          AFF4.deletion_batch_size.
+      threadpool_size: Number of threads deleting batches. Defaults to
+          AFF4.deletion_threadpool_size.
+      max_subjects_per_second: If set, the deletion is throttled to this rate.
+          Defaults to AFF4.deletion_max_subjects_per_second.
+      progress_callback: If set, called with a DeletionProgress after every
+          batch is scheduled.
+
+    Raises:
+      ValueError: if token is None.
+    """
+    if token is None:
+      raise ValueError("token can't be None")
+
+    self.token = token
+    self.batch_size = max(
+        1, batch_size or config_lib.CONFIG["AFF4.deletion_batch_size"])
+    self.threadpool_size = max(
+        1, threadpool_size or
+        config_lib.CONFIG["AFF4.deletion_threadpool_size"])
+    if max_subjects_per_second is None:
+      max_subjects_per_second = config_lib.CONFIG[
+          "AFF4.deletion_max_subjects_per_second"]
+    self.max_subjects_per_second = max_subjects_per_second
+    self.progress_callback = progress_callback
+
+    self.lock = threading.Lock()
+    self.progress = None
+    self._start_time = None
+    self._scheduled = 0
+
+  def Delete(self, urns, checkpoint=None):
+    """Deletes urns and everything below them.
+
+    Args:
+      urns: Urns of objects to remove.
+      checkpoint: A DeletionProgress.checkpoint of an interrupted deletion.
+
+    Returns:
+      The DeletionProgress.
+
+    Raises:
+      RuntimeError: If one of the urns is the root or a batch failed.
+    """
+    urns = [rdfvalue.RDFURN(urn) for urn in urns]
+    for urn in urns:
+      if urn.Path() == "/":
+        raise RuntimeError("Can't delete root URN. Please enter a valid URN")
+
+    self.progress = DeletionProgress(urns)
+    self._start_time = time.time()
+    self._scheduled = 0
+
+    for urn in urns:
+      after_urn = None
+      if checkpoint and checkpoint[0] == urn:
+        after_urn = checkpoint[1]
+
+      self._DeleteSubtree(urn, after_urn=after_urn)
+
+      # Only now that everything below it is gone, the root can go.
+      self._DeleteBatch(urn, [urn])
+      # pylint: disable=protected-access
+      FACTORY._DeleteChildFromIndex(urn, self.token)
+      # pylint: enable=protected-access
+      self.progress.subjects_deleted += 1
+      self.progress.roots_deleted += 1
+      self._ReportProgress()
+
+    return self.progress
+
+  def _DeleteSubtree(self, root, after_urn=None):
+    """Deletes all the subjects below root."""
+    scan_attributes = [
+        AFF4Object.SchemaCls.TYPE.predicate, AFF4Object.SchemaCls.LAST.predicate
+    ]
+    pool = threadpool.ThreadPool.Factory(self.THREAD_POOL_NAME,
+                                         self.threadpool_size)
+    pool.Start()
+
+    # Bounds the number of batches held in memory.
+    max_in_flight = 2 * self.threadpool_size
+    in_flight = threading.Semaphore(max_in_flight)
+    # Batch number -> last subject of finished batches.
+    finished = {}
+    errors = []
+    state = {"next_batch": 0}
+
+    def Run(batch_number, subjects):
+      try:
+        self._DeleteBatch(root, subjects)
+        with self.lock:
+          self.progress.subjects_deleted += len(subjects)
+          finished[batch_number] = subjects[-1]
+          # The checkpoint only moves past batches which are all done.
+          while state["next_batch"] in finished:
+            self.progress.checkpoint = (root,
+                                        finished.pop(state["next_batch"]))
+            state["next_batch"] += 1
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Deleting subjects below %s failed: %s", root, e)
+        with self.lock:
+          errors.append(e)
+      finally:
+        in_flight.release()
+
+    batch_number = 0
+    while not errors:
+      subjects = [
+          subject
+          for subject, _ in data_store.DB.ScanAttributes(
+              root,
+              scan_attributes,
+              after_urn=after_urn,
+              max_records=self.batch_size,
+              token=self.token)
+      ]
+      if not subjects:
+        break
+
+      after_urn = subjects[-1]
+      self.progress.subjects_scanned += len(subjects)
+      self._Throttle(len(subjects))
+
+      in_flight.acquire()
+      pool.AddTask(Run, (batch_number, subjects),
+                   "Delete %d subjects below %s" % (len(subjects), root))
+      batch_number += 1
+      self._ReportProgress()
+
+    # Wait for the remaining batches.
+    for _ in xrange(max_in_flight):
+      in_flight.acquire()
+    for _ in xrange(max_in_flight):
+      in_flight.release()
+
+    if errors:
+      raise RuntimeError("Deleting %s failed: %s" % (root, errors[0]))
+
+  def _DeleteBatch(self, root, subjects):
+    """Deletes subjects, running the OnDelete handlers of their objects."""
+    deletion_pool = DeletionPool(token=self.token)
+    for obj in deletion_pool.MultiOpen(subjects):
+      obj.OnDelete(deletion_pool=deletion_pool)
+
+    mutation_pool = data_store.DB.GetMutationPool(token=self.token)
+    # Objects marked by the OnDelete handlers may live elsewhere, their
+    # parents' indexes have to be updated.
+    prefix = utils.SmartUnicode(root)
+    for urn in deletion_pool.root_urns_for_deletion:
+      str_urn = utils.SmartUnicode(urn)
+      if str_urn != prefix and not str_urn.startswith(prefix + "/"):
+        FACTORY._DeleteChildFromIndex(  # pylint: disable=protected-access
+            urn, self.token, mutation_pool=mutation_pool)
+
+    to_delete = set(subjects)
+    to_delete.update(deletion_pool.urns_for_deletion)
+    for subject in to_delete:
+      try:
+        FACTORY.intermediate_cache.ExpireObject(rdfvalue.RDFURN(subject).Path())
+      except KeyError:
+        pass
+
+    mutation_pool.DeleteSubjects(to_delete)
+    mutation_pool.Flush()
+
+  def _Throttle(self, count):
+    """Sleeps as needed to keep the deletion under the configured rate."""
+    if not self.max_subjects_per_second:
+      return
+
+    self._scheduled += count
+    delay = (self._start_time + float(self._scheduled) /
+             self.max_subjects_per_second) - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def _ReportProgress(self):
+    if self.progress_callback:
+      self.progress_callback(self.progress)
+
+
 def _ValidateAFF4Type(aff4_type):
   """Validates and normalizes aff4_type to class object."""
   if aff4_type is None:
@@ -273,9 +501,117 @@ def _ValidateAFF4Type(aff4_type):
   return aff4_type
 
 
+class VersionedObjectCache(object):
+  """A cache of the attributes of objects opened under lock.
+
+  Each entry holds the serialized attributes of an object together with the
+  values of its LAST and UNLOCKED_WRITE attributes. LAST is rewritten on
+  every flush and UNLOCKED_WRITE by every write which bypasses the lock, such
+  as GRRFlow.MarkForTermination(). Before an entry is used only these two
+  attributes are read from the data store; if either changed, the entry is
+  dropped and the object has to be read again.
+
+  Entries are kept up to date with the writes made through locked objects so
+  objects which are repeatedly opened under lock are only read once.
+  """
+
+  _VERSION_PREDICATES = ["metadata:last", "metadata:unlocked_write"]
+
+  def __init__(self, max_size=1000):
+    self._entries = utils.FastStore(max_size=max_size)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Get(self, urn, token=None):
+    """Returns the cached attributes of the urn.
+
+    Args:
+      urn: The urn of the object.
+      token: The Security Token used to check the entry is current.
+
+    Returns:
+      A list of (predicate, serialized value, timestamp) tuples like
+      Factory.GetAttributes() returns them or None if there is no valid entry.
+    """
+    key = utils.SmartUnicode(urn)
+    try:
+      version, values = self._entries.Get(key)
+    except KeyError:
+      stats.STATS.IncrementCounter("aff4_object_cache_misses")
+      return None
+
+    current = self._Version(
+        data_store.DB.ResolveMulti(
+            key,
+            self._VERSION_PREDICATES,
+            timestamp=data_store.DB.NEWEST_TIMESTAMP,
+            token=token))
+    last = current[AFF4Object.SchemaCls.LAST.predicate]
+    if last is None or current != version:
+      self._entries.ExpireObject(key)
+      stats.STATS.IncrementCounter("aff4_object_cache_stale")
+      return None
+
+    stats.STATS.IncrementCounter("aff4_object_cache_hits")
+    return list(values)
+
+  def _Version(self, values):
+    """Returns the newest value of each of the _VERSION_PREDICATES."""
+    version = dict.fromkeys(self._VERSION_PREDICATES)
+    for predicate, value, _ in sorted(values, key=lambda x: x[-1]):
+      if predicate in version:
+        version[predicate] = long(value)
+    return version
+
+  def Put(self, urn, values):
+    """Caches attributes read from the data store at NEWEST_TIME."""
+    version = self._Version(values)
+    if version[AFF4Object.SchemaCls.LAST.predicate] is not None:
+      self._entries.Put(utils.SmartUnicode(urn), (version, tuple(values)))
+
+  def Update(self, urn, to_set, to_delete):
+    """Applies a write made by Factory.SetAttributes() to the cached entry."""
+    key = utils.SmartUnicode(urn)
+    try:
+      version, values = self._entries.Get(key)
+    except KeyError:
+      return
+
+    written = {}
+    for attribute, value_array in to_set.iteritems():
+      # The latest value written wins.
+      value = value_array[-1]
+      if isinstance(value, tuple):
+        value, ts = value
+      else:
+        ts = None
+      written[str(attribute)] = (value, ts)
+
+    last = long(written[AFF4Object.SchemaCls.LAST.predicate][0])
+    removed = set(str(attribute) for attribute in to_delete)
+    removed.update(written)
+
+    merged = [v for v in values if v[0] not in removed]
+    for predicate, (value, ts) in written.iteritems():
+      merged.append((predicate, value, long(ts or last)))
+    merged.sort(key=lambda x: x[-1], reverse=True)
+
+    # Locked writes never touch UNLOCKED_WRITE, so a write which bypassed the
+    # lock while the object was held still invalidates the entry.
+    version = dict(version)
+    version[AFF4Object.SchemaCls.LAST.predicate] = last
+    self._entries.Put(key, (version, tuple(merged)))
+
+  def Invalidate(self, urn):
+    self._entries.ExpireObject(utils.SmartUnicode(urn))
+
+
 class Factory(object):
   """A central factory for AFF4 objects."""
 
+  LIST_CHILDREN_THREAD_POOL_NAME = "AFF4ListChildren"
+
   def __init__(self):
     self.intermediate_cache = utils.AgeBasedCache(
         max_size=config_lib.CONFIG["AFF4.intermediate_cache_max_size"],
@@ -290,6 +626,15 @@ class Factory(object):
     self.notification_rules = []
     self.notification_rules_timestamp = 0
 
+    # The mutation pool collecting writes in BatchWrites(), per thread.
+    self._write_batches = threading.local()
+
+    # Objects opened under lock are cached by long running processes only.
+    self.object_cache = None
+    object_cache_size = config_lib.CONFIG["AFF4.object_cache_max_size"]
+    if object_cache_size:
+      self.object_cache = VersionedObjectCache(max_size=object_cache_size)
+
   @classmethod
   def ParseAgeSpecification(cls, age):
     """Parses an aff4 age and returns a datastore age specification."""
@@ -358,6 +703,56 @@ class Factory(object):
     if add_child_index:
       self._UpdateChildIndex(urn, token, mutation_pool=mutation_pool)
 
+  @contextlib.contextmanager
+  def BatchWrites(self, token=None):
+    """Collects the writes of the objects flushed in this thread.
+
+    Objects which are not locked and have no mutation pool of their own do not
+    write to the data store when they are flushed or closed inside this block.
+    Their attributes, and the child index entries they need, are written
+    through a single mutation pool when the block ends or once
+    AFF4.write_batch_max_size mutations are pending. Reads made inside the
+    block do not see these writes. Nested blocks are written with the
+    outermost one.
+
+    Flush(sync=True) and Close(sync=True) do not write synchronously inside
+    the block, the writes are only guaranteed to be in the data store once
+    the block ends. If the block raises, the writes collected so far are
+    still made and the original exception is raised again.
+
+    Args:
+      token: The Security Token to use for the writes.
+
+    Yields:
+      The mutation pool collecting the writes.
+    """
+    mutation_pool = self.GetWriteBatch()
+    if mutation_pool is not None:
+      yield mutation_pool
+      return
+
+    mutation_pool = data_store.DB.GetMutationPool(token=token)
+    self._write_batches.mutation_pool = mutation_pool
+    try:
+      yield mutation_pool
+    except:  # pylint: disable=bare-except
+      exc_info = sys.exc_info()
+      self._write_batches.mutation_pool = None
+      # Objects closed before the error would have been written without the
+      # batch. A failure to write them must not hide the original error.
+      try:
+        mutation_pool.Flush()
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Unable to write the batched writes.")
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+    self._write_batches.mutation_pool = None
+    mutation_pool.Flush()
+
+  def GetWriteBatch(self):
+    """Returns the mutation pool of the current BatchWrites() block, if any."""
+    return getattr(self._write_batches, "mutation_pool", None)
+
   def _UpdateChildIndex(self, urn, token, mutation_pool=None):
     """Update the child indexes.
 
@@ -376,41 +771,66 @@ class Factory(object):
       mutation_pool: An optional MutationPool object to write to. If not given,
                      the data_store is used directly.
     """
-    try:
-      # Create navigation aids by touching intermediate subject names.
-      while urn.Path() != "/":
-        basename = urn.Basename()
-        dirname = rdfvalue.RDFURN(urn.Dirname())
+    self._UpdateChildIndexes([urn], token, mutation_pool=mutation_pool)
 
+  def _UpdateChildIndexes(self, urns, token, mutation_pool=None):
+    """Updates the child indexes of many urns at once.
+
+    The index entries needed by all the urns are collected first so every
+    parent is written only once, however many of its children are given.
+
+    Args:
+      urns: The AFF4 objects for which we update the index.
+      token: The token to use.
+      mutation_pool: An optional MutationPool object to write to. If not given,
+                     the data_store is used directly.
+    """
+    # Parent urn -> {basename: urn} of the children to add to its index.
+    index_entries = {}
+    # Urns whose index entries are already collected.
+    seen = set()
+
+    for urn in urns:
+      # Create navigation aids by touching intermediate subject names.
+      while urn.Path() != "/" and urn not in seen:
         try:
           self.intermediate_cache.Get(urn)
-          return
+          break
         except KeyError:
-          attributes = {
-              # This updates the directory index.
-              "index:dir/%s" % utils.SmartStr(basename): [EMPTY_DATA],
-          }
-          # This is a performance optimization. On the root there is no point
-          # setting the last access time since it gets accessed all the time.
-          # TODO(user): Can we get rid of the index in the root node entirely?
-          # It's too big to query anyways...
-          if dirname != u"/":
-            attributes[AFF4Object.SchemaCls.LAST] = [
-                rdfvalue.RDFDatetime.Now().SerializeToDataStore()
-            ]
-
-          if mutation_pool:
-            mutation_pool.MultiSet(dirname, attributes, replace=True)
-          else:
-            data_store.DB.MultiSet(
-                dirname, attributes, token=token, replace=True, sync=False)
-
-          self.intermediate_cache.Put(urn, 1)
-
-          urn = dirname
+          pass
 
-    except access_control.UnauthorizedAccess:
-      pass
+        seen.add(urn)
+        dirname = rdfvalue.RDFURN(urn.Dirname())
+        index_entries.setdefault(dirname, {})[utils.SmartStr(
+            urn.Basename())] = urn
+        urn = dirname
+
+    for dirname, children in index_entries.iteritems():
+      attributes = {}
+      for basename in children:
+        # This updates the directory index.
+        attributes["index:dir/%s" % basename] = [EMPTY_DATA]
+
+      # This is a performance optimization. On the root there is no point
+      # setting the last access time since it gets accessed all the time.
+      # TODO(user): Can we get rid of the index in the root node entirely?
+      # It's too big to query anyways...
+      if dirname != u"/":
+        attributes[AFF4Object.SchemaCls.LAST] = [
+            rdfvalue.RDFDatetime.Now().SerializeToDataStore()
+        ]
+
+      try:
+        if mutation_pool:
+          mutation_pool.UpdateIndex(dirname, attributes)
+        else:
+          data_store.DB.MultiSet(
+              dirname, attributes, token=token, replace=True, sync=False)
+      except access_control.UnauthorizedAccess:
+        continue
+
+      for urn in children.itervalues():
+        self.intermediate_cache.Put(urn, 1)
 
   def _DeleteChildFromIndex(self, urn, token, mutation_pool=None):
     if mutation_pool:
@@ -567,12 +987,22 @@ class Factory(object):
 
     # Since we now own the data store subject, we can simply read the aff4
     # object in the usual way.
+    local_cache = None
+    if self.object_cache is not None and age == NEWEST_TIME:
+      key = utils.SmartUnicode(urn)
+      values = self.object_cache.Get(key, token=token)
+      if values is None:
+        values = dict(self.GetAttributes([key], token=token)).get(key, [])
+        self.object_cache.Put(key, values)
+      local_cache = {key: values}
+
     return self.Open(
         urn,
         aff4_type=aff4_type,
         mode="rw",
         token=token,
         age=age,
+        local_cache=local_cache,
         follow_symlinks=False,
         transaction=transaction)
 
@@ -744,8 +1174,27 @@ class Factory(object):
                 token=None,
                 aff4_type=None,
                 age=NEWEST_TIME,
-                follow_symlinks=True):
-    """Opens a bunch of urns efficiently."""
+                follow_symlinks=True,
+                attributes=None):
+    """Opens a bunch of urns efficiently.
+
+    Args:
+      urns: The urns to open.
+      mode: The mode to open the objects with.
+      token: The Security Token to use for opening the objects.
+      aff4_type: If set, only objects of this type are returned.
+      age: The age policy used to build the objects.
+      follow_symlinks: If an object is a symlink, return its target instead.
+      attributes: If set, only these attributes are fetched and read-only
+          AFF4ObjectView projections are returned instead of full objects.
+          Projections never follow symlinks.
+
+    Yields:
+      AFF4Object instances, or AFF4ObjectView instances if attributes is set.
+
+    Raises:
+      RuntimeError: The mode is invalid.
+    """
 
     if token is None:
       token = data_store.default_token
@@ -757,6 +1206,12 @@ class Factory(object):
 
     aff4_type = _ValidateAFF4Type(aff4_type)
 
+    if attributes is not None:
+      for view in self._MultiOpenViews(
+          urns, attributes, token=token, aff4_type=aff4_type, age=age):
+        yield view
+      return
+
     for urn, values in self.GetAttributes(urns, token=token, age=age):
       try:
         obj = self.Open(
@@ -790,6 +1245,39 @@ class Factory(object):
         obj.symlink_urn = symlinks[obj.urn]
         yield obj
 
+  def _MultiOpenViews(self, urns, attributes, token=None, aff4_type=None,
+                      age=NEWEST_TIME):
+    """Fetches only the given attributes of the urns, see MultiOpen()."""
+    projected = set()
+    for attribute in attributes:
+      if isinstance(attribute, basestring):
+        attribute = Attribute.GetAttributeByName(attribute)
+      projected.add(attribute)
+
+    # The type is always needed to tell which objects exist and to filter on it.
+    predicates = set(str(attribute) for attribute in projected)
+    predicates.add(AFF4Object.SchemaCls.TYPE.predicate)
+
+    for subject, values in data_store.DB.MultiResolvePrefix(
+        set(utils.SmartUnicode(urn) for urn in urns),
+        sorted(predicates),
+        timestamp=self.ParseAgeSpecification(age),
+        token=token,
+        limit=None):
+      view = AFF4ObjectView(subject, projected, age=age, token=token)
+      values.sort(key=lambda x: x[-1], reverse=True)
+      for predicate, value, ts in values:
+        # Resolving is by prefix so there may be other attributes in here.
+        if predicate in predicates:
+          view.DecodeValueFromAttribute(predicate, value, ts)
+
+      if aff4_type is not None:
+        aff4_class = view.aff4_class
+        if aff4_class is None or not issubclass(aff4_class, aff4_type):
+          continue
+
+      yield view
+
   def OpenDiscreteVersions(self,
                            urn,
                            mode="r",
@@ -870,6 +1358,51 @@ class Factory(object):
       new_obj.Initialize()  # This is required to set local attributes.
       yield new_obj
 
+  def GetVersionHistory(self, urn, attributes=None, age=ALL_TIMES,
+                        token=None):
+    """Reads the version history of an object in a single data store call.
+
+    Args:
+      urn: The urn of the object.
+      attributes: The attributes to read the history of. If None all the
+          attributes of the object are read.
+      age: The age policy to read the history for, ALL_TIMES or a time range.
+      token: The Security Token to use for reading the object.
+
+    Returns:
+      An AFF4VersionHistory.
+
+    Raises:
+      IOError: If the age policy is NEWEST_TIME.
+    """
+    if age == NEWEST_TIME:
+      raise IOError("Bad age policy NEWEST_TIME for GetVersionHistory.")
+
+    if token is None:
+      token = data_store.default_token
+
+    if attributes is None:
+      predicates = AFF4_PREFIXES
+    else:
+      attributes = [
+          Attribute.GetAttributeByName(a) if isinstance(a, basestring) else a
+          for a in attributes
+      ]
+      # The type is always needed as it delimits the versions.
+      predicates = set(str(a) for a in attributes)
+      predicates.add(AFF4Object.SchemaCls.TYPE.predicate)
+
+    values = data_store.DB.ResolvePrefix(
+        urn,
+        sorted(predicates),
+        timestamp=self.ParseAgeSpecification(age),
+        token=token)
+    if attributes is not None:
+      # Resolving is by prefix so there may be other attributes in here.
+      values = [v for v in values if v[0] in predicates]
+
+    return AFF4VersionHistory(urn, values, attributes=attributes, token=token)
+
   def Stat(self, urns, token=None):
     """Returns metadata about all urns.
 
@@ -982,6 +1515,56 @@ class Factory(object):
 
     return result
 
+  def CreateMany(self,
+                 urns,
+                 aff4_type,
+                 mode="w",
+                 token=None,
+                 force_new_version=True,
+                 mutation_pool=None):
+    """Creates many objects of the same type.
+
+    The child index entries needed by all the objects are computed and written
+    once up front, so closing the objects does not update the index again.
+
+    Args:
+      urns: The objects to create.
+      aff4_type: The desired type for these objects.
+      mode: The desired mode for these objects, "w" or "rw".
+      token: The Security Token to use for opening these items.
+      force_new_version: Forces the creation of new objects in the data_store.
+      mutation_pool: An optional MutationPool object to write to. If not given,
+                     the data_store is used directly.
+
+    Returns:
+      A list of AFF4 objects, in the same order as urns.
+
+    Raises:
+      AttributeError: If the mode is invalid.
+    """
+    if mode not in ["w", "rw"]:
+      raise AttributeError("Invalid mode %s" % mode)
+
+    if token is None:
+      token = data_store.default_token
+
+    urns = [rdfvalue.RDFURN(urn) for urn in urns]
+    aff4_type = _ValidateAFF4Type(aff4_type)
+
+    if aff4_type.SchemaCls.ADD_CHILD_INDEX:
+      self._UpdateChildIndexes(urns, token, mutation_pool=mutation_pool)
+
+    return [
+        self.Create(
+            urn,
+            aff4_type,
+            mode=mode,
+            token=token,
+            force_new_version=force_new_version,
+            object_exists=True,
+            mutation_pool=mutation_pool) for urn in urns
+    ]
+
   def MultiDelete(self, urns, token=None):
     """Drop all the information about given objects.
 
@@ -1039,6 +1622,30 @@ class Factory(object):
 
     logging.debug("Removed %d objects", len(marked_urns))
 
+  def StreamingMultiDelete(self,
+                           urns,
+                           token=None,
+                           checkpoint=None,
+                           progress_callback=None):
+    """Deletes large object hierarchies in batches, see StreamingDeletion.
+
+    Args:
+      urns: Urns of objects to remove.
+      token: The Security Token to use.
+      checkpoint: A DeletionProgress.checkpoint of an interrupted deletion.
+      progress_callback: If set, called with a DeletionProgress as the
+          deletion goes on.
+
+    Returns:
+      The DeletionProgress.
+    """
+    if token is None:
+      token = data_store.default_token
+
+    deletion = StreamingDeletion(
+        token=token, progress_callback=progress_callback)
+    return deletion.Delete(urns, checkpoint=checkpoint)
+
   def Delete(self, urn, token=None):
     """Drop all the information about this object.
 
@@ -1108,19 +1715,78 @@ class Factory(object):
             [urn], token=token, limit=limit, age=age))[0]
     return children_urns
 
+  def _MultiListChildrenInBackground(self, urns, token=None, limit=None,
+                                     age=NEWEST_TIME):
+    """Lists urns on the thread pool.
+
+    Args:
+      urns: List of urns to list children.
+      token: Security token.
+      limit: Max number of children to list (NOTE: this is per urn).
+      age: The age of the items to retrieve.
+
+    Returns:
+      A callable which waits for the listing and returns it as a list of
+      (subject, children) tuples.
+    """
+    done = threading.Event()
+    result = []
+
+    def List():
+      try:
+        result.append(
+            list(self.MultiListChildren(
+                urns, token=token, limit=limit, age=age)))
+      except Exception as e:  # pylint: disable=broad-except
+        result.append(e)
+      finally:
+        done.set()
+
+    pool = threadpool.ThreadPool.Factory(
+        self.LIST_CHILDREN_THREAD_POOL_NAME,
+        config_lib.CONFIG["AFF4.list_children_threadpool_size"])
+    pool.Start()
+    pool.AddTask(List, (), "List children of %d urns" % len(urns))
+
+    def Wait():
+      done.wait()
+      if isinstance(result[0], Exception):
+        raise result[0]  # pylint: disable=raising-bad-type
+      return result[0]
+
+    return Wait
+
   def RecursiveMultiListChildren(self,
                                  urns,
                                  token=None,
                                  limit=None,
-                                 age=NEWEST_TIME):
+                                 age=NEWEST_TIME,
+                                 max_depth=None,
+                                 max_results=None,
+                                 batch_size=None):
     """Recursively lists bunch of directories.
 
+    Urns are listed depth first in batches of at most batch_size urns: the
+    children of a batch are listed before the rest of its level, so only the
+    batches along the current path are kept in memory rather than a whole
+    level of the tree. The next batch is fetched in the background while the
+    caller consumes the current one.
+
+    Background listings run on the shared AFF4.list_children_threadpool_size
+    thread pool. Every call has at most one listing in flight, so callers
+    beyond the pool size wait for a free thread.
+
     Args:
       urns: List of urns to list children.
       token: Security token.
       limit: Max number of children to list (NOTE: this is per urn).
       age: The age of the items to retrieve. Should be one of ALL_TIMES,
            NEWEST_TIME or a range.
+      max_depth: If set, only descend this many levels. A max_depth of 1 only
+           lists the children of urns.
+      max_results: If set, stop after this many children urns were returned.
+      batch_size: Max number of urns listed per MultiListChildren call.
+           Defaults to AFF4.list_children_batch_size.
 
     Yields:
        (subject<->children urns) tuples. RecursiveMultiListChildren will fetch
@@ -1135,23 +1801,60 @@ class Factory(object):
        RecursiveMultiListChildren(['a']) will return:
        [('a', ['b']), ('b', ['c', 'd'])]
     """
+    batch_size = max(
+        1, batch_size or config_lib.CONFIG["AFF4.list_children_batch_size"])
 
-    checked_urns = set()
-    urns_to_check = urns
-    while True:
-      found_children = []
-
-      for subject, values in self.MultiListChildren(
-          urns_to_check, token=token, limit=limit, age=age):
-
-        found_children.extend(values)
-        yield subject, values
+    # Children are always longer than their parents so the only urns we can
+    # see twice are the ones we started from.
+    roots = set()
+    unique_urns = []
+    for urn in urns:
+      if urn not in roots:
+        roots.add(urn)
+        unique_urns.append(urn)
 
-      checked_urns.update(urns_to_check)
+    # (depth, urns) batches still to be listed, the next one last.
+    stack = [(0, batch)
+             for batch in reversed(list(utils.Grouper(unique_urns,
+                                                      batch_size)))]
+    if not stack:
+      return
 
-      urns_to_check = set(found_children) - checked_urns
-      if not urns_to_check:
-        break
+    results_count = 0
+
+    depth, batch = stack.pop()
+    pending = self._MultiListChildrenInBackground(
+        batch, token=token, limit=limit, age=age)
+    while pending is not None:
+      listing = pending()
+
+      if max_depth is None or depth + 1 < max_depth:
+        children_urns = []
+        for _, children in listing:
+          # With age=ALL_TIMES a child is listed once per version.
+          children_urns.extend(
+              child for child in set(children) if child not in roots)
+
+        stack.extend(
+            (depth + 1, children_batch)
+            for children_batch in reversed(
+                list(utils.Grouper(children_urns, batch_size))))
+
+      # Start listing the next batch before handing out this one.
+      pending = None
+      if stack:
+        depth, batch = stack.pop()
+        pending = self._MultiListChildrenInBackground(
+            batch, token=token, limit=limit, age=age)
+
+      for subject, children in listing:
+        if max_results is not None:
+          if results_count >= max_results:
+            return
+          children = children[:max_results - results_count]
+
+        results_count += len(children)
+        yield subject, children
 
   def Flush(self):
     data_store.DB.Flush()
@@ -1461,6 +2164,226 @@ class LazyDecoder(object):
     return self.serialized
 
 
+class AFF4ObjectView(object):
+  """A read-only projection of some attributes of an AFF4 object.
+
+  These are returned by FACTORY.MultiOpen() when only a few attributes are
+  needed. Unlike a full AFF4Object no schema is built and the object is not
+  upgraded to its type; values are decoded only when they are read.
+  """
+
+  mode = "r"
+
+  def __init__(self, urn, attributes, age=NEWEST_TIME, token=None):
+    """Constructor.
+
+    Args:
+      urn: The urn of the object.
+      attributes: The set of attributes which were fetched for this object.
+      age: The age policy the attributes were fetched with.
+      token: The Security Token the attributes were fetched with.
+    """
+    self.urn = rdfvalue.RDFURN(urn)
+    self.attributes = attributes
+    self.age_policy = age
+    self.token = token
+    self.synced_attributes = {}
+    # Views can not be written to, this is only here for Attribute.GetValues().
+    self.new_attributes = {}
+
+  def __repr__(self):
+    return "<AFF4ObjectView@%X = %s>" % (id(self), self.urn)
+
+  def DecodeValueFromAttribute(self, attribute_name, value, ts):
+    """Adds a serialized value which will be decoded when it is read."""
+    try:
+      attribute = Attribute.PREDICATES[attribute_name]
+    except KeyError:
+      return
+
+    self.synced_attributes.setdefault(attribute, []).append(
+        LazyDecoder(attribute.attribute_type, value, ts))
+
+  @property
+  def aff4_class_name(self):
+    """The name of the AFF4Object class this object would be opened as."""
+    type_values = self.synced_attributes.get(AFF4Object.SchemaCls.TYPE)
+    if type_values:
+      aff4_type = type_values[0].ToRDFValue()
+      if aff4_type is not None:
+        return str(aff4_type)
+
+    return "AFF4Volume"
+
+  @property
+  def aff4_class(self):
+    """The AFF4Object class this object would be opened as, if known."""
+    return AFF4Object.classes.get(self.aff4_class_name)
+
+  def _CheckProjected(self, attribute):
+    if attribute not in self.attributes:
+      raise BadGetAttributeError(
+          "Attribute %s was not fetched for %s." % (attribute, self.urn))
+
+  def IsAttributeSet(self, attribute):
+    """Determines if the attribute is set, see AFF4Object.IsAttributeSet()."""
+    if isinstance(attribute, basestring):
+      attribute = Attribute.GetAttributeByName(attribute)
+    self._CheckProjected(attribute)
+
+    return attribute in self.synced_attributes
+
+  def Get(self, attribute, default=None):
+    """Gets the attribute from this object, see AFF4Object.Get()."""
+    if attribute is None:
+      return default
+
+    elif isinstance(attribute, basestring):
+      attribute = Attribute.GetAttributeByName(attribute)
+
+    for result in self.GetValuesForAttribute(attribute, only_one=True):
+      try:
+        # The attribute may be a naked string or int - i.e. not an RDFValue at
+        # all.
+        result.attribute_instance = attribute
+      except AttributeError:
+        pass
+
+      return result
+
+    return attribute.GetDefault(self, default)
+
+  def GetValuesForAttribute(self, attribute, only_one=False):
+    """Returns the values of this attribute, newest first."""
+    if not only_one and self.age_policy == NEWEST_TIME:
+      raise RuntimeError("Attempting to read all attribute versions for an "
+                         "object opened for NEWEST_TIME. This is probably "
+                         "not what you want.")
+
+    if attribute is None:
+      return []
+
+    elif isinstance(attribute, basestring):
+      attribute = Attribute.GetAttributeByName(attribute)
+    self._CheckProjected(attribute)
+
+    return attribute.GetValues(self)
+
+
+class AFF4VersionHistory(object):
+  """The versions of an AFF4 object, stored as one column per attribute.
+
+  This is returned by FACTORY.GetVersionHistory(). Values are kept serialized
+  and only decoded when they are read. Like OpenDiscreteVersions() a new
+  version starts every time the TYPE attribute is written.
+  """
+
+  def __init__(self, urn, values, attributes=None, token=None):
+    """Constructor.
+
+    Args:
+      urn: The urn of the object.
+      values: A list of (predicate, serialized value, timestamp) tuples.
+      attributes: The attributes which were read, None if all were read.
+      token: The Security Token the values were read with.
+    """
+    self.urn = rdfvalue.RDFURN(urn)
+    self.attributes = attributes
+    self.token = token
+    # Maps predicates to lists of (timestamp, serialized value), newest first.
+    self.columns = {}
+    for predicate, value, ts in values:
+      self.columns.setdefault(predicate, []).append((ts, value))
+
+    for column in self.columns.itervalues():
+      column.sort(key=lambda x: x[0], reverse=True)
+
+  def _GetColumn(self, attribute):
+    if isinstance(attribute, basestring):
+      attribute = Attribute.GetAttributeByName(attribute)
+
+    if (self.attributes is not None and
+        attribute != AFF4Object.SchemaCls.TYPE and
+        attribute not in self.attributes):
+      raise BadGetAttributeError(
+          "History of %s was not read for %s." % (attribute, self.urn))
+
+    return attribute, self.columns.get(attribute.predicate, [])
+
+  def GetVersionTimes(self):
+    """Returns the times of all the versions, newest first."""
+    return [
+        rdfvalue.RDFDatetime(ts)
+        for ts, _ in self.columns.get(AFF4Object.SchemaCls.TYPE.predicate, [])
+    ]
+
+  def GetValues(self, attribute, start=None, end=None):
+    """Returns the decoded values of an attribute, newest first.
+
+    Args:
+      attribute: The attribute to return the values of.
+      start: If set, only values written after this time are returned.
+      end: If set, only values written at or before this time are returned.
+
+    Returns:
+      A list of RDFValues. Values which can not be decoded are skipped.
+    """
+    attribute, column = self._GetColumn(attribute)
+    if start is not None:
+      start = int(start)
+    if end is not None:
+      end = int(end)
+
+    result = []
+    for ts, value in column:
+      if end is not None and ts > end:
+        continue
+      if start is not None and ts <= start:
+        break
+
+      decoded = LazyDecoder(attribute.attribute_type, value, ts).ToRDFValue()
+      if decoded is not None:
+        decoded.attribute_instance = attribute
+        result.append(decoded)
+
+    return result
+
+  def GetValueAt(self, attribute, timestamp):
+    """Returns the value an attribute had at the given time, or None."""
+    for value in self.GetValues(attribute, end=timestamp):
+      return value
+
+  def OpenVersion(self, timestamp, mode="r"):
+    """Builds the full object as it was at the given time.
+
+    If the history holds all the attributes of the object it is built without
+    going back to the data store.
+
+    Args:
+      timestamp: The time of the version to open.
+      mode: The mode to open the object with.
+
+    Returns:
+      An AFF4Object.
+    """
+    timestamp = int(timestamp)
+    if self.attributes is not None:
+      return FACTORY.Open(self.urn, mode=mode, age=timestamp, token=self.token)
+
+    values = []
+    for predicate, column in self.columns.iteritems():
+      values.extend(
+          (predicate, value, ts) for ts, value in column if ts <= timestamp)
+    values.sort(key=lambda x: x[-1], reverse=True)
+
+    return FACTORY.Open(
+        self.urn,
+        mode=mode,
+        age=timestamp,
+        local_cache={utils.SmartUnicode(self.urn): values},
+        token=self.token)
+
+
 class AFF4Object(object):
   """Base class for all objects."""
 
@@ -1517,6 +2440,12 @@ class AFF4Object(object):
         "The last time any attribute of this object was written.",
         creates_new_object_version=False)
 
+    UNLOCKED_WRITE = Attribute(
+        "metadata:unlocked_write",
+        rdfvalue.RDFDatetime,
+        "The last time an attribute was written without holding the lock.",
+        creates_new_object_version=False)
+
     # Note labels should not be Set directly but should be manipulated via
     # the AddLabels method.
     LABELS = Attribute(
@@ -1864,16 +2793,40 @@ class AFF4Object(object):
       if self.object_exists:
         add_child_index = False
 
+      mutation_pool = self.mutation_pool
+      write_batch = None
+      if mutation_pool is None and self.transaction is None:
+        write_batch = mutation_pool = FACTORY.GetWriteBatch()
+
+      if write_batch is not None:
+        # The batch is written later, whatever sync says. Values keep the
+        # time of this flush.
+        now = rdfvalue.RDFDatetime.Now()
+        for values in to_set.itervalues():
+          values[:] = [(value, ts or now) for value, ts in values]
+
       # Write the attributes to the Factory cache.
       FACTORY.SetAttributes(
           self.urn,
           to_set,
           self._to_delete,
           add_child_index=add_child_index,
-          mutation_pool=self.mutation_pool,
+          mutation_pool=mutation_pool,
           sync=sync,
           token=self.token)
 
+      if (write_batch is not None and write_batch.Size() >=
+          config_lib.CONFIG["AFF4.write_batch_max_size"]):
+        write_batch.Flush()
+
+      # Writes made under lock are applied to the cached copy so the object
+      # does not have to be read again the next time it is locked.
+      if FACTORY.object_cache is not None:
+        if self.transaction is not None and self.age_policy == NEWEST_TIME:
+          FACTORY.object_cache.Update(self.urn, to_set, self._to_delete)
+        else:
+          FACTORY.object_cache.Invalidate(self.urn)
+
   @utils.Synchronized
   def _SyncAttributes(self):
     """Sync the new attributes to the synced attribute cache.
@@ -2311,17 +3264,24 @@ class AFF4Volume(AFF4Object):
       _, filename = entry[0].split("/", 1)
       direct_child_urns.append(self.urn.Add(filename))
 
-    children = self.OpenChildren(
-        children=direct_child_urns, limit=limit, age=age)
+    if not filter_string:
+      return self.OpenChildren(
+          children=direct_child_urns, limit=limit, age=age)
 
-    if filter_string:
-      # Parse the query string.
-      ast = AFF4QueryParser(filter_string).Parse()
-      filter_obj = ast.Compile(AFF4Filter)
+    # Parse the query string.
+    ast = AFF4QueryParser(filter_string).Parse()
+    filter_obj = ast.Compile(AFF4Filter)
 
-      children = filter_obj.Filter(children)
+    # The data store only sees the newest values, older versions are filtered
+    # here.
+    if age == NEWEST_TIME:
+      direct_child_urns = data_store.DB.FilterSubjects(
+          direct_child_urns, filter_obj.GetQueryPredicates(), token=self.token)
 
-    return children
+    children = self.OpenChildren(
+        children=direct_child_urns, limit=limit, age=age)
+
+    return filter_obj.Filter(children)
 
   def ListChildren(self, limit=1000000, age=NEWEST_TIME):
     """Yields RDFURNs of all the children of this object.
@@ -2424,24 +3384,49 @@ class AFF4Root(AFF4Volume):
   can be queried across the entire data store.
   """
 
+  # Number of candidates read and filtered at a time by Query().
+  QUERY_BATCH_SIZE = 1000
+
   def Query(self, filter_string="", filter_obj=None, subjects=None, limit=100):
-    """Filter the objects contained within this collection."""
+    """Filter the objects contained within this collection.
+
+    Args:
+      filter_string: A filter string to be used to filter AFF4 objects.
+      filter_obj: An already compiled AFF4Filter, used instead of the string.
+      subjects: The subjects to filter, by default the direct children of the
+        root.
+      limit: Only return up to these many objects.
+
+    Returns:
+      A ResultSet of the matching objects. Its total_count is the number of
+      all the matches, the ones beyond the limit are counted but not kept.
+    """
     if filter_obj is None and filter_string:
       # Parse the query string
       ast = AFF4QueryParser(filter_string).Parse()
+      filter_obj = ast.Compile(AFF4Filter)
 
-      # Query our own data store
-      filter_obj = ast.Compile(data_store.DB.filter)
+    if subjects is None:
+      subjects = self.ListChildren()
+
+    matches = []
+    total_count = 0
+    for batch in utils.Grouper(subjects, self.QUERY_BATCH_SIZE):
+      if filter_obj is not None:
+        # Only the remaining candidates are opened and filtered here.
+        batch = data_store.DB.FilterSubjects(
+            batch, filter_obj.GetQueryPredicates(), token=self.token)
+        objects = filter_obj.Filter(FACTORY.MultiOpen(batch, token=self.token))
+      else:
+        objects = FACTORY.MultiOpen(batch, token=self.token)
 
-    subjects = []
-    result_set = data_store.DB.Query(
-        [], filter_obj, subjects=subjects, limit=limit, token=self.token)
-    for match in result_set:
-      subjects.append(match["subject"][0][0])
+      for obj in objects:
+        total_count += 1
+        if len(matches) < limit:
+          matches.append(obj)
 
-    # Open them all at once.
-    result = data_store.ResultSet(FACTORY.MultiOpen(subjects, token=self.token))
-    result.total_count = result_set.total_count
+    result = data_store.ResultSet(matches)
+    result.total_count = total_count
 
     return result
 
@@ -2558,6 +3543,64 @@ class AFF4Stream(AFF4Object):
         yield fd, chunk, exception
       # pylint: enable=protected-access
 
+  # The largest piece of content CopyTo() holds in memory at once.
+  COPY_BUFFER_SIZE = 1024 * 1024 * 4
+
+  def _GetCopyLength(self, length):
+    """Returns how many bytes a copy from the current offset covers."""
+    available = max(0, self.size - self.offset)
+    if length is None:
+      return available
+    return min(length, available)
+
+  def _ContentWindows(self, length):
+    """Yields lists of consecutive content pieces, one bounded list at a time.
+
+    Subclasses which can fetch several pieces in a single round trip should
+    override this.
+
+    Args:
+      length: The number of bytes to produce from the current offset.
+    """
+    while length > 0:
+      data = self.Read(min(length, self.COPY_BUFFER_SIZE))
+      if not data:
+        break
+      length -= len(data)
+      yield [data]
+
+  def GenerateContent(self, length=None):
+    """Yields the content from the current offset in bounded pieces.
+
+    Args:
+      length: The number of bytes to produce, by default up to the end of the
+        stream.
+
+    Yields:
+      Strings of consecutive content.
+    """
+    for window in self._ContentWindows(self._GetCopyLength(length)):
+      for data in window:
+        yield data
+
+  def CopyTo(self, fileobj, length=None):
+    """Copies the content from the current offset to a file or socket.
+
+    Args:
+      fileobj: A file like object or a socket.
+      length: The number of bytes to copy, by default up to the end of the
+        stream.
+
+    Returns:
+      The number of bytes copied.
+    """
+    copied = 0
+    for window in self._ContentWindows(self._GetCopyLength(length)):
+      utils.WriteAll(fileobj, window)
+      copied += sum(len(data) for data in window)
+
+    return copied
+
   def __len__(self):
     return self.size
 
@@ -2723,6 +3766,81 @@ class ChunkCache(utils.FastStore):
     return self.__dict__
 
 
+class ReadAheadBatch(object):
+  """Chunks prefetched together by one task on the read ahead thread pool.
+
+  The prefetching thread only fills the batch's own cache. The reader moves
+  the chunks into the image's chunk cache once the batch is done.
+  """
+
+  def __init__(self, cache_size):
+    self.started = threading.Event()
+    self.done = threading.Event()
+    self.chunks = ChunkCache(max_size=cache_size)
+
+
+class ReadAheadState(object):
+  """Tracks a sequential reader of an AFF4ImageBase.
+
+  The prefetch window is sized so that it covers one data store round trip at
+  the rate the reader consumes chunks: a fast reader on a slow data store gets
+  a large window, a slow reader a small one.
+  """
+
+  # Weight of a new sample in the moving averages.
+  SMOOTHING = 0.3
+
+  def __init__(self, min_window, max_window):
+    self.lock = threading.Lock()
+    self.min_window = max(1, min_window)
+    self.max_window = max(self.min_window, max_window)
+    self.window = self.min_window
+    # Chunk number -> the ReadAheadBatch prefetching it.
+    self.pending = {}
+    self.last_chunk = None
+    self.last_time = None
+    # The first chunk which has not been scheduled for prefetching yet.
+    self.next_chunk = None
+    # Moving averages of the reader's speed and the prefetch latency.
+    self.read_rate = None
+    self.fetch_latency = None
+
+  def _Average(self, average, sample):
+    if average is None:
+      return sample
+    return self.SMOOTHING * sample + (1 - self.SMOOTHING) * average
+
+  def Reset(self):
+    """Called when the reader stops being sequential."""
+    with self.lock:
+      self.pending = {}
+      self.next_chunk = None
+      self.last_time = None
+      self.window = self.min_window
+
+  def RecordRead(self, now):
+    """Records that the reader moved on to the next chunk."""
+    if self.last_time is not None and now > self.last_time:
+      self.read_rate = self._Average(self.read_rate, 1.0 /
+                                     (now - self.last_time))
+    self.last_time = now
+    self._Resize()
+
+  def RecordFetch(self, latency):
+    """Records how long a background prefetch took."""
+    with self.lock:
+      self.fetch_latency = self._Average(self.fetch_latency, latency)
+
+  def _Resize(self):
+    if self.read_rate is None or self.fetch_latency is None:
+      return
+
+    # Twice the chunks consumed during a round trip, so the next batch is
+    # requested before the current one runs out.
+    window = int(math.ceil(2 * self.read_rate * self.fetch_latency))
+    self.window = min(self.max_window, max(self.min_window, window))
+
+
 class AFF4ImageBase(AFF4Stream):
   """An AFF4 Image is stored in segments.
 
@@ -2743,6 +3861,17 @@ class AFF4ImageBase(AFF4Stream):
   # How many chunks should be cached.
   LOOK_AHEAD = 10
 
+  # Subclasses which can not prefetch chunks from another thread disable the
+  # adaptive read ahead (see AFF4.readahead).
+  ADAPTIVE_READAHEAD = True
+  READAHEAD_THREAD_POOL_NAME = "AFF4ReadAhead"
+  # How long a reader waits for a chunk which is being prefetched. Chunks whose
+  # prefetch has not started yet are read by the reader itself.
+  READAHEAD_TIMEOUT = 60
+
+  # Size of the chunk cache.
+  CHUNK_CACHE_SIZE = 100
+
   class SchemaCls(AFF4Stream.SchemaCls):
     """The schema for AFF4ImageBase."""
     _CHUNKSIZE = Attribute(
@@ -2820,7 +3949,8 @@ class AFF4ImageBase(AFF4Stream):
     super(AFF4ImageBase, self).Initialize()
     self.offset = 0
     # A cache for segments.
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = ChunkCache(self._WriteChunk, self.CHUNK_CACHE_SIZE)
+    self.readahead = self._NewReadAheadState()
 
     if "r" in self.mode:
       self.size = int(self.Get(self.Schema.SIZE))
@@ -2832,6 +3962,19 @@ class AFF4ImageBase(AFF4Stream):
       self.size = 0
       self.content_last = None
 
+  def _NewReadAheadState(self):
+    """Returns the read ahead state or None if read ahead is not used."""
+    # Prefetched chunks could overwrite pending writes in the chunk cache so we
+    # only read ahead for read only images.
+    if (self.mode != "r" or not self.ADAPTIVE_READAHEAD or
+        not config_lib.CONFIG["AFF4.readahead"]):
+      return None
+
+    return ReadAheadState(
+        config_lib.CONFIG["AFF4.readahead_min_chunks"],
+        min(config_lib.CONFIG["AFF4.readahead_max_chunks"],
+            self.CHUNK_CACHE_SIZE / 2))
+
   def SetChunksize(self, chunksize):
     # pylint: disable=protected-access
     self.Set(self.Schema._CHUNKSIZE(chunksize))
@@ -2869,7 +4012,11 @@ class AFF4ImageBase(AFF4Stream):
     self._ReadChunks([chunk])
     return self.chunk_cache.Get(chunk)
 
-  def _ReadChunks(self, chunks):
+  def _ReadChunks(self, chunks, cache=None):
+    """Reads chunks into cache, the chunk cache by default."""
+    if cache is None:
+      cache = self.chunk_cache
+
     chunk_names = {
         self.urn.Add(self.CHUNK_ID_TEMPLATE % chunk): chunk
         for chunk in chunks
@@ -2880,7 +4027,7 @@ class AFF4ImageBase(AFF4Stream):
         fd = StringIO.StringIO(child.read())
         fd.dirty = False
         fd.chunk = chunk_names[child.urn]
-        self.chunk_cache.Put(fd.chunk, fd)
+        cache.Put(fd.chunk, fd)
 
   def _WriteChunk(self, chunk):
     if chunk.dirty:
@@ -2934,6 +4081,101 @@ class AFF4ImageBase(AFF4Stream):
     except KeyError:
       raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
 
+  def _ChunksForReadAhead(self, chunks):
+    """Returns what _ReadChunks() needs to prefetch the given chunk numbers.
+
+    This is called from the reading thread, so subclasses can consult state
+    which is not safe to use from the prefetching threads.
+
+    Args:
+      chunks: A list of chunk numbers.
+
+    Returns:
+      A list suitable for passing to _ReadChunks().
+    """
+    return [chunk for chunk in chunks if chunk not in self.chunk_cache]
+
+  def _PrefetchChunks(self, chunks, batch):
+    """Reads chunks into the batch, runs on the read ahead thread pool."""
+    batch.started.set()
+    start = time.time()
+    try:
+      if chunks:
+        self._ReadChunks(chunks, cache=batch.chunks)
+    except Exception as e:  # pylint: disable=broad-except
+      # The reader will fetch the chunks itself.
+      logging.warning("Prefetching chunks of %s failed: %s", self.urn, e)
+    finally:
+      self.readahead.RecordFetch(time.time() - start)
+      batch.done.set()
+
+  def _AddPrefetchedChunks(self, batch):
+    """Moves the chunks of a finished batch into the chunk cache."""
+    if batch.chunks is None:
+      return
+
+    for key, fd in batch.chunks:
+      self.chunk_cache.Put(key, fd)
+    batch.chunks = None
+
+  def _ReadAhead(self, chunk):
+    """Schedules prefetching of the chunks following a sequential read."""
+    state = self.readahead
+    if state is None or chunk == state.last_chunk:
+      return
+
+    last_chunk, state.last_chunk = state.last_chunk, chunk
+    if last_chunk is None or chunk != last_chunk + 1:
+      # Random access, there is nothing to predict.
+      state.Reset()
+      return
+
+    state.RecordRead(time.time())
+
+    batch = state.pending.pop(chunk, None)
+    if batch is None:
+      if state.next_chunk is not None:
+        stats.STATS.IncrementCounter("aff4_image_readahead_misses")
+    elif batch.done.is_set():
+      stats.STATS.IncrementCounter("aff4_image_readahead_hits")
+    else:
+      # The reader has caught up with the prefetching. Waiting only helps if
+      # the prefetch is running, otherwise the chunk is read inline.
+      stats.STATS.IncrementCounter("aff4_image_readahead_stalls")
+      if batch.started.is_set():
+        batch.done.wait(self.READAHEAD_TIMEOUT)
+
+    if batch is not None and batch.done.is_set():
+      self._AddPrefetchedChunks(batch)
+
+    if state.next_chunk is None or state.next_chunk <= chunk:
+      state.next_chunk = chunk + 1
+
+    # Top up the window once half of it has been consumed.
+    if state.next_chunk - chunk > state.window / 2:
+      return
+
+    last_chunk_in_file = max(0, self.size - 1) / self.chunksize
+    end = min(chunk + 1 + state.window, last_chunk_in_file + 1)
+    if end <= state.next_chunk:
+      return
+
+    chunks = range(state.next_chunk, end)
+    state.next_chunk = end
+
+    to_read = self._ChunksForReadAhead(chunks)
+    batch = ReadAheadBatch(self.CHUNK_CACHE_SIZE)
+    for chunk_number in chunks:
+      state.pending[chunk_number] = batch
+
+    pool = threadpool.ThreadPool.Factory(
+        self.READAHEAD_THREAD_POOL_NAME,
+        config_lib.CONFIG["AFF4.readahead_threadpool_size"])
+    pool.Start()
+    pool.AddTask(
+        self._PrefetchChunks, (to_read, batch),
+        "Prefetch chunks of %s" % self.urn)
+
   def _ReadPartial(self, length):
     """Read as much as possible, but not more than length."""
     chunk = self.offset / self.chunksize
@@ -2941,6 +4183,8 @@ class AFF4ImageBase(AFF4Stream):
 
     available_to_read = min(length, self.chunksize - chunk_offset)
 
+    self._ReadAhead(chunk)
+
     retries = 0
     while retries < self.NUM_RETRIES:
       fd = self._GetChunkForReading(chunk)
@@ -3038,12 +4282,14 @@ class AFF4ImageBase(AFF4Stream):
       self.chunk_cache.Flush()
       res = self.__dict__.copy()
       del res["chunk_cache"]
+      res.pop("readahead", None)
       return res
     return self.__dict__
 
   def __setstate__(self, state):
     self.__dict__ = state
-    self.chunk_cache = ChunkCache(self._WriteChunk, 100)
+    self.chunk_cache = ChunkCache(self._WriteChunk, self.CHUNK_CACHE_SIZE)
+    self.readahead = self._NewReadAheadState()
 
 
 class AFF4Image(AFF4ImageBase):
@@ -3072,6 +4318,12 @@ class AFF4InitHook(registry.InitHook):
     # pylint: enable=unused-variable,global-statement,g-import-not-at-top
     stats.STATS.RegisterCounterMetric("aff4_cache_hits")
     stats.STATS.RegisterCounterMetric("aff4_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_image_readahead_hits")
+    stats.STATS.RegisterCounterMetric("aff4_image_readahead_misses")
+    stats.STATS.RegisterCounterMetric("aff4_image_readahead_stalls")
+    stats.STATS.RegisterCounterMetric("aff4_object_cache_hits")
+    stats.STATS.RegisterCounterMetric("aff4_object_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_object_cache_stale")
 
 
 class AFF4Filter(object):
@@ -3098,6 +4350,18 @@ class AFF4Filter(object):
       if self.FilterOne(subject):
         yield subject
 
+  def GetQueryPredicates(self):
+    """Returns data store predicates implied by this filter.
+
+    Every object passing this filter must satisfy all the returned predicates
+    on the attributes stored under its own subject, so the data store can use
+    them to discard candidates before they are opened.
+
+    Returns:
+      A list of data_store.QueryPredicate instances.
+    """
+    return []
+
   @classmethod
   def GetFilter(cls, filter_name):
     return cls.classes[filter_name]
@@ -6,8 +6,40 @@ import operator
 import re
 
 from grr.lib import aff4
+from grr.lib import data_store
 from grr.lib import utils
 
+# Matches the regexes produced by the startswith operator, the group holds the
+# escaped literal prefix.
+LITERAL_PREFIX_RE = re.compile(
+    r"^\^((?:[^\[\](){}+*?.$^\\|]|\\[\[\](){}+*?.$^\\])*)$")
+
+INTEGER_TYPES = ("integer", "unsigned_integer")
+
+
+def GetPushdownAttribute(attribute, data_store_types):
+  """Returns the predicate to filter on in the data store or None.
+
+  Args:
+    attribute: The aff4.Attribute a filter applies to.
+    data_store_types: The data store types the filter can be evaluated on.
+
+  Returns:
+    The attribute predicate if the data store holds exactly the values the
+    filter sees, otherwise None.
+  """
+  if not isinstance(attribute, aff4.Attribute) or attribute.field_names:
+    return None
+
+  # Objects without a stored value see the default instead.
+  if attribute.default is not None:
+    return None
+
+  if attribute.attribute_type.data_store_type not in data_store_types:
+    return None
+
+  return attribute.predicate
+
 
 class IdentityFilter(aff4.AFF4Filter):
   """Just pass all objects."""
@@ -47,6 +79,12 @@ class AndFilter(aff4.AFF4Filter):
 
     return result
 
+  def GetQueryPredicates(self):
+    result = []
+    for part in self.parts:
+      result.extend(part.GetQueryPredicates())
+    return result
+
   def Compile(self, filter_cls):
     return getattr(filter_cls, self.__class__.__name__)(
         *[x.Compile(filter_cls) for x in self.args])
@@ -62,6 +100,9 @@ class OrFilter(AndFilter):
       if result:
         return result
 
+  def GetQueryPredicates(self):
+    return []
+
 
 class PredicateLessThanFilter(aff4.AFF4Filter):
   """Filter the predicate according to the operator."""
@@ -76,26 +117,64 @@ class PredicateLessThanFilter(aff4.AFF4Filter):
     if predicate_value and self.operator_function(predicate_value, self.value):
       return subject
 
+  def GetBounds(self):
+    """Returns the inclusive (start, end) range of matching integers."""
+    return None, self.value - 1
+
+  def GetQueryPredicates(self):
+    attribute = GetPushdownAttribute(self.attribute_name, INTEGER_TYPES)
+    if attribute is None or not isinstance(self.value, (int, long)):
+      return []
+
+    start, end = self.GetBounds()
+    return [
+        data_store.QueryPredicate(
+            attribute, data_store.QueryPredicate.RANGE, start=start, end=end)
+    ]
+
 
 class PredicateGreaterThanFilter(PredicateLessThanFilter):
   operator_function = operator.gt
 
+  def GetBounds(self):
+    return self.value + 1, None
+
 
 class PredicateGreaterEqualFilter(PredicateLessThanFilter):
   operator_function = operator.ge
 
+  def GetBounds(self):
+    return self.value, None
+
 
 class PredicateLesserEqualFilter(PredicateLessThanFilter):
   operator_function = operator.le
 
+  def GetBounds(self):
+    return None, self.value
+
 
 class PredicateNumericEqualFilter(PredicateLessThanFilter):
   operator_function = operator.eq
 
+  def GetQueryPredicates(self):
+    attribute = GetPushdownAttribute(self.attribute_name, INTEGER_TYPES)
+    if attribute is None or not isinstance(self.value, (int, long)):
+      return []
+
+    return [
+        data_store.QueryPredicate(attribute, data_store.QueryPredicate.EQUAL,
+                                  self.value)
+    ]
+
 
 class PredicateEqualFilter(PredicateLessThanFilter):
   operator_function = operator.eq
 
+  def GetQueryPredicates(self):
+    # The value may be of any type, so there is nothing to push down.
+    return []
+
 
 class PredicateContainsFilter(PredicateLessThanFilter):
   """Applies a RegEx on the content of an attribute."""
@@ -118,6 +197,24 @@ class PredicateContainsFilter(PredicateLessThanFilter):
           self.regex.search(utils.SmartUnicode(predicate_value))):
         return subject
 
+  def GetQueryPredicates(self):
+    attribute = GetPushdownAttribute(self.attribute_name, ("string",))
+    if attribute is None or self.regex is None:
+      return []
+
+    match = LITERAL_PREFIX_RE.match(utils.SmartUnicode(self.value))
+    if match:
+      prefix = re.sub(r"\\(.)", r"\1", match.group(1))
+      return [
+          data_store.QueryPredicate(attribute, data_store.QueryPredicate.PREFIX,
+                                    prefix)
+      ]
+
+    return [
+        data_store.QueryPredicate(attribute, data_store.QueryPredicate.REGEX,
+                                  self.value)
+    ]
+
 
 class SubjectContainsFilter(aff4.AFF4Filter):
   """Applies a RegEx to the subject name."""
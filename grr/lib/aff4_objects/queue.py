@@ -4,6 +4,7 @@
 import random
 
 from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
 
@@ -95,6 +96,10 @@ class Queue(aff4.AFF4Object):
     be claimed twice at the same time. For this reason it should be considered
     weaker than a true lock.
 
+    If Datastore.lock_free_leasing is set, the queue does not need to be
+    locked. Every record is then claimed with a compare-and-set and records
+    claimed concurrently by someone else are skipped.
+
     Args:
       limit: The number of records to claim.
 
@@ -117,13 +122,15 @@ class Queue(aff4.AFF4Object):
       identifier which can be used to delete or release the record.
 
     Raises:
-      LockError: If the queue is not locked.
+      LockError: If the queue is not locked and lock free leasing is off.
 
     """
-    if not self.locked:
+    lock_free = config_lib.CONFIG["Datastore.lock_free_leasing"]
+    if not self.locked and not lock_free:
       raise aff4.LockError("Queue must be locked to claim records.")
 
     now = rdfvalue.RDFDatetime.Now()
+    expiration = now + rdfvalue.Duration(timeout)
 
     after_urn = None
     if start_time:
@@ -154,18 +161,31 @@ class Queue(aff4.AFF4Object):
         if max_filtered and filtered_count >= max_filtered:
           break
         continue
+      if lock_free and not self._ClaimRecord(subject, values, expiration):
+        continue
       results.append((subject, rdf_value))
       filtered_count = 0
       if len(results) >= limit:
         break
 
-    expiration = rdfvalue.RDFDatetime.Now() + rdfvalue.Duration(timeout)
-
-    with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
-      for subject, _ in results:
-        mutation_pool.Set(subject, self.LOCK_ATTRIBUTE, expiration)
+    if not lock_free:
+      with data_store.DB.GetMutationPool(token=self.token) as mutation_pool:
+        for subject, _ in results:
+          mutation_pool.Set(subject, self.LOCK_ATTRIBUTE, expiration)
     return results
 
+  def _ClaimRecord(self, subject, values, expiration):
+    """Claims a record unless it changed since values were read."""
+    # ScanAttributes returns (timestamp, value) pairs.
+    expected = {self.LOCK_ATTRIBUTE: None}
+    for attribute, (timestamp, value) in values.iteritems():
+      expected[attribute] = (value, timestamp)
+
+    return data_store.DB.CheckAndMultiSet(
+        subject,
+        expected, {self.LOCK_ATTRIBUTE: [expiration]},
+        token=self.token)
+
   def RefreshClaims(self, ids, timeout="30m"):
     """Refreshes claims on records identified by ids.
 
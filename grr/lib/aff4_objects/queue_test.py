@@ -158,6 +158,32 @@ class QueueTest(test_lib.AFF4ObjectTest):
     self.assertEqual(50, len(results))
     self.assertEqual(50, results[0][1])
 
+  def testLockFreeClaims(self):
+    queue_urn = "aff4:/queue_test/testLockFreeClaims"
+    with aff4.FACTORY.Create(queue_urn, TestQueue, token=self.token) as queue:
+      for i in range(100):
+        queue.Add(rdfvalue.RDFInteger(i))
+
+    with test_lib.ConfigOverrider({"Datastore.lock_free_leasing": True}):
+      queue = aff4.FACTORY.Open(queue_urn, token=self.token)
+      results = queue.ClaimRecords(limit=60)
+      self.assertEqual(60, len(results))
+      self.assertEqual(0, results[0][1])
+
+      results = queue.ClaimRecords()
+      self.assertEqual(40, len(results))
+      self.assertEqual(60, results[0][1])
+
+      self.assertEqual(0, len(queue.ClaimRecords()))
+
+      # Claims expire as usual.
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("45m")):
+        self.assertEqual(100, len(queue.ClaimRecords()))
+
+    with aff4.FACTORY.Open(queue_urn, token=self.token) as queue:
+      self.assertRaises(aff4.LockError, queue.ClaimRecords)
+
 
 def main(argv):
   # Run the full test suite
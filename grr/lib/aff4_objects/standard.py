@@ -12,6 +12,13 @@ from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import paths as rdf_paths
 
+# pylint: disable=g-import-not-at-top
+try:
+  from sendfile import sendfile
+except ImportError:
+  sendfile = None
+# pylint: enable=g-import-not-at-top
+
 
 class Error(Exception):
   pass
@@ -211,13 +218,146 @@ class BlobImage(aff4.AFF4ImageBase):
     except KeyError:
       raise aff4.ChunkNotFoundError("Cannot open chunk %s" % chunk)
 
-  def _ReadChunks(self, chunks):
+  def _ChunksForReadAhead(self, chunks):
+    """Chunks are cached by their hash so we look them up in the index."""
+    result = []
+    for chunk in chunks:
+      self.index.seek(chunk * self._HASH_SIZE)
+      name = self.index.read(self._HASH_SIZE).encode("hex")
+      if name and name not in self.chunk_cache:
+        result.append(name)
+
+    return result
+
+  def _ReadChunks(self, chunks, cache=None):
+    if cache is None:
+      cache = self.chunk_cache
+
     res = data_store.DB.ReadBlobs(chunks, token=self.token)
     for blob_hash, content in res.iteritems():
       fd = StringIO.StringIO(content)
       fd.dirty = False
       fd.chunk = blob_hash
-      self.chunk_cache.Put(blob_hash, fd)
+      cache.Put(blob_hash, fd)
+
+  # How many chunks CopyTo() holds in memory at once.
+  COPY_WINDOW_CHUNKS = 64
+
+  def _BlobSlices(self, length):
+    """Yields windows of blobs covering length bytes from the current offset.
+
+    Args:
+      length: The number of bytes to cover.
+
+    Yields:
+      Lists of up to COPY_WINDOW_CHUNKS (blob hash, start, end) tuples, the
+      slice of each blob which holds the content.
+    """
+    chunk, start = divmod(self.offset, self.chunksize)
+    self.index.seek(chunk * self._HASH_SIZE)
+    window = []
+    while length > 0:
+      blob_hash = self.index.read(self._HASH_SIZE)
+      if not blob_hash:
+        break
+
+      end = min(self.chunksize, start + length)
+      window.append((blob_hash.encode("hex"), start, end))
+      length -= end - start
+      start = 0
+      if len(window) >= self.COPY_WINDOW_CHUNKS:
+        yield window
+        window = []
+
+    if window:
+      yield window
+
+  def _ReadBlobsForCopy(self, blob_hashes):
+    blobs = data_store.DB.ReadBlobs(list(blob_hashes), token=self.token)
+    missing = [h for h in blob_hashes if blobs.get(h) is None]
+    if missing:
+      raise MissingBlobsError(
+          "%d missing blobs" % len(missing), missing_chunks=missing)
+    return blobs
+
+  def _ContentWindows(self, length):
+    """Reads all the blobs of a window in a single round trip."""
+    for window in self._BlobSlices(length):
+      blobs = self._ReadBlobsForCopy(set(h for h, _, _ in window))
+      pieces = [blobs[blob_hash][start:end] for blob_hash, start, end in window]
+      self.offset += sum(len(data) for data in pieces)
+      yield pieces
+
+  def _SendFile(self, out_fd, path, start, end):
+    """Copies bytes start to end of the file at path to out_fd.
+
+    Args:
+      out_fd: The file descriptor to write to.
+      path: The local file holding the blob.
+      start: Offset of the first byte to copy.
+      end: Offset after the last byte to copy.
+
+    Returns:
+      The number of bytes copied.
+
+    Raises:
+      IOError: If the file ends before end, e.g. because the blob was
+          truncated.
+    """
+    sent = 0
+    with open(path, "rb") as in_fd:
+      while start + sent < end:
+        count = sendfile(out_fd, in_fd.fileno(), start + sent,
+                         end - start - sent)
+        if not count:
+          break
+        sent += count
+
+    if sent != end - start:
+      raise IOError("Short copy from %s: %d of %d bytes." %
+                    (path, sent, end - start))
+
+    return sent
+
+  def CopyTo(self, fileobj, length=None):
+    """Sends blobs kept in local files by the blob store with sendfile."""
+    try:
+      out_fd = fileobj.fileno()
+    except (AttributeError, IOError, ValueError):
+      out_fd = None
+
+    if sendfile is None or out_fd is None:
+      return super(BlobImage, self).CopyTo(fileobj, length=length)
+
+    copied = 0
+    for window in self._BlobSlices(self._GetCopyLength(length)):
+      blob_hashes = set(h for h, _, _ in window)
+      paths = data_store.DB.GetRawBlobPaths(blob_hashes, token=self.token)
+      blobs = {}
+      if len(paths) < len(blob_hashes):
+        blobs = self._ReadBlobsForCopy(blob_hashes.difference(paths))
+
+      pending = []
+      for blob_hash, start, end in window:
+        if blob_hash in blobs:
+          pending.append(blobs[blob_hash][start:end])
+          continue
+
+        # Whatever was written through the file object has to come first.
+        if pending:
+          utils.WriteAll(fileobj, pending)
+          copied += sum(len(data) for data in pending)
+          pending = []
+        if hasattr(fileobj, "flush"):
+          fileobj.flush()
+        copied += self._SendFile(out_fd, paths[blob_hash], start, end)
+
+      if pending:
+        utils.WriteAll(fileobj, pending)
+        copied += sum(len(data) for data in pending)
+
+    self.offset += copied
+    return copied
 
   def _WriteChunk(self, chunk):
     if chunk.dirty:
@@ -337,6 +477,9 @@ class HashImage(aff4.AFF4Image):
   _READAHEAD = 5
   _data_dirty = False
 
+  # The index is itself an AFF4Image which can only be read by one thread.
+  ADAPTIVE_READAHEAD = False
+
   def Initialize(self):
     super(HashImage, self).Initialize()
     self.index = None
@@ -430,7 +573,10 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
         "The highest numbered chunk in this object.",
         default=-1)
 
-  def _ReadChunks(self, chunks):
+  def _ReadChunks(self, chunks, cache=None):
+    if cache is None:
+      cache = self.chunk_cache
+
     chunk_hashes = self._ChunkNrsToHashes(chunks)
     chunk_nrs = {}
     for k, v in chunk_hashes.iteritems():
@@ -441,7 +587,7 @@ class AFF4SparseImage(aff4.AFF4ImageBase):
         fd = StringIO.StringIO(content)
         fd.dirty = False
         fd.chunk = chunk_nr
-        self.chunk_cache.Put(chunk_nr, fd)
+        cache.Put(chunk_nr, fd)
 
   def _WriteChunk(self, chunk):
     if chunk.dirty:
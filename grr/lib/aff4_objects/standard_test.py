@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """Tests for grr.lib.aff4_objects.standard."""
 
+import os
 import StringIO
 
 
@@ -12,6 +13,7 @@ from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import test_lib
 from grr.lib.aff4_objects import standard as aff4_standard
+from grr.lib.blob_stores import filesystem_bs
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import paths as rdf_paths
 
@@ -65,6 +67,23 @@ class BlobImageTest(test_lib.AFF4ObjectTest):
     dest_fd.Seek(0)
     self.assertEqual(dest_fd.Read(5000), src_content + src_content)
 
+  def testReadAhead(self):
+    src_content = "".join("%07d" % i for i in range(300))
+    with aff4.FACTORY.Create(
+        "aff4:/foo", aff4_type=aff4_standard.BlobImage, token=self.token) as fd:
+      fd.SetChunksize(7)
+      fd.AppendContent(StringIO.StringIO(src_content))
+
+    with test_lib.ConfigOverrider({"AFF4.readahead": True}):
+      fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+      result = ""
+      for _ in range(len(src_content) / 5 + 1):
+        result += fd.Read(5)
+
+    self.assertEqual(result, src_content)
+    # All the chunks up to the end of the file have been scheduled.
+    self.assertEqual(fd.readahead.next_chunk, 300)
+
   def testMultiStreamStreamsSingleFileWithSingleChunk(self):
     with aff4.FACTORY.Create(
         "aff4:/foo", aff4_type=aff4_standard.BlobImage, token=self.token) as fd:
@@ -231,6 +250,100 @@ class BlobImageTest(test_lib.AFF4ObjectTest):
 
     self.assertEqual(count, 0)
 
+  @mock.patch.object(aff4_standard.BlobImage, "COPY_WINDOW_CHUNKS", 10)
+  def testCopyTo(self):
+    src_content = "".join("%07d" % i for i in range(300))
+    with aff4.FACTORY.Create(
+        "aff4:/foo", aff4_type=aff4_standard.BlobImage, token=self.token) as fd:
+      fd.SetChunksize(7)
+      fd.AppendContent(StringIO.StringIO(src_content))
+
+    fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+    out = StringIO.StringIO()
+    with mock.patch.object(
+        data_store.DB, "ReadBlobs",
+        wraps=data_store.DB.ReadBlobs) as read_blobs:
+      self.assertEqual(fd.CopyTo(out), len(src_content))
+
+    self.assertEqual(out.getvalue(), src_content)
+    self.assertEqual(fd.Tell(), len(src_content))
+    # Blobs are read in bulk but never more than a window at a time.
+    self.assertEqual(read_blobs.call_count, 30)
+    for args, _ in read_blobs.call_args_list:
+      self.assertLessEqual(len(args[0]), 10)
+
+    # Copies may start and end within a chunk.
+    fd.Seek(12)
+    out = StringIO.StringIO()
+    self.assertEqual(fd.CopyTo(out, length=100), 100)
+    self.assertEqual(out.getvalue(), src_content[12:112])
+
+  def testCopyToRaisesIfBlobIsMissing(self):
+    with aff4.FACTORY.Create(
+        "aff4:/foo", aff4_type=aff4_standard.BlobImage, token=self.token) as fd:
+      fd.SetChunksize(10)
+      fd.AppendContent(StringIO.StringIO("*" * 10 + "123456789"))
+
+      fd.index.seek(0)
+      blob_id = fd.index.read(fd._HASH_SIZE).encode("hex")
+
+    aff4.FACTORY.Delete("aff4:/blobs/" + blob_id, token=self.token)
+
+    fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+    with self.assertRaises(aff4_standard.MissingBlobsError) as e:
+      fd.CopyTo(StringIO.StringIO())
+    self.assertEqual(e.exception.missing_chunks, [blob_id])
+
+  def testCopyToSendsRawBlobFiles(self):
+    blobstore = filesystem_bs.FilesystemBlobstore(
+        location=os.path.join(self.temp_dir, "blobs"))
+    # The compressible chunks are stored encoded, the others as they are.
+    src_content = "A" * 200 + os.urandom(200) + "B" * 50
+    sent = []
+
+    def FakeSendfile(out_fd, in_fd, offset, count):
+      sent.append(count)
+      os.lseek(in_fd, offset, os.SEEK_SET)
+      return os.write(out_fd, os.read(in_fd, count))
+
+    with mock.patch.object(data_store.DB, "blobstore", blobstore):
+      with test_lib.ConfigOverrider({"Blobstore.compression": "zlib"}):
+        with aff4.FACTORY.Create(
+            "aff4:/foo", aff4_type=aff4_standard.BlobImage,
+            token=self.token) as fd:
+          fd.SetChunksize(100)
+          fd.AppendContent(StringIO.StringIO(src_content))
+
+      fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+      fd.Seek(150)
+      path = os.path.join(self.temp_dir, "out")
+      with mock.patch.object(aff4_standard, "sendfile", FakeSendfile):
+        with open(path, "wb") as out:
+          out.write("header")
+          self.assertEqual(fd.CopyTo(out), len(src_content) - 150)
+
+    with open(path, "rb") as out:
+      self.assertEqual(out.read(), "header" + src_content[150:])
+    self.assertEqual(sent, [100, 100])
+
+  def testCopyToRaisesOnShortSendfile(self):
+    blobstore = filesystem_bs.FilesystemBlobstore(
+        location=os.path.join(self.temp_dir, "blobs"))
+
+    with mock.patch.object(data_store.DB, "blobstore", blobstore):
+      with aff4.FACTORY.Create(
+          "aff4:/foo", aff4_type=aff4_standard.BlobImage,
+          token=self.token) as fd:
+        fd.SetChunksize(100)
+        fd.AppendContent(StringIO.StringIO(os.urandom(100)))
+
+      fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+      # The blob file ends early, sendfile hits end of file.
+      with mock.patch.object(aff4_standard, "sendfile", lambda *_: 0):
+        with open(os.path.join(self.temp_dir, "out"), "wb") as out:
+          with self.assertRaises(IOError):
+            fd.CopyTo(out)
+
 
 class LabelSetTest(test_lib.AFF4ObjectTest):
 
@@ -4,6 +4,7 @@
 
 import itertools
 import os
+import StringIO
 import threading
 import time
 
@@ -22,6 +23,7 @@ from grr.lib import data_store
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import utils
 from grr.lib.aff4_objects import aff4_grr
@@ -378,6 +380,26 @@ class AFF4MemoryStreamTest(test_lib.AFF4ObjectTest):
     self.assertEqual(chunks_fds[3][1], "abcd")
     self.assertIs(chunks_fds[3][0], fd2)
 
+  @mock.patch.object(aff4.AFF4Stream, "COPY_BUFFER_SIZE", 4)
+  def testCopyTo(self):
+    with aff4.FACTORY.Create(
+        "aff4:/foo", aff4_type=aff4.AFF4MemoryStream, token=self.token) as fd:
+      fd.Write("0123456789")
+
+    fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+    out = StringIO.StringIO()
+    self.assertEqual(fd.CopyTo(out), 10)
+    self.assertEqual(out.getvalue(), "0123456789")
+    self.assertEqual(fd.Tell(), 10)
+
+    fd.Seek(3)
+    out = StringIO.StringIO()
+    self.assertEqual(fd.CopyTo(out, length=5), 5)
+    self.assertEqual(out.getvalue(), "34567")
+
+    fd.Seek(1)
+    self.assertEqual(list(fd.GenerateContent()), ["1234", "5678", "9"])
+
 
 class AFF4ImageTest(test_lib.AFF4ObjectTest):
   """Tests for AFF4Image class."""
@@ -676,6 +698,50 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertEqual(v2.Get(v2.Schema.TYPE), "VFSGRRClient")
     self.assertEqual(str(v2.Get(v2.Schema.HOSTNAME)), "client2")
 
+  def testGetVersionHistory(self):
+    """Test we can read the versions of an object in bulk."""
+    for t, hostname in [(10, "client1"), (20, "client2")]:
+      with test_lib.FakeTime(t):
+        with aff4.FACTORY.Create(
+            self.client_id, aff4_grr.VFSGRRClient, mode="w",
+            token=self.token) as client:
+          client.Set(client.Schema.HOSTNAME(hostname))
+          client.Set(client.Schema.SYSTEM("Linux"))
+
+    with test_lib.FakeTime(30):
+      aff4.FACTORY.Create(
+          self.client_id, aff4_grr.VFSFile, mode="w", token=self.token).Close()
+
+    schema = aff4_grr.VFSGRRClient.SchemaCls
+    with utils.Stubber(data_store.DB, "ResolvePrefix",
+                       mock.Mock(wraps=data_store.DB.ResolvePrefix)):
+      history = aff4.FACTORY.GetVersionHistory(
+          self.client_id, attributes=[schema.HOSTNAME], token=self.token)
+      self.assertEqual(data_store.DB.ResolvePrefix.call_count, 1)
+
+    times = [rdfvalue.RDFDatetime().FromSecondsFromEpoch(t)
+             for t in [30, 20, 10]]
+    self.assertEqual(history.GetVersionTimes(), times)
+    self.assertEqual(history.GetValues(schema.HOSTNAME),
+                     ["client2", "client1"])
+    self.assertEqual(history.GetValueAt(schema.HOSTNAME, times[2]), "client1")
+    self.assertEqual(history.GetValueAt(schema.HOSTNAME, 0), None)
+    self.assertRaises(aff4.BadGetAttributeError, history.GetValues,
+                      schema.SYSTEM)
+
+    # Full objects are only built when asked for.
+    history = aff4.FACTORY.GetVersionHistory(self.client_id, token=self.token)
+    self.assertEqual(history.GetValues(schema.SYSTEM), ["Linux", "Linux"])
+
+    with utils.Stubber(data_store.DB, "MultiResolvePrefix",
+                       mock.Mock(wraps=data_store.DB.MultiResolvePrefix)):
+      client = history.OpenVersion(times[1])
+      self.assertFalse(data_store.DB.MultiResolvePrefix.called)
+
+    self.assertTrue(isinstance(client, aff4_grr.VFSGRRClient))
+    self.assertEqual(client.Get(client.Schema.HOSTNAME), "client2")
+    self.assertTrue(isinstance(history.OpenVersion(times[0]), aff4_grr.VFSFile))
+
   def _CheckAFF4AttributeDefaults(self, client):
     self.assertEqual(client.Get(client.Schema.HOSTNAME), "client1")
     self.assertEqual(
@@ -740,6 +806,44 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
       self.assertEqual(client.Get(client.Schema.HOSTNAME), "client1")
       self.assertEqual(client.Get(client.Schema.DOESNOTEXIST), None)
 
+  def testMultiOpenAttributes(self):
+    """Test that MultiOpen can fetch only some attributes."""
+    client_ids = self.SetupClients(2)
+    aff4.FACTORY.Create(
+        "aff4:/foo", aff4.AFF4MemoryStream, token=self.token).Close()
+    schema = aff4_grr.VFSGRRClient.SchemaCls
+
+    with mock.patch.object(aff4.AFF4Object, "Upgrade") as upgrade:
+      views = list(
+          aff4.FACTORY.MultiOpen(
+              client_ids + [rdfvalue.RDFURN("aff4:/foo")],
+              aff4_type=aff4_grr.VFSGRRClient,
+              attributes=[schema.HOSTNAME, schema.CLIENT_INFO],
+              token=self.token))
+    self.assertFalse(upgrade.called)
+
+    self.assertEqual(
+        sorted(view.urn for view in views), sorted(client_ids))
+    for view in views:
+      self.assertTrue(isinstance(view, aff4.AFF4ObjectView))
+      self.assertEqual(view.aff4_class, aff4_grr.VFSGRRClient)
+      self.assertEqual(view.Get(schema.HOSTNAME),
+                       "Host-%s" % view.urn.Basename()[-1])
+      self.assertTrue(view.IsAttributeSet(schema.CLIENT_INFO))
+      self.assertEqual(view.Get("GRR client.client_name"), "GRR Monitor")
+
+      # Attributes that were not asked for can not be read.
+      self.assertRaises(aff4.BadGetAttributeError, view.Get, schema.SYSTEM)
+
+    # Without a type restriction all existing objects are returned.
+    views = aff4.FACTORY.MultiOpen(
+        client_ids + [rdfvalue.RDFURN("aff4:/foo")],
+        attributes=[schema.HOSTNAME],
+        token=self.token)
+    types = dict((view.urn, view.aff4_class_name) for view in views)
+    self.assertEqual(types[rdfvalue.RDFURN("aff4:/foo")], "AFF4MemoryStream")
+    self.assertEqual(types[client_ids[0]], "VFSGRRClient")
+
   def testAppendAttribute(self):
     """Test that append attribute works."""
     # Create an object to carry attributes
@@ -897,6 +1001,94 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     fd = aff4.FACTORY.Open(path1, token=self.token)
     self.assertEqual(fd.read(100), content)
 
+  def testCreateMany(self):
+    """Tests that index entries are written once for many objects."""
+    paths = ["aff4:/C.0123456789abcdef/fs/os/dir/file%d" % i for i in range(10)]
+
+    with utils.Stubber(aff4.FACTORY, "intermediate_cache",
+                       utils.AgeBasedCache(max_size=100)):
+      pool = data_store.DB.GetMutationPool(token=self.token)
+      fds = aff4.FACTORY.CreateMany(
+          paths,
+          aff4.AFF4MemoryStream,
+          mode="w",
+          mutation_pool=pool,
+          token=self.token)
+      self.assertEqual([fd.urn for fd in fds], paths)
+
+      for fd in fds:
+        fd.Write("hello")
+        fd.Close()
+
+      # One index write for each of the 5 parents.
+      self.assertEqual(len(pool.index_updates), 5)
+      pool.Flush()
+
+    children = aff4.FACTORY.ListChildren(
+        "aff4:/C.0123456789abcdef/fs/os/dir", token=self.token)
+    self.assertEqual(sorted(children), sorted(paths))
+
+    fd = aff4.FACTORY.Open(paths[3], token=self.token)
+    self.assertEqual(fd.Read(100), "hello")
+
+  def testBatchWrites(self):
+    """Tests that objects closed in BatchWrites() are written at once."""
+    paths = ["aff4:/C.0123456789abcdef/fs/os/dir/file%d" % i for i in range(10)]
+
+    with utils.Stubber(aff4.FACTORY, "intermediate_cache",
+                       utils.AgeBasedCache(max_size=100)):
+      with aff4.FACTORY.BatchWrites(token=self.token) as pool:
+        for i, path in enumerate(paths):
+          with test_lib.FakeTime(100 + i):
+            with aff4.FACTORY.Create(
+                path, aff4.AFF4MemoryStream, token=self.token) as fd:
+              fd.Write("hello")
+
+        with aff4.FACTORY.BatchWrites(token=self.token) as nested_pool:
+          self.assertIs(nested_pool, pool)
+
+        # Nothing is written until the block ends, each parent only once.
+        self.assertEqual(len(pool.set_requests), 10)
+        self.assertEqual(len(pool.index_updates), 5)
+
+    self.assertEqual(pool.Size(), 0)
+    self.assertIsNone(aff4.FACTORY.GetWriteBatch())
+
+    children = aff4.FACTORY.ListChildren(
+        "aff4:/C.0123456789abcdef/fs/os/dir", token=self.token)
+    self.assertEqual(sorted(children), sorted(paths))
+
+    for i, path in enumerate(paths):
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      self.assertEqual(fd.Read(100), "hello")
+      # Values keep the time their object was closed at.
+      self.assertEqual(
+          fd.Get(fd.Schema.TYPE).age,
+          rdfvalue.RDFDatetime().FromSecondsFromEpoch(100 + i))
+
+  def testBatchWritesRaisesOriginalError(self):
+    path = "aff4:/C.0123456789abcdef/fs/os/dir/file"
+
+    with self.assertRaises(ValueError):
+      with aff4.FACTORY.BatchWrites(token=self.token):
+        with aff4.FACTORY.Create(
+            path, aff4.AFF4MemoryStream, token=self.token) as fd:
+          fd.Write("hello")
+        raise ValueError("Error in the block.")
+
+    # What was closed before the error is still written.
+    self.assertIsNone(aff4.FACTORY.GetWriteBatch())
+    fd = aff4.FACTORY.Open(path, token=self.token)
+    self.assertEqual(fd.Read(100), "hello")
+
+    def FailingFlush(unused_pool):
+      raise IOError("Data store is down.")
+
+    with utils.Stubber(data_store.MutationPool, "Flush", FailingFlush):
+      with self.assertRaises(ValueError):
+        with aff4.FACTORY.BatchWrites(token=self.token):
+          raise ValueError("Error in the block.")
+
   def testObjectUpgrade(self):
     """Test that we can create a new object of a different type."""
     path = "C.0123456789abcdef"
@@ -1017,6 +1209,80 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
         for value, _ in values:
           self.assertFalse(unique_token in utils.SmartUnicode(value))
 
+  def testStreamingMultiDeleteRemovesAllTracesOfObjectsFromDataStore(self):
+    unique_token = "streaming_delete"
+
+    for i in range(5):
+      for j in range(5):
+        with aff4.FACTORY.Create(
+            "aff4:" + ("/%s%d" % (unique_token, i)) * (j + 1),
+            aff4.AFF4Volume,
+            token=self.token):
+          pass
+
+    reports = []
+    deletion = aff4.StreamingDeletion(
+        token=self.token,
+        batch_size=2,
+        threadpool_size=2,
+        progress_callback=reports.append)
+    progress = deletion.Delete(
+        ["aff4:/%s%d" % (unique_token, i) for i in range(5)])
+
+    self.assertEqual(progress.roots_deleted, 5)
+    self.assertEqual(progress.subjects_scanned, 20)
+    self.assertEqual(progress.subjects_deleted, 25)
+    self.assertTrue(reports)
+
+    # NOTE: We assume that tests are running with FakeDataStore.
+    for subject, subject_data in data_store.DB.subjects.items():
+      self.assertFalse(unique_token in subject)
+
+      for column_name, values in subject_data.items():
+        self.assertFalse(unique_token in column_name)
+
+        for value, _ in values:
+          self.assertFalse(unique_token in utils.SmartUnicode(value))
+
+  def testStreamingMultiDeleteCheckpoint(self):
+    for i in range(6):
+      with aff4.FACTORY.Create(
+          "aff4:/streaming/file%d" % i, aff4.AFF4Volume, token=self.token):
+        pass
+
+    deletion = aff4.StreamingDeletion(token=self.token, batch_size=2)
+    self.assertRaises(RuntimeError, deletion.Delete, ["aff4:/"])
+
+    # Resuming skips what was scanned before the checkpoint.
+    progress = deletion.Delete(
+        ["aff4:/streaming"],
+        checkpoint=(rdfvalue.RDFURN("aff4:/streaming"),
+                    "aff4:/streaming/file1"))
+    self.assertEqual(progress.subjects_deleted, 5)
+    self.assertEqual(progress.checkpoint,
+                     ("aff4:/streaming", "aff4:/streaming/file5"))
+
+    self.assertIn("aff4:/streaming/file0", data_store.DB.subjects)
+    self.assertNotIn("aff4:/streaming/file2", data_store.DB.subjects)
+    self.assertNotIn("aff4:/streaming", data_store.DB.subjects)
+
+  def testStreamingMultiDeleteIsThrottled(self):
+    for i in range(10):
+      with aff4.FACTORY.Create(
+          "aff4:/throttled/file%d" % i, aff4.AFF4Volume, token=self.token):
+        pass
+
+    with mock.patch.object(time, "sleep") as sleep:
+      deletion = aff4.StreamingDeletion(
+          token=self.token, batch_size=5, max_subjects_per_second=5)
+      deletion.Delete(["aff4:/throttled"])
+
+    # Two batches of 5 subjects at 5 subjects a second.
+    delays = [call[0][0] for call in sleep.call_args_list]
+    self.assertEqual(len(delays), 2)
+    self.assertAlmostEqual(delays[0], 1.0, delta=0.5)
+    self.assertAlmostEqual(delays[1], 2.0, delta=0.5)
+
   def testClientObject(self):
     fd = aff4.FACTORY.Create(
         self.client_id, aff4_grr.VFSGRRClient, token=self.token)
@@ -1173,6 +1439,85 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertTrue("Hello World" in data)
     fd.Close()
 
+  def testAFF4ImageReadAhead(self):
+    path = "/C.12345/readahead"
+    data = "".join("Test%08X\n" % i for i in range(500))
+    with aff4.FACTORY.Create(path, aff4.AFF4Image, token=self.token) as fd:
+      fd.SetChunksize(10)
+      fd.Write(data)
+
+    hits_before = stats.STATS.GetMetricValue("aff4_image_readahead_hits")
+    stalls_before = stats.STATS.GetMetricValue("aff4_image_readahead_stalls")
+    with test_lib.ConfigOverrider({"AFF4.readahead": True}):
+      fd = aff4.FACTORY.Open(path, token=self.token)
+      self.assertIsNotNone(fd.readahead)
+
+      result = ""
+      while True:
+        chunk = fd.Read(7)
+        if not chunk:
+          break
+        result += chunk
+
+    self.assertEqual(result, data)
+    self.assertGreater(
+        stats.STATS.GetMetricValue("aff4_image_readahead_hits") +
+        stats.STATS.GetMetricValue("aff4_image_readahead_stalls"),
+        hits_before + stalls_before)
+
+    # Seeking around resets the window.
+    fd.Seek(3000)
+    self.assertEqual(fd.Read(10), data[3000:3010])
+    self.assertEqual(fd.readahead.window, fd.readahead.min_window)
+    self.assertEqual(fd.readahead.pending, {})
+
+    # Images opened for writing never prefetch.
+    with test_lib.ConfigOverrider({"AFF4.readahead": True}):
+      fd = aff4.FACTORY.Open(path, mode="rw", token=self.token)
+      self.assertIsNone(fd.readahead)
+
+  def testAFF4ImageReadAheadDoesNotWaitForQueuedPrefetches(self):
+    path = "/C.12345/readahead_queued"
+    data = "".join("Test%08X\n" % i for i in range(50))
+    with aff4.FACTORY.Create(path, aff4.AFF4Image, token=self.token) as fd:
+      fd.SetChunksize(10)
+      fd.Write(data)
+
+    # A pool which never gets around to running the prefetches.
+    pool = mock.MagicMock()
+    with utils.Stubber(aff4.threadpool.ThreadPool, "Factory",
+                       lambda *_: pool):
+      with test_lib.ConfigOverrider({"AFF4.readahead": True}):
+        fd = aff4.FACTORY.Open(path, token=self.token)
+        fd.READAHEAD_TIMEOUT = 1000
+        start = time.time()
+        self.assertEqual(fd.Read(len(data)), data)
+
+    self.assertTrue(pool.AddTask.called)
+    self.assertLess(time.time() - start, 100)
+
+  def testReadAheadWindow(self):
+    state = aff4.ReadAheadState(4, 32)
+    self.assertEqual(state.window, 4)
+
+    # A reader consuming 4 chunks per second with a 2.5s round trip needs
+    # about 10 chunks in flight.
+    state.RecordFetch(2.5)
+    for i in range(10):
+      state.RecordRead(i * 0.25)
+    self.assertEqual(state.window, 20)
+
+    # Faster data store, smaller window.
+    for _ in range(20):
+      state.RecordFetch(0.001)
+    state.RecordRead(2.5)
+    self.assertEqual(state.window, 4)
+
+    # Very slow data store, the window is capped.
+    state.RecordFetch(100)
+    state.RecordRead(2.75)
+    self.assertEqual(state.window, 32)
+
   def testAFF4ImageWithFlush(self):
     """Make sure the AFF4Image can survive with partial flushes."""
     path = "/C.12345/foo"
@@ -1408,6 +1753,71 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
       self.assertEqual(len(matched), 1)
       self.assertEqual(matched[0].read(100), "1500")
 
+  def testQueryPushdown(self):
+    """Tests that simple predicates are evaluated by the data store."""
+    client_ids = self.SetupClients(12)
+    root = aff4.FACTORY.Open(aff4.ROOT_URN, token=self.token)
+
+    with mock.patch.object(
+        data_store.DB, "FilterSubjects",
+        wraps=data_store.DB.FilterSubjects) as filter_subjects:
+      matched = root.Query("Host startswith 'Host-1'")
+
+    self.assertEqual(matched.total_count, 3)
+    self.assertEqual(
+        sorted(x.urn for x in matched),
+        [client_ids[1], client_ids[10], client_ids[11]])
+
+    predicates = filter_subjects.call_args[0][1]
+    self.assertEqual([(p.attribute, p.operator, p.value) for p in predicates],
+                     [("metadata:hostname", "prefix", u"Host-1")])
+
+    # Predicates are still applied to the opened objects.
+    matched = root.Query("Host startswith 'Host-1' and FQDN contains '0'")
+    self.assertEqual([x.urn for x in matched], [client_ids[10]])
+
+  def testQueryReadsInBatchesAndKeepsOnlyTheLimit(self):
+    client_ids = self.SetupClients(12)
+    root = aff4.FACTORY.Open(aff4.ROOT_URN, token=self.token)
+
+    with utils.Stubber(aff4.AFF4Root, "QUERY_BATCH_SIZE", 5):
+      with mock.patch.object(
+          aff4.FACTORY, "MultiOpen",
+          wraps=aff4.FACTORY.MultiOpen) as multi_open:
+        matched = root.Query("Host startswith 'Host-'", limit=4)
+
+    self.assertEqual(len(list(matched)), 4)
+    self.assertEqual(matched.total_count, 12)
+    self.assertTrue(set(x.urn for x in matched).issubset(client_ids))
+    for call in multi_open.call_args_list:
+      self.assertLessEqual(len(call[0][0]), 5)
+
+  def testQueryPredicates(self):
+    """Tests which filters are pushed down into the data store."""
+
+    def Predicates(filter_string):
+      ast = aff4.AFF4QueryParser(filter_string).Parse()
+      return ast.Compile(aff4.AFF4Filter).GetQueryPredicates()
+
+    predicate, = Predicates("Host matches 'Host-[0-9]$'")
+    self.assertEqual(predicate.attribute, "metadata:hostname")
+    self.assertEqual(predicate.operator, data_store.QueryPredicate.REGEX)
+
+    predicate, = Predicates("Install < 2011/11/18")
+    self.assertEqual(predicate.attribute, "metadata:install_date")
+    self.assertEqual(predicate.operator, data_store.QueryPredicate.RANGE)
+    self.assertIsNone(predicate.start)
+    self.assertEqual(predicate.end,
+                     rdfvalue.RDFDatetime.FromHumanReadable("2011/11/18"))
+
+    self.assertEqual(
+        len(Predicates("Host startswith 'a' and Install < 2011/11/18")), 2)
+
+    # Alternatives and attributes with defaults are left to the client.
+    self.assertEqual(
+        Predicates("Host startswith 'a' or Install < 2011/11/18"), [])
+    self.assertEqual(Predicates("LastCheckin < 2011/11/18"), [])
+
   def testMultiOpen(self):
     root_urn = aff4.ROOT_URN.Add("path")
 
@@ -1464,6 +1874,78 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
     self.assertListEqual(children[client1_urn], [client1_urn.Add("some1")])
     self.assertListEqual(children[client2_urn], [client2_urn.Add("some2")])
 
+  def testRecursiveMultiListChildren(self):
+    root = rdfvalue.RDFURN("aff4:/tree")
+    for i in range(5):
+      for j in range(3):
+        with aff4.FACTORY.Create(
+            root.Add("d%d/f%d" % (i, j)), aff4.AFF4Volume, token=self.token):
+          pass
+
+    with mock.patch.object(
+        aff4.FACTORY,
+        "MultiListChildren",
+        wraps=aff4.FACTORY.MultiListChildren) as list_children:
+      children = dict(
+          aff4.FACTORY.RecursiveMultiListChildren(
+              [root], token=self.token, batch_size=2))
+
+    for call in list_children.call_args_list:
+      self.assertLessEqual(len(call[0][0]), 2)
+
+    self.assertEqual(len(children), 21)
+    self.assertEqual(
+        sorted(children[root]), [root.Add("d%d" % i) for i in range(5)])
+    self.assertEqual(
+        sorted(children[root.Add("d3")]),
+        [root.Add("d3/f%d" % j) for j in range(3)])
+    self.assertEqual(children[root.Add("d3/f1")], [])
+
+  def testRecursiveMultiListChildrenIsDepthFirst(self):
+    root = rdfvalue.RDFURN("aff4:/tree")
+    for i in range(5):
+      for j in range(3):
+        with aff4.FACTORY.Create(
+            root.Add("d%d/f%d" % (i, j)), aff4.AFF4Volume, token=self.token):
+          pass
+
+    subjects = [
+        subject
+        for subject, _ in aff4.FACTORY.RecursiveMultiListChildren(
+            [root], token=self.token, batch_size=1)
+    ]
+
+    self.assertEqual(len(subjects), 21)
+    self.assertEqual(subjects[0], root)
+    # Every directory is followed by its files before the next directory.
+    for i in range(1, len(subjects), 4):
+      self.assertEqual(
+          sorted(subjects[i + 1:i + 4]),
+          [subjects[i].Add("f%d" % j) for j in range(3)])
+
+  def testRecursiveMultiListChildrenLimits(self):
+    root = rdfvalue.RDFURN("aff4:/tree")
+    for i in range(5):
+      for j in range(3):
+        with aff4.FACTORY.Create(
+            root.Add("d%d/f%d" % (i, j)), aff4.AFF4Volume, token=self.token):
+          pass
+
+    children = dict(
+        aff4.FACTORY.RecursiveMultiListChildren(
+            [root], token=self.token, max_depth=1))
+    self.assertEqual(children.keys(), [root])
+
+    children = dict(
+        aff4.FACTORY.RecursiveMultiListChildren(
+            [root], token=self.token, max_depth=2))
+    self.assertEqual(len(children), 6)
+
+    results = list(
+        aff4.FACTORY.RecursiveMultiListChildren(
+            [root], token=self.token, max_results=7, batch_size=1))
+    self.assertEqual(sum(len(children) for _, children in results), 7)
+
   def testFactoryListChildren(self):
     client_urn = rdfvalue.RDFURN("C.%016X" % 0)
 
@@ -1771,6 +2253,49 @@ class AFF4Tests(test_lib.AFF4ObjectTest):
 
         self.assertRaises(aff4.LockError, TryOpen)
 
+  def testOpenWithLockUsesObjectCache(self):
+    urn = rdfvalue.RDFURN("aff4:/obj")
+    cache = aff4.VersionedObjectCache(max_size=10)
+    with utils.Stubber(aff4.FACTORY, "object_cache", cache):
+      with aff4.FACTORY.Create(
+          urn, ObjectWithLockProtectedAttribute, token=self.token) as fd:
+        fd.Set(fd.Schema.UNPROTECTED_ATTR("value1"))
+
+      with aff4.FACTORY.OpenWithLock(urn, token=self.token) as fd:
+        self.assertEqual(fd.Get(fd.Schema.UNPROTECTED_ATTR), "value1")
+        fd.Set(fd.Schema.LOCK_PROTECTED_ATTR("locked1"))
+      self.assertEqual(len(cache), 1)
+
+      # Writes made under lock are applied to the cached attributes.
+      hits_before = stats.STATS.GetMetricValue("aff4_object_cache_hits")
+      with mock.patch.object(aff4.FACTORY, "GetAttributes") as get_attributes:
+        with aff4.FACTORY.OpenWithLock(urn, token=self.token) as fd:
+          self.assertTrue(isinstance(fd, ObjectWithLockProtectedAttribute))
+          self.assertEqual(fd.Get(fd.Schema.UNPROTECTED_ATTR), "value1")
+          self.assertEqual(fd.Get(fd.Schema.LOCK_PROTECTED_ATTR), "locked1")
+      self.assertFalse(get_attributes.called)
+      self.assertEqual(
+          stats.STATS.GetMetricValue("aff4_object_cache_hits"),
+          hits_before + 1)
+
+      # A write the cache does not know about, e.g. from another process.
+      with utils.Stubber(aff4.FACTORY, "object_cache", None):
+        with aff4.FACTORY.Open(urn, mode="rw", token=self.token) as fd:
+          fd.Set(fd.Schema.UNPROTECTED_ATTR("value2"))
+
+      stale_before = stats.STATS.GetMetricValue("aff4_object_cache_stale")
+      with aff4.FACTORY.OpenWithLock(urn, token=self.token) as fd:
+        self.assertEqual(fd.Get(fd.Schema.UNPROTECTED_ATTR), "value2")
+        self.assertEqual(fd.Get(fd.Schema.LOCK_PROTECTED_ATTR), "locked1")
+      self.assertEqual(
+          stats.STATS.GetMetricValue("aff4_object_cache_stale"),
+          stale_before + 1)
+
+      # Writes made without a lock in this process drop the entry.
+      with aff4.FACTORY.Open(urn, mode="rw", token=self.token) as fd:
+        fd.Set(fd.Schema.UNPROTECTED_ATTR("value3"))
+      self.assertEqual(len(cache), 0)
+
   def testLockProtectedAttributesWorkCorrectly(self):
     obj = aff4.FACTORY.Create(
         "aff4:/obj", ObjectWithLockProtectedAttribute, token=self.token)
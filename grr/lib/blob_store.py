@@ -1,11 +1,199 @@
 #!/usr/bin/env python
 """The blob store abstraction."""
 
+import time
+import zlib
+
+import logging
+
+from grr.lib import config_lib
 from grr.lib import registry
+from grr.lib import stats
+
+# pylint: disable=g-import-not-at-top
+try:
+  import snappy
+except ImportError:
+  snappy = None
+# pylint: enable=g-import-not-at-top
+
+# Encoded blobs start with this magic followed by a single codec id byte. Blobs
+# without it were stored before codecs existed and are returned unchanged.
+BLOB_HEADER_MAGIC = "\x89GRRBLOB"
+
+
+class BlobDecodeError(Exception):
+  """Raised when a stored blob can not be decoded."""
+
+
+class BlobCodec(object):
+  """A codec blob contents can be encoded with."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # The id stored in the blob header. Must never change once blobs using the
+  # codec have been written.
+  codec_id = None
+
+  # The name used in the Blobstore.compression config option.
+  name = None
+
+  @classmethod
+  def Available(cls):
+    return True
+
+  def Encode(self, data):
+    raise NotImplementedError()
+
+  def Decode(self, data):
+    raise NotImplementedError()
+
+
+class NoneCodec(BlobCodec):
+  """Stores blobs uncompressed."""
+
+  codec_id = 0
+  name = "none"
+
+  def Encode(self, data):
+    return data
+
+  def Decode(self, data):
+    return data
+
+
+class ZlibCodec(BlobCodec):
+  """zlib compression at Blobstore.compression_level."""
+
+  codec_id = 1
+  name = "zlib"
+
+  def Encode(self, data):
+    return zlib.compress(data,
+                         config_lib.CONFIG["Blobstore.compression_level"])
+
+  def Decode(self, data):
+    return zlib.decompress(data)
+
+
+class SnappyCodec(BlobCodec):
+  """Fast snappy compression, available if python-snappy is installed."""
+
+  codec_id = 2
+  name = "snappy"
+
+  @classmethod
+  def Available(cls):
+    return snappy is not None
+
+  def Encode(self, data):
+    return snappy.compress(data)
+
+  def Decode(self, data):
+    return snappy.decompress(data)
+
+
+def _GetCodecClassById(codec_id):
+  for cls in BlobCodec.classes.itervalues():
+    if cls.codec_id == codec_id:
+      return cls
+
+
+def EncodeBlob(content):
+  """Encodes blob content with the configured codec.
+
+  The content is only stored compressed if that saves space.
+
+  Args:
+    content: The blob content.
+
+  Returns:
+    The data to store for the blob.
+
+  Raises:
+    ValueError: The configured codec is not available.
+  """
+  codec_name = config_lib.CONFIG["Blobstore.compression"]
+  try:
+    codec_cls = BlobCodec.classes_by_name[codec_name]
+  except KeyError:
+    raise ValueError("Unknown blob codec %s." % codec_name)
+
+  if not codec_cls.Available():
+    raise ValueError("Blob codec %s is not available." % codec_name)
+
+  codec = codec_cls()
+  start = time.time()
+  encoded = codec.Encode(content)
+  stats.STATS.RecordEvent(
+      "blobstore_codec_time",
+      time.time() - start,
+      fields=[codec.name, "encode"])
+
+  if len(encoded) + len(BLOB_HEADER_MAGIC) + 1 >= len(content):
+    codec = NoneCodec()
+    encoded = content
+
+  if codec.codec_id or content.startswith(BLOB_HEADER_MAGIC):
+    encoded = BLOB_HEADER_MAGIC + chr(codec.codec_id) + encoded
+
+  stats.STATS.IncrementCounter(
+      "blobstore_uncompressed_bytes", len(content), fields=[codec.name])
+  stats.STATS.IncrementCounter(
+      "blobstore_stored_bytes", len(encoded), fields=[codec.name])
+  return encoded
+
+
+def DecodeBlob(data, identifier=None):
+  """Returns the content of a blob stored as data by EncodeBlob().
+
+  Args:
+    data: The stored data.
+    identifier: The identifier of the blob, used in errors.
+
+  Returns:
+    The blob content.
+
+  Raises:
+    BlobDecodeError: The codec the blob was stored with is not available or
+        could not decode it.
+  """
+  if data is None or not data.startswith(BLOB_HEADER_MAGIC):
+    return data
+
+  codec_cls = _GetCodecClassById(ord(data[len(BLOB_HEADER_MAGIC)]))
+  if codec_cls is None:
+    # This can only be a blob stored before codecs existed which happens to
+    # start with the magic.
+    return data
+
+  if not codec_cls.Available():
+    raise BlobDecodeError("Blob %s was stored with the %s codec which is not "
+                          "available." % (identifier, codec_cls.name))
+
+  codec = codec_cls()
+  start = time.time()
+  try:
+    content = codec.Decode(data[len(BLOB_HEADER_MAGIC) + 1:])
+  except Exception as e:  # pylint: disable=broad-except
+    logging.error("Unable to decode blob %s with the %s codec: %s", identifier,
+                  codec.name, e)
+    raise BlobDecodeError("Unable to decode blob %s with the %s codec: %s" %
+                          (identifier, codec.name, e))
+  stats.STATS.RecordEvent(
+      "blobstore_codec_time",
+      time.time() - start,
+      fields=[codec.name, "decode"])
+  return content
 
 
 class Blobstore(object):
-  """The blob store base class."""
+  """The blob store base class.
+
+  Implementations should store EncodeBlob(content) for each blob and return
+  DecodeBlob() of the stored data, while identifying blobs by the digest of
+  the unencoded content.
+  """
 
   __metaclass__ = registry.MetaclassRegistry
 
@@ -41,6 +229,24 @@ class Blobstore(object):
       or None if the blob doesn't exist.
     """
 
+  def GetRawBlobPaths(self, identifiers, token=None):
+    """Returns local files holding exactly the content of blobs.
+
+    Readers can copy such blobs straight from the file, e.g. with sendfile,
+    instead of reading them into memory. Blob stores which do not keep blobs
+    in local files return an empty dict.
+
+    Args:
+      identifiers: A list of identifiers for the blobs to look up.
+      token: Data store token.
+
+    Returns:
+      A dict mapping identifiers to paths. Blobs which are missing or stored
+      encoded are left out.
+    """
+    _ = identifiers, token
+    return {}
+
   def BlobsExist(self, identifiers, token=None):
     """Checks if blobs for the given identifiers already exist.
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Tests for the blob codecs in grr.lib.blob_store."""
+
+
+from grr.lib import blob_store
+from grr.lib import flags
+from grr.lib import stats
+from grr.lib import test_lib
+
+
+class BlobCodecTest(test_lib.GRRBaseTest):
+
+  def testUncompressedBlobsAreStoredAsIs(self):
+    self.assertEqual(blob_store.EncodeBlob("foo" * 100), "foo" * 100)
+    self.assertEqual(blob_store.DecodeBlob("foo" * 100), "foo" * 100)
+    self.assertIsNone(blob_store.DecodeBlob(None))
+
+  def testZlib(self):
+    content = "A" * 10000
+    with test_lib.ConfigOverrider({"Blobstore.compression": "zlib"}):
+      uncompressed_before = stats.STATS.GetMetricValue(
+          "blobstore_uncompressed_bytes", fields=["zlib"])
+      stored_before = stats.STATS.GetMetricValue(
+          "blobstore_stored_bytes", fields=["zlib"])
+
+      encoded = blob_store.EncodeBlob(content)
+
+      self.assertEqual(
+          stats.STATS.GetMetricValue(
+              "blobstore_uncompressed_bytes", fields=["zlib"]),
+          uncompressed_before + len(content))
+      self.assertEqual(
+          stats.STATS.GetMetricValue("blobstore_stored_bytes", fields=["zlib"]),
+          stored_before + len(encoded))
+
+    self.assertTrue(encoded.startswith(blob_store.BLOB_HEADER_MAGIC))
+    self.assertLess(len(encoded), 100)
+    # Compressed blobs stay readable whatever the current configuration.
+    self.assertEqual(blob_store.DecodeBlob(encoded), content)
+
+  def testIncompressibleBlobsAreStoredUncompressed(self):
+    with test_lib.ConfigOverrider({"Blobstore.compression": "zlib"}):
+      self.assertEqual(blob_store.EncodeBlob("foo"), "foo")
+
+  def testContentStartingWithMagic(self):
+    content = blob_store.BLOB_HEADER_MAGIC + "\x01not zlib"
+    encoded = blob_store.EncodeBlob(content)
+    self.assertNotEqual(encoded, content)
+    self.assertEqual(blob_store.DecodeBlob(encoded), content)
+
+    # Blobs stored before codecs existed are returned unchanged unless the
+    # magic is followed by the id of a known codec.
+    content = blob_store.BLOB_HEADER_MAGIC + "\xffstored long ago"
+    self.assertEqual(blob_store.DecodeBlob(content), content)
+
+  def testCorruptBlobRaises(self):
+    data = blob_store.BLOB_HEADER_MAGIC + "\x01not zlib"
+    with self.assertRaises(blob_store.BlobDecodeError) as e:
+      blob_store.DecodeBlob(data, identifier="abcdef")
+    self.assertIn("abcdef", str(e.exception))
+
+  def testSnappy(self):
+    if not blob_store.SnappyCodec.Available():
+      return
+
+    content = "A" * 10000
+    with test_lib.ConfigOverrider({"Blobstore.compression": "snappy"}):
+      encoded = blob_store.EncodeBlob(content)
+    self.assertLess(len(encoded), len(content))
+    self.assertEqual(blob_store.DecodeBlob(encoded), content)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""A content addressed blob store keeping every blob in its own file.
+
+Blobs are named by the sha256 digest of their content and sharded into
+directories named after the leading hex digits of the digest, e.g. with the
+default FilesystemBlobstore.shard_depth of 2:
+
+  <FilesystemBlobstore.location>/ab/cd/abcdef0123...
+
+Blobs are written to a temporary file in the shard directory first and renamed
+into place, so readers never see partially written blobs.
+"""
+
+import errno
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from grr.lib import blob_store
+from grr.lib import config_lib
+from grr.lib import threadpool
+from grr.lib import utils
+
+
+class FilesystemBlobstore(blob_store.Blobstore):
+  """A blob store keeping blobs in hash sharded directories on disk."""
+
+  THREAD_POOL_NAME = "FilesystemBlobstore"
+
+  IDENTIFIER_RE = re.compile(r"^[0-9a-f]{64}$")
+
+  def __init__(self, location=None):
+    super(FilesystemBlobstore, self).__init__()
+    self.location = location or config_lib.CONFIG[
+        "FilesystemBlobstore.location"]
+    self.shard_depth = config_lib.CONFIG["FilesystemBlobstore.shard_depth"]
+    self.read_batch_size = max(
+        1, config_lib.CONFIG["FilesystemBlobstore.read_batch_size"])
+    self.mmap_threshold = config_lib.CONFIG[
+        "FilesystemBlobstore.mmap_threshold"]
+    self.pool = threadpool.ThreadPool.Factory(
+        self.THREAD_POOL_NAME,
+        config_lib.CONFIG["FilesystemBlobstore.threadpool_size"])
+    self.pool.Start()
+
+  def _BlobPath(self, identifier):
+    """Returns the path of the file holding the blob identifier."""
+    identifier = utils.SmartStr(identifier).lower()
+    # Identifiers end up in paths so anything but a digest is rejected.
+    if not self.IDENTIFIER_RE.match(identifier):
+      raise ValueError("Invalid blob identifier: %s" % identifier)
+
+    shards = [identifier[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+    return os.path.join(self.location, *(shards + [identifier]))
+
+  def _WriteBlob(self, path, content):
+    """Atomically writes content to path."""
+    directory = os.path.dirname(path)
+    try:
+      os.makedirs(directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+      with os.fdopen(fd, "wb") as out:
+        out.write(content)
+        out.flush()
+        os.fsync(out.fileno())
+      os.rename(tmp_path, path)
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+  def _ReadBlob(self, path):
+    """Returns the content of the blob at path or None if it doesn't exist."""
+    try:
+      fd = open(path, "rb")
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return None
+      raise
+
+    with fd:
+      size = os.fstat(fd.fileno()).st_size
+      if self.mmap_threshold and size >= self.mmap_threshold:
+        mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          return mapped[:]
+        finally:
+          mapped.close()
+
+      return fd.read()
+
+  def _ReadBatch(self, batch, result, errors, done):
+    """Reads a batch of (identifier, path) pairs into result."""
+    try:
+      for identifier, path in batch:
+        result[identifier] = blob_store.DecodeBlob(
+            self._ReadBlob(path), identifier=identifier)
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+    finally:
+      done.release()
+
+  def StoreBlobs(self, contents, token=None):
+    """Creates blobs, skipping the ones which are already stored."""
+    _ = token
+    identifiers = []
+    for content in contents:
+      identifier = hashlib.sha256(content).hexdigest()
+      identifiers.append(identifier)
+
+      path = self._BlobPath(identifier)
+      # Blobs are content addressed so existing blobs never need rewriting.
+      if not os.path.exists(path):
+        self._WriteBlob(path, blob_store.EncodeBlob(content))
+
+    return identifiers
+
+  def ReadBlobs(self, identifiers, token=None):
+    """Reads blobs in batches from the thread pool."""
+    _ = token
+    result = {identifier: None for identifier in identifiers}
+    batches = list(
+        utils.Grouper(((identifier, self._BlobPath(identifier))
+                       for identifier in result), self.read_batch_size))
+
+    errors = []
+    done = threading.Semaphore(0)
+    if len(batches) == 1:
+      self._ReadBatch(batches[0], result, errors, done)
+    else:
+      for batch in batches:
+        self.pool.AddTask(
+            target=self._ReadBatch,
+            args=(batch, result, errors, done),
+            name="ReadBlobs")
+      for _ in batches:
+        done.acquire()
+
+    if errors:
+      raise errors[0]
+
+    return result
+
+  def GetRawBlobPaths(self, identifiers, token=None):
+    """Returns the paths of the blobs which are stored unencoded."""
+    _ = token
+    result = {}
+    for identifier in identifiers:
+      path = self._BlobPath(identifier)
+      try:
+        with open(path, "rb") as fd:
+          header = fd.read(len(blob_store.BLOB_HEADER_MAGIC))
+      except IOError as e:
+        if e.errno == errno.ENOENT:
+          continue
+        raise
+
+      if header != blob_store.BLOB_HEADER_MAGIC:
+        result[identifier] = path
+
+    return result
+
+  def BlobsExist(self, identifiers, token=None):
+    """Checks for blobs with a stat call each."""
+    _ = token
+    return {
+        identifier: os.path.exists(self._BlobPath(identifier))
+        for identifier in identifiers
+    }
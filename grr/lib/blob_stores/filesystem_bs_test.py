@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Tests the filesystem blob store."""
+
+import hashlib
+import os
+
+
+from grr.lib import flags
+from grr.lib import test_lib
+
+from grr.lib.blob_stores import filesystem_bs
+
+# pylint: mode=test
+
+
+class FilesystemBlobstoreTest(test_lib.GRRBaseTest):
+
+  def setUp(self):
+    super(FilesystemBlobstoreTest, self).setUp()
+    self.location = os.path.join(self.temp_dir, "blobs")
+    self.blobstore = filesystem_bs.FilesystemBlobstore(location=self.location)
+
+  def testStoreAndReadBlobs(self):
+    contents = ["foo", "bar", "foo", ""]
+    identifiers = self.blobstore.StoreBlobs(contents, token=self.token)
+    self.assertEqual(identifiers,
+                     [hashlib.sha256(c).hexdigest() for c in contents])
+
+    result = self.blobstore.ReadBlobs(identifiers, token=self.token)
+    self.assertEqual(len(result), 3)
+    for identifier, content in zip(identifiers, contents):
+      self.assertEqual(result[identifier], content)
+
+    missing = hashlib.sha256("missing").hexdigest()
+    self.assertIsNone(self.blobstore.ReadBlob(missing, token=self.token))
+
+  def testBlobsAreSharded(self):
+    identifier = self.blobstore.StoreBlob("foo", token=self.token)
+    path = os.path.join(self.location, identifier[:2], identifier[2:4],
+                        identifier)
+    with open(path, "rb") as fd:
+      self.assertEqual(fd.read(), "foo")
+
+    # No temporary files are left behind.
+    self.assertEqual(os.listdir(os.path.dirname(path)), [identifier])
+
+  def testBlobsExist(self):
+    identifier = self.blobstore.StoreBlob("foo", token=self.token)
+    missing = hashlib.sha256("missing").hexdigest()
+
+    self.assertEqual(
+        self.blobstore.BlobsExist([identifier, missing], token=self.token),
+        {identifier: True,
+         missing: False})
+
+  def testBatchedReads(self):
+    contents = ["blob %d" % i for i in range(50)]
+    with test_lib.ConfigOverrider({"FilesystemBlobstore.read_batch_size": 3}):
+      blobstore = filesystem_bs.FilesystemBlobstore(location=self.location)
+      identifiers = blobstore.StoreBlobs(contents, token=self.token)
+      result = blobstore.ReadBlobs(identifiers, token=self.token)
+
+    self.assertEqual(result, dict(zip(identifiers, contents)))
+
+  def testMmapReads(self):
+    with test_lib.ConfigOverrider({"FilesystemBlobstore.mmap_threshold": 10}):
+      blobstore = filesystem_bs.FilesystemBlobstore(location=self.location)
+      identifiers = blobstore.StoreBlobs(["small", "x" * 100], token=self.token)
+      result = blobstore.ReadBlobs(identifiers, token=self.token)
+
+    self.assertEqual(result[identifiers[0]], "small")
+    self.assertEqual(result[identifiers[1]], "x" * 100)
+
+  def testCompressedBlobs(self):
+    content = "A" * 10000
+    with test_lib.ConfigOverrider({"Blobstore.compression": "zlib"}):
+      identifier = self.blobstore.StoreBlob(content, token=self.token)
+
+    self.assertEqual(identifier, hashlib.sha256(content).hexdigest())
+    self.assertLess(os.path.getsize(self.blobstore._BlobPath(identifier)), 100)
+    self.assertEqual(
+        self.blobstore.ReadBlob(identifier, token=self.token), content)
+
+  def testGetRawBlobPaths(self):
+    raw = self.blobstore.StoreBlob("foo", token=self.token)
+    with test_lib.ConfigOverrider({"Blobstore.compression": "zlib"}):
+      compressed = self.blobstore.StoreBlob("A" * 10000, token=self.token)
+    missing = hashlib.sha256("missing").hexdigest()
+
+    # Only blobs whose file holds exactly their content are returned.
+    self.assertEqual(
+        self.blobstore.GetRawBlobPaths(
+            [raw, compressed, missing], token=self.token),
+        {raw: self.blobstore._BlobPath(raw)})
+
+  def testInvalidIdentifiers(self):
+    self.assertRaises(ValueError, self.blobstore.ReadBlob, "../../etc/passwd")
+    self.assertRaises(ValueError, self.blobstore.BlobExists, "foo")
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
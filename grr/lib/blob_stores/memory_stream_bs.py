@@ -44,7 +44,7 @@ class MemoryStreamBlobstore(blob_store.Blobstore):
           token=token,
           mutation_pool=mutation_pool)
       content = contents_by_digest[digest]
-      fd.Write(content)
+      fd.Write(blob_store.EncodeBlob(content))
       fd.Close()
 
       logging.debug("Got blob %s (length %s)", digest, len(content))
@@ -60,7 +60,8 @@ class MemoryStreamBlobstore(blob_store.Blobstore):
     fds = aff4.FACTORY.MultiOpen(urns, mode="r", token=token)
 
     for fd in fds:
-      res[urns[fd.urn]] = fd.read()
+      digest = urns[fd.urn]
+      res[digest] = blob_store.DecodeBlob(fd.read(), identifier=digest)
 
     return res
 
@@ -5,3 +5,6 @@
 
 # The memory stream object based blob store.
 from grr.lib.blob_stores import memory_stream_bs
+
+# A blob store keeping blobs in files on disk.
+from grr.lib.blob_stores import filesystem_bs
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+"""GRR blob store tests.
+
+This module loads and registers all the blob store tests.
+"""
+
+
+# These need to register plugins so,
+# pylint: disable=unused-import,g-import-not-at-top
+
+from grr.lib.blob_stores import filesystem_bs_test
@@ -37,7 +37,13 @@ able to filter it directly).
 
 import abc
 import atexit
+import functools
+import inspect
+import itertools
+import os
+import re
 import sys
+import threading
 import time
 
 import logging
@@ -115,6 +121,8 @@ class MutationPool(object):
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
+    # Subject -> {attribute: values} of buffered index writes.
+    self.index_updates = {}
 
   def DeleteSubjects(self, subjects):
     self.delete_subject_requests.extend(subjects)
@@ -137,39 +145,40 @@ class MutationPool(object):
   def DeleteAttributes(self, subject, attributes, start=None, end=None):
     self.delete_attributes_requests.append((subject, attributes, start, end))
 
+  def UpdateIndex(self, subject, values):
+    """Buffers an idempotent index write.
+
+    All the index writes to a subject are merged and applied as a single
+    MultiSet on Flush(), later values replacing earlier ones.
+
+    Args:
+      subject: The subject holding the index.
+      values: A dict mapping attributes to lists of values.
+    """
+    subject = utils.SmartUnicode(subject)
+    self.index_updates.setdefault(subject, {}).update(values)
+
   def Flush(self):
     """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(
-        self.delete_subject_requests, token=self.token, sync=False)
+    set_requests = self.set_requests
+    for subject, values in self.index_updates.iteritems():
+      set_requests.append((subject, values, None, True, None))
 
-    for req in self.delete_attributes_requests:
-      subject, attributes, start, end = req
-      DB.DeleteAttributes(
-          subject,
-          attributes,
-          start=start,
-          end=end,
-          token=self.token,
-          sync=False)
-
-    for req in self.set_requests:
-      subject, values, timestamp, replace, to_delete = req
-      DB.MultiSet(
-          subject,
-          values,
-          timestamp=timestamp,
-          replace=replace,
-          to_delete=to_delete,
-          token=self.token,
-          sync=False)
+    DB.MultiSubjectMutate(
+        delete_subjects=self.delete_subject_requests,
+        delete_attributes=self.delete_attributes_requests,
+        set_requests=set_requests,
+        token=self.token,
+        sync=False)
 
     if (self.delete_subject_requests or self.delete_attributes_requests or
-        self.set_requests):
+        set_requests):
       DB.Flush()
 
     self.delete_subject_requests = []
     self.set_requests = []
     self.delete_attributes_requests = []
+    self.index_updates = {}
 
   def __enter__(self):
     return self
@@ -179,7 +188,169 @@ class MutationPool(object):
 
   def Size(self):
     return (len(self.delete_subject_requests) + len(self.set_requests) +
-            len(self.delete_attributes_requests))
+            len(self.delete_attributes_requests) + len(self.index_updates))
+
+
+class AttributeCache(utils.FastStore):
+  """A process local LRU cache of resolved attributes.
+
+  Entries are keyed by subject and hold the results of the prefix queries made
+  for that subject together with a generation number. Writing to a subject
+  moves it to a new generation, so a reader which started before the write
+  can not store what it read.
+
+  Only subjects below one of the configured prefixes are cached, and only for
+  the TTL of the longest matching prefix. Writes made by other processes are
+  not seen until the TTL expires.
+  """
+
+  def __init__(self, max_size, ttls):
+    """Constructor.
+
+    Args:
+      max_size: The maximum number of subjects held in the cache.
+      ttls: A list of (subject prefix, seconds) tuples.
+    """
+    super(AttributeCache, self).__init__(max_size=max_size)
+    # The most specific prefix wins.
+    self.ttls = sorted(ttls, key=lambda x: len(x[0]), reverse=True)
+    self._generations = itertools.count()
+
+  @classmethod
+  def FromConfig(cls):
+    ttls = []
+    for spec in config_lib.CONFIG["Datastore.attribute_cache_ttls"]:
+      prefix, seconds = spec.rsplit("=", 1)
+      ttls.append((prefix, int(seconds)))
+
+    return cls(config_lib.CONFIG["Datastore.attribute_cache_size"], ttls)
+
+  def GetTTL(self, subject):
+    """Returns the TTL for the subject or None if it may not be cached."""
+    for prefix, ttl in self.ttls:
+      if subject.startswith(prefix):
+        return ttl
+
+  @utils.Synchronized
+  def GetGeneration(self, subject):
+    """Returns the current generation of the subject."""
+    try:
+      return self.Get(subject)[0]
+    except KeyError:
+      generation = self._generations.next()
+      self.Put(subject, [generation, {}])
+      return generation
+
+  @utils.Synchronized
+  def Lookup(self, subject, query):
+    """Returns the cached values for the query or None."""
+    try:
+      _, results = self.Get(subject)
+    except KeyError:
+      return None
+
+    expires, values = results.get(query, (0, None))
+    if expires < time.time():
+      return None
+
+    return list(values)
+
+  @utils.Synchronized
+  def Store(self, subject, query, generation, values):
+    """Stores the values read in the given generation of the subject."""
+    try:
+      entry = self.Get(subject)
+    except KeyError:
+      return
+
+    if entry[0] != generation:
+      return
+
+    entry[1][query] = (time.time() + self.GetTTL(subject), list(values))
+
+  @utils.Synchronized
+  def Invalidate(self, subject):
+    """Drops everything cached for the subject."""
+    subject = utils.SmartUnicode(subject)
+    if subject in self:
+      self.Get(subject)[:] = [self._generations.next(), {}]
+
+
+class QueryPredicate(object):
+  """A condition on the newest value of a single attribute.
+
+  Predicates are simple enough to be evaluated natively by the data store, so
+  queries can discard most candidate subjects before reading them. Equality and
+  range predicates apply to integer attributes, prefix and regex predicates to
+  string attributes.
+  """
+
+  EQUAL = "eq"
+  PREFIX = "prefix"
+  REGEX = "regex"
+  RANGE = "range"
+
+  def __init__(self, attribute, operator, value=None, start=None, end=None):
+    """Constructor.
+
+    Args:
+      attribute: The attribute predicate this condition applies to.
+      operator: One of EQUAL, PREFIX, REGEX or RANGE.
+      value: The value to compare to. For EQUAL this is an integer, for PREFIX
+        and REGEX a string.
+      start: The inclusive lower bound of a RANGE, None for no bound.
+      end: The inclusive upper bound of a RANGE, None for no bound.
+
+    Raises:
+      ValueError: If the operator is unknown.
+    """
+    if operator not in (self.EQUAL, self.PREFIX, self.REGEX, self.RANGE):
+      raise ValueError("Unknown predicate operator %s" % operator)
+
+    self.attribute = utils.SmartStr(attribute)
+    self.operator = operator
+    self.start = start
+    self.end = end
+    if operator == self.EQUAL:
+      self.value = long(value)
+      self.start = self.end = self.value
+    elif operator == self.RANGE:
+      self.value = None
+    else:
+      self.value = utils.SmartUnicode(value)
+    self.regex = None
+    if operator == self.REGEX:
+      self.regex = re.compile(self.value)
+
+  def Matches(self, value):
+    """Returns True if the stored value satisfies this predicate."""
+    if value is None:
+      return False
+
+    if self.operator in (self.EQUAL, self.RANGE):
+      try:
+        value = long(value)
+      except (TypeError, ValueError):
+        return False
+      if self.start is not None and value < self.start:
+        return False
+      if self.end is not None and value > self.end:
+        return False
+      return True
+
+    value = utils.SmartUnicode(value)
+    if self.operator == self.PREFIX:
+      return value.startswith(self.value)
+
+    return self.regex.search(value) is not None
+
+  def __repr__(self):
+    if self.operator in (self.EQUAL, self.RANGE):
+      return "<QueryPredicate(%s %s [%s, %s])>" % (self.attribute,
+                                                   self.operator, self.start,
+                                                   self.end)
+    return "<QueryPredicate(%s %s %r)>" % (self.attribute, self.operator,
+                                           self.value)
 
 
 class DataStore(object):
@@ -193,8 +364,25 @@ class DataStore(object):
   TIMESTAMPS = [ALL_TIMESTAMPS, NEWEST_TIMESTAMP]
   LEASE_ATTRIBUTE = "aff4:lease"
 
+  # Default number of values fetched per page by ResolvePrefixIter().
+  RESOLVE_PREFIX_PAGE_SIZE = 1000
+
+  # Set by data stores which override ResolvePrefixPage() to read only the
+  # requested page. Other data stores resolve a row in a single call when it
+  # is iterated.
+  NATIVE_RESOLVE_PREFIX_PAGE = False
+
   mutation_pool_cls = MutationPool
 
+  # Public methods whose latency is exported per method and implementation.
+  INSTRUMENTED_METHODS = [
+      "BlobsExist", "CheckAndMultiSet", "DBSubjectLock", "DeleteAttributes",
+      "DeleteSubject", "DeleteSubjects", "FilterSubjects",
+      "MultiDeleteAttributes", "MultiResolvePrefix", "MultiSet",
+      "MultiSubjectMutate", "ReadBlobs", "ResolveMulti", "ResolvePrefix",
+      "ResolvePrefixPage", "ScanAttributes", "Set", "StoreBlobs"
+  ]
+
   flusher_thread = None
   monitor_thread = None
 
@@ -208,6 +396,15 @@ class DataStore(object):
         name="DataStore flusher thread", target=self.Flush, sleep_time=0.5)
     self.flusher_thread.start()
     self.monitor_thread = None
+    self.slow_query_threshold = config_lib.CONFIG[
+        "Datastore.slow_query_threshold"]
+    # Tracks how many instrumented calls each thread is inside of.
+    self._instrumented_calls = threading.local()
+    for name in self.INSTRUMENTED_METHODS:
+      setattr(self, name, self._Instrument(name, getattr(self, name)))
+    self.attribute_cache = None
+    if config_lib.CONFIG["Datastore.attribute_cache_size"]:
+      self.EnableAttributeCache(AttributeCache.FromConfig())
 
   def GetRequiredResolveAccess(self, attribute_prefix):
     """Returns required level of access for resolve operations.
@@ -246,6 +443,394 @@ class DataStore(object):
 
     return "r"
 
+  def _Instrument(self, name, method):
+    """Wraps a bound method to record its latency and log slow calls.
+
+    Only the outermost instrumented call is recorded, calls an implementation
+    makes to its own public methods are part of the caller's latency.
+
+    Args:
+      name: The name of the method.
+      method: The bound method to wrap.
+
+    Returns:
+      The wrapped method.
+    """
+    backend = self.__class__.__name__
+    arg_names = inspect.getargspec(method).args[1:]
+    calls = self._instrumented_calls
+
+    def Record(elapsed, args, kwargs, rows):
+      stats.STATS.RecordEvent(
+          "datastore_latency", elapsed, fields=[name, backend])
+      if self.slow_query_threshold and elapsed >= self.slow_query_threshold:
+        call_args = dict(zip(arg_names, args))
+        call_args.update(kwargs)
+        self._LogSlowQuery(name, elapsed, call_args, rows)
+
+    def InstrumentedGenerator(generator, elapsed, args, kwargs, count_rows):
+      # Only the time spent producing items counts, not the time the caller
+      # spends consuming them.
+      rows = 0
+      try:
+        while True:
+          start_time = time.time()
+          calls.depth = getattr(calls, "depth", 0) + 1
+          try:
+            item = generator.next()
+          except StopIteration:
+            return
+          finally:
+            calls.depth -= 1
+            elapsed += time.time() - start_time
+          rows += count_rows(item)
+          yield item
+      finally:
+        Record(elapsed, args, kwargs, rows)
+
+    @functools.wraps(method)
+    def Instrumented(*args, **kwargs):
+      depth = getattr(calls, "depth", 0)
+      if depth:
+        return method(*args, **kwargs)
+
+      start_time = time.time()
+      rows = None
+      calls.depth = 1
+      try:
+        result = method(*args, **kwargs)
+        if name == "MultiResolvePrefix":
+          if isinstance(result, list):
+            rows = sum(len(values) for _, values in result)
+          else:
+            # Counted as the caller consumes the results.
+            elapsed = time.time() - start_time
+            start_time = None
+            return InstrumentedGenerator(
+                result, elapsed, args, kwargs, lambda item: len(item[1]))
+        elif inspect.isgenerator(result):
+          elapsed = time.time() - start_time
+          start_time = None
+          return InstrumentedGenerator(result, elapsed, args, kwargs,
+                                       lambda _: 1)
+        elif name == "ResolvePrefixPage":
+          rows = len(result[0])
+        elif isinstance(result, (list, dict)):
+          rows = len(result)
+        return result
+      finally:
+        calls.depth = 0
+        if start_time is not None:
+          Record(time.time() - start_time, args, kwargs, rows)
+
+    return Instrumented
+
+  def _LogSlowQuery(self, name, elapsed, call_args, rows):
+    """Logs a call which took longer than the slow query threshold."""
+    subject = None
+    for arg in ["subject", "subject_prefix", "subjects", "delete_subjects",
+                "identifiers"]:
+      subject = call_args.get(arg)
+      if subject:
+        break
+
+    if isinstance(subject, (list, tuple, set)):
+      subjects = list(subject)
+      subject = "%s (%d subjects)" % (subjects[0], len(subjects))
+
+    attributes = None
+    for arg in ["attribute_prefix", "attributes", "values", "attribute"]:
+      if arg in call_args:
+        attributes = call_args[arg]
+        if isinstance(attributes, basestring):
+          attributes = 1
+        else:
+          attributes = len(attributes)
+        break
+
+    caller, flow_urn = self._GetSlowQueryCaller()
+    logging.warning(
+        "Slow data store call %s.%s took %.3fs: subject %s, %s attributes, "
+        "%s rows, called from %s, flow %s", self.__class__.__name__, name,
+        elapsed,
+        utils.SmartStr(subject)[:200], attributes, rows, caller, flow_urn)
+
+  def _GetSlowQueryCaller(self):
+    """Finds the first caller outside the data store and its flow, if any."""
+    # Frames in this module or in the module of the implementation are part
+    # of the data store.
+    data_store_files = set()
+    for module_name in [__name__, self.__class__.__module__]:
+      module_file = getattr(sys.modules.get(module_name), "__file__", None)
+      if module_file:
+        data_store_files.add(os.path.splitext(os.path.abspath(module_file))[0])
+
+    caller = None
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    while frame:
+      code = frame.f_code
+      if caller is None and os.path.splitext(os.path.abspath(
+          code.co_filename))[0] not in data_store_files:
+        caller = "%s:%d %s()" % (os.path.basename(code.co_filename),
+                                 frame.f_lineno, code.co_name)
+      if caller is not None:
+        session_id = getattr(frame.f_locals.get("self"), "session_id", None)
+        if session_id:
+          return caller, session_id
+      frame = frame.f_back
+
+    return caller, None
+
+  def EnableAttributeCache(self, cache):
+    """Serves prefix reads from the cache and invalidates it on local writes.
+
+    The read and write methods of this instance are replaced by wrappers with
+    the same signatures, so this works for every data store implementation.
+
+    Args:
+      cache: An AttributeCache instance.
+    """
+    if self.attribute_cache is None:
+      self._uncached = {}
+      for name in [
+          "ResolvePrefix", "MultiResolvePrefix", "Set", "MultiSet",
+          "CheckAndMultiSet", "DeleteAttributes", "MultiDeleteAttributes",
+          "DeleteSubject", "DeleteSubjects", "MultiSubjectMutate"
+      ]:
+        self._uncached[name] = getattr(self, name)
+        setattr(self, name, getattr(self, "_Cached" + name))
+
+    self.attribute_cache = cache
+
+  def DisableAttributeCache(self):
+    if self.attribute_cache is None:
+      return
+
+    for name, method in self._uncached.iteritems():
+      setattr(self, name, method)
+    self.attribute_cache = None
+
+  def _AttributeCacheQuery(self, attribute_prefix, timestamp, limit):
+    """Returns the cache key for a prefix query or None if not cacheable."""
+    if limit or timestamp not in [
+        None, self.NEWEST_TIMESTAMP, self.ALL_TIMESTAMPS
+    ]:
+      return None
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+
+    return tuple(utils.SmartStr(p) for p in attribute_prefix), timestamp
+
+  def _CachedResolvePrefix(self,
+                           subject,
+                           attribute_prefix,
+                           timestamp=None,
+                           limit=None,
+                           token=None):
+    """ResolvePrefix() reading through the attribute cache."""
+    uncached = self._uncached["ResolvePrefix"]
+    cache = self.attribute_cache
+    query = self._AttributeCacheQuery(attribute_prefix, timestamp, limit)
+    key = utils.SmartUnicode(subject)
+    if query is None or cache.GetTTL(key) is None:
+      return uncached(
+          subject,
+          attribute_prefix,
+          timestamp=timestamp,
+          limit=limit,
+          token=token)
+
+    values = cache.Lookup(key, query)
+    if values is not None:
+      stats.STATS.IncrementCounter("datastore_attribute_cache_hits")
+      self.security_manager.CheckDataStoreAccess(
+          token, [subject], self.GetRequiredResolveAccess(attribute_prefix))
+      return values
+
+    stats.STATS.IncrementCounter("datastore_attribute_cache_misses")
+    generation = cache.GetGeneration(key)
+    values = list(
+        uncached(
+            subject, attribute_prefix, timestamp=timestamp, token=token))
+    cache.Store(key, query, generation, values)
+    return values
+
+  def _CachedMultiResolvePrefix(self,
+                                subjects,
+                                attribute_prefix,
+                                timestamp=None,
+                                limit=None,
+                                token=None):
+    """MultiResolvePrefix() reading through the attribute cache."""
+    uncached = self._uncached["MultiResolvePrefix"]
+    cache = self.attribute_cache
+    query = self._AttributeCacheQuery(attribute_prefix, timestamp, limit)
+    if query is None:
+      return uncached(
+          subjects,
+          attribute_prefix,
+          timestamp=timestamp,
+          limit=limit,
+          token=token)
+
+    hits = []
+    # Maps the subjects we need to read to their cache generation.
+    to_read = {}
+    for subject in subjects:
+      key = utils.SmartUnicode(subject)
+      if cache.GetTTL(key) is None:
+        to_read[subject] = None
+        continue
+
+      values = cache.Lookup(key, query)
+      if values is None:
+        stats.STATS.IncrementCounter("datastore_attribute_cache_misses")
+        to_read[subject] = cache.GetGeneration(key)
+      else:
+        stats.STATS.IncrementCounter("datastore_attribute_cache_hits")
+        hits.append((subject, values))
+
+    if hits:
+      self.security_manager.CheckDataStoreAccess(
+          token, [subject for subject, _ in hits],
+          self.GetRequiredResolveAccess(attribute_prefix))
+
+    results = [(subject, values) for subject, values in hits if values]
+    if to_read:
+      read = {}
+      for subject, values in uncached(
+          list(to_read), attribute_prefix, timestamp=timestamp, token=token):
+        read[utils.SmartUnicode(subject)] = values
+
+      for subject, generation in to_read.iteritems():
+        key = utils.SmartUnicode(subject)
+        values = read.get(key, [])
+        if generation is not None:
+          cache.Store(key, query, generation, values)
+        if values:
+          results.append((subject, values))
+
+    return iter(results)
+
+  def _CallAndInvalidate(self, name, subjects, *args, **kwargs):
+    try:
+      return self._uncached[name](*args, **kwargs)
+    finally:
+      for subject in subjects:
+        self.attribute_cache.Invalidate(subject)
+
+  def _CachedSet(self,
+                 subject,
+                 attribute,
+                 value,
+                 timestamp=None,
+                 token=None,
+                 replace=True,
+                 sync=True):
+    return self._CallAndInvalidate(
+        "Set", [subject],
+        subject,
+        attribute,
+        value,
+        timestamp=timestamp,
+        token=token,
+        replace=replace,
+        sync=sync)
+
+  def _CachedMultiSet(self,
+                      subject,
+                      values,
+                      timestamp=None,
+                      replace=True,
+                      sync=True,
+                      to_delete=None,
+                      token=None):
+    return self._CallAndInvalidate(
+        "MultiSet", [subject],
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete,
+        token=token)
+
+  def _CachedCheckAndMultiSet(self,
+                              subject,
+                              expected_values,
+                              new_values,
+                              timestamp=None,
+                              to_delete=None,
+                              token=None):
+    return self._CallAndInvalidate(
+        "CheckAndMultiSet", [subject],
+        subject,
+        expected_values,
+        new_values,
+        timestamp=timestamp,
+        to_delete=to_delete,
+        token=token)
+
+  def _CachedDeleteAttributes(self,
+                              subject,
+                              attributes,
+                              start=None,
+                              end=None,
+                              sync=True,
+                              token=None):
+    return self._CallAndInvalidate(
+        "DeleteAttributes", [subject],
+        subject,
+        attributes,
+        start=start,
+        end=end,
+        sync=sync,
+        token=token)
+
+  def _CachedMultiDeleteAttributes(self,
+                                   subjects,
+                                   attributes,
+                                   start=None,
+                                   end=None,
+                                   sync=True,
+                                   token=None):
+    return self._CallAndInvalidate(
+        "MultiDeleteAttributes",
+        subjects,
+        subjects,
+        attributes,
+        start=start,
+        end=end,
+        sync=sync,
+        token=token)
+
+  def _CachedDeleteSubject(self, subject, sync=False, token=None):
+    return self._CallAndInvalidate(
+        "DeleteSubject", [subject], subject, sync=sync, token=token)
+
+  def _CachedDeleteSubjects(self, subjects, sync=False, token=None):
+    return self._CallAndInvalidate(
+        "DeleteSubjects", subjects, subjects, sync=sync, token=token)
+
+  def _CachedMultiSubjectMutate(self,
+                                delete_subjects=None,
+                                delete_attributes=None,
+                                set_requests=None,
+                                sync=True,
+                                token=None):
+    subjects = list(delete_subjects or [])
+    subjects.extend(req[0] for req in delete_attributes or [])
+    subjects.extend(req[0] for req in set_requests or [])
+    return self._CallAndInvalidate(
+        "MultiSubjectMutate",
+        subjects,
+        delete_subjects=delete_subjects,
+        delete_attributes=delete_attributes,
+        set_requests=set_requests,
+        sync=sync,
+        token=token)
+
   def InitializeBlobstore(self):
     blobstore_name = config_lib.CONFIG.Get("Blobstore.implementation")
     try:
@@ -394,6 +979,87 @@ class DataStore(object):
       token: An ACL token.
     """
 
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Atomically sets values if other attributes are unchanged.
+
+    This is a compare-and-set primitive: the new values are only written if
+    the newest version of every attribute in expected_values is still the one
+    the caller has seen. The values are written as MultiSet(replace=True)
+    would.
+
+    This default implementation holds a DBSubjectLock for the check and the
+    write and so is only atomic with respect to other lock holders. Data
+    stores should override it with a native conditional write.
+
+    Args:
+      subject: The subject this applies to.
+      expected_values: A dict mapping attributes to the (value, timestamp) of
+        their newest version as returned by ResolveMulti(), or to None if the
+        attribute must not exist.
+      new_values: A dict of values to set as accepted by MultiSet().
+      timestamp: The timestamp for the new values in microseconds since the
+        epoch. None means now.
+      to_delete: An array of attributes to clear prior to setting.
+      token: An ACL token.
+
+    Returns:
+      True if the values were written, False if any expectation failed.
+    """
+    try:
+      with self.DBSubjectLock(subject, token=token):
+        current_values = self._ResolveNewestValues(subject, expected_values,
+                                                   token)
+        if not self._ExpectedValuesMatch(expected_values, current_values):
+          return False
+
+        self.MultiSet(
+            subject,
+            new_values,
+            timestamp=timestamp,
+            replace=True,
+            to_delete=to_delete,
+            token=token)
+        return True
+    except DBSubjectLockError:
+      return False
+
+  def _ResolveNewestValues(self, subject, attributes, token):
+    """Returns a dict of attribute to (value, timestamp) of newest versions."""
+    result = {}
+    for attribute, value, ts in self.ResolveMulti(
+        subject,
+        list(attributes),
+        timestamp=self.NEWEST_TIMESTAMP,
+        token=token):
+      if attribute not in result or ts > result[attribute][1]:
+        result[attribute] = (value, ts)
+    return result
+
+  def _ExpectedValuesMatch(self, expected_values, current_values):
+    """Checks CheckAndMultiSet() expectations against the current values."""
+    for attribute, expected in expected_values.iteritems():
+      current = current_values.get(attribute)
+      if expected is None or current is None:
+        if expected is not current:
+          return False
+        continue
+
+      expected_value, expected_ts = expected
+      current_value, current_ts = current
+      if long(expected_ts) != long(current_ts):
+        return False
+      # Backends differ in how they return strings and integers.
+      if utils.SmartStr(expected_value) != utils.SmartStr(current_value):
+        return False
+
+    return True
+
   def MultiDeleteAttributes(self,
                             subjects,
                             attributes,
@@ -434,6 +1100,46 @@ class DataStore(object):
       token: An ACL token.
     """
 
+  def MultiSubjectMutate(self,
+                         delete_subjects=None,
+                         delete_attributes=None,
+                         set_requests=None,
+                         sync=True,
+                         token=None):
+    """Apply mutations to many subjects in one operation.
+
+    This is the batch write path used by MutationPool.Flush(). Subject
+    deletions are applied first, then attribute deletions and finally all the
+    sets. Data stores which can group writes to different subjects into a
+    single transaction or request should override this method, the default
+    implementation applies every mutation separately.
+
+    Args:
+      delete_subjects: A list of subjects to delete completely.
+      delete_attributes: A list of (subject, attributes, start, end) tuples
+        as accepted by DeleteAttributes().
+      set_requests: A list of (subject, values, timestamp, replace, to_delete)
+        tuples as accepted by MultiSet().
+      sync: If true we block until the operation completes.
+      token: An ACL token.
+    """
+    if delete_subjects:
+      self.DeleteSubjects(delete_subjects, sync=sync, token=token)
+
+    for subject, attributes, start, end in delete_attributes or []:
+      self.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=sync, token=token)
+
+    for subject, values, timestamp, replace, to_delete in set_requests or []:
+      self.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete,
+          sync=sync,
+          token=token)
+
   def Resolve(self, subject, attribute, token=None):
     """Retrieve a value set for a subject's attribute.
 
@@ -537,6 +1243,187 @@ class DataStore(object):
 
     return []
 
+  def _MakeCursor(self, attribute, timestamp):
+    """Encodes the position after (attribute, timestamp) as a cursor."""
+    return "%d:%s" % (timestamp, utils.SmartStr(attribute))
+
+  def _ParseCursor(self, cursor):
+    """Decodes a cursor produced by _MakeCursor into (attribute, timestamp)."""
+    try:
+      timestamp, attribute = utils.SmartStr(cursor).split(":", 1)
+      return attribute, int(timestamp)
+    except ValueError:
+      raise Error("Invalid ResolvePrefix cursor: %r" % cursor)
+
+  def ResolvePrefixPage(self,
+                        subject,
+                        attribute_prefix,
+                        timestamp=None,
+                        page_size=None,
+                        cursor=None,
+                        token=None):
+    """Retrieve one page of values matching the subject's attribute prefix.
+
+    Pages are ordered by attribute and then by decreasing timestamp. The
+    returned cursor is opaque and is passed back to fetch the following page.
+    This default implementation resolves the whole row for every page, data
+    stores should override it with a native implementation that only reads
+    the requested page and set NATIVE_RESOLVE_PREFIX_PAGE.
+
+    Args:
+      subject: The subject that we will search.
+      attribute_prefix: The attribute prefix or a list of prefixes.
+      timestamp: A range of times for consideration (In
+          microseconds). Can be a constant such as ALL_TIMESTAMPS or
+          NEWEST_TIMESTAMP or a tuple of ints (start, end).
+      page_size: The maximum number of values to return.
+      cursor: A cursor returned by a previous call or None to start at the
+          beginning of the row.
+      token: An ACL token.
+
+    Returns:
+       A tuple (values, cursor). values is a list of (attribute, value string,
+       timestamp) and cursor is None if there are no more values.
+
+    Raises:
+      AccessError: if anything goes wrong.
+    """
+    page_size = page_size or self.RESOLVE_PREFIX_PAGE_SIZE
+
+    values = self._ResolveSortedPrefix(
+        subject, attribute_prefix, timestamp=timestamp, cursor=cursor,
+        token=token)
+
+    page = values[:page_size]
+    if len(values) > page_size:
+      return page, self._MakeCursor(page[-1][0], page[-1][2])
+
+    return page, None
+
+  def _ResolveSortedPrefix(self,
+                           subject,
+                           attribute_prefix,
+                           timestamp=None,
+                           cursor=None,
+                           token=None):
+    """Resolves the rest of a row after cursor in a single call, in order."""
+    values = self.ResolvePrefix(
+        subject, attribute_prefix, timestamp=timestamp, token=token)
+    values = sorted(values, key=lambda v: (utils.SmartStr(v[0]), -v[2]))
+
+    if cursor:
+      after_attribute, after_timestamp = self._ParseCursor(cursor)
+      values = [
+          v for v in values
+          if utils.SmartStr(v[0]) > after_attribute or (
+              utils.SmartStr(v[0]) == after_attribute and v[2] < after_timestamp)
+      ]
+
+    return values
+
+  def _ResolvePrefixPages(self,
+                          subject,
+                          attribute_prefix,
+                          timestamp=None,
+                          page_size=None,
+                          cursor=None,
+                          token=None):
+    """Yields the non empty pages of values of a subject after cursor."""
+    if not self.NATIVE_RESOLVE_PREFIX_PAGE:
+      # Paging through the default ResolvePrefixPage() would resolve the
+      # whole row once per page.
+      page_size = page_size or self.RESOLVE_PREFIX_PAGE_SIZE
+      values = self._ResolveSortedPrefix(
+          subject, attribute_prefix, timestamp=timestamp, cursor=cursor,
+          token=token)
+      for i in xrange(0, len(values), page_size):
+        yield values[i:i + page_size]
+      return
+
+    while True:
+      values, cursor = self.ResolvePrefixPage(
+          subject,
+          attribute_prefix,
+          timestamp=timestamp,
+          page_size=page_size,
+          cursor=cursor,
+          token=token)
+      if values:
+        yield values
+
+      if cursor is None:
+        return
+
+  def ResolvePrefixIter(self,
+                        subject,
+                        attribute_prefix,
+                        timestamp=None,
+                        page_size=None,
+                        cursor=None,
+                        token=None):
+    """Iterate over all values matching the subject's attribute prefix.
+
+    On data stores with a native ResolvePrefixPage() values are fetched page
+    by page so arbitrarily large rows can be walked without holding them in
+    memory. Other data stores resolve the row with a single ResolvePrefix()
+    call.
+
+    Args:
+      subject: The subject that we will search.
+      attribute_prefix: The attribute prefix or a list of prefixes.
+      timestamp: A range of times for consideration (In
+          microseconds). Can be a constant such as ALL_TIMESTAMPS or
+          NEWEST_TIMESTAMP or a tuple of ints (start, end).
+      page_size: The number of values fetched from the data store at once.
+      cursor: An optional cursor to resume a previous iteration.
+      token: An ACL token.
+
+    Yields:
+       Tuples (attribute, value string, timestamp), ordered by attribute and
+       then by decreasing timestamp.
+    """
+    for values in self._ResolvePrefixPages(
+        subject,
+        attribute_prefix,
+        timestamp=timestamp,
+        page_size=page_size,
+        cursor=cursor,
+        token=token):
+      for value in values:
+        yield value
+
+  def MultiResolvePrefixIter(self,
+                             subjects,
+                             attribute_prefix,
+                             timestamp=None,
+                             page_size=None,
+                             token=None):
+    """Iterate over pages of values for many subjects.
+
+    Args:
+      subjects: A list of subjects.
+      attribute_prefix: The attribute prefix or a list of prefixes.
+      timestamp: A range of times for consideration (In
+          microseconds). Can be a constant such as ALL_TIMESTAMPS or
+          NEWEST_TIMESTAMP or a tuple of ints (start, end).
+      page_size: The number of values fetched from the data store at once.
+      token: An ACL token.
+
+    Yields:
+       Tuples (subject, values) where values is a non empty page of
+       (attribute, value string, timestamp). Large subjects are returned in
+       several consecutive pages. Data stores without a native
+       ResolvePrefixPage() resolve every subject in a single call.
+    """
+    for subject in subjects:
+      for values in self._ResolvePrefixPages(
+          subject,
+          attribute_prefix,
+          timestamp=timestamp,
+          page_size=page_size,
+          token=token):
+        yield subject, values
+
   def ResolveMulti(self,
                    subject,
                    attributes,
@@ -646,6 +1533,44 @@ class DataStore(object):
       ts, v = r[attribute]
       yield (s, ts, v)
 
+  def FilterSubjects(self, subjects, predicates, token=None):
+    """Returns the subjects which may satisfy all the predicates.
+
+    This lets queries discard candidates without reading them. Implementations
+    should evaluate the predicates natively where they can but are allowed to
+    return subjects which do not match, so callers must still apply the full
+    filter to the objects they read. Subjects which match are never dropped.
+
+    Args:
+      subjects: A list of subjects to filter.
+      predicates: A list of QueryPredicate instances which must all hold.
+      token: The security token to authenticate with.
+
+    Returns:
+      The matching subjects in their original order and type.
+    """
+    subjects = list(subjects)
+    if not predicates or not subjects:
+      return subjects
+
+    attributes = set(p.attribute for p in predicates)
+    matching = set()
+    for subject, values in self.MultiResolvePrefix(
+        subjects,
+        attributes,
+        timestamp=self.NEWEST_TIMESTAMP,
+        token=token):
+      newest = {}
+      for attribute, value, _ in values:
+        # Resolving is by prefix so there may be other attributes in here.
+        if attribute in attributes:
+          newest.setdefault(attribute, value)
+
+      if all(p.Matches(newest.get(p.attribute)) for p in predicates):
+        matching.add(utils.SmartUnicode(subject))
+
+    return [s for s in subjects if utils.SmartUnicode(s) in matching]
+
   def ReadBlob(self, identifier, token=None):
     return self.ReadBlobs([identifier], token=token).values()[0]
 
@@ -658,6 +1583,9 @@ class DataStore(object):
   def StoreBlobs(self, contents, token=None):
     return self.blobstore.StoreBlobs(contents, token=token)
 
+  def GetRawBlobPaths(self, identifiers, token=None):
+    return self.blobstore.GetRawBlobPaths(identifiers, token=token)
+
   def BlobExists(self, identifier, token=None):
     return self.BlobsExist([identifier], token=token).values()[0]
 
@@ -806,3 +1734,29 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric("datastore_attribute_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_attribute_cache_misses")
+    stats.STATS.RegisterCounterMetric(
+        "blobstore_uncompressed_bytes",
+        fields=[("codec", str)],
+        docstring="Size of blobs written before compression.",
+        units="BYTES")
+    stats.STATS.RegisterCounterMetric(
+        "blobstore_stored_bytes",
+        fields=[("codec", str)],
+        docstring="Size of blobs written after compression.",
+        units="BYTES")
+    stats.STATS.RegisterEventMetric(
+        "blobstore_codec_time",
+        fields=[("codec", str), ("operation", str)],
+        docstring="Time spent compressing and decompressing blobs.",
+        units="SECONDS")
+    stats.STATS.RegisterEventMetric(
+        "datastore_latency",
+        bins=[
+            0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10,
+            50
+        ],
+        fields=[("method", str), ("backend", str)],
+        docstring="Latency of data store calls.",
+        units="SECONDS")
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""Workloads and a runner to benchmark data stores with GRR shaped load.
+
+Every workload is run by a number of threads against the current data store
+and produces one result record, so results from different implementations
+and runs can be compared over time. grr/tools/data_store_benchmark.py is the
+command line entry point.
+
+Workload operations are derived from a seeded random generator so that two
+runs with the same settings issue the same sequence of data store calls.
+"""
+
+
+import math
+import os
+import random
+import threading
+import time
+
+
+import psutil
+
+from grr.lib import aff4
+from grr.lib import client_index
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import queue_manager
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import utils
+from grr.lib.aff4_objects import sequential_collection
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+
+
+class Workload(object):
+  """A synthetic workload issuing data store operations from many threads.
+
+  Subclasses implement Operation(), which is called once per operation from
+  several threads at the same time, and may prepare data in Setup().
+  """
+  __metaclass__ = registry.MetaclassRegistry
+
+  # A short description of the workload.
+  description = ""
+
+  def __init__(self, token=None, seed=0):
+    self.token = token
+    self.seed = seed
+    self.lock = threading.Lock()
+    self.counters = {}
+
+  def Setup(self):
+    """Creates the data the workload operates on."""
+
+  def Operation(self, rng, thread_index, iteration):
+    """Performs a single timed operation.
+
+    Args:
+      rng: A random.Random instance private to the calling thread.
+      thread_index: The index of the calling thread.
+      iteration: The number of operations this thread has already performed.
+    """
+    raise NotImplementedError()
+
+  def IncrementCounter(self, name, delta=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + delta
+
+
+class QueueChurnWorkload(Workload):
+  """Schedules tasks on client queues and leases and deletes them again."""
+
+  description = "QueueManager.Schedule/QueryAndOwn/Delete on client queues."
+
+  CLIENT_COUNT = 20
+  TASKS_PER_SCHEDULE = 5
+  LEASE_LIMIT = 10
+
+  def Setup(self):
+    self.queues = [
+        rdf_client.ClientURN("C.%016X" % i).Queue()
+        for i in range(self.CLIENT_COUNT)
+    ]
+
+  def Operation(self, rng, thread_index, iteration):
+    queue = rng.choice(self.queues)
+    manager = queue_manager.QueueManager(token=self.token)
+    if iteration % 2 == 0:
+      tasks = [
+          rdf_flows.GrrMessage(
+              queue=queue,
+              session_id=rdfvalue.SessionID(flow_name="%X" % thread_index),
+              name="Benchmark",
+              generate_task_id=True)
+          for _ in range(self.TASKS_PER_SCHEDULE)
+      ]
+      manager.Schedule(tasks, sync=True)
+    else:
+      tasks = manager.QueryAndOwn(
+          queue, lease_seconds=60, limit=self.LEASE_LIMIT)
+      manager.Delete(queue, tasks)
+      manager.Flush()
+      self.IncrementCounter("leased_tasks", len(tasks))
+
+
+class NotificationShardingWorkload(Workload):
+  """Notifies the sharded flow queue and collects notifications."""
+
+  description = "MultiNotifyQueue and GetNotificationsForAllShards."
+
+  SESSION_COUNT = 100
+
+  def Operation(self, rng, thread_index, iteration):
+    manager = queue_manager.QueueManager(token=self.token)
+    if iteration % 10 == 9:
+      notifications = manager.GetNotificationsForAllShards(
+          rdfvalue.DEFAULT_FLOW_QUEUE)
+      self.IncrementCounter("notifications_read", len(notifications))
+    else:
+      session_id = rdfvalue.SessionID(
+          queue=rdfvalue.DEFAULT_FLOW_QUEUE,
+          flow_name="%X" % rng.randint(0, self.SESSION_COUNT - 1))
+      manager.MultiNotifyQueue(
+          [rdf_flows.GrrNotification(session_id=session_id)])
+
+
+class SequentialCollectionWorkload(Workload):
+  """Appends to a sequential collection and scans it."""
+
+  description = "GeneralIndexedCollection StaticAdd and Scan."
+
+  SCAN_SIZE = 100
+
+  def Setup(self):
+    self.urn = rdfvalue.RDFURN("aff4:/benchmark/collection_%d" % self.seed)
+    with aff4.FACTORY.Create(
+        self.urn,
+        sequential_collection.GeneralIndexedCollection,
+        mode="w",
+        token=self.token):
+      pass
+
+  def Operation(self, rng, thread_index, iteration):
+    if iteration % 10 == 9:
+      collection = aff4.FACTORY.Open(
+          self.urn,
+          aff4_type=sequential_collection.GeneralIndexedCollection,
+          token=self.token)
+      records = list(collection.Scan(max_records=self.SCAN_SIZE))
+      self.IncrementCounter("records_scanned", len(records))
+    else:
+      sequential_collection.GeneralIndexedCollection.StaticAdd(
+          self.urn, self.token,
+          rdfvalue.RDFString("%d:%d:%d" % (thread_index, iteration,
+                                           rng.getrandbits(32))))
+
+
+class ClientIndexWorkload(Workload):
+  """Looks up clients by keyword while the index is being updated."""
+
+  description = "ClientIndex LookupClients with occasional updates."
+
+  CLIENT_COUNT = 1000
+  USER_COUNT = 50
+  LABEL_COUNT = 10
+
+  def _Keywords(self, rng, client_number):
+    return [
+        "host:host%d" % client_number,
+        "user:user%d" % rng.randint(0, self.USER_COUNT - 1),
+        "label:label%d" % rng.randint(0, self.LABEL_COUNT - 1)
+    ]
+
+  def Setup(self):
+    self.index = aff4.FACTORY.Create(
+        "aff4:/benchmark/client_index_%d" % self.seed,
+        aff4_type=client_index.ClientIndex,
+        mode="rw",
+        token=self.token)
+    rng = random.Random(self.seed)
+    for i in range(self.CLIENT_COUNT):
+      self.index.AddKeywordsForName("C.%016X" % i, self._Keywords(rng, i))
+
+  def Operation(self, rng, thread_index, iteration):
+    if iteration % 10 == 9:
+      client_number = rng.randint(0, self.CLIENT_COUNT - 1)
+      self.index.AddKeywordsForName("C.%016X" % client_number,
+                                    self._Keywords(rng, client_number))
+      return
+
+    if rng.random() < 0.5:
+      keywords = ["host:host%d" % rng.randint(0, self.CLIENT_COUNT - 1)]
+    else:
+      keywords = [
+          "user:user%d" % rng.randint(0, self.USER_COUNT - 1),
+          "label:label%d" % rng.randint(0, self.LABEL_COUNT - 1)
+      ]
+    self.IncrementCounter("clients_found",
+                          len(self.index.LookupClients(keywords)))
+
+
+class BlobWorkload(Workload):
+  """Writes blobs and reads back previously written ones."""
+
+  description = "DataStore.StoreBlob and ReadBlob."
+
+  BLOB_SIZE = 64 * 1024
+
+  def Setup(self):
+    self.blob_ids = []
+
+  def Operation(self, rng, thread_index, iteration):
+    if iteration % 2 == 0 or not self.blob_ids:
+      # Blobs are content addressed so every blob has to be distinct.
+      prefix = "%d:%d:%d:" % (self.seed, thread_index, iteration)
+      content = prefix + "\x00" * (self.BLOB_SIZE - len(prefix))
+      blob_id = data_store.DB.StoreBlob(content, token=self.token)
+      with self.lock:
+        self.blob_ids.append(blob_id)
+    else:
+      with self.lock:
+        blob_id = rng.choice(self.blob_ids)
+      if data_store.DB.ReadBlob(blob_id, token=self.token) is None:
+        self.IncrementCounter("missing_blobs")
+
+
+class LockContentionWorkload(Workload):
+  """Many threads locking and updating a handful of subjects."""
+
+  description = "DBSubjectLock contention on a few hot subjects."
+
+  SUBJECT_COUNT = 5
+
+  def Setup(self):
+    self.subjects = [
+        "aff4:/benchmark/locked_%d_%d" % (self.seed, i)
+        for i in range(self.SUBJECT_COUNT)
+    ]
+
+  def Operation(self, rng, thread_index, iteration):
+    subject = rng.choice(self.subjects)
+    try:
+      with data_store.DB.DBSubjectLock(
+          subject, lease_time=10, token=self.token):
+        data_store.DB.Set(
+            subject,
+            "metadata:last",
+            "%d:%d" % (thread_index, iteration),
+            token=self.token)
+    except data_store.DBSubjectLockError:
+      self.IncrementCounter("lock_conflicts")
+
+
+def Percentile(sorted_values, percentile):
+  """Returns the nearest rank percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.0
+  rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+  return sorted_values[max(0, min(rank, len(sorted_values)) - 1)]
+
+
+class BenchmarkRunner(object):
+  """Runs workloads against the current data_store.DB."""
+
+  def __init__(self, threads=10, operations=1000, seed=0, token=None):
+    self.threads = threads
+    self.operations = operations
+    self.seed = seed
+    self.token = token
+    self.process = psutil.Process(os.getpid())
+
+  def _Worker(self, workload, thread_index, operations, latencies, errors):
+    rng = random.Random("%d:%s:%d" % (self.seed, workload.__class__.__name__,
+                                      thread_index))
+    for iteration in xrange(operations):
+      start = time.time()
+      try:
+        workload.Operation(rng, thread_index, iteration)
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append(utils.SmartStr(e))
+      latencies.append(time.time() - start)
+
+  def RunWorkload(self, workload_cls):
+    """Runs a workload and returns a dict with the results."""
+    workload = workload_cls(token=self.token, seed=self.seed)
+    workload.Setup()
+
+    rss_before = self.process.memory_info().rss
+    per_thread = [
+        self.operations // self.threads + (i < self.operations % self.threads)
+        for i in range(self.threads)
+    ]
+    latencies = [[] for _ in range(self.threads)]
+    errors = []
+    threads = [
+        threading.Thread(
+            target=self._Worker,
+            args=(workload, i, per_thread[i], latencies[i], errors))
+        for i in range(self.threads)
+    ]
+
+    start = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    wall_time = time.time() - start
+
+    all_latencies = sorted(sum(latencies, []))
+    rss_after = self.process.memory_info().rss
+    operations = len(all_latencies)
+
+    return {
+        "workload": workload_cls.__name__,
+        "description": workload.description,
+        "threads": self.threads,
+        "operations": operations,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_time": wall_time,
+        "throughput": operations / wall_time if wall_time else 0.0,
+        "latency_mean": (sum(all_latencies) / operations
+                         if operations else 0.0),
+        "latency_p50": Percentile(all_latencies, 50),
+        "latency_p99": Percentile(all_latencies, 99),
+        "latency_max": all_latencies[-1] if all_latencies else 0.0,
+        "rss_bytes": rss_after,
+        "rss_delta_bytes": rss_after - rss_before,
+        "counters": workload.counters,
+    }
+
+
+def GetWorkloads(names):
+  """Returns the workload classes for names, or all of them if empty."""
+  if not names:
+    return [
+        cls for _, cls in sorted(Workload.classes.items())
+        if cls is not Workload
+    ]
+
+  try:
+    return [Workload.classes[name] for name in names]
+  except KeyError as e:
+    raise ValueError("Unknown workload %s, known workloads: %s" %
+                     (e, ", ".join(sorted(Workload.classes))))
+
+
+def OpenDataStore(implementation, location=None):
+  """Replaces data_store.DB with a fresh instance of implementation.
+
+  Args:
+    implementation: The name of the data store class.
+    location: If set, the data store uses a Datastore.location named after
+        the implementation below this directory.
+
+  Returns:
+    The new data store.
+
+  Raises:
+    ValueError: If there is no such data store.
+  """
+  if location:
+    location = os.path.join(location, implementation)
+    if not os.path.isdir(location):
+      os.makedirs(location)
+    config_lib.CONFIG.Set("Datastore.location", location)
+
+  try:
+    cls = data_store.DataStore.GetPlugin(implementation)
+  except KeyError:
+    raise ValueError("No Storage System %s found." % implementation)
+
+  data_store.DB = cls()  # pylint: disable=g-bad-name
+  data_store.DB.Initialize()
+  return data_store.DB
+
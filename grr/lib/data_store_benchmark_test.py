@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Tests for grr.lib.data_store_benchmark."""
+
+
+import json
+
+from grr.lib import data_store_benchmark
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class DataStoreBenchmarkTest(test_lib.GRRBaseTest):
+
+  def testPercentile(self):
+    values = range(1, 101)
+    self.assertEqual(data_store_benchmark.Percentile(values, 50), 50)
+    self.assertEqual(data_store_benchmark.Percentile(values, 99), 99)
+    self.assertEqual(data_store_benchmark.Percentile([3], 99), 3)
+    self.assertEqual(data_store_benchmark.Percentile([], 50), 0.0)
+
+  def testGetWorkloads(self):
+    workloads = data_store_benchmark.GetWorkloads([])
+    self.assertNotIn(data_store_benchmark.Workload, workloads)
+    self.assertIn(data_store_benchmark.LockContentionWorkload, workloads)
+
+    self.assertEqual(
+        data_store_benchmark.GetWorkloads(["BlobWorkload"]),
+        [data_store_benchmark.BlobWorkload])
+    self.assertRaises(ValueError, data_store_benchmark.GetWorkloads,
+                      ["NonExistentWorkload"])
+
+  def testAllWorkloadsRun(self):
+    # Keep the workloads tiny, this only checks that they work.
+    benchmark = data_store_benchmark
+    with utils.MultiStubber(
+        (benchmark.QueueChurnWorkload, "CLIENT_COUNT", 2),
+        (benchmark.NotificationShardingWorkload, "SESSION_COUNT", 2),
+        (benchmark.ClientIndexWorkload, "CLIENT_COUNT", 5),
+        (benchmark.BlobWorkload, "BLOB_SIZE", 1024)):
+      runner = data_store_benchmark.BenchmarkRunner(
+          threads=2, operations=4, token=self.token)
+      results = [
+          (workload_cls, runner.RunWorkload(workload_cls))
+          for workload_cls in data_store_benchmark.GetWorkloads([])
+      ]
+
+    for workload_cls, result in results:
+      self.assertEqual(result["workload"], workload_cls.__name__)
+      self.assertEqual(result["operations"], 4)
+      self.assertEqual(result["errors"], 0, result["first_error"])
+      self.assertGreater(result["throughput"], 0)
+      self.assertLessEqual(result["latency_p50"], result["latency_p99"])
+      self.assertLessEqual(result["latency_p99"], result["latency_max"])
+      self.assertGreater(result["rss_bytes"], 0)
+      # Results have to be serializable so runs can be compared later.
+      self.assertEqual(json.loads(json.dumps(result))["workload"],
+                       workload_cls.__name__)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -29,6 +29,7 @@ from grr.lib import data_store
 from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import test_lib
 from grr.lib import threadpool
 from grr.lib import worker
@@ -1388,6 +1389,344 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     # Predicate
     self.assertEqual(results[0][0], predicate)
 
+  def testResolvePrefixPage(self):
+    predicates = ["metadata:%02d" % i for i in range(25)]
+    data_store.DB.MultiSet(
+        self.test_row, {p: ["value"]
+                        for p in predicates},
+        token=self.token)
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+      values, cursor = data_store.DB.ResolvePrefixPage(
+          self.test_row,
+          "metadata:",
+          timestamp=data_store.DB.ALL_TIMESTAMPS,
+          page_size=10,
+          cursor=cursor,
+          token=self.token)
+      pages += 1
+      self.assertLessEqual(len(values), 10)
+      seen.extend(v[0] for v in values)
+      if cursor is None:
+        break
+
+    self.assertEqual(pages, 3)
+    self.assertEqual(seen, predicates)
+
+  def testResolvePrefixIter(self):
+    predicate1 = "metadata:predicate1"
+    predicate2 = "metadata:predicate2"
+    for i in range(5):
+      data_store.DB.MultiSet(
+          self.test_row, {predicate1: [("v1_%d" % i, 1000 + i)],
+                          predicate2: [("v2_%d" % i, 2000 + i)]},
+          replace=False,
+          token=self.token)
+
+    result = list(
+        data_store.DB.ResolvePrefixIter(
+            self.test_row,
+            "metadata:",
+            timestamp=data_store.DB.ALL_TIMESTAMPS,
+            page_size=3,
+            token=self.token))
+
+    # Values are ordered by attribute and then by decreasing timestamp.
+    self.assertEqual(result, [(predicate1, "v1_%d" % i, 1000 + i)
+                              for i in reversed(range(5))] +
+                     [(predicate2, "v2_%d" % i, 2000 + i)
+                      for i in reversed(range(5))])
+
+    result = list(
+        data_store.DB.ResolvePrefixIter(
+            self.test_row,
+            "metadata:",
+            timestamp=(1002, 2001),
+            page_size=2,
+            token=self.token))
+    self.assertEqual(result, [(predicate1, "v1_4", 1004),
+                              (predicate1, "v1_3", 1003),
+                              (predicate1, "v1_2", 1002),
+                              (predicate2, "v2_1", 2001),
+                              (predicate2, "v2_0", 2000)])
+
+    result = list(
+        data_store.DB.ResolvePrefixIter(
+            self.test_row,
+            "metadata:",
+            timestamp=data_store.DB.NEWEST_TIMESTAMP,
+            page_size=1,
+            token=self.token))
+    self.assertEqual(result, [(predicate1, "v1_4", 1004),
+                              (predicate2, "v2_4", 2004)])
+
+    # Without a timestamp all versions are returned.
+    result = list(
+        data_store.DB.ResolvePrefixIter(
+            self.test_row, "metadata:", page_size=4, token=self.token))
+    self.assertEqual(len(result), 10)
+
+  def testMultiResolvePrefixIter(self):
+    subjects = ["aff4:/row:%d" % i for i in range(3)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.MultiSet(
+          subject, {"metadata:%d" % j: [j]
+                    for j in range(i + 2)},
+          token=self.token)
+
+    pages = list(
+        data_store.DB.MultiResolvePrefixIter(
+            subjects, "metadata:", page_size=2, token=self.token))
+
+    self.assertEqual([subject for subject, _ in pages], [
+        "aff4:/row:0", "aff4:/row:1", "aff4:/row:1", "aff4:/row:2",
+        "aff4:/row:2"
+    ])
+    for _, values in pages:
+      self.assertLessEqual(len(values), 2)
+
+  def testCheckAndMultiSet(self):
+    predicate1 = "metadata:predicate1"
+    predicate2 = "metadata:predicate2"
+
+    # None expects the attribute to be missing.
+    self.assertTrue(
+        data_store.DB.CheckAndMultiSet(
+            self.test_row, {predicate1: None}, {predicate1: ["v1"]},
+            timestamp=1000,
+            token=self.token))
+    self.assertFalse(
+        data_store.DB.CheckAndMultiSet(
+            self.test_row, {predicate1: None}, {predicate1: ["v2"]},
+            token=self.token))
+
+    current = data_store.DB.Resolve(
+        self.test_row, predicate1, token=self.token)
+    self.assertEqual(current, ("v1", 1000))
+
+    # Stale values or timestamps are rejected.
+    self.assertFalse(
+        data_store.DB.CheckAndMultiSet(
+            self.test_row, {predicate1: ("v0", 1000)}, {predicate1: ["v2"]},
+            token=self.token))
+    self.assertFalse(
+        data_store.DB.CheckAndMultiSet(
+            self.test_row, {predicate1: ("v1", 999)}, {predicate1: ["v2"]},
+            token=self.token))
+
+    self.assertTrue(
+        data_store.DB.CheckAndMultiSet(
+            self.test_row, {predicate1: current},
+            {predicate1: ["v2"],
+             predicate2: ["other"]},
+            timestamp=2000,
+            token=self.token))
+    # The new value replaces all old versions.
+    self.assertEqual(
+        list(
+            data_store.DB.ResolveMulti(
+                self.test_row, [predicate1],
+                timestamp=data_store.DB.ALL_TIMESTAMPS,
+                token=self.token)), [(predicate1, "v2", 2000)])
+
+    self.assertTrue(
+        data_store.DB.CheckAndMultiSet(
+            self.test_row, {predicate1: ("v2", 2000)}, {},
+            to_delete=[predicate2],
+            token=self.token))
+    self.assertEqual(
+        data_store.DB.Resolve(self.test_row, predicate2, token=self.token),
+        (None, 0))
+
+  def testFilterSubjects(self):
+    subjects = ["aff4:/filter/row%d" % i for i in range(5)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.MultiSet(
+          subject, {"aff4:size": [i * 10],
+                    "metadata:name": [u"file%d.txt" % i]},
+          token=self.token)
+    # A subject without the attributes never matches.
+    data_store.DB.Set(
+        "aff4:/filter/other", "metadata:other", "x", token=self.token)
+    candidates = subjects + ["aff4:/filter/other"]
+
+    def Filter(*predicates):
+      return data_store.DB.FilterSubjects(
+          candidates, predicates, token=self.token)
+
+    predicate_cls = data_store.QueryPredicate
+    self.assertEqual(
+        Filter(predicate_cls("aff4:size", predicate_cls.EQUAL, 20)),
+        [subjects[2]])
+    self.assertEqual(
+        Filter(predicate_cls("aff4:size", predicate_cls.RANGE, start=15)),
+        subjects[2:])
+    self.assertEqual(
+        Filter(
+            predicate_cls(
+                "aff4:size", predicate_cls.RANGE, start=10, end=30)),
+        subjects[1:4])
+    self.assertEqual(
+        Filter(predicate_cls("metadata:name", predicate_cls.PREFIX, "file3")),
+        [subjects[3]])
+
+    # All the predicates must hold.
+    self.assertEqual(
+        Filter(
+            predicate_cls("aff4:size", predicate_cls.RANGE, end=30),
+            predicate_cls("metadata:name", predicate_cls.PREFIX, "file4")), [])
+
+    # Data stores may leave regular expressions to the caller but must not
+    # drop matching subjects.
+    result = Filter(
+        predicate_cls("metadata:name", predicate_cls.REGEX, r"[13]\.txt$"))
+    self.assertTrue(set([subjects[1], subjects[3]]).issubset(result))
+
+    self.assertEqual(Filter(), candidates)
+
+  def _ResolveCached(self, subject):
+    return [(attribute, value)
+            for attribute, value, _ in data_store.DB.ResolvePrefix(
+                subject, "metadata:", token=self.token)]
+
+  def testAttributeCache(self):
+    subject = "aff4:/cached/row"
+    predicate = "metadata:predicate"
+    data_store.DB.EnableAttributeCache(
+        data_store.AttributeCache(100, [("aff4:/cached/", 60)]))
+    try:
+      with test_lib.FakeTime(1000):
+        data_store.DB.Set(subject, predicate, "hello", token=self.token)
+        data_store.DB.Flush()
+
+        hits = stats.STATS.GetMetricValue("datastore_attribute_cache_hits")
+        self.assertEqual(self._ResolveCached(subject), [(predicate, "hello")])
+        self.assertEqual(self._ResolveCached(subject), [(predicate, "hello")])
+        self.assertEqual(
+            stats.STATS.GetMetricValue("datastore_attribute_cache_hits"),
+            hits + 1)
+
+        # Local writes invalidate the subject.
+        data_store.DB.Set(subject, predicate, "world", token=self.token)
+        data_store.DB.Flush()
+        self.assertEqual(self._ResolveCached(subject), [(predicate, "world")])
+
+        with data_store.DB.GetMutationPool(token=self.token) as pool:
+          pool.DeleteAttributes(subject, [predicate])
+        self.assertEqual(self._ResolveCached(subject), [])
+
+        data_store.DB.Set(subject, predicate, "hello", token=self.token)
+        data_store.DB.Flush()
+        result = dict(
+            data_store.DB.MultiResolvePrefix(
+                [subject, self.test_row], "metadata:", token=self.token))
+        self.assertEqual([v for _, v, _ in result[subject]], ["hello"])
+        self.assertNotIn(self.test_row, result)
+
+      # Entries expire after their TTL.
+      misses = stats.STATS.GetMetricValue("datastore_attribute_cache_misses")
+      with test_lib.FakeTime(1000 + 61):
+        self.assertEqual(self._ResolveCached(subject), [(predicate, "hello")])
+      self.assertGreater(
+          stats.STATS.GetMetricValue("datastore_attribute_cache_misses"),
+          misses)
+
+      # Subjects outside the configured prefixes are never cached.
+      misses = stats.STATS.GetMetricValue("datastore_attribute_cache_misses")
+      hits = stats.STATS.GetMetricValue("datastore_attribute_cache_hits")
+      data_store.DB.ResolvePrefix(self.test_row, "metadata:", token=self.token)
+      data_store.DB.ResolvePrefix(self.test_row, "metadata:", token=self.token)
+      self.assertEqual(
+          stats.STATS.GetMetricValue("datastore_attribute_cache_misses"),
+          misses)
+      self.assertEqual(
+          stats.STATS.GetMetricValue("datastore_attribute_cache_hits"), hits)
+    finally:
+      data_store.DB.DisableAttributeCache()
+      data_store.DB.DeleteSubject(subject, token=self.token)
+
+  def _LatencyCount(self, method):
+    return stats.STATS.GetMetricValue(
+        "datastore_latency",
+        fields=[method, data_store.DB.__class__.__name__]).count
+
+  def testLatencyMetrics(self):
+    sets = self._LatencyCount("MultiSet")
+    resolves = self._LatencyCount("ResolvePrefix")
+    scans = self._LatencyCount("ScanAttributes")
+
+    data_store.DB.MultiSet(
+        self.test_row, {"metadata:predicate": ["hello"]}, token=self.token)
+    data_store.DB.Flush()
+    data_store.DB.ResolvePrefix(self.test_row, "metadata:", token=self.token)
+    scan = data_store.DB.ScanAttributes(
+        "aff4:/", ["metadata:predicate"], token=self.token)
+
+    # Scans are recorded once they have been consumed.
+    self.assertEqual(self._LatencyCount("ScanAttributes"), scans)
+    list(scan)
+
+    self.assertEqual(self._LatencyCount("MultiSet"), sets + 1)
+    self.assertEqual(self._LatencyCount("ResolvePrefix"), resolves + 1)
+    self.assertEqual(self._LatencyCount("ScanAttributes"), scans + 1)
+
+  def testOnlyOutermostCallIsRecorded(self):
+    data_store.DB.MultiSet(
+        self.test_row, {"metadata:predicate": ["hello"]}, token=self.token)
+    pages = self._LatencyCount("ResolvePrefixPage")
+    resolves = self._LatencyCount("ResolvePrefix")
+
+    data_store.DB.ResolvePrefixPage(
+        self.test_row, "metadata:", token=self.token)
+
+    self.assertEqual(self._LatencyCount("ResolvePrefixPage"), pages + 1)
+    self.assertEqual(self._LatencyCount("ResolvePrefix"), resolves)
+
+  def testSlowQueryLog(self):
+    data_store.DB.slow_query_threshold = 1e-9
+    try:
+      with mock.patch.object(logging, "warning") as warning:
+        data_store.DB.MultiSet(
+            self.test_row, {"metadata:predicate": ["hello"]},
+            token=self.token)
+    finally:
+      data_store.DB.slow_query_threshold = 0
+
+    calls = [
+        c for c in warning.call_args_list
+        if "MultiSet" in c[0] and "data_store_test.py" in c[0][-2]
+    ]
+    self.assertTrue(calls)
+    # Subject, number of attributes and rows.
+    self.assertEqual(calls[0][0][4:7], (self.test_row, 1, None))
+
+  def testSlowQueryLogCountsMultiResolvePrefixRows(self):
+    subjects = ["aff4:/row:%d" % i for i in range(2)]
+    for i, subject in enumerate(subjects):
+      data_store.DB.MultiSet(
+          subject, {"metadata:%d" % j: ["hello"]
+                    for j in range(i + 1)},
+          token=self.token)
+
+    data_store.DB.slow_query_threshold = 1e-9
+    try:
+      with mock.patch.object(logging, "warning") as warning:
+        results = list(
+            data_store.DB.MultiResolvePrefix(
+                subjects, "metadata:", token=self.token))
+    finally:
+      data_store.DB.slow_query_threshold = 0
+
+    self.assertEqual(len(results), 2)
+    calls = [
+        c for c in warning.call_args_list if "MultiResolvePrefix" in c[0]
+    ]
+    self.assertTrue(calls)
+    self.assertEqual(calls[0][0][6], 3)
+
   def testResolveMulti(self):
     """Test regex Multi Resolving works."""
     subject = "aff4:/resolve_multi"
@@ -1783,12 +2122,14 @@ class _DataStoreTest(test_lib.GRRBaseTest):
   def testApi(self):
     api = [
         "DeleteAttributes", "MultiDeleteAttributes", "DeleteSubject",
-        "DeleteSubjects", "MultiResolvePrefix", "MultiSet", "Resolve",
-        "ResolveMulti", "ResolvePrefix", "ScanAttribute", "ScanAttributes",
-        "Set", "DBSubjectLock"
+        "DeleteSubjects", "MultiResolvePrefix", "MultiSet",
+        "MultiSubjectMutate", "Resolve", "ResolveMulti", "ResolvePrefix",
+        "ResolvePrefixPage", "ScanAttribute", "ScanAttributes", "Set",
+        "DBSubjectLock"
     ]
 
-    implementation = data_store.DB
+    # The instance methods are wrapped for metrics, so look at the class.
+    implementation = data_store.DB.__class__
     reference = data_store.DataStore
 
     for f in api:
@@ -1859,6 +2200,28 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     self.assertEqual(stored, "hello")
     self.assertEqual(type(stored), str)
 
+  def testPoolUpdateIndex(self):
+    pool = data_store.DB.GetMutationPool(token=self.token)
+    pool.UpdateIndex(self.test_row, {"index:dir/a": ["X"]})
+    pool.UpdateIndex(self.test_row, {"index:dir/b": ["X"]})
+    pool.UpdateIndex(self.test_row, {"index:dir/a": ["X"]})
+
+    # Writes to the same subject are merged.
+    self.assertEqual(pool.Size(), 1)
+
+    stored, _ = data_store.DB.Resolve(
+        self.test_row, "index:dir/a", token=self.token)
+    self.assertIsNone(stored)
+
+    pool.Flush()
+
+    self.assertEqual(pool.Size(), 0)
+    result = data_store.DB.ResolvePrefix(
+        self.test_row, "index:dir/", token=self.token)
+    self.assertEqual(
+        sorted(attribute for attribute, _, _ in result),
+        ["index:dir/a", "index:dir/b"])
+
   @DeletionTest
   def testPoolDeleteAttributes(self):
     predicate = "metadata:predicate"
@@ -1884,6 +2247,61 @@ class _DataStoreTest(test_lib.GRRBaseTest):
         self.test_row, predicate, token=self.token)
     self.assertIsNone(stored)
 
+  @DeletionTest
+  def testMultiSubjectMutate(self):
+    predicate = "metadata:predicate"
+    for i in range(3):
+      data_store.DB.Set(
+          "aff4:/row:%d" % i, predicate, "old%d" % i, token=self.token)
+
+    data_store.DB.MultiSubjectMutate(
+        delete_subjects=["aff4:/row:0"],
+        delete_attributes=[("aff4:/row:1", [predicate], None, None)],
+        set_requests=[("aff4:/row:%d" % i, {
+            "aff4:size": [i]
+        }, None, True, None) for i in range(3, 10)] +
+        [("aff4:/row:2", {
+            predicate: ["new2"]
+        }, None, True, None)],
+        token=self.token)
+
+    for i in range(2):
+      stored, _ = data_store.DB.Resolve(
+          "aff4:/row:%d" % i, predicate, token=self.token)
+      self.assertIsNone(stored)
+
+    stored, _ = data_store.DB.Resolve(
+        "aff4:/row:2", predicate, token=self.token)
+    self.assertEqual(stored, "new2")
+    self.assertEqual(
+        len(
+            data_store.DB.ResolvePrefix(
+                "aff4:/row:2",
+                predicate,
+                timestamp=data_store.DB.ALL_TIMESTAMPS,
+                token=self.token)), 1)
+
+    for i in range(3, 10):
+      stored, _ = data_store.DB.Resolve(
+          "aff4:/row:%d" % i, "aff4:size", token=self.token)
+      self.assertEqual(stored, i)
+
+  @DeletionTest
+  def testPoolDeleteSubjectThenSet(self):
+    predicate = "metadata:predicate"
+    data_store.DB.Set(self.test_row, predicate, "hello", token=self.token)
+
+    with data_store.DB.GetMutationPool(token=self.token) as pool:
+      pool.DeleteSubject(self.test_row)
+      pool.Set(self.test_row, "aff4:size", 1)
+
+    stored, _ = data_store.DB.Resolve(
+        self.test_row, predicate, token=self.token)
+    self.assertIsNone(stored)
+    stored, _ = data_store.DB.Resolve(
+        self.test_row, "aff4:size", token=self.token)
+    self.assertEqual(stored, 1)
+
 
 class DataStoreCSVBenchmarks(test_lib.MicroBenchmarks):
   """Long running benchmarks where the results are dumped to a CSV file.
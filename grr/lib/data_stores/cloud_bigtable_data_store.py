@@ -314,7 +314,7 @@ class CloudBigTableDataStore(data_store.DataStore):
   def GetFamilyColumn(self, attribute):
     return utils.SmartStr(attribute).split(":", 1)
 
-  def _DeleteAllTimeStamps(self, row, attribute_list):
+  def _DeleteAllTimeStamps(self, row, attribute_list, **kwargs):
     """Add delete mutations to row, but don't commit."""
     delete_dict = {}
     # Group column families together so we can use delete_cells
@@ -322,7 +322,7 @@ class CloudBigTableDataStore(data_store.DataStore):
       family, column = self.GetFamilyColumn(attribute)
       delete_dict.setdefault(family, []).append(column)
     for family, column in delete_dict.iteritems():
-      row.delete_cells(family, column)
+      row.delete_cells(family, column, **kwargs)
 
   def Set(self,
           subject,
@@ -350,15 +350,26 @@ class CloudBigTableDataStore(data_store.DataStore):
                token=None):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
     row = self.table.row(utils.SmartStr(subject))
+    self._AddSetMutations(row, values, timestamp, replace, to_delete)
+
+    if sync:
+      self.CallWithRetry(row.commit, "write")
+    else:
+      self.pool.map_async(self._WrapCallWithRetry,
+                          [((row.commit, "write"), {})])
+
+  def _AddSetMutations(self, row, values, timestamp, replace, to_delete,
+                       **kwargs):
+    """Add the mutations of a MultiSet() to row, but don't commit."""
     if to_delete:
-      self._DeleteAllTimeStamps(row, to_delete)
+      self._DeleteAllTimeStamps(row, to_delete, **kwargs)
 
     for attribute, value_list in values.items():
       # Attributes must be strings
       family, column = self.GetFamilyColumn(attribute)
 
       if replace:
-        row.delete_cell(family, column)
+        row.delete_cell(family, column, **kwargs)
 
       for value in value_list:
         element_timestamp = timestamp
@@ -377,13 +388,70 @@ class CloudBigTableDataStore(data_store.DataStore):
         # string:
         # https://googlecloudplatform.github.io/google-cloud-python/stable/bigtable-row.html#google.cloud.bigtable.row.DirectRow.set_cell
         value = self.Encode(attribute, value)
-        row.set_cell(family, column, value, timestamp=datetime_ts)
+        row.set_cell(family, column, value, timestamp=datetime_ts, **kwargs)
 
-    if sync:
-      self.CallWithRetry(row.commit, "write")
+  def _ExpectationViolatedFilter(self, attribute, expected):
+    """Returns a filter matching the newest cell of attribute if unexpected."""
+    family, column = self.GetFamilyColumn(attribute)
+    newest = [
+        row_filters.ColumnRangeFilter(
+            family, start_column=column, end_column=column),
+        row_filters.CellsColumnLimitFilter(1)
+    ]
+    if expected is None:
+      # Any value is unexpected.
+      return row_filters.RowFilterChain(filters=newest)
+
+    value, timestamp = expected
+    value = self.Encode(attribute, value)
+    # Bigtable can only handle ms precision.
+    timestamp = long(timestamp)
+    timestamp -= timestamp % 1000
+    mismatch = row_filters.RowFilterUnion(filters=[
+        row_filters.ValueRangeFilter(end_value=value, inclusive_end=False),
+        row_filters.ValueRangeFilter(start_value=value, inclusive_start=False),
+        row_filters.TimestampRangeFilter(
+            row_filters.TimestampRange(
+                end=self.DatetimeFromMicroseconds(timestamp))),
+        row_filters.TimestampRangeFilter(
+            row_filters.TimestampRange(
+                start=self.DatetimeFromMicroseconds(timestamp + 1000)))
+    ])
+    return row_filters.RowFilterChain(filters=newest + [mismatch])
+
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Checks and sets with a single conditional row mutation."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if not expected_values:
+      self.MultiSet(
+          subject,
+          new_values,
+          timestamp=timestamp,
+          to_delete=to_delete,
+          token=token)
+      return True
+
+    violations = [
+        self._ExpectationViolatedFilter(utils.SmartStr(attribute), expected)
+        for attribute, expected in expected_values.iteritems()
+    ]
+    if len(violations) > 1:
+      violated = row_filters.RowFilterUnion(filters=violations)
     else:
-      self.pool.map_async(self._WrapCallWithRetry,
-                          [((row.commit, "write"), {})])
+      violated = violations[0]
+
+    # state=False mutations are only applied if the filter matches no cell,
+    # that is if every expectation holds.
+    row = self.table.row(utils.SmartStr(subject), filter_=violated)
+    self._AddSetMutations(
+        row, new_values, timestamp, True, to_delete, state=False)
+    return not self.CallWithRetry(row.commit, "write")
 
   def DeleteAttributes(self,
                        subject,
@@ -652,6 +720,73 @@ class CloudBigTableDataStore(data_store.DataStore):
             result.row_key], self._SortResultsByAttrTimestampValue(
                 subject_results)
 
+  def _PredicateToValueFilter(self, predicate):
+    """Returns a row filter for the value of a predicate or None."""
+    if predicate.operator == data_store.QueryPredicate.EQUAL:
+      value = structs.VarintEncode(int(predicate.value))
+      return row_filters.ValueRangeFilter(start_value=value, end_value=value)
+
+    elif predicate.operator == data_store.QueryPredicate.PREFIX:
+      start = utils.SmartStr(predicate.value)
+      # The smallest value which does not start with the prefix.
+      end = start.rstrip("\xff")
+      if end:
+        end = end[:-1] + chr(ord(end[-1]) + 1)
+      return row_filters.ValueRangeFilter(
+          start_value=start, end_value=end or None, inclusive_end=False)
+
+    # Integers are varint encoded so their byte order is not their numeric
+    # order, and RE2 does not follow python regex semantics. Both are left to
+    # the caller.
+    return None
+
+  def FilterSubjects(self, subjects, predicates, token=None):
+    """Evaluates equality and prefix predicates using row filters."""
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(token, subjects, "r")
+
+    # A row filter can not tell which of several conditions on the same
+    # column matched, so only the first one per attribute is pushed.
+    value_filters = {}
+    for predicate in predicates:
+      value_filter = self._PredicateToValueFilter(predicate)
+      if value_filter is not None:
+        value_filters.setdefault(predicate.attribute, value_filter)
+
+    if not value_filters or not subjects:
+      return subjects
+
+    # Each chain keeps the newest cell of an attribute only if its value
+    # matches, so a row matches when all the attributes are returned.
+    filter_union = []
+    for attribute, value_filter in value_filters.iteritems():
+      family, column = self.GetFamilyColumn(attribute)
+      col_filter = row_filters.ColumnRangeFilter(
+          family, start_column=column, end_column=column)
+      latest_value = row_filters.CellsColumnLimitFilter(1)
+      filter_union.append(
+          row_filters.RowFilterChain(
+              filters=[col_filter, latest_value, value_filter]))
+
+    if len(filter_union) > 1:
+      row_filter = row_filters.RowFilterUnion(filters=filter_union)
+    else:
+      row_filter = filter_union[0]
+
+    pool_args = []
+    for subject in subjects:
+      pool_args.append(((self.table.read_row, "read", utils.SmartStr(subject)),
+                        {
+                            "filter_": row_filter
+                        }))
+
+    matching = set()
+    for result in self.pool.imap_unordered(self._WrapCallWithRetry, pool_args):
+      if result and set(value_filters).issubset(result.to_dict()):
+        matching.add(result.row_key)
+
+    return [s for s in subjects if utils.SmartStr(s) in matching]
+
   @utils.Synchronized
   def Flush(self):
     """Wait for threadpool jobs to finish, then make a new pool."""
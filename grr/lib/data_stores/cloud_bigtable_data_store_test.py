@@ -184,6 +184,33 @@ class CloudBigTableDataStoreTest(test_lib.GRRBaseTest):
       # 1 failure == 1 sleep
       self.assertEqual(mock_time.call_count, 1)
 
+  def testCheckAndMultiSetIsAConditionalMutation(self):
+    row = self.db.table.row.return_value
+    expected_values = {
+        "aff4:lease": None,
+        "aff4:owner": ("worker1", 1477415013716000)
+    }
+
+    # No cell violated the expectations, the values were written.
+    row.commit.return_value = False
+    self.assertTrue(
+        self.db.CheckAndMultiSet(
+            "aff4:/subject",
+            expected_values, {"aff4:owner": ["worker2"]},
+            token=self.token))
+
+    self.assertIsNotNone(self.db.table.row.call_args[1]["filter_"])
+    self.assertTrue(row.set_cell.called)
+    for call in row.set_cell.call_args_list + row.delete_cell.call_args_list:
+      self.assertIs(call[1]["state"], False)
+
+    row.commit.return_value = True
+    self.assertFalse(
+        self.db.CheckAndMultiSet(
+            "aff4:/subject",
+            expected_values, {"aff4:owner": ["worker2"]},
+            token=self.token))
+
   def testTimestampRangeFromTupleNoStart(self):
     result = self.db._TimestampRangeFromTuple((None, 1477415013716002))
     self.assertEqual(result.start, None)
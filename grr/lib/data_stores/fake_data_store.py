@@ -150,6 +150,29 @@ class FakeDataStore(data_store.DataStore):
                  replace=replace,
                  sync=sync)
 
+  @utils.Synchronized
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Checks and sets while holding the store lock."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    current_values = self._ResolveNewestValues(subject, expected_values, token)
+    if not self._ExpectedValuesMatch(expected_values, current_values):
+      return False
+
+    self.MultiSet(
+        subject,
+        new_values,
+        timestamp=timestamp,
+        replace=True,
+        to_delete=to_delete,
+        token=token)
+    return True
+
   @utils.Synchronized
   def DeleteAttributes(self,
                        subject,
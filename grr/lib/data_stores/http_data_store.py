@@ -467,6 +467,8 @@ class HTTPDataStore(data_store.DataStore):
   cache = None
   inquirer = None
 
+  NATIVE_RESOLVE_PREFIX_PAGE = True
+
   def __init__(self):
     super(HTTPDataStore, self).__init__()
     self.cache = RemoteMappingCache(1000)
@@ -539,6 +541,15 @@ class HTTPDataStore(data_store.DataStore):
                        token=None):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
+    request = self._MakeDeleteAttributesRequest(subject, attributes, start, end,
+                                                sync, token)
+
+    typ = rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def _MakeDeleteAttributesRequest(self, subject, attributes, start, end, sync,
+                                   token):
+    """Builds the request used to delete attributes from a subject."""
     request = rdf_data_store.DataStoreRequest(subject=[subject])
 
     if isinstance(attributes, basestring):
@@ -563,8 +574,7 @@ class HTTPDataStore(data_store.DataStore):
     for attr in attributes:
       request.values.Append(attribute=attr)
 
-    typ = rdf_data_server.DataStoreCommand.Command.DELETE_ATTRIBUTES
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
 
   def DeleteSubject(self, subject, sync=False, token=None):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
@@ -576,6 +586,58 @@ class HTTPDataStore(data_store.DataStore):
     typ = rdf_data_server.DataStoreCommand.Command.DELETE_SUBJECT
     self._MakeRequestSyncOrAsync(request, typ, sync)
 
+  def MultiSubjectMutate(self,
+                         delete_subjects=None,
+                         delete_attributes=None,
+                         set_requests=None,
+                         sync=True,
+                         token=None):
+    """Apply mutations to many subjects with one request per data server."""
+    delete_subjects = delete_subjects or []
+    delete_attributes = delete_attributes or []
+    set_requests = set_requests or []
+
+    subjects = set(delete_subjects)
+    subjects.update(req[0] for req in delete_attributes)
+    subjects.update(req[0] for req in set_requests)
+    if not subjects:
+      return
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    token = token or data_store.default_token
+    mutation_type = rdf_data_store.DataStoreMutation.Type
+    # Maps data servers to their batched request. The first subject added to a
+    # batch is used to route the request to its data server.
+    batches = {}
+
+    def _AddMutation(subject, typ, mutation_request):
+      server = self.cache.Get(subject)
+      if server not in batches:
+        batch_request = rdf_data_store.DataStoreRequest(
+            subject=[subject], sync=sync)
+        if token:
+          batch_request.token = token
+        batches[server] = batch_request
+      batches[server].mutations.Append(type=typ, request=mutation_request)
+
+    for subject in delete_subjects:
+      _AddMutation(subject, mutation_type.DELETE_SUBJECT,
+                   rdf_data_store.DataStoreRequest(subject=[subject]))
+
+    for subject, attributes, start, end in delete_attributes:
+      _AddMutation(subject, mutation_type.DELETE_ATTRIBUTES,
+                   self._MakeDeleteAttributesRequest(subject, attributes, start,
+                                                     end, sync, None))
+
+    for subject, values, timestamp, replace, to_delete in set_requests:
+      _AddMutation(subject, mutation_type.MULTI_SET,
+                   self._MakeMultiSetRequest(subject, values, timestamp,
+                                             replace, sync, to_delete, None))
+
+    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SUBJECT_MUTATE
+    for request in batches.itervalues():
+      self._MakeRequestSyncOrAsync(request, typ, sync)
+
   def _MakeRequest(self,
                    subjects,
                    attributes,
@@ -637,6 +699,36 @@ class HTTPDataStore(data_store.DataStore):
         results[subject] = values
     return results.iteritems()
 
+  def ResolvePrefixPage(self,
+                        subject,
+                        attribute_prefix,
+                        timestamp=None,
+                        page_size=None,
+                        cursor=None,
+                        token=None):
+    """Fetch one page of a subject's row from its data server."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attribute_prefix))
+
+    request = self._MakeRequest(
+        [subject],
+        attribute_prefix,
+        timestamp=timestamp,
+        token=token,
+        limit=page_size or self.RESOLVE_PREFIX_PAGE_SIZE)
+    if cursor:
+      request.cursor = cursor
+
+    typ = rdf_data_server.DataStoreCommand.Command.RESOLVE_PREFIX_PAGE
+    response = self._MakeSyncRequest(request, typ)
+
+    values = []
+    if response.results:
+      values = [(pred, self._Decode(value), ts)
+                for (pred, value, ts) in response.results[0].payload]
+
+    return values, response.cursor or None
+
   def ScanAttributes(self,
                      subject_prefix,
                      attributes,
@@ -687,8 +779,41 @@ class HTTPDataStore(data_store.DataStore):
     """MultiSet."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
-    request = rdf_data_store.DataStoreRequest(sync=sync)
     token = token or data_store.default_token
+    request = self._MakeMultiSetRequest(subject, values, timestamp, replace,
+                                        sync, to_delete, token)
+
+    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SET
+    self._MakeRequestSyncOrAsync(request, typ, sync)
+
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Checks and sets on the data server in a single request."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    token = token or data_store.default_token
+    request = self._MakeMultiSetRequest(subject, dict(new_values), timestamp,
+                                        True, True, to_delete, token)
+    for attribute, expected in expected_values.iteritems():
+      expected_value = request.expected_values.Append(
+          attribute=utils.SmartUnicode(attribute))
+      if expected is not None:
+        value, ts = expected
+        expected_value.value.SetValue(value)
+        expected_value.timestamp = self.TimestampSpecFromTimestamp(ts)
+
+    typ = rdf_data_server.DataStoreCommand.Command.CHECK_AND_MULTI_SET
+    return bool(self._MakeSyncRequest(request, typ).applied)
+
+  def _MakeMultiSetRequest(self, subject, values, timestamp, replace, sync,
+                           to_delete, token):
+    """Builds the request used to set attributes on a subject."""
+    request = rdf_data_store.DataStoreRequest(sync=sync)
     if token:
       request.token = token
 
@@ -728,8 +853,7 @@ class HTTPDataStore(data_store.DataStore):
         if v is not None:
           new_value.value.SetValue(v)
 
-    typ = rdf_data_server.DataStoreCommand.Command.MULTI_SET
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return request
 
   def ResolveMulti(self,
                    subject,
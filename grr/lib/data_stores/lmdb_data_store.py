@@ -0,0 +1,704 @@
+#!/usr/bin/env python
+"""A single file data store based on the LMDB key/value store.
+
+All values live in one memory mapped LMDB environment under
+Datastore.location. Every value is stored under the key
+
+  subject \\x00 predicate \\x00 inverted timestamp
+
+so the values of a subject are contiguous, grouped by predicate and newest
+first within each predicate. Prefix scans are therefore ordered range reads on
+the memory mapped pages and need no query parsing at all.
+
+LMDB limits the size of keys, so subjects and predicates which are too long
+are shortened to a prefix followed by a hash. The full predicate is then kept
+with the value and the full subject in a separate table. Such entries still
+sort by their prefix but not strictly by their full name.
+"""
+
+
+import hashlib
+import os
+import struct
+import thread
+import time
+
+import lmdb
+
+from grr.lib import aff4
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import utils
+
+# Separates the subject, predicate and timestamp parts of a key.
+SEPARATOR = "\x00"
+# Marks subjects and predicates which have been shortened to fit in a key.
+HASH_MARKER = "\x01"
+# 40 hex digits of the SHA1 hash and the marker.
+HASH_LENGTH = 41
+
+# Two shortened names, the separators and the timestamp must fit in the
+# 511 bytes LMDB allows for a key by default.
+MAX_SUBJECT_KEY = 240
+MAX_PREDICATE_KEY = 240
+
+MAX_TIMESTAMP = 2**64 - 1
+TIMESTAMP = struct.Struct(">Q")
+# Sorts after every timestamp of a predicate.
+AFTER_ALL_TIMESTAMPS = "\xff" * (TIMESTAMP.size + 1)
+
+# Value tags. Lower case tags mark values which are prefixed by the full
+# predicate name because the predicate was shortened in the key.
+INTEGER_TAG = "I"
+BYTES_TAG = "B"
+
+# Number of subjects read in a single transaction by ScanAttributes.
+SCAN_BATCH_SIZE = 1000
+
+
+def _ShortKey(name, max_length):
+  if len(name) <= max_length:
+    return name
+  return (name[:max_length - HASH_LENGTH] + HASH_MARKER +
+          hashlib.sha1(name).hexdigest())
+
+
+def _SearchKey(prefix, max_length):
+  """Returns the key prefix under which all names starting with prefix are."""
+  return prefix[:max_length - HASH_LENGTH]
+
+
+class LmdbDataStore(data_store.DataStore):
+  """A memory mapped data store using the LMDB database."""
+
+  env = None
+
+  NATIVE_RESOLVE_PREFIX_PAGE = True
+
+  def __init__(self, path=None):
+    self._CalculateAttributeStorageTypes()
+    self.root_path = path or config_lib.CONFIG.Get("Datastore.location")
+    self._OpenEnvironment()
+    super(LmdbDataStore, self).__init__()
+
+  def _OpenEnvironment(self):
+    try:
+      if not os.path.isdir(self.root_path):
+        os.makedirs(self.root_path)
+    except OSError:
+      # Directory was created after the if.
+      pass
+
+    # Durability is provided by Flush() which the flusher thread calls
+    # regularly, like the SQLite data store with synchronous = OFF.
+    self.env = lmdb.open(
+        self.root_path,
+        map_size=config_lib.CONFIG["LmdbDatastore.map_size"],
+        max_readers=config_lib.CONFIG["LmdbDatastore.max_readers"],
+        max_dbs=3,
+        sync=False,
+        metasync=False)
+    self.data_db = self.env.open_db("data")
+    self.subjects_db = self.env.open_db("subjects")
+    self.locks_db = self.env.open_db("locks")
+
+  def _CalculateAttributeStorageTypes(self):
+    """Build a mapping between column names and types."""
+    self._attribute_types = {}
+
+    for attribute in aff4.Attribute.PREDICATES.values():
+      self._attribute_types[attribute.predicate] = (
+          attribute.attribute_type.data_store_type)
+
+  def _Encode(self, value):
+    """Returns the tag and the serialized form of the value."""
+    try:
+      return BYTES_TAG, value.SerializeToString()
+    except AttributeError:
+      if isinstance(value, (int, long)):
+        return INTEGER_TAG, str(value)
+      else:
+        # Types "string" and "bytes" are stored as strings here.
+        return BYTES_TAG, utils.SmartStr(value)
+
+  def _Decode(self, attribute, value):
+    required_type = self._attribute_types.get(attribute, "bytes")
+    if required_type in ("integer", "unsigned_integer"):
+      return int(value)
+    elif required_type == "string":
+      return utils.SmartUnicode(value)
+    else:
+      return value
+
+  def _EncodeRecord(self, predicate, predicate_key, value):
+    tag, data = self._Encode(value)
+    if predicate_key != predicate:
+      return tag.lower() + predicate + SEPARATOR + data
+    return tag + data
+
+  def _DecodeRecord(self, predicate_key, record):
+    """Returns the predicate and the value of a stored record."""
+    tag, data = record[0], record[1:]
+    predicate = predicate_key
+    if tag.islower():
+      predicate, data = data.split(SEPARATOR, 1)
+      tag = tag.upper()
+    if tag == INTEGER_TAG:
+      data = int(data)
+    return predicate, self._Decode(predicate, data)
+
+  def _SubjectKey(self, subject):
+    return _ShortKey(utils.SmartStr(subject), MAX_SUBJECT_KEY)
+
+  def _ColumnKey(self, subject_key, predicate):
+    predicate_key = _ShortKey(utils.SmartStr(predicate), MAX_PREDICATE_KEY)
+    return subject_key + SEPARATOR + predicate_key + SEPARATOR
+
+  def _PackTimestamp(self, timestamp):
+    # Newer values sort first.
+    return TIMESTAMP.pack(MAX_TIMESTAMP - max(0, long(timestamp)))
+
+  def _UnpackTimestamp(self, key):
+    return MAX_TIMESTAMP - TIMESTAMP.unpack(key[-TIMESTAMP.size:])[0]
+
+  def _GetStartEndTimestamp(self, timestamp):
+    if timestamp in [None, self.ALL_TIMESTAMPS, self.NEWEST_TIMESTAMP]:
+      return 0, (2**63) - 1
+    elif isinstance(timestamp, (list, tuple)):
+      start, end = timestamp  # pylint: disable=unpacking-non-sequence
+      return int(start), int(end)
+    else:
+      return int(timestamp), int(timestamp)
+
+  def _FullSubject(self, txn, subject_key):
+    if HASH_MARKER not in subject_key:
+      return subject_key
+    return txn.get(subject_key, db=self.subjects_db) or subject_key
+
+  def _IterColumns(self,
+                   txn,
+                   search_key,
+                   start,
+                   end,
+                   newest=False,
+                   after=None):
+    """Yields (predicate, value, timestamp) for all keys under search_key.
+
+    Args:
+      txn: The transaction to read in.
+      search_key: The prefix of all keys to read.
+      start: Only values not older than this are returned.
+      end: Only values not newer than this are returned.
+      newest: If True only the newest value of each predicate is returned and
+          start and end are ignored.
+      after: If set, only keys after this key are read.
+
+    Yields:
+      Triples of (predicate, value, timestamp) in key order.
+    """
+    if not newest and end < max(start, 0):
+      return
+
+    cursor = txn.cursor(db=self.data_db)
+    cursor.set_range(max(search_key, after or ""))
+    while True:
+      key = cursor.key()
+      if not key.startswith(search_key):
+        return
+
+      column = key[:-TIMESTAMP.size]
+      timestamp = self._UnpackTimestamp(key)
+      if not newest:
+        if timestamp > end:
+          cursor.set_range(column + self._PackTimestamp(end))
+          continue
+        if timestamp < start:
+          cursor.set_range(column + AFTER_ALL_TIMESTAMPS)
+          continue
+
+      predicate_key = column[column.index(SEPARATOR) + 1:-1]
+      predicate, value = self._DecodeRecord(predicate_key, cursor.value())
+      yield predicate, value, timestamp
+
+      if newest:
+        cursor.set_range(column + AFTER_ALL_TIMESTAMPS)
+      else:
+        cursor.next()
+
+  def _IterPrefixes(self,
+                    txn,
+                    subject_key,
+                    prefixes,
+                    timestamp,
+                    after=None):
+    """Yields the values of all predicates matching any of the prefixes."""
+    start, end = self._GetStartEndTimestamp(timestamp)
+    newest = timestamp == self.NEWEST_TIMESTAMP
+
+    # Drop prefixes covered by a shorter one so the key ranges we read are
+    # disjoint and come out in key order.
+    search_keys = []
+    for search_key in sorted(
+        set(_SearchKey(p, MAX_PREDICATE_KEY) for p in prefixes)):
+      if not search_keys or not search_key.startswith(search_keys[-1]):
+        search_keys.append(search_key)
+
+    for search_key in search_keys:
+      for predicate, value, ts in self._IterColumns(
+          txn,
+          subject_key + SEPARATOR + search_key,
+          start,
+          end,
+          newest=newest,
+          after=after):
+        for prefix in prefixes:
+          if predicate.startswith(prefix):
+            yield predicate, value, ts
+            break
+
+  def _MultiSet(self, txn, subject, values, timestamp, replace, to_delete):
+    """Writes the values for a subject in an open transaction."""
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = time.time() * 1000000
+
+    subject = utils.SmartStr(subject)
+    subject_key = self._SubjectKey(subject)
+    if subject_key != subject:
+      txn.put(subject_key, subject, db=self.subjects_db)
+
+    to_delete = set(to_delete or [])
+    if replace:
+      to_delete.update(values.keys())
+
+    if to_delete:
+      self._DeleteAttributes(txn, subject, to_delete, None, None)
+
+    for attribute, seq in values.items():
+      attribute = utils.SmartStr(attribute)
+      column = self._ColumnKey(subject_key, attribute)
+      predicate_key = column[len(subject_key) + 1:-1]
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        txn.put(
+            column + self._PackTimestamp(element_timestamp),
+            self._EncodeRecord(attribute, predicate_key, v),
+            db=self.data_db)
+
+  def _DeleteAttributes(self, txn, subject, attributes, start, end):
+    """Removes attributes in an open transaction."""
+    start = start or 0
+    if end is None:
+      end = (2**63) - 1  # sys.maxint
+
+    subject_key = self._SubjectKey(subject)
+    cursor = txn.cursor(db=self.data_db)
+    for attribute in attributes:
+      column = self._ColumnKey(subject_key, attribute)
+      # Newer values come first so we start at the end of the range.
+      cursor.set_range(column + self._PackTimestamp(end))
+      while True:
+        key = cursor.key()
+        if not key.startswith(column) or self._UnpackTimestamp(key) < start:
+          break
+        # This moves the cursor to the next key.
+        cursor.delete()
+
+  def _DeleteSubject(self, txn, subject):
+    subject_key = self._SubjectKey(subject)
+    prefix = subject_key + SEPARATOR
+    cursor = txn.cursor(db=self.data_db)
+    cursor.set_range(prefix)
+    while cursor.key().startswith(prefix):
+      cursor.delete()
+    txn.delete(subject_key, db=self.subjects_db)
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None,
+               token=None):
+    """Set multiple values at once."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    _ = sync
+
+    with self.env.begin(write=True) as txn:
+      self._MultiSet(txn, subject, values, timestamp, replace, to_delete)
+
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Checks and sets in a single write transaction."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    subject_key = self._SubjectKey(subject)
+
+    # There is only one writer at a time so nothing can change the values
+    # between the check and the write.
+    with self.env.begin(write=True) as txn:
+      current_values = {}
+      for attribute in expected_values:
+        for _, value, ts in self._IterColumns(
+            txn,
+            self._ColumnKey(subject_key, utils.SmartStr(attribute)),
+            None,
+            None,
+            newest=True):
+          current_values[attribute] = (value, ts)
+
+      if not self._ExpectedValuesMatch(expected_values, current_values):
+        return False
+
+      self._MultiSet(txn, subject, new_values, timestamp, True, to_delete)
+      return True
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True,
+                       token=None):
+    """Remove some attributes from a subject."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    _ = sync
+
+    if isinstance(attributes, basestring):
+      raise ValueError(
+          "String passed to DeleteAttributes (non string iterable expected).")
+
+    with self.env.begin(write=True) as txn:
+      self._DeleteAttributes(txn, subject, attributes, start, end)
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    with self.env.begin(write=True) as txn:
+      self._DeleteSubject(txn, subject)
+
+  def DeleteSubjects(self, subjects, sync=False, token=None):
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    with self.env.begin(write=True) as txn:
+      for subject in subjects:
+        self._DeleteSubject(txn, subject)
+
+  def MultiSubjectMutate(self,
+                         delete_subjects=None,
+                         delete_attributes=None,
+                         set_requests=None,
+                         sync=True,
+                         token=None):
+    """Apply mutations to many subjects in a single transaction."""
+    _ = sync
+    delete_subjects = delete_subjects or []
+    delete_attributes = delete_attributes or []
+    set_requests = set_requests or []
+
+    subjects = set(delete_subjects)
+    subjects.update(req[0] for req in delete_attributes)
+    subjects.update(req[0] for req in set_requests)
+    if not subjects:
+      return
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    for attributes in [req[1] for req in delete_attributes]:
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+
+    with self.env.begin(write=True) as txn:
+      for subject in delete_subjects:
+        self._DeleteSubject(txn, subject)
+      for subject, attributes, start, end in delete_attributes:
+        self._DeleteAttributes(txn, subject, attributes, start, end)
+      for subject, values, timestamp, replace, to_delete in set_requests:
+        self._MultiSet(txn, subject, values, timestamp, replace, to_delete)
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None,
+                         token=None):
+    """Result multiple subjects using one or more attribute prefixes."""
+    result = {}
+
+    remaining_limit = limit
+    for subject in subjects:
+      values = self.ResolvePrefix(
+          subject,
+          attribute_prefix,
+          token=token,
+          timestamp=timestamp,
+          limit=remaining_limit)
+
+      if values:
+        if limit:
+          if len(values) >= remaining_limit:
+            result[subject] = values[:remaining_limit]
+            return result.iteritems()
+          remaining_limit -= len(values)
+        result[subject] = values
+
+    return result.iteritems()
+
+  def ResolvePrefix(self,
+                    subject,
+                    attribute_prefix,
+                    timestamp=None,
+                    limit=None,
+                    token=None):
+    """Resolve all attributes for a subject matching a prefix."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attribute_prefix))
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+    prefixes = [utils.SmartStr(p) for p in attribute_prefix]
+
+    results = []
+    with self.env.begin() as txn:
+      for item in self._IterPrefixes(txn,
+                                     self._SubjectKey(subject), prefixes,
+                                     timestamp):
+        results.append(item)
+        if limit and len(results) >= limit:
+          break
+
+    return results
+
+  def ResolvePrefixPage(self,
+                        subject,
+                        attribute_prefix,
+                        timestamp=None,
+                        page_size=None,
+                        cursor=None,
+                        token=None):
+    """Resolve one page of attributes for a subject matching a prefix."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attribute_prefix))
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+    prefixes = [utils.SmartStr(p) for p in attribute_prefix]
+
+    page_size = page_size or self.RESOLVE_PREFIX_PAGE_SIZE
+    subject_key = self._SubjectKey(subject)
+
+    after = None
+    if cursor:
+      after_attribute, after_timestamp = self._ParseCursor(cursor)
+      column = self._ColumnKey(subject_key, after_attribute)
+      if timestamp == self.NEWEST_TIMESTAMP:
+        after = column + AFTER_ALL_TIMESTAMPS
+      else:
+        after = column + self._PackTimestamp(after_timestamp) + SEPARATOR
+
+    results = []
+    with self.env.begin() as txn:
+      # Read one extra value to know if there is another page.
+      for item in self._IterPrefixes(
+          txn, subject_key, prefixes, timestamp, after=after):
+        results.append(item)
+        if len(results) > page_size:
+          break
+
+    if len(results) > page_size:
+      attribute, _, ts = results[page_size - 1]
+      return results[:page_size], self._MakeCursor(attribute, ts)
+
+    return results, None
+
+  def ResolveMulti(self,
+                   subject,
+                   attributes,
+                   timestamp=None,
+                   limit=None,
+                   token=None):
+    """Resolve multiple attributes for a subject."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attributes))
+
+    if isinstance(attributes, basestring):
+      attributes = [attributes]
+
+    start, end = self._GetStartEndTimestamp(timestamp)
+    newest = timestamp == self.NEWEST_TIMESTAMP
+    subject_key = self._SubjectKey(subject)
+
+    results = []
+    with self.env.begin() as txn:
+      for attribute in attributes:
+        attribute = utils.SmartStr(attribute)
+        for _, value, ts in self._IterColumns(
+            txn,
+            self._ColumnKey(subject_key, attribute),
+            start,
+            end,
+            newest=newest):
+          results.append((attribute, value, ts))
+          if limit and len(results) >= limit:
+            return results
+
+    return results
+
+  def _ScanBatch(self, subject_prefix, attributes, after_key, after_urn,
+                 batch_size):
+    """Reads up to batch_size subjects following after_key."""
+    search_key = _SearchKey(subject_prefix, MAX_SUBJECT_KEY)
+    columns = [(attribute, SEPARATOR + _ShortKey(
+        utils.SmartStr(attribute), MAX_PREDICATE_KEY) + SEPARATOR)
+               for attribute in attributes]
+
+    batch = []
+    subject_key = None
+    with self.env.begin() as txn:
+      cursor = txn.cursor(db=self.data_db)
+      cursor.set_range(max(search_key, after_key))
+      while len(batch) < batch_size:
+        key = cursor.key()
+        if not key.startswith(search_key):
+          return batch, None
+
+        subject_key = key[:key.index(SEPARATOR)]
+        subject = self._FullSubject(txn, subject_key)
+        if (subject.startswith(subject_prefix) and
+            (not after_urn or subject > after_urn)):
+          results = {}
+          for attribute, column in columns:
+            for _, value, ts in self._IterColumns(
+                txn, subject_key + column, None, None, newest=True):
+              results[attribute] = (ts, value)
+              break
+          batch.append((subject, results))
+
+        # Skip to the first key of the next subject.
+        cursor.set_range(subject_key + HASH_MARKER)
+
+    return batch, subject_key + HASH_MARKER
+
+  def ScanAttributes(self,
+                     subject_prefix,
+                     attributes,
+                     after_urn=None,
+                     max_records=None,
+                     token=None,
+                     relaxed_order=False):
+    _ = relaxed_order
+    subject_prefix = self._CleanSubjectPrefix(subject_prefix)
+    after_urn = self._CleanAfterURN(after_urn, subject_prefix)
+    self.security_manager.CheckDataStoreAccess(token, [subject_prefix], "rq")
+
+    after_key = ""
+    if after_urn:
+      after_key = self._SubjectKey(after_urn) + HASH_MARKER
+
+    # Read transactions are kept short so we never hold a snapshot while the
+    # caller works on the results.
+    return_count = 0
+    while after_key is not None:
+      batch, after_key = self._ScanBatch(subject_prefix, attributes, after_key,
+                                         after_urn, SCAN_BATCH_SIZE)
+      for subject, results in batch:
+        if not results:
+          continue
+        yield subject, results
+        return_count += 1
+        if max_records and return_count >= max_records:
+          return
+
+  def TryLock(self, subject, expires, token):
+    """Locks a subject unless it is currently locked.
+
+    Args:
+     subject: The subject to lock.
+     expires: When the lock expires in microseconds since the epoch.
+     token: Identifies the owner of the lock.
+
+    Returns:
+     True if the lock was taken.
+    """
+    subject_key = self._SubjectKey(subject)
+    # Write transactions are serialized so checking and setting is atomic.
+    with self.env.begin(write=True) as txn:
+      current = txn.get(subject_key, db=self.locks_db)
+      if current:
+        locked_until = int(current.split(":")[0])
+        if time.time() * 1e6 < locked_until:
+          return False
+      txn.put(subject_key, "%d:%d" % (expires, token), db=self.locks_db)
+      return True
+
+  def SetLock(self, subject, expires, token):
+    with self.env.begin(write=True) as txn:
+      txn.put(
+          self._SubjectKey(subject),
+          "%d:%d" % (expires, token),
+          db=self.locks_db)
+
+  def RemoveLock(self, subject):
+    with self.env.begin(write=True) as txn:
+      txn.delete(self._SubjectKey(subject), db=self.locks_db)
+
+  def DBSubjectLock(self, subject, lease_time=None, token=None):
+    return LmdbDBSubjectLock(self, subject, lease_time=lease_time, token=token)
+
+  def Size(self):
+    info = self.env.info()
+    return (info["last_pgno"] + 1) * self.env.stat()["psize"]
+
+  def Location(self):
+    """Get location of the data store."""
+    return self.root_path
+
+  def Flush(self):
+    if self.env:
+      self.env.sync(True)
+
+  def Close(self):
+    """Flush and close the environment."""
+    if self.env:
+      env, self.env = self.env, None
+      env.sync(True)
+      env.close()
+
+
+class LmdbDBSubjectLock(data_store.DBSubjectLock):
+  """The LMDB data store transaction object.
+
+  Like the SQLite data store we only ensure that two simultaneous locks can not
+  be held on the same subject. Locks expire after their lease time.
+  """
+  locked = False
+
+  def _Acquire(self, lease_time):
+    self.lock_token = thread.get_ident()
+    self.expires = int((time.time() + lease_time) * 1e6)
+
+    if not self.store.TryLock(self.subject, self.expires, self.lock_token):
+      raise data_store.DBSubjectLockError("Subject %s is locked" %
+                                          self.subject)
+
+    self.locked = True
+
+  def UpdateLease(self, duration):
+    self.expires = int((time.time() + duration) * 1e6)
+    self.store.SetLock(self.subject, self.expires, self.lock_token)
+
+  def Release(self):
+    if self.locked:
+      self.store.RemoveLock(self.subject)
+      self.locked = False
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+"""Benchmark tests for LMDB datastore."""
+
+
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+
+from grr.lib.data_stores import lmdb_data_store_test
+
+
+class LmdbDataStoreBenchmarks(lmdb_data_store_test.LmdbTestMixin,
+                              data_store_test.DataStoreBenchmarks):
+  """Benchmark the LMDB data store abstraction."""
+
+
+class LmdbDataStoreCSVBenchmarks(lmdb_data_store_test.LmdbTestMixin,
+                                 data_store_test.DataStoreCSVBenchmarks):
+  """Benchmark the LMDB data store abstraction."""
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
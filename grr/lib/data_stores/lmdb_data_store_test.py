@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Tests the LMDB data store."""
+
+import shutil
+
+
+from grr.lib import access_control
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import test_lib
+from grr.lib import utils
+
+from grr.lib.data_stores import lmdb_data_store
+
+# pylint: mode=test
+
+
+class LmdbTestMixin(object):
+
+  def InitDatastore(self):
+    self.token = access_control.ACLToken(
+        username="test", reason="Running tests")
+    self.root_path = utils.SmartStr("%s/lmdb_test/" % self.temp_dir)
+
+    self.DestroyDatastore()
+
+    with test_lib.ConfigOverrider({"LmdbDatastore.map_size": 1024**3}):
+      data_store.DB = lmdb_data_store.LmdbDataStore(path=self.root_path)
+    data_store.DB.Initialize()
+    data_store.DB.security_manager = test_lib.MockSecurityManager()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(isinstance(data_store.DB, lmdb_data_store.LmdbDataStore))
+
+  def DestroyDatastore(self):
+    try:
+      data_store.DB.Close()
+    except AttributeError:
+      pass
+    try:
+      if self.root_path:
+        shutil.rmtree(self.root_path)
+    except (OSError, IOError):
+      pass
+
+
+class LmdbDataStoreTest(LmdbTestMixin, data_store_test._DataStoreTest):
+  """Test the LMDB data store."""
+
+  def testLongSubjectsAndPredicates(self):
+    subject = "aff4:/C/" + "s" * 600
+    predicate = "metadata:" + "p" * 600
+
+    data_store.DB.Set(subject, predicate, "value", token=self.token)
+    data_store.DB.Set(subject, "metadata:short", "short", token=self.token)
+
+    stored, _ = data_store.DB.Resolve(subject, predicate, token=self.token)
+    self.assertEqual(stored, "value")
+
+    result = data_store.DB.ResolvePrefix(
+        subject, "metadata:" + "p" * 500, token=self.token)
+    self.assertEqual([(p, v) for p, v, _ in result], [(predicate, "value")])
+
+    scanned = list(
+        data_store.DB.ScanAttribute(
+            "aff4:/C", "metadata:short", token=self.token))
+    self.assertEqual([s for s, _, _ in scanned], [subject])
+
+    data_store.DB.DeleteSubject(subject, token=self.token)
+    self.assertEqual(
+        data_store.DB.ResolvePrefix(subject, "metadata:", token=self.token), [])
+
+
+def main(args):
+  test_lib.main(args)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -2,6 +2,7 @@
 # -*- mode: python; encoding: utf-8 -*-
 """An implementation of a data store based on mysql."""
 
+import collections
 import logging
 import Queue
 import thread
@@ -152,6 +153,14 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
   POOL = None
 
+  # Maximum number of rows written by a single multi-row INSERT statement.
+  MAX_ROWS_PER_INSERT = 1000
+
+  # Maximum number of subjects checked by a single FilterSubjects() query.
+  FILTER_SUBJECTS_BATCH_SIZE = 1000
+
+  NATIVE_RESOLVE_PREFIX_PAGE = True
+
   def __init__(self):
     self.database_name = config_lib.CONFIG["Mysql.database_name"]
     # Use the global connection pool.
@@ -314,6 +323,89 @@ class MySQLAdvancedDataStore(data_store.DataStore):
 
     return results
 
+  def ResolvePrefixPage(self,
+                        subject,
+                        attribute_prefix,
+                        timestamp=None,
+                        page_size=None,
+                        cursor=None,
+                        token=None):
+    """Resolve one page of attributes for a subject matching a prefix."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attribute_prefix))
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+
+    page_size = page_size or self.RESOLVE_PREFIX_PAGE_SIZE
+    after_attribute, after_timestamp = None, None
+    if cursor:
+      after_attribute, after_timestamp = self._ParseCursor(cursor)
+
+    # Fetch one extra row to know if there is another page.
+    query, args = self._BuildPageQuery(subject, attribute_prefix, timestamp,
+                                       page_size + 1, after_attribute,
+                                       after_timestamp)
+    rows, _ = self.ExecuteQuery(query, args)
+
+    results = []
+    for row in rows[:page_size]:
+      attribute = row["attribute"]
+      value = self._Decode(attribute, row["value"])
+      results.append((attribute, value, row["timestamp"]))
+
+    if len(rows) > page_size:
+      attribute, _, ts = results[-1]
+      return results, self._MakeCursor(attribute, ts)
+
+    return results, None
+
+  def _BuildPageQuery(self, subject, attribute_prefix, timestamp, limit,
+                      after_attribute, after_timestamp):
+    """Build a SELECT query returning one ordered page of a subject's row."""
+    subject = utils.SmartUnicode(subject)
+    # Like the other data stores, pages default to all timestamps.
+    newest = timestamp == self.NEWEST_TIMESTAMP
+
+    args = []
+    tables = ("FROM aff4 "
+              "JOIN attributes ON aff4.attribute_hash=attributes.hash")
+    if newest:
+      tables += (" JOIN (SELECT attribute_hash, MAX(timestamp) timestamp "
+                 "FROM aff4 WHERE subject_hash=unhex(md5(%s)) "
+                 "GROUP BY attribute_hash) maxtime ON "
+                 "aff4.attribute_hash=maxtime.attribute_hash AND "
+                 "aff4.timestamp=maxtime.timestamp")
+      args.append(subject)
+
+    criteria = "WHERE aff4.subject_hash=unhex(md5(%s))"
+    args.append(subject)
+    criteria += " AND (%s)" % " OR ".join(["attributes.attribute like %s"] *
+                                          len(attribute_prefix))
+    args.extend([utils.SmartUnicode(p) + "%" for p in attribute_prefix])
+
+    if isinstance(timestamp, (tuple, list)):
+      criteria += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
+      args.append(int(timestamp[0]))
+      args.append(int(timestamp[1]))
+
+    if newest:
+      if after_attribute is not None:
+        criteria += " AND attributes.attribute > %s"
+        args.append(after_attribute)
+      sorting = "ORDER BY attributes.attribute"
+    else:
+      if after_attribute is not None:
+        criteria += (" AND (attributes.attribute > %s OR "
+                     "(attributes.attribute = %s AND aff4.timestamp < %s))")
+        args.extend([after_attribute, after_attribute, after_timestamp])
+      sorting = "ORDER BY attributes.attribute, aff4.timestamp DESC"
+    sorting += " LIMIT %s" % int(limit)
+
+    fields = "aff4.value, aff4.timestamp, attributes.attribute"
+    query = " ".join(["SELECT", fields, tables, criteria, sorting])
+    return (query, args)
+
   def _ScanAttribute(self,
                      subject_prefix,
                      attribute,
@@ -388,6 +480,56 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       if max_records and result_count >= max_records:
         return
 
+  def FilterSubjects(self, subjects, predicates, token=None):
+    """Evaluates equality, range and prefix predicates in SQL."""
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(token, subjects, "r")
+
+    # MySQL regular expressions do not follow python semantics, so these are
+    # left to the caller.
+    sql_predicates = [
+        p for p in predicates if p.operator != data_store.QueryPredicate.REGEX
+    ]
+    if not sql_predicates or not subjects:
+      return subjects
+
+    conditions = []
+    condition_args = []
+    for predicate in sql_predicates:
+      # Any version of the attribute may match, which at worst returns
+      # subjects that the caller filters out again.
+      condition = ("EXISTS (SELECT 1 FROM aff4 "
+                   "WHERE aff4.subject_hash=subjects.hash "
+                   "AND aff4.attribute_hash=unhex(md5(%s))")
+      condition_args.append(predicate.attribute)
+      if predicate.operator == data_store.QueryPredicate.PREFIX:
+        prefix = utils.SmartStr(predicate.value)
+        for char in "\\%_":
+          prefix = prefix.replace(char, "\\" + char)
+        condition += " AND aff4.value LIKE %s"
+        condition_args.append(prefix + "%")
+      else:
+        # Integers are stored as their decimal representation.
+        if predicate.start is not None:
+          condition += " AND CAST(aff4.value AS SIGNED) >= %s"
+          condition_args.append(predicate.start)
+        if predicate.end is not None:
+          condition += " AND CAST(aff4.value AS SIGNED) <= %s"
+          condition_args.append(predicate.end)
+      conditions.append(condition + ")")
+
+    matching = set()
+    for batch in utils.Grouper(subjects, self.FILTER_SUBJECTS_BATCH_SIZE):
+      query = ("SELECT subjects.subject FROM subjects WHERE subjects.hash IN "
+               "(%s) AND %s" % (", ".join(["unhex(md5(%s))"] * len(batch)),
+                                " AND ".join(conditions)))
+      args = [utils.SmartUnicode(s) for s in batch] + condition_args
+      rows, _ = self.ExecuteQuery(query, args)
+      for row in rows:
+        matching.add(utils.SmartUnicode(row["subject"]))
+
+    return [s for s in subjects if utils.SmartUnicode(s) in matching]
+
   def MultiSet(self,
                subject,
                values,
@@ -455,6 +597,152 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         with self.buffer_lock:
           self.to_insert.extend(to_insert)
 
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Checks and sets in a transaction locking the checked rows."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    subject = utils.SmartUnicode(subject)
+
+    to_replace = []
+    for attribute, sequence in new_values.items():
+      attribute = utils.SmartUnicode(attribute)
+      for value in sequence:
+        entry_timestamp = timestamp
+        if isinstance(value, tuple):
+          value, entry_timestamp = value
+        if entry_timestamp is not None:
+          entry_timestamp = int(entry_timestamp)
+        to_replace.append(
+            [subject, attribute, self._Encode(value), entry_timestamp])
+
+    transaction = []
+    for attribute in set(to_delete or []).difference(new_values):
+      transaction.extend(
+          self._BuildDelete(subject, utils.SmartUnicode(attribute)))
+    if to_replace:
+      transaction.extend(self._BuildReplaces(to_replace))
+
+    query = ("SELECT value, timestamp FROM aff4 "
+             "WHERE subject_hash=unhex(md5(%s)) "
+             "AND attribute_hash=unhex(md5(%s)) "
+             "ORDER BY timestamp DESC LIMIT 1 FOR UPDATE")
+
+    connection = self.pool.GetConnection()
+    try:
+      connection.cursor.execute("START TRANSACTION")
+      current_values = {}
+      for attribute in expected_values:
+        connection.cursor.execute(query,
+                                  [subject, utils.SmartUnicode(attribute)])
+        row = connection.cursor.fetchone()
+        if row:
+          current_values[attribute] = (self._Decode(attribute, row["value"]),
+                                       row["timestamp"])
+
+      if not self._ExpectedValuesMatch(expected_values, current_values):
+        connection.cursor.execute("ROLLBACK")
+        self.pool.PutConnection(connection)
+        return False
+
+      for q in transaction:
+        connection.cursor.execute(q["query"], q["args"])
+      connection.cursor.execute("COMMIT")
+      self.pool.PutConnection(connection)
+      return True
+    except MySQLdb.Error as e:
+      self.pool.DropConnection(connection)
+      if "doesn't exist" in str(e):
+        # This should indicate missing tables and raise immediately
+        raise e
+      # Nothing was written, typically because a concurrent writer deadlocked
+      # with us. The caller treats this like a failed expectation.
+      logging.warning("CheckAndMultiSet rolled back after %s.", str(e))
+      return False
+    finally:
+      # Reduce the open connection count by calling task_done. This will
+      # increment again if the connection is returned to the pool.
+      self.pool.connections.task_done()
+
+  def MultiSubjectMutate(self,
+                         delete_subjects=None,
+                         delete_attributes=None,
+                         set_requests=None,
+                         sync=True,
+                         token=None):
+    """Apply mutations to many subjects in a single transaction."""
+    _ = sync  # Mutations are always applied before returning.
+    delete_subjects = delete_subjects or []
+    delete_attributes = delete_attributes or []
+    set_requests = set_requests or []
+
+    subjects = set(delete_subjects)
+    subjects.update(req[0] for req in delete_attributes)
+    subjects.update(req[0] for req in set_requests)
+    if not subjects:
+      return
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    transaction = []
+    for subject in delete_subjects:
+      transaction.extend(self._BuildDelete(utils.SmartUnicode(subject)))
+
+    for subject, attributes, start, end in delete_attributes:
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+      subject = utils.SmartUnicode(subject)
+      timestamp = self._MakeTimestamp(start, end)
+      for attribute in attributes:
+        transaction.extend(
+            self._BuildDelete(subject, utils.SmartUnicode(attribute), timestamp))
+
+    # Rows to insert keyed by (subject, attribute) so a later replace in the
+    # same batch discards rows queued by an earlier request.
+    rows = collections.OrderedDict()
+    for subject, values, timestamp, replace, to_delete in set_requests:
+      subject = utils.SmartUnicode(subject)
+      to_delete = set(utils.SmartUnicode(a) for a in to_delete or [])
+      if replace:
+        to_delete.update(utils.SmartUnicode(a) for a in values)
+
+      for attribute in to_delete:
+        transaction.extend(self._BuildDelete(subject, attribute))
+        rows.pop((subject, attribute), None)
+
+      for attribute, sequence in values.items():
+        attribute = utils.SmartUnicode(attribute)
+        for value in sequence:
+          if isinstance(value, tuple):
+            value, entry_timestamp = value
+          else:
+            entry_timestamp = timestamp
+
+          if entry_timestamp is None:
+            entry_timestamp = timestamp
+
+          if entry_timestamp is not None:
+            entry_timestamp = int(entry_timestamp)
+
+          rows.setdefault((subject, attribute), []).append(
+              [subject, attribute, self._Encode(value), entry_timestamp])
+
+    to_insert = []
+    for attribute_rows in rows.values():
+      to_insert.extend(attribute_rows)
+
+    # Keep single statements below the server's packet size limit.
+    for i in xrange(0, len(to_insert), self.MAX_ROWS_PER_INSERT):
+      transaction.extend(
+          self._BuildInserts(to_insert[i:i + self.MAX_ROWS_PER_INSERT]))
+
+    if transaction:
+      self._ExecuteTransaction(transaction)
+
   def _CountExistingRows(self, subject, attribute):
     query = ("SELECT count(*) AS total FROM aff4 "
              "WHERE subject_hash=unhex(md5(%s)) "
@@ -23,6 +23,12 @@ try:
 except ImportError:
   pass
 
+# Memory mapped data store based on LMDB.
+try:
+  from grr.lib.data_stores import lmdb_data_store
+except ImportError:
+  pass
+
 # HTTP remote data store.
 try:
   from grr.lib.data_stores import http_data_store
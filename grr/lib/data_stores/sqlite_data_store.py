@@ -14,6 +14,7 @@ import tempfile
 import thread
 import threading
 import time
+import weakref
 
 import sqlite3
 
@@ -28,15 +29,39 @@ from grr.lib.data_stores import common
 SQLITE_EXTENSION = ".sqlite"
 SQLITE_TIMEOUT = 600.0
 SQLITE_ISOLATION = "DEFERRED"
+# In high throughput mode several connections write to the same file, so
+# write transactions take the database lock before reading anything.
+SQLITE_HIGH_THROUGHPUT_ISOLATION = "IMMEDIATE"
 SQLITE_SUBJECT_SPEC = "TEXT"
 SQLITE_DETECT_TYPES = 0
 SQLITE_FACTORY = sqlite3.Connection
-SQLITE_CACHED_STATEMENTS = 20
+SQLITE_CACHED_STATEMENTS = 100
 SQLITE_PAGE_SIZE = 1024
 
 
+def _RegexpMatch(pattern, value):
+  """Implements the REGEXP operator with python regex semantics."""
+  if value is None:
+    return False
+  if isinstance(value, buffer):
+    value = str(value)
+  return re.search(pattern, utils.SmartUnicode(value)) is not None
+
+
+class ThreadConnectionStore(utils.FastStore):
+  """The SQLite connections of a single thread in high throughput mode."""
+
+  def KillObject(self, conn):
+    conn.Close()
+
+
 class SqliteConnectionCache(utils.FastStore):
-  """A local cache of SQLite connection objects."""
+  """A local cache of SQLite connection objects.
+
+  In high throughput mode every thread keeps its own connections in a
+  ThreadConnectionStore of up to max_size connections, so a thread never
+  evicts a connection another thread is using.
+  """
 
   # Contents of the database that are written initially to a database file.
   template = None
@@ -136,6 +161,9 @@ class SqliteConnectionCache(utils.FastStore):
   def __init__(self, max_size, path):
     super(SqliteConnectionCache, self).__init__(max_size=max_size)
     self.root_path = path or config_lib.CONFIG.Get("Datastore.location")
+    self.high_throughput = config_lib.CONFIG["SqliteDatastore.high_throughput"]
+    self.thread_connections = threading.local()
+    self.thread_stores = weakref.WeakSet()
     self._CreateModelDatabase()
     self.RecreatePathing()
 
@@ -157,14 +185,41 @@ class SqliteConnectionCache(utils.FastStore):
   def KillObject(self, conn):
     conn.Close()
 
+  def _ConnectionStore(self):
+    """Returns the store holding the calling thread's connections."""
+    if not self.high_throughput:
+      return super(SqliteConnectionCache, self)
+
+    try:
+      return self.thread_connections.store
+    except AttributeError:
+      store = ThreadConnectionStore(max_size=self._limit)
+      self.thread_connections.store = store
+      self.thread_stores.add(store)
+      return store
+
+  @utils.Synchronized
+  def __iter__(self):
+    connections = list(super(SqliteConnectionCache, self).__iter__())
+    for store in list(self.thread_stores):
+      connections.extend(store)
+    return iter(connections)
+
+  @utils.Synchronized
+  def Flush(self):
+    super(SqliteConnectionCache, self).Flush()
+    for store in list(self.thread_stores):
+      store.Flush()
+
   @utils.Synchronized
   def Get(self, subject):
     """This will create the connection if needed so should not fail."""
     filename, directory = common.ResolveSubjectDestination(subject,
                                                            self.path_regexes)
     key = common.MakeDestinationKey(directory, filename)
+    store = self._ConnectionStore()
     try:
-      return super(SqliteConnectionCache, self).Get(key)
+      return store.Get(key)
     except KeyError:
       dirname = utils.JoinPath(self.root_path, directory)
       path = utils.JoinPath(dirname, filename) + SQLITE_EXTENSION
@@ -178,9 +233,10 @@ class SqliteConnectionCache(utils.FastStore):
         except OSError:
           pass
       self._EnsureDatabaseExists(path)
-      connection = SqliteConnection(path)
+      connection = SqliteConnection(
+          path, high_throughput=self.high_throughput)
 
-      super(SqliteConnectionCache, self).Put(key, connection)
+      store.Put(key, connection)
 
       return connection
 
@@ -238,7 +294,8 @@ class SqliteConnectionCache(utils.FastStore):
             mod_db = self.root_path
           if mod_db.startswith(dir_prefix) or dir_prefix.startswith(mod_db):
             databases_found.add(db)
-            yield SqliteConnection(db + SQLITE_EXTENSION)
+            yield SqliteConnection(
+                db + SQLITE_EXTENSION, high_throughput=self.high_throughput)
       if not shortened_path_prefix:
         break
       components = shortened_path_prefix.split(os.path.sep)
@@ -250,19 +307,33 @@ class SqliteConnectionCache(utils.FastStore):
 class SqliteConnection(object):
   """A wrapper around the raw SQLite connection."""
 
-  def __init__(self, filename):
+  def __init__(self, filename, high_throughput=False):
     self.filename = filename
+    if high_throughput:
+      isolation = SQLITE_HIGH_THROUGHPUT_ISOLATION
+    else:
+      isolation = SQLITE_ISOLATION
     self.conn = sqlite3.connect(filename, SQLITE_TIMEOUT, SQLITE_DETECT_TYPES,
-                                SQLITE_ISOLATION, False, SQLITE_FACTORY,
+                                isolation, False, SQLITE_FACTORY,
                                 SQLITE_CACHED_STATEMENTS)
     self.conn.text_factory = str
+    self.conn.create_function("regexp", 2, _RegexpMatch)
     self.cursor = self.conn.cursor()
     self.Execute("PRAGMA synchronous = OFF")
-    self.Execute("PRAGMA journal_mode = OFF")
+    if high_throughput:
+      # Write ahead logging lets readers proceed while another connection
+      # writes to the same file.
+      self.Execute("PRAGMA journal_mode = WAL")
+    else:
+      self.Execute("PRAGMA journal_mode = OFF")
     self.Execute("PRAGMA count_changes = OFF")
     self.Execute("PRAGMA cache_size = 10000")
     self.lock = threading.RLock()
     self.dirty = False
+    # Number of open "with" blocks using this connection. A connection expired
+    # from the cache while in use is closed when the last one exits.
+    self.users = 0
+    self.expired = False
     # Counter for vacuuming purposes.
     self.deleted = 0
     self.next_vacuum_check = config_lib.CONFIG["SqliteDatastore.vacuum_check"]
@@ -278,18 +349,34 @@ class SqliteConnection(object):
                         args)
       raise
 
+  def ExecuteMany(self, query, args):
+    try:
+      return self.cursor.executemany(query, args)
+    except sqlite3.DatabaseError:
+      logging.exception("DB error in file: %s for query: %s", self.filename,
+                        query)
+      raise
+
   @utils.Synchronized
-  def GetLock(self, subject):
-    """Gets the expiration time for a given subject."""
-    subject = utils.SmartStr(subject)
-    query = "SELECT expires, token FROM lock WHERE subject = ?"
-    args = (subject,)
-    data = self.Execute(query, args).fetchone()
+  def TryLock(self, subject, expires, token):
+    """Locks a subject unless it is currently locked.
 
-    if data:
-      return data[0], data[1]
-    else:
-      return None, None
+    Args:
+     subject: The subject to lock.
+     expires: When the lock expires in microseconds since the epoch.
+     token: Identifies the owner of the lock.
+
+    Returns:
+     True if the lock was taken.
+    """
+    subject = utils.SmartStr(subject)
+    query = """INSERT OR REPLACE INTO lock
+               SELECT ?, ?, ? WHERE NOT EXISTS
+                 (SELECT 1 FROM lock WHERE subject = ? AND expires > ?)"""
+    args = (subject, expires, token, subject, int(time.time() * 1e6))
+    self.Execute(query, args)
+    self.dirty = True
+    return self.cursor.rowcount > 0
 
   @utils.Synchronized
   def SetLock(self, subject, expires, token):
@@ -326,6 +413,45 @@ class SqliteConnection(object):
     else:
       return None
 
+  @utils.Synchronized
+  def FilterSubjects(self, subjects, predicates):
+    """Returns the subjects which have values matching all the predicates.
+
+    Args:
+     subjects: A list of subjects stored in this file.
+     predicates: A list of data_store.QueryPredicate instances.
+
+    Returns:
+     A list of matching subjects.
+    """
+    query = "SELECT DISTINCT subject FROM tbl WHERE subject IN (%s)" % (
+        ", ".join(["?"] * len(subjects)))
+    args = [utils.SmartStr(s) for s in subjects]
+    for predicate in predicates:
+      # Any version of the attribute may match, which at worst returns
+      # subjects that the caller filters out again.
+      query += """ AND EXISTS (SELECT 1 FROM tbl AS p
+                               WHERE p.subject = tbl.subject
+                               AND p.predicate = ?"""
+      args.append(predicate.attribute)
+      if predicate.operator == data_store.QueryPredicate.PREFIX:
+        prefix = utils.SmartStr(predicate.value)
+        query += " AND substr(p.value, 1, ?) = ?"
+        args.extend([len(prefix), buffer(prefix)])
+      elif predicate.operator == data_store.QueryPredicate.REGEX:
+        query += " AND p.value REGEXP ?"
+        args.append(predicate.value)
+      else:
+        if predicate.start is not None:
+          query += " AND p.value >= ?"
+          args.append(predicate.start)
+        if predicate.end is not None:
+          query += " AND p.value <= ?"
+          args.append(predicate.end)
+      query += ")"
+
+    return [row[0] for row in self.Execute(query, args).fetchall()]
+
   @utils.Synchronized
   def GetNewestFromPrefix(self, subject, prefix, limit=None):
     """Returns the newest values for attributes that match 'prefix'.
@@ -383,6 +509,60 @@ class SqliteConnection(object):
     data = self.Execute(query, args).fetchall()
     return data
 
+  @utils.Synchronized
+  def GetPageFromPrefix(self,
+                        subject,
+                        prefixes,
+                        start,
+                        end,
+                        limit,
+                        after_attribute=None,
+                        after_timestamp=None,
+                        newest=False):
+    """Returns one page of values for attributes matching 'prefixes'.
+
+    The page is ordered by attribute and then by decreasing timestamp. Since
+    this order follows the table index, only the rows in the page are read.
+
+    Args:
+     subject: The subject.
+     prefixes: A list of attribute prefixes.
+     start: The start timestamp.
+     end: The end timestamp.
+     limit: The maximum number of values to return.
+     after_attribute: If set, only values ordered after the pair
+       (after_attribute, after_timestamp) are returned.
+     after_timestamp: The timestamp part of the position to resume from.
+     newest: If True, only return the newest value for each attribute.
+
+    Returns:
+     A list of the form (attribute, value, timestamp).
+    """
+    subject = utils.SmartStr(subject)
+    prefix_query = " OR ".join(["predicate LIKE ?"] * len(prefixes))
+    args = [subject] + [utils.SmartStr(prefix) + "%" for prefix in prefixes]
+
+    if newest:
+      query = """SELECT predicate, value, MAX(timestamp) FROM tbl
+                 WHERE subject = ? AND (%s)""" % prefix_query
+      if after_attribute is not None:
+        query += " AND predicate > ?"
+        args.append(after_attribute)
+      query += " GROUP BY predicate ORDER BY predicate LIMIT ?"
+    else:
+      query = """SELECT predicate, value, timestamp FROM tbl
+                 WHERE subject = ? AND (%s)
+                       AND timestamp >= ? AND timestamp <= ?""" % prefix_query
+      args.extend([start, end])
+      if after_attribute is not None:
+        query += """ AND (predicate > ? OR
+                          (predicate = ? AND timestamp < ?))"""
+        args.extend([after_attribute, after_attribute, after_timestamp])
+      query += " ORDER BY predicate, timestamp DESC LIMIT ?"
+
+    args.append(limit)
+    return self.Execute(query, args).fetchall()
+
   @utils.Synchronized
   def GetValues(self, subject, attribute, start, end, limit=None):
     """Returns the values of the attribute between 'start' and 'end'.
@@ -465,39 +645,49 @@ class SqliteConnection(object):
       yield r
 
   @utils.Synchronized
-  def DeleteAttribute(self, subject, attribute):
-    """Deletes all values for the given subject/attribute."""
+  def DeleteAttributes(self, subject, attributes):
+    """Deletes all values for the given subject's attributes."""
     subject = utils.SmartStr(subject)
-    attribute = utils.SmartStr(attribute)
     query = "DELETE FROM tbl WHERE subject = ? AND predicate = ?"
-    args = (subject, attribute)
-    self.Execute(query, args)
+    args = [(subject, utils.SmartStr(attribute)) for attribute in attributes]
+    self.ExecuteMany(query, args)
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
   @utils.Synchronized
-  def SetAttribute(self, subject, attribute, value, timestamp):
-    """Sets subject's attribute value with the given timestamp."""
+  def SetAttributes(self, subject, values):
+    """Inserts a list of (attribute, value, timestamp) for the subject."""
     subject = utils.SmartStr(subject)
-    attribute = utils.SmartStr(attribute)
     query = "INSERT INTO tbl VALUES (?, ?, ?, ?)"
-    args = (subject, attribute, timestamp, value)
-    self.Execute(query, args)
+    args = [(subject, utils.SmartStr(attribute), timestamp, value)
+            for attribute, value, timestamp in values]
+    self.ExecuteMany(query, args)
     self.dirty = True
     self.deleted = max(0, self.deleted - self.cursor.rowcount)
 
   @utils.Synchronized
-  def DeleteAttributeRange(self, subject, attribute, start, end):
-    """Deletes all values of a attribute within the range [start, end]."""
+  def DeleteAttributesRange(self, subject, attributes, start, end):
+    """Deletes all values of the attributes within the range [start, end]."""
     subject = utils.SmartStr(subject)
-    attribute = utils.SmartStr(attribute)
     query = """DELETE FROM tbl WHERE subject = ? AND predicate = ?
                AND timestamp >= ? AND timestamp <= ?"""
-    args = (subject, attribute, int(start), int(end))
-    self.Execute(query, args)
+    args = [(subject, utils.SmartStr(attribute), int(start), int(end))
+            for attribute in attributes]
+    self.ExecuteMany(query, args)
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
+  @utils.Synchronized
+  def BeginWrite(self):
+    """Starts a write transaction which lasts until the next Flush().
+
+    Reads made in the transaction see no concurrent writes from other
+    connections until it is committed.
+    """
+    self.conn.commit()
+    self.Execute("BEGIN IMMEDIATE")
+    self.dirty = True
+
   @utils.Synchronized
   def DeleteSubject(self, subject):
     """Deletes subject information."""
@@ -517,13 +707,19 @@ class SqliteConnection(object):
 
   def __enter__(self):
     self.lock.acquire()
+    self.users += 1
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
-    if self.dirty:
-      self.Flush()
-    self.dirty = False
-    self.lock.release()
+    try:
+      if self.dirty:
+        self.Flush()
+      self.dirty = False
+      self.users -= 1
+      if self.expired and not self.users:
+        self.Close()
+    finally:
+      self.lock.release()
 
   @utils.Synchronized
   def Flush(self):
@@ -597,6 +793,14 @@ class SqliteConnection(object):
   @utils.Synchronized
   def Close(self):
     """Flush and close connection."""
+    if self.users:
+      # Still in use by this thread, __exit__ closes it.
+      self.expired = True
+      return
+
+    if self.conn is None:
+      return
+
     if self.dirty:
       self.Flush()
     self.cursor.close()
@@ -611,6 +815,11 @@ class SqliteDataStore(data_store.DataStore):
   # A cache of SQLite connections.
   cache = None
 
+  # Maximum number of subjects checked by a single FilterSubjects() query.
+  FILTER_SUBJECTS_BATCH_SIZE = 500
+
+  NATIVE_RESOLVE_PREFIX_PAGE = True
+
   def __init__(self, path=None):
     self._CalculateAttributeStorageTypes()
     super(SqliteDataStore, self).__init__()
@@ -662,32 +871,65 @@ class SqliteDataStore(data_store.DataStore):
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
     # All operations are synchronized.
     _ = sync
+
+    with self.cache.Get(subject) as sqlite_connection:
+      self._MultiSet(sqlite_connection, subject, values, timestamp, replace,
+                     to_delete)
+
+  def _MultiSet(self, sqlite_connection, subject, values, timestamp, replace,
+                to_delete):
+    """Writes the values for a subject using an already held connection."""
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
     to_delete = set(to_delete or [])
+    if replace:
+      to_delete.update(values.keys())
+
+    # Delete attribute if needed.
+    if to_delete:
+      sqlite_connection.DeleteAttributes(subject, to_delete)
+
+    rows = []
+    for attribute, seq in values.items():
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        element_timestamp = long(element_timestamp)
+        rows.append((attribute, self._Encode(v), element_timestamp))
+
+    if rows:
+      sqlite_connection.SetAttributes(subject, rows)
+
+  def CheckAndMultiSet(self,
+                       subject,
+                       expected_values,
+                       new_values,
+                       timestamp=None,
+                       to_delete=None,
+                       token=None):
+    """Checks and sets in a single write transaction."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
     with self.cache.Get(subject) as sqlite_connection:
-      if replace:
-        to_delete.update(values.keys())
-
-      # Delete attribute if needed.
-      if to_delete:
-        for attribute in to_delete:
-          sqlite_connection.DeleteAttribute(subject, attribute)
-
-      for attribute, seq in values.items():
-        for v in seq:
-          element_timestamp = None
-          if isinstance(v, (list, tuple)):
-            v, element_timestamp = v
-          if element_timestamp is None:
-            element_timestamp = timestamp
-
-          element_timestamp = long(element_timestamp)
-          value = self._Encode(v)
-          sqlite_connection.SetAttribute(subject, attribute, value,
-                                         element_timestamp)
+      sqlite_connection.BeginWrite()
+      current_values = {}
+      for attribute in expected_values:
+        ret = sqlite_connection.GetNewestValue(subject, attribute)
+        if ret:
+          value, ts = ret
+          current_values[attribute] = (self._Decode(attribute, value), ts)
+
+      if not self._ExpectedValuesMatch(expected_values, current_values):
+        return False
+
+      self._MultiSet(sqlite_connection, subject, new_values, timestamp, True,
+                     to_delete)
+      return True
 
   def DeleteAttributes(self,
                        subject,
@@ -705,18 +947,73 @@ class SqliteDataStore(data_store.DataStore):
           "String passed to DeleteAttributes (non string iterable expected).")
 
     with self.cache.Get(subject) as sqlite_connection:
-      if start is None and end is None:
-        # This is done when we delete all attributes at once without
-        # caring about timestamps.
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttribute(subject, attribute)
-      else:
-        # This code path is taken when we have a timestamp range.
-        start = start or 0
-        if end is None:
-          end = (2**63) - 1  # sys.maxint
-        for attribute in list(attributes):
-          sqlite_connection.DeleteAttributeRange(subject, attribute, start, end)
+      self._DeleteAttributes(sqlite_connection, subject, attributes, start, end)
+
+  def _DeleteAttributes(self, sqlite_connection, subject, attributes, start,
+                        end):
+    """Removes attributes using an already held connection."""
+    if start is None and end is None:
+      # This is done when we delete all attributes at once without
+      # caring about timestamps.
+      sqlite_connection.DeleteAttributes(subject, list(attributes))
+    else:
+      # This code path is taken when we have a timestamp range.
+      start = start or 0
+      if end is None:
+        end = (2**63) - 1  # sys.maxint
+      sqlite_connection.DeleteAttributesRange(subject, list(attributes), start,
+                                              end)
+
+  def MultiSubjectMutate(self,
+                         delete_subjects=None,
+                         delete_attributes=None,
+                         set_requests=None,
+                         sync=True,
+                         token=None):
+    """Apply mutations to many subjects, one transaction per database file."""
+    _ = sync
+    delete_subjects = delete_subjects or []
+    delete_attributes = delete_attributes or []
+    set_requests = set_requests or []
+
+    subjects = set(delete_subjects)
+    subjects.update(req[0] for req in delete_attributes)
+    subjects.update(req[0] for req in set_requests)
+    if not subjects:
+      return
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    for attributes in [req[1] for req in delete_attributes]:
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+
+    # Group the mutations by database file while keeping the order of
+    # operations within every group.
+    groups = {}
+
+    def _AddMutation(subject, method, *args):
+      filename = self.cache.Get(subject).Filename()
+      groups.setdefault(filename, (subject, []))[1].append((method, args))
+
+    for subject in delete_subjects:
+      _AddMutation(subject, self._DeleteSubject, subject)
+    for subject, attributes, start, end in delete_attributes:
+      _AddMutation(subject, self._DeleteAttributes, subject, attributes, start,
+                   end)
+    for subject, values, timestamp, replace, to_delete in set_requests:
+      _AddMutation(subject, self._MultiSet, subject, values, timestamp, replace,
+                   to_delete)
+
+    # Everything going to the same file is committed once when the connection
+    # context exits.
+    for subject, mutations in groups.itervalues():
+      with self.cache.Get(subject) as sqlite_connection:
+        for method, args in mutations:
+          method(sqlite_connection, *args)
+
+  def _DeleteSubject(self, sqlite_connection, subject):
+    sqlite_connection.DeleteSubject(subject)
 
   def DeleteSubject(self, subject, sync=False, token=None):
     _ = sync
@@ -809,6 +1106,71 @@ class SqliteDataStore(data_store.DataStore):
 
       return results
 
+  def FilterSubjects(self, subjects, predicates, token=None):
+    """Evaluates the predicates in SQL, one query per database file."""
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(token, subjects, "r")
+    if not predicates or not subjects:
+      return subjects
+
+    by_file = {}
+    for subject in subjects:
+      filename = self.cache.Get(subject).Filename()
+      by_file.setdefault(filename, []).append(subject)
+
+    matching = set()
+    for file_subjects in by_file.itervalues():
+      with self.cache.Get(file_subjects[0]) as sqlite_connection:
+        # Stay well below the limit on the number of bound parameters.
+        for batch in utils.Grouper(file_subjects,
+                                   self.FILTER_SUBJECTS_BATCH_SIZE):
+          for subject in sqlite_connection.FilterSubjects(batch, predicates):
+            matching.add(utils.SmartUnicode(subject))
+
+    return [s for s in subjects if utils.SmartUnicode(s) in matching]
+
+  def ResolvePrefixPage(self,
+                        subject,
+                        attribute_prefix,
+                        timestamp=None,
+                        page_size=None,
+                        cursor=None,
+                        token=None):
+    """Resolve one page of attributes for a subject matching a prefix."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attribute_prefix))
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+
+    page_size = page_size or self.RESOLVE_PREFIX_PAGE_SIZE
+    start, end = self._GetStartEndTimestamp(timestamp)
+
+    after_attribute, after_timestamp = None, None
+    if cursor:
+      after_attribute, after_timestamp = self._ParseCursor(cursor)
+
+    with self.cache.Get(subject) as sqlite_connection:
+      # Fetch one extra value to know if there is another page.
+      data = sqlite_connection.GetPageFromPrefix(
+          subject,
+          attribute_prefix,
+          start,
+          end,
+          page_size + 1,
+          after_attribute=after_attribute,
+          after_timestamp=after_timestamp,
+          newest=timestamp == self.NEWEST_TIMESTAMP)
+
+    results = [(attribute, self._Decode(attribute, value), ts)
+               for attribute, value, ts in data[:page_size]]
+
+    if len(data) > page_size:
+      attribute, _, ts = results[-1]
+      return results, self._MakeCursor(attribute, ts)
+
+    return results, None
+
   def _GroupSubjects(self, collection, max_records):
     """Group results by subject and convert to ScanAttribute output format."""
     record_count = 0
@@ -979,30 +1341,16 @@ class SqliteDBSubjectLock(data_store.DBSubjectLock):
 
   def _Acquire(self, lease_time):
     self.lock_token = thread.get_ident()
-    sqlite_connection = self.store.cache.Get(self.subject)
-
-    # We first check if there is a lock on the subject.
-    # Next we set our lease time and lock_token as identification.
-    with sqlite_connection:
-      locked_until, stored_token = sqlite_connection.GetLock(self.subject)
+    self.expires = int((time.time() + lease_time) * 1e6)
 
-      # This is currently locked by another thread.
-      if locked_until and (time.time() * 1e6) < float(locked_until):
-        raise data_store.DBSubjectLockError("Subject %s is locked" %
-                                            self.subject)
-
-      # Subject is not locked, we take a lease on it.
-      self.expires = int((time.time() + lease_time) * 1e6)
-      sqlite_connection.SetLock(self.subject, self.expires, self.lock_token)
+    # Checking for an existing lease and taking ours is a single statement so
+    # it is atomic even with several connections to the same file.
+    with self.store.cache.Get(self.subject) as sqlite_connection:
+      locked = sqlite_connection.TryLock(self.subject, self.expires,
+                                         self.lock_token)
 
-    # TODO(user): This shouldn't really be necessary, and seems fragile. We
-    # should be able to use an UPDATE WHERE lock_expiration < now inside a
-    # transaction and check that we changed one row.
-    # Check if the lock stuck. If the stored token is not ours
-    # then probably someone was able to grab it before us.
-    locked_until, stored_token = sqlite_connection.GetLock(self.subject)
-    if stored_token != self.lock_token:
-      raise data_store.DBSubjectLockError("Unable to lock subject %s" %
+    if not locked:
+      raise data_store.DBSubjectLockError("Subject %s is locked" %
                                           self.subject)
 
     self.locked = True
@@ -2,11 +2,18 @@
 """Benchmark tests for sqlite datastore."""
 
 
+import threading
+import time
+
+
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import queue_manager
+from grr.lib import rdfvalue
 from grr.lib import test_lib
 
 from grr.lib.data_stores import sqlite_data_store_test
+from grr.lib.rdfvalues import flows as rdf_flows
 
 
 class SqliteDataStoreBenchmarks(sqlite_data_store_test.SqliteTestMixin,
@@ -19,6 +26,109 @@ class SqliteDataStoreCSVBenchmarks(sqlite_data_store_test.SqliteTestMixin,
   """Benchmark the SQLite data store abstraction."""
 
 
+class SqliteQueueBenchmarks(sqlite_data_store_test.SqliteTestMixin,
+                            test_lib.MicroBenchmarks):
+  """Compares the default and high throughput modes on queue workloads.
+
+  These tests should be run with --labels=benchmark
+  """
+  units = "s"
+
+  nr_threads = 10
+  nr_queues = 5
+  tasks_per_thread = 200
+  lease_batch = 20
+
+  def _RunThreads(self, target):
+    threads = [
+        threading.Thread(target=target, args=(i,))
+        for i in xrange(self.nr_threads)
+    ]
+    start_time = time.time()
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return time.time() - start_time
+
+  def _QueueWorkload(self, mode):
+    """Schedules, leases and deletes tasks from several threads."""
+    queues = [
+        rdfvalue.RDFURN("aff4:/BENCHMARK%d" % i) for i in xrange(self.nr_queues)
+    ]
+
+    def Schedule(thread_id):
+      queue = queues[thread_id % self.nr_queues]
+      manager = queue_manager.QueueManager(token=self.token)
+      for _ in xrange(self.tasks_per_thread):
+        manager.Schedule(
+            [rdf_flows.GrrMessage(queue=queue, generate_task_id=True)],
+            sync=True)
+
+    def Lease(thread_id):
+      queue = queues[thread_id % self.nr_queues]
+      manager = queue_manager.QueueManager(token=self.token)
+      while True:
+        tasks = manager.QueryAndOwn(
+            queue, lease_seconds=300, limit=self.lease_batch)
+        if not tasks:
+          break
+        manager.Delete(queue, tasks)
+        manager.Flush()
+
+    total = self.nr_threads * self.tasks_per_thread
+    self.AddResult("Queue schedule (%s)" % mode,
+                   self._RunThreads(Schedule), total)
+    self.AddResult("Queue lease and delete (%s)" % mode,
+                   self._RunThreads(Lease), total)
+
+  def _NotificationWorkload(self, mode):
+    """Notifies and reads back notifications from several threads."""
+
+    def Notify(thread_id):
+      manager = queue_manager.QueueManager(token=self.token)
+      notifications = [
+          rdf_flows.GrrNotification(
+              session_id=rdfvalue.SessionID(
+                  queue=rdfvalue.DEFAULT_FLOW_QUEUE,
+                  flow_name="%d_%d" % (thread_id, i)))
+          for i in xrange(self.tasks_per_thread)
+      ]
+      manager.MultiNotifyQueue(notifications)
+
+    def Read(_):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.GetNotificationsForAllShards(rdfvalue.DEFAULT_FLOW_QUEUE)
+
+    total = self.nr_threads * self.tasks_per_thread
+    self.AddResult("Notify queue (%s)" % mode, self._RunThreads(Notify), total)
+    self.AddResult("Read notifications (%s)" % mode,
+                   self._RunThreads(Read), self.nr_threads)
+
+  def _RunInMode(self, workload, high_throughput):
+    mode = "high throughput" if high_throughput else "default"
+    with test_lib.ConfigOverrider({
+        "SqliteDatastore.high_throughput": high_throughput
+    }):
+      self.InitDatastore()
+      try:
+        workload(mode)
+      finally:
+        self.DestroyDatastore()
+
+  @test_lib.SetLabel("benchmark")
+  def testQueueWorkload(self):
+    """Concurrent Schedule/QueryAndOwn/Delete on a handful of queues."""
+    for high_throughput in [False, True]:
+      self._RunInMode(self._QueueWorkload, high_throughput)
+
+  @test_lib.SetLabel("benchmark")
+  def testNotificationWorkload(self):
+    """Concurrent notification writes and shard scans."""
+    for high_throughput in [False, True]:
+      self._RunInMode(self._NotificationWorkload, high_throughput)
+
+
 def main(args):
   test_lib.main(args)
 
@@ -2,6 +2,7 @@
 """Tests the SQLite data store."""
 
 import shutil
+import threading
 
 
 from grr.lib import access_control
@@ -51,6 +52,42 @@ class SqliteDataStoreTest(SqliteTestMixin, data_store_test._DataStoreTest):
   """Test the sqlite data store."""
 
 
+class SqliteConnectionCacheTest(test_lib.GRRBaseTest):
+  """Tests the cache of SQLite connections."""
+
+  def _MakeCache(self, high_throughput):
+    with test_lib.ConfigOverrider({
+        "SqliteDatastore.high_throughput": high_throughput
+    }):
+      cache = sqlite_data_store.SqliteConnectionCache(
+          1, utils.SmartStr("%s/sqlite_cache/" % self.temp_dir))
+    self.addCleanup(cache.Flush)
+    return cache
+
+  def testHighThroughputThreadsDoNotEvictEachOther(self):
+    cache = self._MakeCache(True)
+    connection = cache.Get("aff4:/C.1000000000000000")
+
+    other_connections = []
+    thread = threading.Thread(target=lambda: other_connections.append(
+        cache.Get("aff4:/C.1000000000000001")))
+    thread.start()
+    thread.join()
+
+    self.assertIsNotNone(connection.conn)
+    self.assertIs(cache.Get("aff4:/C.1000000000000000"), connection)
+    self.assertIsNot(other_connections[0], connection)
+
+  def testConnectionInUseIsClosedWhenReleased(self):
+    cache = self._MakeCache(False)
+    with cache.Get("aff4:/C.1000000000000000") as connection:
+      # Only one connection fits in the cache.
+      cache.Get("aff4:/C.1000000000000001")
+      self.assertIsNotNone(connection.conn)
+
+    self.assertIsNone(connection.conn)
+
+
 def main(args):
   test_lib.main(args)
 
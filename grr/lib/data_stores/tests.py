@@ -25,6 +25,11 @@ try:
 except ImportError:
   pass
 
+try:
+  from grr.lib.data_stores import lmdb_data_store_test
+except ImportError:
+  pass
+
 try:
   from grr.lib.data_stores import http_data_store_test
 except ImportError:
@@ -139,19 +139,24 @@ def DownloadFile(file_obj, target_path, buffer_size=BUFFER_SIZE):
   """
   logging.info(u"Downloading: %s to: %s", file_obj.urn, target_path)
 
-  target_file = open(target_path, "wb")
   file_obj.Seek(0)
-  count = 0
-
-  data_buffer = file_obj.Read(buffer_size)
-  while data_buffer:
-    target_file.write(data_buffer)
-    data_buffer = file_obj.Read(buffer_size)
-    count += 1
-    if not count % 3:
-      logging.debug(u"Downloading: %s: %s done", file_obj.urn,
-                    utils.FormatNumberAsString(count * buffer_size))
-  target_file.close()
+  with open(target_path, "wb") as target_file:
+    count = 0
+    while True:
+      # Streams copy their content in bulk without going through Read().
+      if isinstance(file_obj, aff4.AFF4Stream):
+        if not file_obj.CopyTo(target_file, length=buffer_size):
+          break
+      else:
+        data_buffer = file_obj.Read(buffer_size)
+        if not data_buffer:
+          break
+        target_file.write(data_buffer)
+
+      count += 1
+      if not count % 3:
+        logging.debug(u"Downloading: %s: %s done", file_obj.urn,
+                      utils.FormatNumberAsString(count * buffer_size))
 
 
 def RecursiveDownload(dir_obj,
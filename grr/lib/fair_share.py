@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""Fair-share ordering of the flows a worker processes.
+
+Workers process notifications highest priority first. Within a priority,
+flows compete for worker threads by share class. Flows belonging to a hunt
+are in the hunt class and all other flows are in the interactive class.
+Every class gets threads in proportion to its weight. Inside a class the
+threads are handed out between hunts, or between the creators of the flows,
+so one large hunt can not starve everything else at the same priority.
+
+On top of that, a guaranteed slice of every batch goes to interactive flows
+while any are waiting, whatever their priority.
+"""
+
+
+import collections
+import heapq
+import itertools
+
+
+from grr.lib import config_lib
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+HUNT_CLASS = "hunt"
+INTERACTIVE_CLASS = "interactive"
+
+
+class FairShareScheduler(object):
+  """Orders notifications using weighted fair queueing."""
+
+  def __init__(self,
+               class_weights=None,
+               creator_weights=None,
+               interactive_slice=None,
+               max_creators=10000):
+    """Constructor.
+
+    Args:
+      class_weights: A dict of share class to weight. Defaults to the
+          Worker.fair_share_hunt_weight and
+          Worker.fair_share_interactive_weight config options.
+      creator_weights: A dict of creator to the weight of the interactive
+          flows they started, Worker.fair_share_creator_weights by default.
+          Creators not listed have weight 1.
+      interactive_slice: The minimum fraction of every batch given to
+          interactive flows, Worker.fair_share_interactive_slice by default.
+      max_creators: The number of flow creators remembered.
+    """
+    if class_weights is None:
+      class_weights = {
+          HUNT_CLASS: config_lib.CONFIG["Worker.fair_share_hunt_weight"],
+          INTERACTIVE_CLASS:
+              config_lib.CONFIG["Worker.fair_share_interactive_weight"]
+      }
+
+    if creator_weights is None:
+      creator_weights = {}
+      for entry in config_lib.CONFIG["Worker.fair_share_creator_weights"]:
+        creator, weight = entry.rsplit(":", 1)
+        creator_weights[creator] = float(weight)
+
+    if interactive_slice is None:
+      interactive_slice = config_lib.CONFIG[
+          "Worker.fair_share_interactive_slice"]
+
+    self.class_weights = class_weights
+    self.creator_weights = creator_weights
+    self.interactive_slice = interactive_slice
+    # The creators of the flows this worker has processed, by root session.
+    self.creators = utils.FastStore(max_size=max_creators)
+
+  @staticmethod
+  def RootSession(session_id):
+    """Returns the hunt or the top level flow a flow belongs to."""
+    components = rdfvalue.RDFURN(session_id).Split()
+    for i, component in enumerate(components):
+      if ":" in component:
+        return "/".join(components[:i + 1])
+
+    return "/".join(components)
+
+  def GetShareClass(self, notification):
+    root = self.RootSession(notification.session_id)
+    if root.startswith("hunts/"):
+      return HUNT_CLASS
+    return INTERACTIVE_CLASS
+
+  def SetCreator(self, session_id, creator):
+    """Remembers who started a flow, to share the worker between creators."""
+    if creator:
+      self.creators.Put(self.RootSession(session_id), creator)
+
+  def _GetShareKey(self, share_class, notification):
+    """Returns the key and weight flows are shared by inside their class."""
+    root = self.RootSession(notification.session_id)
+    if share_class == HUNT_CLASS:
+      return root, 1.0
+
+    try:
+      creator = self.creators.Get(root)
+    except KeyError:
+      # Until a worker processed the flow once, its creator is unknown.
+      return root, 1.0
+
+    return creator, self.creator_weights.get(creator, 1.0)
+
+  def _OrderFairly(self, notifications):
+    """Orders notifications of the same priority by weighted fair queueing."""
+    # Share class -> key -> the notifications in arrival order.
+    pending = collections.OrderedDict()
+    key_weights = {}
+    for notification in notifications:
+      share_class = self.GetShareClass(notification)
+      key, weight = self._GetShareKey(share_class, notification)
+      pending.setdefault(share_class, collections.OrderedDict()).setdefault(
+          key, collections.deque()).append(notification)
+      key_weights[share_class, key] = weight
+
+    # Every class and every key inside a class has a virtual time which
+    # advances by 1 / weight each time it is served. The earliest goes next.
+    counter = itertools.count()
+    class_heap = []
+    key_heaps = {}
+    for share_class, keys in pending.iteritems():
+      class_heap.append((0.0, next(counter), share_class))
+      key_heaps[share_class] = [(0.0, next(counter), key) for key in keys]
+
+    result = []
+    while class_heap:
+      class_time, _, share_class = heapq.heappop(class_heap)
+      key_heap = key_heaps[share_class]
+      key_time, _, key = heapq.heappop(key_heap)
+
+      queue = pending[share_class][key]
+      result.append(queue.popleft())
+
+      if queue:
+        key_weight = max(key_weights[share_class, key], 1e-6)
+        heapq.heappush(key_heap,
+                       (key_time + 1.0 / key_weight, next(counter), key))
+      if key_heap:
+        class_weight = max(self.class_weights.get(share_class, 1), 1e-6)
+        heapq.heappush(class_heap, (class_time + 1.0 / class_weight,
+                                    next(counter), share_class))
+
+    return result
+
+  def _ReserveInteractiveSlice(self, notifications):
+    """Moves interactive flows forward until they fill their slice."""
+    if not self.interactive_slice:
+      return notifications
+
+    interactive = collections.deque()
+    other = collections.deque()
+    for position, notification in enumerate(notifications):
+      if self.GetShareClass(notification) == INTERACTIVE_CLASS:
+        interactive.append((position, notification))
+      else:
+        other.append((position, notification))
+
+    result = []
+    interactive_count = 0
+    while interactive or other:
+      if interactive and (
+          not other or interactive[0][0] < other[0][0] or
+          interactive_count < self.interactive_slice * (len(result) + 1)):
+        result.append(interactive.popleft()[1])
+        interactive_count += 1
+      else:
+        result.append(other.popleft()[1])
+
+    return result
+
+  def Order(self, notifications):
+    """Returns notifications in the order they should be processed.
+
+    Args:
+      notifications: A list of rdf_flows.GrrNotification objects.
+
+    Returns:
+      The same notifications, highest priority first and shared fairly
+      between the share classes, hunts and creators within every priority.
+    """
+    by_priority = utils.GroupBy(notifications, lambda n: n.priority)
+    ordered = []
+    for priority in sorted(by_priority, reverse=True):
+      ordered.extend(self._OrderFairly(by_priority[priority]))
+
+    return self._ReserveInteractiveSlice(ordered)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Tests for the fair-share scheduling of flows."""
+
+
+
+from grr.lib import fair_share
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib.rdfvalues import flows as rdf_flows
+
+# pylint: mode=test
+
+MEDIUM = rdf_flows.GrrNotification.Priority.MEDIUM_PRIORITY
+LOW = rdf_flows.GrrNotification.Priority.LOW_PRIORITY
+
+
+class FairShareSchedulerTest(test_lib.GRRBaseTest):
+  """Tests for FairShareScheduler."""
+
+  def _HuntFlow(self, hunt, client, priority=MEDIUM):
+    return rdf_flows.GrrNotification(
+        session_id=rdfvalue.SessionID(
+            "aff4:/hunts/H:%s/C.%016X/W:%X" % (hunt, client, client)),
+        priority=priority)
+
+  def _Flow(self, flow_id, priority=MEDIUM):
+    return rdf_flows.GrrNotification(
+        session_id=rdfvalue.SessionID(
+            "aff4:/C.1000000000000000/flows/W:%X" % flow_id),
+        priority=priority)
+
+  def _Names(self, notifications):
+    return [n.session_id.Basename() for n in notifications]
+
+  def testRootSession(self):
+    root = fair_share.FairShareScheduler.RootSession
+    self.assertEqual(root("aff4:/hunts/H:123/C.1000000000000000/W:ABC"),
+                     "hunts/H:123")
+    self.assertEqual(root("aff4:/C.1000000000000000/flows/W:1/W:2"),
+                     "C.1000000000000000/flows/W:1")
+    self.assertEqual(root("aff4:/flows/W:Foreman"), "flows/W:Foreman")
+
+  def testLargeHuntDoesNotStarveOtherFlows(self):
+    scheduler = fair_share.FairShareScheduler(interactive_slice=0)
+    notifications = [self._HuntFlow("AAA", i) for i in range(1, 7)]
+    notifications += [self._HuntFlow("BBB", 100), self._Flow(1), self._Flow(2)]
+
+    ordered = scheduler.Order(notifications)
+    classes = [scheduler.GetShareClass(n) for n in ordered]
+    # Hunt and interactive flows alternate while both are waiting.
+    self.assertEqual(classes[:4], ["hunt", "interactive"] * 2)
+    # The second hunt gets its turn right after the first flow of the first.
+    hunts = [scheduler.RootSession(n.session_id) for n in ordered
+             if scheduler.GetShareClass(n) == "hunt"]
+    self.assertEqual(hunts[:2], ["hunts/H:AAA", "hunts/H:BBB"])
+    self.assertEqual(sorted(self._Names(ordered)),
+                     sorted(self._Names(notifications)))
+
+  def testClassWeights(self):
+    scheduler = fair_share.FairShareScheduler(
+        class_weights={"hunt": 1,
+                       "interactive": 3},
+        interactive_slice=0)
+    notifications = [self._HuntFlow("AAA", i) for i in range(1, 5)]
+    notifications += [self._Flow(i) for i in range(1, 9)]
+
+    classes = [scheduler.GetShareClass(n)
+               for n in scheduler.Order(notifications)]
+    self.assertEqual(classes[:8], ["hunt"] + ["interactive"] * 3 +
+                     ["hunt"] + ["interactive"] * 3)
+
+  def testCreatorWeights(self):
+    scheduler = fair_share.FairShareScheduler(
+        creator_weights={"analyst": 2}, interactive_slice=0)
+    notifications = [self._Flow(i) for i in range(1, 7)]
+    for notification in notifications[:3]:
+      scheduler.SetCreator(notification.session_id, "analyst")
+    for notification in notifications[3:]:
+      scheduler.SetCreator(notification.session_id, "other")
+
+    ordered = scheduler.Order(notifications)
+    self.assertEqual(self._Names(ordered)[:3], ["W:1", "W:4", "W:2"])
+
+  def testPriorityIsRespected(self):
+    scheduler = fair_share.FairShareScheduler(interactive_slice=0)
+    notifications = [
+        self._HuntFlow("AAA", 1, priority=LOW), self._Flow(1),
+        self._HuntFlow("AAA", 2)
+    ]
+
+    ordered = scheduler.Order(notifications)
+    self.assertEqual(ordered[-1].priority, LOW)
+
+  def testInteractiveSliceIsGuaranteed(self):
+    scheduler = fair_share.FairShareScheduler(interactive_slice=0.25)
+    notifications = [self._HuntFlow("AAA", i) for i in range(1, 13)]
+    notifications += [self._Flow(i, priority=LOW) for i in range(1, 4)]
+
+    classes = [scheduler.GetShareClass(n)
+               for n in scheduler.Order(notifications)]
+    for end in range(1, 13):
+      interactive = classes[:end].count("interactive")
+      self.assertGreaterEqual(interactive, min(3, int(0.25 * end)))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
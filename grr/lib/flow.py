@@ -960,18 +960,26 @@ class GRRFlow(FlowBase):
     # Doing a blind write here using low-level data store API. Accessing
     # the flow via AFF4 is not really possible here, because it forces a state
     # to be written in Close() method.
+    #
+    # UNLOCKED_WRITE is bumped so copies of the flow cached while it was
+    # locked are not used anymore.
+    values = {
+        cls.SchemaCls.PENDING_TERMINATION.predicate:
+            [PendingFlowTermination(reason=reason)],
+        cls.SchemaCls.UNLOCKED_WRITE.predicate: [rdfvalue.RDFDatetime.Now()],
+    }
+    to_delete = [cls.SchemaCls.UNLOCKED_WRITE.predicate]
     if mutation_pool:
-      mutation_pool.Set(flow_urn,
-                        cls.SchemaCls.PENDING_TERMINATION.predicate,
-                        PendingFlowTermination(reason=reason),
-                        replace=False)
+      mutation_pool.MultiSet(
+          flow_urn, values, replace=False, to_delete=to_delete)
     else:
-      data_store.DB.Set(flow_urn,
-                        cls.SchemaCls.PENDING_TERMINATION.predicate,
-                        PendingFlowTermination(reason=reason),
-                        replace=False,
-                        sync=sync,
-                        token=token)
+      data_store.DB.MultiSet(
+          flow_urn,
+          values,
+          replace=False,
+          to_delete=to_delete,
+          sync=sync,
+          token=token)
 
   @classmethod
   def TerminateFlow(cls,
@@ -482,7 +482,8 @@ class FlowRunner(object):
     # ASAP. This must happen before we actually run the flow to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
+      # Requests prefetched by the worker are read through our own manager.
+      for request, _ in self.queue_manager.FetchCompletedRequests(
           self.session_id, timestamp=(0, notification.timestamp)):
         # Requests which are not destined to clients have no embedded request
         # message.
@@ -1219,12 +1220,18 @@ class FlowRunner(object):
           source=self.session_id,
           timestamp=rdfvalue.RDFDatetime.Now())
 
-      data_store.DB.Set(self.session_id,
-                        self.flow_obj.Schema.NOTIFICATION,
-                        notification,
-                        replace=False,
-                        sync=False,
-                        token=self.token)
+      # This bypasses the flow object, so UNLOCKED_WRITE is bumped to keep
+      # cached copies of the flow from hiding the notification.
+      schema = self.flow_obj.Schema
+      data_store.DB.MultiSet(
+          self.session_id, {
+              schema.NOTIFICATION: [notification],
+              schema.UNLOCKED_WRITE: [rdfvalue.RDFDatetime.Now()]
+          },
+          replace=False,
+          to_delete=[schema.UNLOCKED_WRITE],
+          sync=False,
+          token=self.token)
 
       # Disable further notifications.
       self.context.user_notified = True
@@ -723,6 +723,21 @@ class FlowTerminationTest(BasicFlowTest):
 
     self.assertRaisesRegexp(RuntimeError, "because i can", ProcessFlow)
 
+  def testMarkForTerminationIsSeenThroughObjectCache(self):
+    flow_obj = self.FlowSetup("FlowOrderTest")
+    cache = aff4.VersionedObjectCache(max_size=10)
+    with utils.Stubber(aff4.FACTORY, "object_cache", cache):
+      # The flow is marked while it is held, e.g. by a worker, whose flush
+      # then rewrites LAST.
+      with aff4.FACTORY.OpenWithLock(flow_obj.urn, token=self.token):
+        flow.GRRFlow.MarkForTermination(
+            flow_obj.urn, reason="because i can", token=self.token)
+      self.assertEqual(len(cache), 1)
+
+      with aff4.FACTORY.OpenWithLock(flow_obj.urn, token=self.token) as fd:
+        self.assertEqual(
+            fd.Get(fd.Schema.PENDING_TERMINATION).reason, "because i can")
+
 
 class DummyFlowOutputPlugin(output_plugin.OutputPluginWithOutputStreams):
   """Dummy plugin that opens a dummy stream."""
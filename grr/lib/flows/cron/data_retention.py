@@ -3,6 +3,8 @@
 
 
 
+import time
+
 from grr.lib import aff4
 from grr.lib import client_index
 from grr.lib import config_lib
@@ -15,8 +17,106 @@ from grr.lib.aff4_objects import cronjobs
 
 from grr.lib.hunts import implementation
 
+from grr.lib.rdfvalues import aff4_rdfvalues
+
+
+# Minimum number of seconds between two writes of the deletion checkpoint.
+CHECKPOINT_INTERVAL = 60
+
+
+class _DeletionCheckpoint(object):
+  """The deletion checkpoint of a cron flow, kept in its cron job state.
+
+  The checkpoint is read once per run, so the next run resumes a subtree the
+  previous run did not finish deleting. It is cleared once its root is gone.
+  """
 
-class CleanHunts(cronjobs.SystemCronFlow):
+  def __init__(self, cron_flow):
+    self.cron_flow = cron_flow
+    try:
+      self.cron_state = cron_flow.ReadCronState()
+    except cronjobs.StateReadError:
+      # Not started by the cron manager, there is nowhere to keep a checkpoint.
+      self.cron_state = None
+
+    self.checkpoint = None
+    if self.cron_state and self.cron_state.get("deletion_checkpoint_root"):
+      self.checkpoint = (
+          rdfvalue.RDFURN(self.cron_state["deletion_checkpoint_root"]),
+          rdfvalue.RDFURN(self.cron_state["deletion_checkpoint_subject"]))
+    self.written_time = time.time()
+
+  def _Write(self, checkpoint):
+    self.checkpoint = checkpoint
+    self.written_time = time.time()
+    if self.cron_state is None:
+      return
+
+    root, subject = checkpoint or ("", "")
+    self.cron_state["deletion_checkpoint_root"] = utils.SmartUnicode(root)
+    self.cron_state["deletion_checkpoint_subject"] = utils.SmartUnicode(subject)
+    try:
+      self.cron_flow.WriteCronState(self.cron_state)
+    except cronjobs.StateWriteError as e:
+      self.cron_flow.Log("Unable to save the deletion checkpoint: %s", e)
+
+  def _RootIn(self, urns):
+    if self.checkpoint is None:
+      return False
+    root = utils.SmartUnicode(self.checkpoint[0])
+    return any(utils.SmartUnicode(urn) == root for urn in urns)
+
+  def Resume(self, urns):
+    """Returns the checkpoint to delete urns with, None to start afresh."""
+    if self._RootIn(urns):
+      return self.checkpoint
+    return None
+
+  def Update(self, checkpoint):
+    """Stores a newer checkpoint, at most every CHECKPOINT_INTERVAL seconds."""
+    if (checkpoint is not None and checkpoint != self.checkpoint and
+        time.time() - self.written_time >= CHECKPOINT_INTERVAL):
+      self._Write(checkpoint)
+
+  def Deleted(self, urns):
+    """Clears the checkpoint if its root is among the deleted urns."""
+    if self._RootIn(urns):
+      self._Write(None)
+
+
+def _DeleteSubtrees(cron_flow, urns, checkpoint):
+  """Deletes urns and everything below them, reporting progress.
+
+  Args:
+    cron_flow: The StatefulSystemCronFlow doing the deletion. It heartbeats
+        as batches are deleted.
+    urns: Urns of objects to remove.
+    checkpoint: The _DeletionCheckpoint of this run of cron_flow.
+  """
+  if not urns:
+    return
+
+  state = {"roots_deleted": 0}
+
+  def Progress(progress):
+    cron_flow.HeartBeat()
+    if progress.roots_deleted != state["roots_deleted"]:
+      state["roots_deleted"] = progress.roots_deleted
+      cron_flow.Log("Deletion progress: %s", progress)
+
+    checkpoint.Update(progress.checkpoint)
+
+  aff4.FACTORY.StreamingMultiDelete(
+      urns,
+      token=cron_flow.token,
+      checkpoint=checkpoint.Resume(urns),
+      progress_callback=Progress)
+
+  # Everything is gone, there is nothing left to resume.
+  checkpoint.Deleted(urns)
+
+
+class CleanHunts(cronjobs.StatefulSystemCronFlow):
   """Cleaner that deletes old hunts."""
 
   frequency = rdfvalue.Duration("1d")
@@ -39,14 +139,16 @@ class CleanHunts(cronjobs.SystemCronFlow):
 
     hunts = aff4.FACTORY.MultiOpen(
         hunts_urns, aff4_type=implementation.GRRHunt, token=self.token)
+    expired_hunt_urns = []
     for hunt in hunts:
       if exception_label in hunt.GetLabelsNames():
         continue
 
       runner = hunt.GetRunner()
       if runner.context.expires < deadline:
-        aff4.FACTORY.Delete(hunt.urn, token=self.token)
-        self.HeartBeat()
+        expired_hunt_urns.append(hunt.urn)
+
+    _DeleteSubtrees(self, expired_hunt_urns, _DeletionCheckpoint(self))
 
 
 class CleanCronJobs(cronjobs.SystemCronFlow):
@@ -106,7 +208,7 @@ class CleanTemp(cronjobs.SystemCronFlow):
       self.HeartBeat()
 
 
-class CleanInactiveClients(cronjobs.SystemCronFlow):
+class CleanInactiveClients(cronjobs.StatefulSystemCronFlow):
   """Cleaner that deletes inactive clients."""
 
   frequency = rdfvalue.Duration("1d")
@@ -132,18 +234,25 @@ class CleanInactiveClients(cronjobs.SystemCronFlow):
 
     deadline = rdfvalue.RDFDatetime.Now() - inactive_client_ttl
 
+    # A checkpoint left by an earlier run is only cleared once the group
+    # holding its root is deleted.
+    checkpoint = _DeletionCheckpoint(self)
+    schema = aff4_grr.VFSGRRClient.SchemaCls
     for client_group in utils.Grouper(client_urns, 1000):
       inactive_client_urns = []
       for client in aff4.FACTORY.MultiOpen(
           client_group,
           mode="r",
           aff4_type=aff4_grr.VFSGRRClient,
+          attributes=[schema.LABELS, schema.LAST],
           token=self.token):
-        if exception_label in client.GetLabelsNames():
+        labels = client.Get(schema.LABELS,
+                            aff4_rdfvalues.AFF4ObjectLabelsList())
+        if exception_label in labels.GetLabelNames():
           continue
 
-        if client.Get(client.Schema.LAST) < deadline:
+        if client.Get(schema.LAST) < deadline:
           inactive_client_urns.append(client.urn)
 
-      aff4.FACTORY.MultiDelete(inactive_client_urns, token=self.token)
+      _DeleteSubtrees(self, inactive_client_urns, checkpoint)
       self.HeartBeat()
@@ -381,6 +381,121 @@ class CleanInactiveClientsTest(test_lib.FlowTestsBaseclass):
       self.assertEqual(len(client_urns), 3)
 
 
+class FakeCronFlow(object):
+  """A cron flow keeping its state in memory."""
+
+  def __init__(self, token, state=None):
+    self.token = token
+    self.state = state
+    self.written = []
+
+  def ReadCronState(self):
+    if self.state is None:
+      raise cronjobs.StateReadError("No cron job.")
+    return flow.AttributedDict(self.state)
+
+  def WriteCronState(self, state):
+    self.written.append(dict(state))
+
+  def HeartBeat(self):
+    pass
+
+  def Log(self, *unused_args):
+    pass
+
+
+class DeleteSubtreesTest(test_lib.GRRBaseTest):
+  """Test the checkpointing of _DeleteSubtrees."""
+
+  def _DeleteSubtrees(self,
+                      cron_flow,
+                      checkpoints,
+                      urns=("aff4:/hunts/H:1",),
+                      checkpoint=None):
+    calls = []
+
+    def StreamingMultiDelete(urns, token=None, checkpoint=None,
+                             progress_callback=None):
+      calls.append((urns, token, checkpoint))
+      progress = aff4.DeletionProgress(urns)
+      # Every checkpoint is reported a minute after the previous one.
+      for i, progress.checkpoint in enumerate(checkpoints):
+        with test_lib.FakeTime(1000 + 60 * (i + 1)):
+          progress_callback(progress)
+
+    with utils.Stubber(aff4.FACTORY, "StreamingMultiDelete",
+                       StreamingMultiDelete):
+      with test_lib.FakeTime(1000):
+        if checkpoint is None:
+          checkpoint = data_retention._DeletionCheckpoint(cron_flow)
+        data_retention._DeleteSubtrees(cron_flow, list(urns), checkpoint)
+
+    return calls
+
+  def testCheckpointIsStoredAndCleared(self):
+    cron_flow = FakeCronFlow(self.token, state={})
+    checkpoint = (rdfvalue.RDFURN("aff4:/hunts/H:1"),
+                  rdfvalue.RDFURN("aff4:/hunts/H:1/Results"))
+    calls = self._DeleteSubtrees(cron_flow, [])
+    self.assertEqual(calls[0][2], None)
+    self.assertEqual(cron_flow.written, [])
+
+    self._DeleteSubtrees(cron_flow, [checkpoint])
+
+    self.assertEqual(len(cron_flow.written), 2)
+    self.assertEqual(cron_flow.written[0]["deletion_checkpoint_subject"],
+                     "aff4:/hunts/H:1/Results")
+    # Once the deletion finished, there is nothing left to resume.
+    self.assertEqual(cron_flow.written[1]["deletion_checkpoint_root"], "")
+
+  def testStoredCheckpointIsResumed(self):
+    cron_flow = FakeCronFlow(
+        self.token,
+        state={
+            "deletion_checkpoint_root": "aff4:/hunts/H:1",
+            "deletion_checkpoint_subject": "aff4:/hunts/H:1/Results"
+        })
+    calls = self._DeleteSubtrees(cron_flow, [])
+
+    root, subject = calls[0][2]
+    self.assertEqual(root, rdfvalue.RDFURN("aff4:/hunts/H:1"))
+    self.assertEqual(subject, rdfvalue.RDFURN("aff4:/hunts/H:1/Results"))
+
+  def testWorksWithoutCronJob(self):
+    cron_flow = FakeCronFlow(self.token)
+    calls = self._DeleteSubtrees(cron_flow, [
+        (rdfvalue.RDFURN("aff4:/hunts/H:1"),
+         rdfvalue.RDFURN("aff4:/hunts/H:1/Results"))
+    ])
+
+    self.assertEqual(calls[0][2], None)
+    self.assertEqual(cron_flow.written, [])
+
+  def testCheckpointIsKeptUntilItsRootIsDeleted(self):
+    cron_flow = FakeCronFlow(
+        self.token,
+        state={
+            "deletion_checkpoint_root": "aff4:/hunts/H:2",
+            "deletion_checkpoint_subject": "aff4:/hunts/H:2/Results"
+        })
+    with test_lib.FakeTime(1000):
+      checkpoint = data_retention._DeletionCheckpoint(cron_flow)
+
+    # The first group does not hold the root of the checkpoint.
+    calls = self._DeleteSubtrees(
+        cron_flow, [], urns=["aff4:/hunts/H:1"], checkpoint=checkpoint)
+    self.assertEqual(calls[0][2], None)
+    self.assertEqual(cron_flow.written, [])
+
+    calls = self._DeleteSubtrees(
+        cron_flow, [],
+        urns=["aff4:/hunts/H:2", "aff4:/hunts/H:3"],
+        checkpoint=checkpoint)
+    self.assertEqual(calls[0][2][0], rdfvalue.RDFURN("aff4:/hunts/H:2"))
+    self.assertEqual(len(cron_flow.written), 1)
+    self.assertEqual(cron_flow.written[0]["deletion_checkpoint_root"], "")
+
+
 def main(argv):
   # Run the full test suite
   test_lib.GrrTestProgram(argv=argv)
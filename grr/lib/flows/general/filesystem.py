@@ -9,6 +9,7 @@ from grr.client.client_actions import searching as searching_actions
 from grr.client.client_actions import standard as standard_actions
 from grr.lib import aff4
 from grr.lib import artifact_utils
+from grr.lib import data_store
 from grr.lib import flow
 from grr.lib.aff4_objects import aff4_grr
 from grr.lib.aff4_objects import standard
@@ -26,9 +27,8 @@ stat_type_mask = (stat.S_IFREG | stat.S_IFDIR | stat.S_IFLNK | stat.S_IFBLK
                   | stat.S_IFCHR | stat.S_IFIFO | stat.S_IFSOCK)
 
 
-def CreateAFF4Object(stat_response, client_id, token, sync=False):
-  """This creates a File or a Directory from a stat response."""
-
+def _AFF4TypeForStat(stat_response, client_id):
+  """Sets the aff4path of stat_response and returns the type to create."""
   stat_response.aff4path = aff4_grr.VFSGRRClient.PathspecToURN(
       stat_response.pathspec, client_id)
 
@@ -41,9 +41,14 @@ def CreateAFF4Object(stat_response, client_id, token, sync=False):
     stat_response.st_mode |= stat.S_IFREG
 
   if stat.S_ISDIR(stat_response.st_mode):
-    ftype = standard.VFSDirectory
+    return standard.VFSDirectory
   else:
-    ftype = aff4_grr.VFSFile
+    return aff4_grr.VFSFile
+
+
+def CreateAFF4Object(stat_response, client_id, token, sync=False):
+  """This creates a File or a Directory from a stat response."""
+  ftype = _AFF4TypeForStat(stat_response, client_id)
 
   fd = aff4.FACTORY.Create(stat_response.aff4path, ftype, mode="w", token=token)
   fd.Set(fd.Schema.STAT(stat_response))
@@ -51,6 +56,36 @@ def CreateAFF4Object(stat_response, client_id, token, sync=False):
   fd.Close(sync=sync)
 
 
+def CreateAFF4Objects(stat_responses, client_id, token):
+  """Creates Files and Directories from many stat responses at once.
+
+  The child index entries are written once for all the objects and all the
+  writes go through a single mutation pool.
+
+  Args:
+    stat_responses: A list of StatEntry objects.
+    client_id: The client the stat responses come from.
+    token: The Security Token to use.
+  """
+  responses_by_type = {}
+  for stat_response in stat_responses:
+    ftype = _AFF4TypeForStat(stat_response, client_id)
+    responses_by_type.setdefault(ftype, []).append(stat_response)
+
+  with data_store.DB.GetMutationPool(token=token) as mutation_pool:
+    for ftype, responses in responses_by_type.iteritems():
+      fds = aff4.FACTORY.CreateMany(
+          [response.aff4path for response in responses],
+          ftype,
+          mode="w",
+          token=token,
+          mutation_pool=mutation_pool)
+      for fd, stat_response in zip(fds, responses):
+        fd.Set(fd.Schema.STAT(stat_response))
+        fd.Set(fd.Schema.PATHSPEC(stat_response.pathspec))
+        fd.Close(sync=False)
+
+
 class ListDirectoryArgs(rdf_structs.RDFProtoStruct):
   protobuf = flows_pb2.ListDirectoryArgs
 
@@ -102,18 +137,22 @@ class ListDirectory(flow.GRRFlow):
 
     self.Status("Listed %s", self.state.urn)
 
-    # The AFF4 object is opened for writing with an asyncronous close for speed.
-    fd = aff4.FACTORY.Create(
-        self.state.urn, standard.VFSDirectory, mode="w", token=self.token)
+    stat_entries = [rdf_client.StatEntry(st) for st in responses]
 
-    fd.Set(fd.Schema.PATHSPEC(self.state.stat.pathspec))
-    fd.Set(fd.Schema.STAT(self.state.stat))
+    # All the objects are written to the data store at once.
+    with aff4.FACTORY.BatchWrites(token=self.token):
+      fd = aff4.FACTORY.Create(
+          self.state.urn, standard.VFSDirectory, mode="w", token=self.token)
 
-    fd.Close(sync=False)
+      fd.Set(fd.Schema.PATHSPEC(self.state.stat.pathspec))
+      fd.Set(fd.Schema.STAT(self.state.stat))
+
+      fd.Close(sync=False)
 
-    for st in responses:
-      st = rdf_client.StatEntry(st)
-      CreateAFF4Object(st, self.client_id, self.token, sync=False)
+      for st in stat_entries:
+        CreateAFF4Object(st, self.client_id, self.token, sync=False)
+
+    for st in stat_entries:
       self.SendReply(st)  # Send Stats to parent flows.
 
     aff4.FACTORY.Flush()
@@ -190,9 +229,9 @@ class IteratedListDirectory(ListDirectory):
     fd = aff4.FACTORY.Create(urn, standard.VFSDirectory, token=self.token)
     fd.Close(sync=False)
 
-    for st in self.state.responses:
-      st = rdf_client.StatEntry(st)
-      CreateAFF4Object(st, self.client_id, self.token)
+    stat_entries = [rdf_client.StatEntry(st) for st in self.state.responses]
+    CreateAFF4Objects(stat_entries, self.client_id, self.token)
+    for st in stat_entries:
       self.SendReply(st)  # Send Stats to parent flows.
 
   def NotifyAboutEnd(self):
@@ -270,9 +309,12 @@ class RecursiveListDirectory(flow.GRRFlow):
 
   def StoreDirectory(self, responses):
     """Stores all stat responses."""
-    for st in responses:
-      st = rdf_client.StatEntry(st)
-      CreateAFF4Object(st, self.client_id, self.token)
+    stat_entries = [rdf_client.StatEntry(st) for st in responses]
+    with aff4.FACTORY.BatchWrites(token=self.token):
+      for st in stat_entries:
+        CreateAFF4Object(st, self.client_id, self.token)
+
+    for st in stat_entries:
       self.SendReply(st)  # Send Stats to parent flows.
 
   def NotifyAboutEnd(self):
@@ -4,6 +4,7 @@
 
 from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import config_lib
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib.aff4_objects import queue as aff4_queue
@@ -64,14 +65,21 @@ class HuntResultQueue(aff4_queue.Queue):
 
     f = CollectionFilter(collection)
     results = []
-    with aff4.FACTORY.OpenWithLock(
-        RESULT_NOTIFICATION_QUEUE,
-        aff4_type=HuntResultQueue,
-        lease_time=300,
-        blocking=True,
-        blocking_sleep_interval=15,
-        blocking_lock_timeout=600,
-        token=token) as queue:
+    if config_lib.CONFIG["Datastore.lock_free_leasing"]:
+      # Records are claimed one by one with compare-and-set so there is no
+      # need to serialize all callers on the queue lock.
+      queue = aff4.FACTORY.Open(
+          RESULT_NOTIFICATION_QUEUE, aff4_type=HuntResultQueue, token=token)
+    else:
+      queue = aff4.FACTORY.OpenWithLock(
+          RESULT_NOTIFICATION_QUEUE,
+          aff4_type=HuntResultQueue,
+          lease_time=300,
+          blocking=True,
+          blocking_sleep_interval=15,
+          blocking_lock_timeout=600,
+          token=token)
+    with queue:
       for record_id, value in queue.ClaimRecords(
           record_filter=f.FilterRecord,
           start_time=start_time,
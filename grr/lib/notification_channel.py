@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""Channels waking up workers as soon as flows are notified.
+
+Workers find work by scanning the notification shards of their queues and
+wait for a while when a scan finds nothing. Processes writing notifications
+publish the notified queues to the configured channel so waiting workers can
+scan again right away. The wait always times out eventually, so work whose
+notifications were not published is still picked up by polling.
+"""
+
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class NotificationChannel(object):
+  """Base class for the channels between notifying processes and workers."""
+
+  __metaclass__ = registry.MetaclassRegistry
+
+  # If False nothing is ever published and workers have to poll as often as
+  # they would without a channel.
+  delivers_wakeups = True
+
+  def Publish(self, queues, token=None):
+    """Wakes up the workers waiting on any of the queues.
+
+    Args:
+      queues: The queues which got new notifications.
+      token: The token to use for the data store.
+    """
+    raise NotImplementedError()
+
+  def Wait(self, queues, timeout, token=None):
+    """Blocks until one of the queues is published to or timeout expires.
+
+    Args:
+      queues: The queues the worker processes.
+      timeout: The longest time to wait, in seconds.
+      token: The token to use for the data store.
+
+    Returns:
+      True if the worker was woken up, False on timeout.
+    """
+    raise NotImplementedError()
+
+  def Close(self):
+    """Releases the resources of this channel."""
+
+
+class PollingNotificationChannel(NotificationChannel):
+  """Delivers no wakeups, workers just sleep between scans."""
+
+  delivers_wakeups = False
+
+  def Publish(self, queues, token=None):
+    pass
+
+  def Wait(self, queues, timeout, token=None):
+    time.sleep(timeout)
+    return False
+
+
+class UnixSocketNotificationChannel(NotificationChannel):
+  """Wakes up the workers running on this host through UNIX sockets.
+
+  Every waiting worker binds a datagram socket in
+  Worker.notification_channel_socket_dir. Publishers send the names of the
+  notified queues to all the sockets found there.
+  """
+
+  MAX_MESSAGE_SIZE = 65536
+
+  def __init__(self, socket_dir=None):
+    super(UnixSocketNotificationChannel, self).__init__()
+    self.socket_dir = socket_dir or config_lib.CONFIG[
+        "Worker.notification_channel_socket_dir"]
+    self._socket = None
+    self._socket_path = None
+    self._lock = threading.Lock()
+
+  def _Listen(self):
+    """Returns the socket of this worker, binding it if needed."""
+    with self._lock:
+      if self._socket is None:
+        utils.EnsureDirExists(self.socket_dir)
+        path = os.path.join(self.socket_dir,
+                            "%d-%x.sock" % (os.getpid(), id(self)))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.setblocking(0)
+        self._socket, self._socket_path = sock, path
+
+      return self._socket
+
+  def Publish(self, queues, token=None):
+    _ = token
+    message = "\n".join(sorted(set(utils.SmartStr(q) for q in queues)))
+    try:
+      names = os.listdir(self.socket_dir)
+    except OSError:
+      # No worker ever waited on this host.
+      return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    try:
+      for name in names:
+        if not name.endswith(".sock"):
+          continue
+
+        path = os.path.join(self.socket_dir, name)
+        try:
+          sock.sendto(message, path)
+        except socket.error as e:
+          if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            # Left behind by a worker which is gone.
+            try:
+              os.unlink(path)
+            except OSError:
+              pass
+          elif e.errno != errno.EAGAIN:
+            # A full socket already has wakeups pending, anything else is
+            # unexpected but must not break the notifying process.
+            logging.debug("Unable to wake up worker at %s: %s", path, e)
+    finally:
+      sock.close()
+
+  def Wait(self, queues, timeout, token=None):
+    _ = token
+    sock = self._Listen()
+    wanted = set(utils.SmartStr(q) for q in queues)
+    deadline = time.time() + timeout
+
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+
+      readable, _, _ = select.select([sock], [], [], remaining)
+      if not readable:
+        return False
+
+      # Drain everything which is pending, one wakeup is enough.
+      woken = False
+      while True:
+        try:
+          message = sock.recv(self.MAX_MESSAGE_SIZE)
+        except socket.error:
+          break
+
+        if wanted.intersection(message.split("\n")):
+          woken = True
+
+      if woken:
+        stats.STATS.IncrementCounter("worker_notification_channel_wakeups")
+        return True
+
+  def Close(self):
+    with self._lock:
+      if self._socket is not None:
+        self._socket.close()
+        try:
+          os.unlink(self._socket_path)
+        except OSError:
+          pass
+
+        self._socket = self._socket_path = None
+
+
+class DataStoreNotificationChannel(NotificationChannel):
+  """Wakes up workers on any host through the data store.
+
+  Publishing writes the current time to a wakeup cell of each notified queue.
+  Waiting workers long-poll the cells of their queues every
+  Worker.notification_channel_poll_interval seconds, which is a lot cheaper
+  than scanning all the notification shards of the queues.
+  """
+
+  WAKEUP_PREDICATE = "queue:wakeup"
+
+  def __init__(self, poll_interval=None):
+    super(DataStoreNotificationChannel, self).__init__()
+    self.poll_interval = (
+        poll_interval or
+        config_lib.CONFIG["Worker.notification_channel_poll_interval"])
+    # Wakeup subject -> the last wakeup this worker has seen.
+    self._last_seen = {}
+
+  def _WakeupSubject(self, queue):
+    return rdfvalue.RDFURN(queue).Add("wakeup")
+
+  def Publish(self, queues, token=None):
+    now = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+    for queue in set(queues):
+      data_store.DB.Set(
+          self._WakeupSubject(queue),
+          self.WAKEUP_PREDICATE,
+          now,
+          replace=True,
+          sync=True,
+          token=token)
+
+  def _CheckWakeups(self, subjects, token=None):
+    """Returns True if any of the wakeup cells changed since last seen."""
+    woken = False
+    seen = set()
+    for subject, values in data_store.DB.MultiResolvePrefix(
+        subjects, [self.WAKEUP_PREDICATE],
+        timestamp=data_store.DB.NEWEST_TIMESTAMP,
+        token=token):
+      key = utils.SmartUnicode(subject)
+      seen.add(key)
+      for _, value, _ in values:
+        value = long(value)
+        # The first value seen is only the baseline.
+        if self._last_seen.setdefault(key, value) != value:
+          self._last_seen[key] = value
+          woken = True
+
+    # Queues nobody ever published to, the first wakeup must not be missed.
+    for subject in subjects:
+      key = utils.SmartUnicode(subject)
+      if key not in seen:
+        self._last_seen.setdefault(key, 0)
+
+    return woken
+
+  def Wait(self, queues, timeout, token=None):
+    subjects = [self._WakeupSubject(queue) for queue in queues]
+    deadline = time.time() + timeout
+
+    while True:
+      if self._CheckWakeups(subjects, token=token):
+        stats.STATS.IncrementCounter("worker_notification_channel_wakeups")
+        return True
+
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+
+      time.sleep(min(self.poll_interval, remaining))
+
+
+# The channel of this process, set up from Worker.notification_channel.
+CHANNEL = None
+
+
+class NotificationChannelInit(registry.InitHook):
+  """Sets up the configured notification channel."""
+
+  pre = ["DataStoreInit"]
+
+  def Run(self):
+    global CHANNEL  # pylint: disable=global-statement
+
+    name = config_lib.CONFIG["Worker.notification_channel"]
+    try:
+      cls = NotificationChannel.GetPlugin(name)
+    except KeyError:
+      raise RuntimeError("No notification channel %s found." % name)
+
+    CHANNEL = cls()  # pylint: disable=g-bad-name
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("worker_notification_channel_wakeups")
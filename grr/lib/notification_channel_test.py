@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Tests for the channels waking up workers."""
+
+
+import os
+import socket
+
+
+from grr.lib import flags
+from grr.lib import notification_channel
+from grr.lib import queues
+from grr.lib import test_lib
+
+# pylint: mode=test
+
+
+class UnixSocketNotificationChannelTest(test_lib.GRRBaseTest):
+  """Tests for UnixSocketNotificationChannel."""
+
+  def setUp(self):
+    super(UnixSocketNotificationChannelTest, self).setUp()
+    self.socket_dir = os.path.join(self.temp_dir, "wakeup")
+    self.worker = notification_channel.UnixSocketNotificationChannel(
+        socket_dir=self.socket_dir)
+    self.publisher = notification_channel.UnixSocketNotificationChannel(
+        socket_dir=self.socket_dir)
+
+  def tearDown(self):
+    self.worker.Close()
+    super(UnixSocketNotificationChannelTest, self).tearDown()
+
+  def testPublishWakesUpWorker(self):
+    # Nothing is listening yet.
+    self.publisher.Publish([queues.FLOWS])
+    self.assertFalse(self.worker.Wait([queues.FLOWS], 0))
+
+    self.publisher.Publish([queues.FLOWS, queues.HUNTS])
+    self.assertTrue(self.worker.Wait([queues.FLOWS], 10))
+
+    # All the pending wakeups were consumed.
+    self.assertFalse(self.worker.Wait([queues.FLOWS], 0.1))
+
+  def testOtherQueuesDoNotWakeUpWorker(self):
+    self.assertFalse(self.worker.Wait([queues.FLOWS], 0))
+    self.publisher.Publish([queues.HUNTS])
+    self.assertFalse(self.worker.Wait([queues.FLOWS], 0.1))
+
+  def testSocketsOfGoneWorkersAreRemoved(self):
+    self.assertFalse(self.worker.Wait([queues.FLOWS], 0))
+
+    stale_path = os.path.join(self.socket_dir, "1-1.sock")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(stale_path)
+    sock.close()
+
+    self.publisher.Publish([queues.FLOWS])
+    self.assertFalse(os.path.exists(stale_path))
+    self.assertTrue(self.worker.Wait([queues.FLOWS], 10))
+
+    self.worker.Close()
+    self.assertEqual(os.listdir(self.socket_dir), [])
+
+
+class DataStoreNotificationChannelTest(test_lib.GRRBaseTest):
+  """Tests for DataStoreNotificationChannel."""
+
+  def testPublishWakesUpWorker(self):
+    worker = notification_channel.DataStoreNotificationChannel(
+        poll_interval=0.01)
+    publisher = notification_channel.DataStoreNotificationChannel()
+
+    self.assertFalse(worker.Wait([queues.FLOWS], 0, token=self.token))
+    publisher.Publish([queues.FLOWS], token=self.token)
+    self.assertTrue(worker.Wait([queues.FLOWS], 10, token=self.token))
+    self.assertFalse(worker.Wait([queues.FLOWS], 0.05, token=self.token))
+
+    publisher.Publish([queues.HUNTS], token=self.token)
+    self.assertFalse(worker.Wait([queues.FLOWS], 0.05, token=self.token))
+
+    with test_lib.FakeTime(1000):
+      publisher.Publish([queues.FLOWS], token=self.token)
+    self.assertTrue(worker.Wait([queues.FLOWS], 10, token=self.token))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
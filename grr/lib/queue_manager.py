@@ -13,6 +13,7 @@ import logging
 
 from grr.lib import config_lib
 from grr.lib import data_store
+from grr.lib import notification_channel
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -29,6 +30,51 @@ class MoreDataException(Error):
   """Raised when there is more data available."""
 
 
+class NotificationShardLayout(object):
+  """How the notifications of a queue are spread over shards.
+
+  Attributes:
+    shard_count: The number of shards new notifications are written to.
+    drain_shard_count: The number of shards of an earlier, larger layout
+        which may still hold notifications. Readers keep scanning these
+        shards until they are found empty.
+    version: When the layout was last changed, 0 if it never was and the
+        configured Worker.queue_shards is used.
+  """
+
+  def __init__(self, shard_count, drain_shard_count=0, version=0):
+    self.shard_count = shard_count
+    self.drain_shard_count = drain_shard_count
+    self.version = version
+
+  @property
+  def scanned_shard_count(self):
+    return max(self.shard_count, self.drain_shard_count)
+
+  @property
+  def draining(self):
+    return self.drain_shard_count > self.shard_count
+
+
+class PrefetchedResponses(object):
+  """The completed requests and responses of a flow, read ahead of time.
+
+  Attributes:
+    timestamp: The end of the time range the data was read for.
+    completed_requests: A list of (request, status, responses) tuples in
+        ascending order of request ids.
+  """
+
+  def __init__(self, timestamp, completed_requests):
+    self.timestamp = timestamp
+    self.completed_requests = completed_requests
+
+  def Matches(self, timestamp):
+    """Returns True if the data was read for this (start, end) range."""
+    return (timestamp is not None and timestamp[0] == 0 and
+            timestamp[1] == self.timestamp)
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -87,8 +133,20 @@ class QueueManager(object):
   request_limit = 1000000
   response_limit = 1000000
 
+  # Number of notifications and tasks read from the data store at once.
+  notification_page_size = 1000
+  task_page_size = 100
+
   notification_shard_counters = {}
 
+  # The shard layouts are stored next to the notification shards of a queue.
+  SHARD_LAYOUT_SUBJECT = "shard_layout"
+  SHARD_COUNT_PREDICATE = "queue:shard_count"
+  DRAIN_SHARD_COUNT_PREDICATE = "queue:drain_shard_count"
+
+  # Queue -> (time read, stored NotificationShardLayout or None).
+  shard_layout_cache = {}
+
   def __init__(self, store=None, token=None):
     self.token = token
     if store is None:
@@ -109,23 +167,161 @@ class QueueManager(object):
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
+    # Session id -> PrefetchedResponses handed over by the worker.
+    self.prefetched_responses = {}
+
     self.num_notification_shards = config_lib.CONFIG["Worker.queue_shards"]
+    self.lock_free_leasing = config_lib.CONFIG["Datastore.lock_free_leasing"]
 
-  def GetNotificationShard(self, queue):
+  def GetShardLayout(self, queue):
+    """Returns the current notification shard layout of a queue.
+
+    Layouts are cached for Worker.queue_shard_layout_cache_time seconds, so a
+    change takes that long to reach all the processes.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+    Returns:
+      A NotificationShardLayout.
+    """
+    queue_name = str(queue)
+    max_age = config_lib.CONFIG["Worker.queue_shard_layout_cache_time"]
+    cached = QueueManager.shard_layout_cache.get(queue_name)
+    if cached is None or cached[0] + max_age < time.time():
+      cached = (time.time(), self._ReadShardLayout(queue))
+      QueueManager.shard_layout_cache[queue_name] = cached
+
+    layout = cached[1]
+    if layout is None:
+      return NotificationShardLayout(self.num_notification_shards)
+    return layout
+
+  def _ReadShardLayout(self, queue):
+    """Reads the stored layout of the queue, None if there is none."""
+    values = {}
+    for predicate, value, ts in self.data_store.ResolvePrefix(
+        queue.Add(self.SHARD_LAYOUT_SUBJECT),
+        "queue:",
+        timestamp=self.data_store.NEWEST_TIMESTAMP,
+        token=self.token):
+      values[predicate] = (long(value), ts)
+
+    if self.SHARD_COUNT_PREDICATE not in values:
+      return None
+
+    shard_count, version = values[self.SHARD_COUNT_PREDICATE]
+    drain_shard_count, _ = values.get(self.DRAIN_SHARD_COUNT_PREDICATE, (0, 0))
+    return NotificationShardLayout(
+        shard_count, drain_shard_count=drain_shard_count, version=version)
+
+  def SetShardCount(self, queue, shard_count):
+    """Changes the number of notification shards of a queue online.
+
+    Writers move to the new layout as soon as their cached copy expires. If
+    the queue shrinks, readers keep scanning the shards which are no longer
+    written to until DrainNotificationShards finds them empty.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      shard_count: The new number of shards.
+    Returns:
+      The new NotificationShardLayout.
+    Raises:
+      ValueError: If the shard count is not positive.
+    """
+    if shard_count < 1:
+      raise ValueError("A queue needs at least one notification shard.")
+
+    QueueManager.shard_layout_cache.pop(str(queue), None)
+    layout = self.GetShardLayout(queue)
+    # Every shard beyond the new count may still hold notifications.
+    drain_shard_count = layout.scanned_shard_count
+    if drain_shard_count <= shard_count:
+      drain_shard_count = 0
+
+    # Old versions of the count are kept, the newest one is the layout. Both
+    # counts are written in one call, so no reader ever sees the new count
+    # without the shards it still has to drain.
+    version = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch()
+    self.data_store.MultiSet(
+        queue.Add(self.SHARD_LAYOUT_SUBJECT), {
+            self.SHARD_COUNT_PREDICATE: [(shard_count, version)],
+            self.DRAIN_SHARD_COUNT_PREDICATE: [(drain_shard_count, version)]
+        },
+        to_delete=[self.DRAIN_SHARD_COUNT_PREDICATE],
+        replace=False,
+        sync=True,
+        token=self.token)
+
+    QueueManager.shard_layout_cache.pop(str(queue), None)
+    return self.GetShardLayout(queue)
+
+  def DrainNotificationShards(self, queue):
+    """Stops scanning shards left over by a shrunk layout once they are empty.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+    Returns:
+      True if there are no shards left to drain.
+    """
+    layout = self.GetShardLayout(queue)
+    if not layout.draining:
+      return True
+
+    # Writers still using the previous layout may add notifications to the
+    # drained shards until their cached layout expires.
+    age = rdfvalue.RDFDatetime.Now().AsMicroSecondsFromEpoch() - layout.version
+    max_age = config_lib.CONFIG["Worker.queue_shard_layout_cache_time"]
+    if age < max_age * 1e6:
+      return False
+
+    drained_shards = self.GetAllNotificationShards(queue)[layout.shard_count:]
+    for queue_shard in drained_shards:
+      if self.data_store.ResolvePrefix(
+          queue_shard,
+          self.NOTIFY_PREDICATE_PREFIX,
+          limit=1,
+          timestamp=self.data_store.ALL_TIMESTAMPS,
+          token=self.token):
+        return False
+
+    self.data_store.Set(
+        queue.Add(self.SHARD_LAYOUT_SUBJECT),
+        self.DRAIN_SHARD_COUNT_PREDICATE,
+        0,
+        replace=True,
+        sync=True,
+        token=self.token)
+    QueueManager.shard_layout_cache.pop(str(queue), None)
+    logging.info("Drained notification shards %d to %d of queue %s.",
+                 layout.shard_count, layout.drain_shard_count - 1, queue)
+    return True
+
+  def _NextNotificationShard(self, queue, shard_count):
     queue_name = str(queue)
     QueueManager.notification_shard_counters.setdefault(queue_name, 0)
     QueueManager.notification_shard_counters[queue_name] += 1
     notification_shard_index = (
-        QueueManager.notification_shard_counters[queue_name] %
-        self.num_notification_shards)
+        QueueManager.notification_shard_counters[queue_name] % shard_count)
     if notification_shard_index > 0:
       return queue.Add(str(notification_shard_index))
     else:
       return queue
 
+  def GetNotificationShard(self, queue):
+    """Returns the shard the next notification for the queue is written to."""
+    return self._NextNotificationShard(queue,
+                                       self.GetShardLayout(queue).shard_count)
+
+  def _GetNotificationShardToScan(self, queue):
+    """Returns the next shard to read, including the ones being drained."""
+    return self._NextNotificationShard(
+        queue, self.GetShardLayout(queue).scanned_shard_count)
+
   def GetAllNotificationShards(self, queue):
+    """Returns all the shards of the queue which may hold notifications."""
     result = [queue]
-    for i in range(1, self.num_notification_shards):
+    for i in range(1, self.GetShardLayout(queue).scanned_shard_count):
       result.append(queue.Add(str(i)))
     return result
 
@@ -203,6 +399,12 @@ class QueueManager(object):
 
   def FetchCompletedRequests(self, session_id, timestamp=None):
     """Fetch all the requests with a status message queued for them."""
+    prefetched = self.prefetched_responses.get(str(session_id))
+    if prefetched is not None and prefetched.Matches(timestamp):
+      for request, status, _ in prefetched.completed_requests:
+        yield request, status
+      return
+
     subject = session_id.Add("state")
     requests = {}
     status = {}
@@ -231,6 +433,13 @@ class QueueManager(object):
   def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000):
     """Fetch only completed requests and responses up to a limit."""
 
+    # Prefetched data is only good for one pass, later passes read again.
+    prefetched = self.prefetched_responses.pop(str(session_id), None)
+    if prefetched is not None and prefetched.Matches(timestamp):
+      for request, _, responses in prefetched.completed_requests:
+        yield request, responses
+      return
+
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now())
 
@@ -281,6 +490,112 @@ class QueueManager(object):
         if total_size > limit:
           raise MoreDataException()
 
+  def PrefetchCompletedResponses(self, notifications, limit=10000):
+    """Reads the completed requests and responses of many flows at once.
+
+    Every flow is read as FetchCompletedResponses would read it when
+    processing its notification, but all the flows are read with two
+    multi-subject reads instead of a few reads per flow.
+
+    Args:
+      notifications: The notifications of the flows to read.
+      limit: The most responses read in total. Flows which do not fit are
+          left out and read on their own when they are processed.
+
+    Returns:
+      A dict of session id strings to PrefetchedResponses.
+    """
+    flows = collections.OrderedDict()
+    for notification in notifications:
+      if notification.timestamp:
+        flows[str(notification.session_id.Add("state"))] = notification
+
+    if not flows:
+      return {}
+
+    end = max(n.timestamp.AsMicroSecondsFromEpoch() for n in flows.values())
+
+    # Read the requests and statuses of all the flows.
+    requests_and_statuses = {}
+    for subject, values in self.data_store.MultiResolvePrefix(
+        flows.keys(), [self.FLOW_REQUEST_PREFIX, self.FLOW_STATUS_PREFIX],
+        timestamp=(0, end),
+        token=self.token):
+      flow_end = flows[str(subject)].timestamp.AsMicroSecondsFromEpoch()
+      requests, status = {}, {}
+      for predicate, serialized, ts in values:
+        if ts > flow_end:
+          continue
+
+        parts = predicate.split(":", 3)
+        if parts[1] == "status":
+          status[parts[2]] = serialized
+        else:
+          requests[parts[2]] = serialized
+
+      requests_and_statuses[str(subject)] = (requests, status)
+
+    # Pick the flows whose responses fit and read those at once.
+    completed = {}
+    response_subjects = []
+    total_size = 0
+    for subject, notification in flows.iteritems():
+      requests, status = requests_and_statuses.get(subject, ({}, {}))
+      flow_completed = []
+      flow_size = 0
+      for request_id, serialized in sorted(requests.items()):
+        if request_id in status:
+          request = rdf_flows.RequestState.FromSerializedString(serialized)
+          request_status = rdf_flows.GrrMessage.FromSerializedString(
+              status[request_id])
+          flow_completed.append((request, request_status))
+          flow_size += request_status.response_id
+
+      if total_size + flow_size > limit:
+        continue
+
+      total_size += flow_size
+      completed[subject] = flow_completed
+      for request, _ in flow_completed:
+        response_subjects.append(
+            str(self.GetFlowResponseSubject(notification.session_id,
+                                            request.id)))
+
+    response_data = {}
+    if response_subjects:
+      for subject, values in self.data_store.MultiResolvePrefix(
+          response_subjects,
+          self.FLOW_RESPONSE_PREFIX,
+          timestamp=(0, end),
+          token=self.token):
+        response_data[str(subject)] = values
+
+    result = {}
+    for subject, flow_completed in completed.iteritems():
+      notification = flows[subject]
+      flow_end = notification.timestamp.AsMicroSecondsFromEpoch()
+      completed_requests = []
+      for request, status in flow_completed:
+        response_subject = str(
+            self.GetFlowResponseSubject(notification.session_id, request.id))
+        responses = [
+            rdf_flows.GrrMessage.FromSerializedString(serialized)
+            for _, serialized, ts in response_data.get(response_subject, [])
+            if ts <= flow_end
+        ]
+        completed_requests.append(
+            (request, status, sorted(
+                responses, key=lambda msg: msg.response_id)))
+
+      result[str(notification.session_id)] = PrefetchedResponses(
+          notification.timestamp, completed_requests)
+
+    return result
+
+  def SetPrefetchedResponses(self, session_id, prefetched):
+    """Makes the next fetch of a flow's completed responses use prefetched."""
+    self.prefetched_responses[str(session_id)] = prefetched
+
   def FetchRequestsAndResponses(self, session_id, timestamp=None):
     """Fetches all outstanding requests and responses for this flow.
 
@@ -411,11 +726,14 @@ class QueueManager(object):
               mutation_pool=mutation_pool)
 
     if self.notifications:
+      notified_queues = set()
       for notification, timestamp in self.notifications.itervalues():
+        notified_queues.add(notification.session_id.Queue())
         self.NotifyQueue(
             notification, timestamp=timestamp, mutation_pool=mutation_pool)
 
       mutation_pool.Flush()
+      self._WakeUpWorkers(notified_queues)
 
     self.to_write = {}
     self.to_delete = {}
@@ -561,13 +879,25 @@ class QueueManager(object):
 
     return output_dict
 
-  def GetNotificationsByPriority(self, queue):
-    """Retrieves session ids for processing grouped by priority."""
+  def GetNotificationsByPriority(self, queue, queue_shard=None):
+    """Retrieves session ids for processing grouped by priority.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      queue_shard: The notification shard of the queue to read. By default the
+          shards are read in turn.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
-    queue_shard = self.GetNotificationShard(queue)
-    return self._SortByPriority(
-        self._GetUnsortedNotifications(queue_shard).values(), queue)
+    if queue_shard is None:
+      queue_shard = self._GetNotificationShardToScan(queue)
+    notifications = self._GetUnsortedNotifications(queue_shard)
+    if not notifications and self.GetShardLayout(queue).draining:
+      self.DrainNotificationShards(queue)
+
+    return self._SortByPriority(notifications.values(), queue)
 
   def GetNotificationsByPriorityForAllShards(self, queue):
     """Same as GetNotificationsByPriority but for all shards.
@@ -588,7 +918,7 @@ class QueueManager(object):
 
   def GetNotifications(self, queue):
     """Returns all queue notifications sorted by priority."""
-    queue_shard = self.GetNotificationShard(queue)
+    queue_shard = self._GetNotificationShardToScan(queue)
     notifications = self._GetUnsortedNotifications(queue_shard).values()
     notifications.sort(
         key=lambda notification: notification.priority, reverse=True)
@@ -630,12 +960,16 @@ class QueueManager(object):
     if notifications_by_session_id is None:
       notifications_by_session_id = {}
     end_time = self.frozen_timestamp or rdfvalue.RDFDatetime.Now()
-    for predicate, serialized_notification, ts in self.data_store.ResolvePrefix(
-        queue_shard,
-        self.NOTIFY_PREDICATE_PREFIX,
-        timestamp=(0, end_time),
-        token=self.token,
-        limit=10000):
+    depth = 0
+    # Walk the shard page by page so large shards are neither truncated nor
+    # loaded in one go.
+    for predicate, serialized_notification, ts in (
+        self.data_store.ResolvePrefixIter(
+            queue_shard,
+            self.NOTIFY_PREDICATE_PREFIX,
+            timestamp=(0, end_time),
+            page_size=self.notification_page_size,
+            token=self.token)):
 
       # Parse the notification.
       try:
@@ -655,6 +989,7 @@ class QueueManager(object):
             sync=True)
         continue
 
+      depth += 1
       # Strip the prefix from the predicate to get the session_id.
       session_id = predicate[len(self.NOTIFY_PREDICATE_PREFIX):]
       notification.session_id = session_id
@@ -677,6 +1012,8 @@ class QueueManager(object):
       else:
         notifications_by_session_id[notification.session_id] = notification
 
+    stats.STATS.SetGaugeValue(
+        "notification_shard_depth", depth, fields=[str(queue_shard)])
     return notifications_by_session_id
 
   def NotifyQueue(self, notification, **kwargs):
@@ -742,6 +1079,7 @@ class QueueManager(object):
       values[self.NOTIFY_PREDICATE_TEMPLATE % session_id] = [(data, timestamp)]
 
     if mutation_pool:
+      # Workers are woken up by whoever flushes the pool.
       mutation_pool.MultiSet(
           self.GetNotificationShard(queue), values, replace=False)
     else:
@@ -751,6 +1089,13 @@ class QueueManager(object):
           sync=sync,
           replace=False,
           token=self.token)
+      if values:
+        self._WakeUpWorkers([queue])
+
+  def _WakeUpWorkers(self, queues):
+    """Tells the workers waiting on these queues they have new notifications."""
+    if queues and notification_channel.CHANNEL is not None:
+      notification_channel.CHANNEL.Publish(queues, token=self.token)
 
   def DeleteNotification(self, session_id, start=None, end=None):
     self.DeleteNotifications([session_id], start=start, end=end)
@@ -841,6 +1186,14 @@ class QueueManager(object):
     user = ""
     if self.token:
       user = self.token.username
+    if self.lock_free_leasing:
+      try:
+        return self._QueryAndOwnLockFree(
+            queue, lease_seconds=lease_seconds, limit=limit, user=user)
+      except data_store.Error as e:
+        logging.warning("Datastore exception: %s", e)
+        return []
+
     # Do the real work in a transaction
     try:
       lock = self.data_store.LockRetryWrapper(queue, token=self.token)
@@ -864,10 +1217,12 @@ class QueueManager(object):
     # Only grab attributes with timestamps in the past.
     delete_attrs = set()
     serialized_tasks_dict = {}
-    for predicate, task, timestamp in data_store.DB.ResolvePrefix(
+    # Tasks are read page by page so we stop reading once we have enough.
+    for predicate, task, timestamp in data_store.DB.ResolvePrefixIter(
         subject,
         self.TASK_PREDICATE_PREFIX,
         timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now()),
+        page_size=max(limit, self.task_page_size),
         token=self.token):
       task = rdf_flows.GrrMessage.FromSerializedString(task)
       task.eta = timestamp
@@ -905,6 +1260,65 @@ class QueueManager(object):
                    len(delete_attrs), subject)
     return tasks
 
+  def _QueryAndOwnLockFree(self, subject, lease_seconds=100, limit=1, user=""):
+    """Leases tasks with a compare-and-set per task instead of a queue lock.
+
+    Tasks which another process leased or deleted since we read them are
+    skipped, so concurrent callers never lease the same task.
+
+    Args:
+      subject: The queue to query from.
+      lease_seconds: The tasks will be leased for this long.
+      limit: Number of values to fetch.
+      user: The user name recorded in the lease.
+
+    Returns:
+      A list of GrrMessage() objects leased.
+    """
+    tasks = []
+    expired = 0
+    lease_end = long(time.time() * 1e6) + long(lease_seconds * 1e6)
+
+    for predicate, serialized, timestamp in data_store.DB.ResolvePrefixIter(
+        subject,
+        self.TASK_PREDICATE_PREFIX,
+        timestamp=(0, self.frozen_timestamp or rdfvalue.RDFDatetime.Now()),
+        page_size=max(limit, self.task_page_size),
+        token=self.token):
+      expected = {predicate: (serialized, timestamp)}
+      task = rdf_flows.GrrMessage.FromSerializedString(serialized)
+      task.eta = timestamp
+      task.last_lease = "%s@%s:%d" % (user, socket.gethostname(), os.getpid())
+      # Decrement the ttl
+      task.task_ttl -= 1
+      if task.task_ttl <= 0:
+        # Remove the task if ttl is exhausted.
+        if data_store.DB.CheckAndMultiSet(
+            subject, expected, {}, to_delete=[predicate], token=self.token):
+          expired += 1
+          stats.STATS.IncrementCounter("grr_task_ttl_expired_count")
+        continue
+
+      if not data_store.DB.CheckAndMultiSet(
+          subject,
+          expected, {predicate: [task.SerializeToString()]},
+          timestamp=lease_end,
+          token=self.token):
+        stats.STATS.IncrementCounter("grr_task_lease_conflict_count")
+        continue
+
+      if task.task_ttl != rdf_flows.GrrMessage.max_ttl - 1:
+        stats.STATS.IncrementCounter("grr_task_retransmission_count")
+
+      tasks.append(task)
+      if len(tasks) >= limit:
+        break
+
+    if expired:
+      logging.info("TTL exceeded for %d messages on queue %s", expired,
+                   subject)
+    return tasks
+
 
 class WellKnownQueueManager(QueueManager):
   """A flow manager for well known flows."""
@@ -960,7 +1374,13 @@ class QueueManagerInit(registry.InitHook):
     # Counters used by the QueueManager.
     stats.STATS.RegisterCounterMetric("grr_task_retransmission_count")
     stats.STATS.RegisterCounterMetric("grr_task_ttl_expired_count")
+    stats.STATS.RegisterCounterMetric("grr_task_lease_conflict_count")
     stats.STATS.RegisterGaugeMetric(
         "notification_queue_count",
         int,
         fields=[("queue_name", str), ("priority", str)])
+    stats.STATS.RegisterGaugeMetric(
+        "notification_shard_depth",
+        int,
+        fields=[("shard", str)],
+        docstring="Notifications found in a shard when it was last scanned.")
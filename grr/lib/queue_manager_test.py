@@ -5,14 +5,18 @@
 import time
 
 
+import mock
+
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flags
+from grr.lib import notification_channel
 from grr.lib import queue_manager
 from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
 
 # pylint: mode=test
@@ -160,6 +164,96 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
       # Responses contain just the status message.
       self.assertEqual(len(responses), 1)
 
+  def _QueueCompletedRequests(self, session_id, request_ids, num_responses=3):
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for request_id in request_ids:
+        manager.QueueRequest(session_id,
+                             rdf_flows.RequestState(
+                                 id=request_id,
+                                 client_id=self.client_id,
+                                 next_state="TestState",
+                                 session_id=session_id))
+        for response_id in range(1, num_responses):
+          manager.QueueResponse(session_id,
+                                rdf_flows.GrrMessage(
+                                    request_id=request_id,
+                                    response_id=response_id))
+        manager.QueueResponse(session_id,
+                              rdf_flows.GrrMessage(
+                                  request_id=request_id,
+                                  response_id=num_responses,
+                                  type=rdf_flows.GrrMessage.Type.STATUS))
+
+  def testPrefetchCompletedResponses(self):
+    session_ids = [
+        rdfvalue.SessionID(flow_name="prefetch%d" % i) for i in range(3)
+    ]
+    for session_id in session_ids:
+      self._QueueCompletedRequests(session_id, [1, 2])
+
+    notifications = [
+        rdf_flows.GrrNotification(
+            session_id=session_id, timestamp=rdfvalue.RDFDatetime.Now())
+        for session_id in session_ids
+    ]
+
+    manager = queue_manager.QueueManager(token=self.token)
+    with mock.patch.object(
+        data_store.DB,
+        "MultiResolvePrefix",
+        wraps=data_store.DB.MultiResolvePrefix) as multi_resolve:
+      prefetched = manager.PrefetchCompletedResponses(notifications)
+
+    # One read for the requests of all flows and one for their responses.
+    self.assertEqual(multi_resolve.call_count, 2)
+    self.assertEqual(len(prefetched), 3)
+
+    for notification in notifications:
+      session_id = notification.session_id
+      timestamp = (0, notification.timestamp)
+      expected = list(
+          manager.FetchCompletedResponses(session_id, timestamp=timestamp))
+      self.assertEqual(len(expected), 2)
+
+      runner_manager = queue_manager.QueueManager(token=self.token)
+      runner_manager.SetPrefetchedResponses(session_id,
+                                            prefetched[str(session_id)])
+      with mock.patch.object(data_store.DB, "ResolvePrefix") as resolve:
+        with mock.patch.object(data_store.DB,
+                               "MultiResolvePrefix") as multi_resolve:
+          requests = list(
+              runner_manager.FetchCompletedRequests(
+                  session_id, timestamp=timestamp))
+          responses = list(
+              runner_manager.FetchCompletedResponses(
+                  session_id, timestamp=timestamp))
+
+      self.assertFalse(resolve.called)
+      self.assertFalse(multi_resolve.called)
+      self.assertEqual([r for r, _ in requests], [r for r, _ in expected])
+      self.assertEqual(responses, expected)
+
+      # Prefetched data is only used for one pass.
+      self.assertFalse(runner_manager.prefetched_responses)
+
+  def testPrefetchCompletedResponsesLimit(self):
+    session_ids = [
+        rdfvalue.SessionID(flow_name="prefetch%d" % i) for i in range(3)
+    ]
+    for session_id in session_ids:
+      self._QueueCompletedRequests(session_id, [1, 2])
+
+    notifications = [
+        rdf_flows.GrrNotification(
+            session_id=session_id, timestamp=rdfvalue.RDFDatetime.Now())
+        for session_id in session_ids
+    ]
+
+    # Every flow has 6 responses, only the first one fits.
+    manager = queue_manager.QueueManager(token=self.token)
+    prefetched = manager.PrefetchCompletedResponses(notifications, limit=6)
+    self.assertEqual(prefetched.keys(), [str(session_ids[0])])
+
   def testDeleteFlowRequestStates(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID(flow_name="test3")
@@ -293,6 +387,41 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     tasks = manager.QueryAndOwn(test_queue, lease_seconds=100)
     self.assertEqual(len(tasks), 0)
 
+  def testQueryAndOwnLockFree(self):
+    test_queue = rdfvalue.RDFURN("fooLockFree")
+    with test_lib.ConfigOverrider({"Datastore.lock_free_leasing": True}):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.Schedule([
+          rdf_flows.GrrMessage(
+              queue=test_queue,
+              task_ttl=5,
+              session_id="aff4:/Test",
+              generate_task_id=True) for _ in range(10)
+      ])
+
+      # Leasing does not need the queue lock.
+      with data_store.DB.DBSubjectLock(test_queue, token=self.token):
+        tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=6)
+      self.assertEqual(len(tasks), 6)
+      self.assertEqual(tasks[0].task_ttl, 4)
+
+      self._current_mock_time += 10
+      more_tasks = manager.QueryAndOwn(
+          test_queue, lease_seconds=100, limit=100)
+      self.assertEqual(len(more_tasks), 4)
+      self.assertFalse(
+          set(t.task_id for t in tasks) & set(t.task_id for t in more_tasks))
+
+      self._current_mock_time += 10
+      self.assertEqual(
+          manager.QueryAndOwn(test_queue, lease_seconds=100, limit=100), [])
+
+      # Leases expire as usual.
+      self._current_mock_time += 110
+      tasks = manager.QueryAndOwn(test_queue, lease_seconds=100, limit=100)
+      self.assertEqual(len(tasks), 10)
+      self.assertEqual(tasks[0].task_ttl, 3)
+
   def testTaskRetransmissionsAreCorrectlyAccounted(self):
     test_queue = rdfvalue.RDFURN("fooSchedule")
     task = rdf_flows.GrrMessage(
@@ -524,6 +653,7 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
   def tearDown(self):
     super(MultiShardedQueueManagerTest, self).tearDown()
     self.config_overrider.Stop()
+    queue_manager.QueueManager.shard_layout_cache.clear()
 
   def testFirstShardNameIsEqualToTheQueue(self):
     manager = queue_manager.QueueManager(token=self.token)
@@ -545,6 +675,126 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
 
     self.assertEqual(shard, queues.HUNTS.Add("1"))
 
+  def _NotifyAllShards(self, manager, count):
+    session_ids = []
+    for i in range(count):
+      session_id = rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name=str(100 + i))
+      manager.QueueNotification(session_id=session_id)
+      manager.Flush()
+      session_ids.append(session_id)
+    return session_ids
+
+  def testShardCountChangesOnline(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    self.assertEqual(len(manager.GetAllNotificationShards(queues.HUNTS)), 2)
+
+    layout = manager.SetShardCount(queues.HUNTS, 4)
+    self.assertEqual(layout.shard_count, 4)
+    self.assertFalse(layout.draining)
+
+    # Other processes see the new layout once their cache expires.
+    queue_manager.QueueManager.shard_layout_cache.clear()
+    manager = queue_manager.QueueManager(token=self.token)
+    all_shards = manager.GetAllNotificationShards(queues.HUNTS)
+    self.assertEqual(all_shards, [queues.HUNTS] +
+                     [queues.HUNTS.Add(str(i)) for i in range(1, 4)])
+
+    self._NotifyAllShards(manager, 4)
+    for queue_shard in all_shards:
+      notifications = manager.GetNotificationsByPriority(
+          queues.HUNTS, queue_shard=queue_shard)
+      self.assertEqual(sum(len(n) for n in notifications.values()), 1)
+
+    # Only the newest version of the count is used.
+    manager.SetShardCount(queues.HUNTS, 3)
+    self.assertEqual(manager.GetShardLayout(queues.HUNTS).shard_count, 3)
+
+  def testShrunkShardsAreDrainedUntilEmpty(self):
+    with test_lib.FakeTime(1000):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.SetShardCount(queues.HUNTS, 4)
+      session_ids = self._NotifyAllShards(manager, 4)
+
+      layout = manager.SetShardCount(queues.HUNTS, 1)
+      self.assertEqual(layout.shard_count, 1)
+      self.assertEqual(layout.drain_shard_count, 4)
+
+      # New notifications only go to the remaining shard but all the old
+      # shards are still read.
+      self.assertEqual(manager.GetNotificationShard(queues.HUNTS), queues.HUNTS)
+      self.assertEqual(len(manager.GetAllNotificationShards(queues.HUNTS)), 4)
+      self.assertEqual(
+          len(manager.GetNotificationsForAllShards(queues.HUNTS)), 4)
+
+    with test_lib.FakeTime(2000):
+      # The old shards still hold notifications.
+      self.assertFalse(manager.DrainNotificationShards(queues.HUNTS))
+
+      manager.DeleteNotifications(session_ids)
+      self.assertTrue(manager.DrainNotificationShards(queues.HUNTS))
+      self.assertEqual(
+          manager.GetAllNotificationShards(queues.HUNTS), [queues.HUNTS])
+
+  def testShardCountsAreWrittenTogether(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.SetShardCount(queues.HUNTS, 4)
+
+    with mock.patch.object(
+        data_store.DB, "MultiSet", wraps=data_store.DB.MultiSet) as multi_set:
+      layout = manager.SetShardCount(queues.HUNTS, 1)
+
+    self.assertEqual(multi_set.call_count, 1)
+    self.assertItemsEqual(multi_set.call_args[0][1], [
+        queue_manager.QueueManager.SHARD_COUNT_PREDICATE,
+        queue_manager.QueueManager.DRAIN_SHARD_COUNT_PREDICATE
+    ])
+    self.assertEqual(layout.shard_count, 1)
+    self.assertEqual(layout.drain_shard_count, 4)
+
+    # Only the newest drain count is kept.
+    layout = manager.SetShardCount(queues.HUNTS, 4)
+    self.assertEqual(layout.drain_shard_count, 0)
+    self.assertEqual(
+        len(data_store.DB.ResolvePrefix(
+            queues.HUNTS.Add(queue_manager.QueueManager.SHARD_LAYOUT_SUBJECT),
+            queue_manager.QueueManager.DRAIN_SHARD_COUNT_PREDICATE,
+            timestamp=data_store.DB.ALL_TIMESTAMPS,
+            token=self.token)), 1)
+
+  def testShardsAreNotDrainedWhileWritersMayUseTheOldLayout(self):
+    with test_lib.FakeTime(1000):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.SetShardCount(queues.HUNTS, 1)
+      self.assertTrue(manager.GetShardLayout(queues.HUNTS).draining)
+      self.assertFalse(manager.DrainNotificationShards(queues.HUNTS))
+
+    with test_lib.FakeTime(2000):
+      self.assertTrue(manager.DrainNotificationShards(queues.HUNTS))
+      self.assertFalse(manager.GetShardLayout(queues.HUNTS).draining)
+
+  def testNotificationsWakeUpWorkers(self):
+    channel = mock.Mock()
+    with utils.Stubber(notification_channel, "CHANNEL", channel):
+      manager = queue_manager.QueueManager(token=self.token)
+      manager.QueueNotification(session_id=rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name="42"))
+      manager.QueueNotification(session_id=rdfvalue.SessionID(
+          base="aff4:/hunts", queue=queues.HUNTS, flow_name="43"))
+      self.assertFalse(channel.Publish.called)
+
+      # The queue is published once, after the notifications are written.
+      manager.Flush()
+      channel.Publish.assert_called_once_with(
+          set([queues.HUNTS]), token=self.token)
+
+      channel.Publish.reset_mock()
+      manager.MultiNotifyQueue([
+          rdf_flows.GrrNotification(session_id=rdfvalue.SessionID(
+              base="aff4:/flows", queue=queues.FLOWS, flow_name="44"))
+      ])
+      channel.Publish.assert_called_once_with([queues.FLOWS], token=self.token)
+
   def testNotificationsAreDeletedFromAllShards(self):
     manager = queue_manager.QueueManager(token=self.token)
     manager.QueueNotification(session_id=rdfvalue.SessionID(
@@ -20,6 +20,10 @@ class DataStoreRequest(structs.RDFProtoStruct):
   protobuf = data_store_pb2.DataStoreRequest
 
 
+class DataStoreMutation(structs.RDFProtoStruct):
+  protobuf = data_store_pb2.DataStoreMutation
+
+
 class DataStoreResponse(structs.RDFProtoStruct):
   protobuf = data_store_pb2.DataStoreResponse
 
@@ -15,17 +15,20 @@ try:
 except ImportError:
   pass
 
+from grr.lib import blob_store_test
 from grr.lib import build_test
 from grr.lib import client_index_test
 from grr.lib import communicator_test
 from grr.lib import config_lib_test
 from grr.lib import config_validation_test
 from grr.lib import console_utils_test
+from grr.lib import data_store_benchmark_test
 from grr.lib import data_store_test
 from grr.lib import email_alerts_test
 from grr.lib import events_test
 from grr.lib import export_test
 from grr.lib import export_utils_test
+from grr.lib import fair_share_test
 from grr.lib import flow_test
 from grr.lib import flow_utils_test
 from grr.lib import front_end_test
@@ -34,6 +37,7 @@ from grr.lib import hunt_test
 from grr.lib import instant_output_plugin_test
 from grr.lib import ipv6_utils_test
 from grr.lib import lexer_test
+from grr.lib import notification_channel_test
 from grr.lib import objectfilter_test
 from grr.lib import output_plugin_test
 from grr.lib import parsers_test
@@ -50,6 +54,7 @@ from grr.lib import utils_test
 
 from grr.lib.aff4_objects import tests
 from grr.lib.authorization import tests
+from grr.lib.blob_stores import tests
 from grr.lib.builders import tests
 from grr.lib.checks import tests
 from grr.lib.data_stores import tests
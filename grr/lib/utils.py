@@ -757,6 +757,15 @@ def Grouper(iterable, n):
     yield items
 
 
+def WriteAll(fileobj, data_list):
+  """Writes a list of strings to a file like object or a socket."""
+  if hasattr(fileobj, "writelines"):
+    fileobj.writelines(data_list)
+  else:
+    for data in data_list:
+      fileobj.sendall(data)
+
+
 def EncodeReasonString(reason):
   return base64.urlsafe_b64encode(SmartStr(reason))
 
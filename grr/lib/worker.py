@@ -2,7 +2,10 @@
 """Module with GRRWorker implementation."""
 
 
+import errno
+import os
 import pdb
+import signal
 import time
 import traceback
 
@@ -11,9 +14,12 @@ import logging
 
 from grr.lib import aff4
 from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import fair_share
 from grr.lib import flags
 from grr.lib import flow
 from grr.lib import master
+from grr.lib import notification_channel
 from grr.lib import queue_manager as queue_manager_lib
 from grr.lib import queues as queues_config
 from grr.lib import registry
@@ -57,6 +63,8 @@ class GRRWorker(object):
                queues=queues_config.WORKER_LIST,
                threadpool_prefix="grr_threadpool",
                threadpool_size=None,
+               process_index=0,
+               num_processes=1,
                token=None):
     """Constructor.
 
@@ -64,6 +72,11 @@ class GRRWorker(object):
       queues: The queues we use to fetch new messages from.
       threadpool_prefix: A name for the thread pool used by this worker.
       threadpool_size: The number of workers to start in this thread pool.
+      process_index: The index of this worker when several processes share
+          the notification shards.
+      num_processes: The number of processes sharing the notification shards.
+          Only the shards whose index modulo num_processes is process_index
+          are scanned, by default all shards are scanned in turn.
       token: The token to use for the worker.
 
     Raises:
@@ -72,6 +85,10 @@ class GRRWorker(object):
     logging.info("started worker with queues: " + str(queues))
     self.queues = queues
     self.queued_flows = utils.TimeBasedCache(max_size=10, max_age=60)
+    self.scheduler = fair_share.FairShareScheduler()
+    self.process_index = process_index
+    self.num_processes = num_processes
+    self.notification_shard_counters = {}
 
     if token is None:
       raise RuntimeError("A valid ACLToken is required.")
@@ -89,6 +106,11 @@ class GRRWorker(object):
     self.token = token
     self.last_active = 0
 
+    self.notification_channel = notification_channel.CHANNEL
+    if self.notification_channel is None:
+      self.notification_channel = (
+          notification_channel.PollingNotificationChannel())
+
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
     self.flow_lease_time = config_lib.CONFIG["Worker.flow_lease_time"]
@@ -109,17 +131,22 @@ class GRRWorker(object):
           for h in logger.handlers:
             h.flush()
 
-          if time.time() - self.last_active > self.SHORT_POLL_TIME:
+          if self.notification_channel.delivers_wakeups:
+            # New notifications wake us up, the timeout is only a fallback.
+            interval = config_lib.CONFIG["Worker.notification_channel_max_wait"]
+          elif time.time() - self.last_active > self.SHORT_POLL_TIME:
             interval = self.POLLING_INTERVAL
           else:
             interval = self.SHORT_POLLING_INTERVAL
 
-          time.sleep(interval)
+          self.notification_channel.Wait(
+              self.queues, interval, token=self.token)
         else:
           self.last_active = time.time()
 
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
+      self.notification_channel.Close()
       self.thread_pool.Join()
 
   def RunOnce(self):
@@ -141,8 +168,8 @@ class GRRWorker(object):
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      notifications_by_priority = self._GetNotificationsByPriority(
+          queue, queue_manager)
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -160,6 +187,9 @@ class GRRWorker(object):
           if notification.session_id not in self.queued_flows:
             notifications_available.append(notification)
 
+      # Share the worker fairly between hunts, creators and interactive flows.
+      notifications_available = self.scheduler.Order(notifications_available)
+
       try:
         # If we spent too much time processing what we have so far, the
         # active_sessions list might not be current. We therefore break here
@@ -189,6 +219,31 @@ class GRRWorker(object):
         return processed
     return processed
 
+  def _GetNotificationsByPriority(self, queue, queue_manager):
+    """Reads the notifications of the next shard of the queue to scan."""
+    if self.num_processes <= 1:
+      return queue_manager.GetNotificationsByPriority(queue)
+
+    # Only the shards owned by this worker are scanned, in turn. The shard
+    # count of a queue can change, so ownership is recomputed every time.
+    queue_shards = queue_manager.GetAllNotificationShards(queue)
+    owned = range(self.process_index, len(queue_shards), self.num_processes)
+    stats.STATS.SetGaugeValue(
+        "worker_process_notification_shards",
+        len(owned),
+        fields=[queue.Basename()])
+    if not owned:
+      return {}
+
+    counter = self.notification_shard_counters.get(queue, 0)
+    self.notification_shard_counters[queue] = counter + 1
+    shard_index = owned[counter % len(owned)]
+
+    stats.STATS.IncrementCounter(
+        "worker_notification_shard_scans", fields=[str(shard_index)])
+    return queue_manager.GetNotificationsByPriority(
+        queue, queue_shard=queue_shards[shard_index])
+
   def ProcessStuckFlows(self, stuck_flows, queue_manager):
     stats.STATS.IncrementCounter("grr_flows_stuck", len(stuck_flows))
 
@@ -228,21 +283,98 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    # Flows are dispatched in chunks, the responses of a chunk are prefetched
+    # right before it is dispatched. Flows left over by the time limit are
+    # never read.
+    batch_size = config_lib.CONFIG["Worker.prefetch_batch_size"]
+    chunk = []
     for notification in active_notifications:
-      if notification.session_id not in self.queued_flows:
-        if time_limit and time.time() - now > time_limit:
-          break
+      if notification.session_id in self.queued_flows:
+        continue
+
+      if time_limit and time.time() - now > time_limit:
+        break
 
-        processed += 1
-        self.queued_flows.Put(notification.session_id, 1)
-        self.thread_pool.AddTask(
-            target=self._ProcessMessages,
-            args=(notification, queue_manager.Copy()),
-            name=self.__class__.__name__)
+      self.queued_flows.Put(notification.session_id, 1)
+      chunk.append(notification)
+      if len(chunk) >= max(batch_size, 1):
+        processed += self._DispatchFlows(chunk, queue_manager, batch_size)
+        chunk = []
 
+    processed += self._DispatchFlows(chunk, queue_manager, batch_size)
     return processed
 
-  def _ProcessRegularFlowMessages(self, flow_obj, notification):
+  def _DispatchFlows(self, notifications, queue_manager, prefetch):
+    """Hands the notified flows to the thread pool.
+
+    Args:
+        notifications: The notifications of the flows to process.
+        queue_manager: QueueManager object used to manage notifications,
+                       requests and responses.
+        prefetch: If set, the responses of the flows are read at once first.
+
+    Returns:
+        The number of dispatched flows.
+    """
+    prefetched = {}
+    if prefetch and notifications:
+      prefetched = self._PrefetchResponses(notifications, queue_manager)
+
+    for notification in notifications:
+      share_class = self.scheduler.GetShareClass(notification)
+      stats.STATS.IncrementCounter(
+          "worker_fair_share_dispatched", fields=[share_class])
+      if notification.timestamp:
+        stats.STATS.RecordEvent(
+            "worker_notification_queueing_delay",
+            time.time() - notification.timestamp.AsSecondsFromEpoch(),
+            fields=[share_class])
+
+      self.thread_pool.AddTask(
+          target=self._ProcessMessages,
+          args=(notification, queue_manager.Copy(),
+                prefetched.get(str(notification.session_id))),
+          name=self.__class__.__name__)
+
+    return len(notifications)
+
+  def _PrefetchResponses(self, notifications, queue_manager):
+    """Reads the requests and responses of a batch of flows at once.
+
+    Args:
+        notifications: The notifications of the flows about to be processed.
+        queue_manager: QueueManager object used to read the data.
+
+    Returns:
+        A dict of session id strings to PrefetchedResponses. Flows missing
+        from it read their data themselves.
+    """
+    # Well known flows do not keep request states. Hunts do not check the
+    # requests they read against what was processed already, so they must
+    # only read them once they hold the lock.
+    notifications = [
+        n for n in notifications
+        if n.session_id.FlowName() not in self.well_known_flows and
+        n.session_id.Queue() != queues_config.HUNTS
+    ]
+    if not notifications:
+      return {}
+
+    limit = config_lib.CONFIG["Worker.prefetch_max_responses"]
+    start = time.time()
+    try:
+      prefetched = queue_manager.PrefetchCompletedResponses(
+          notifications, limit=limit)
+    except data_store.Error as e:
+      logging.warning("Unable to prefetch flow responses: %s", e)
+      return {}
+
+    stats.STATS.RecordEvent("worker_prefetch_time", time.time() - start)
+    stats.STATS.IncrementCounter("worker_prefetched_flows", len(prefetched))
+    return prefetched
+
+  def _ProcessRegularFlowMessages(self, flow_obj, notification,
+                                  prefetched=None):
     """Processes messages for a given flow."""
     session_id = notification.session_id
     if not isinstance(flow_obj, flow.FlowBase):
@@ -254,6 +386,9 @@ class GRRWorker(object):
       raise FlowProcessingError("Not a GRRFlow.")
 
     runner = flow_obj.GetRunner()
+    self.scheduler.SetCreator(session_id, runner.context.creator)
+    if prefetched is not None:
+      runner.queue_manager.SetPrefetchedResponses(session_id, prefetched)
     try:
       runner.ProcessCompletedRequests(notification, self.thread_pool)
     except Exception as e:  # pylint: disable=broad-except
@@ -263,7 +398,7 @@ class GRRWorker(object):
       logging.error("Flow %s: %s", flow_obj, e)
       raise FlowProcessingError(e)
 
-  def _ProcessMessages(self, notification, queue_manager):
+  def _ProcessMessages(self, notification, queue_manager, prefetched=None):
     """Does the real work with a single flow."""
     flow_obj = None
     session_id = notification.session_id
@@ -312,7 +447,8 @@ class GRRWorker(object):
 
       else:
         with flow_obj:
-          self._ProcessRegularFlowMessages(flow_obj, notification)
+          self._ProcessRegularFlowMessages(
+              flow_obj, notification, prefetched=prefetched)
 
       elapsed = time.time() - now
       logging.debug("Done processing %s: %s sec", session_id, elapsed)
@@ -346,6 +482,132 @@ class GRRWorker(object):
       queue_manager.DeleteNotification(session_id)
 
 
+class WorkerSupervisor(object):
+  """Runs workers in several processes to use more than one core.
+
+  The notification shards of the worker queues are split between the
+  processes by index, so every process scans a disjoint subset of them. When
+  a process dies, a new process is forked which takes over the shards of the
+  dead one.
+
+  Every process has its own stats collector. Its stats are served on
+  Monitoring.http_port plus the index of the process, if the port is set,
+  and written to the stats store under StatsStore.process_id (or "worker")
+  followed by the index.
+  """
+
+  # A process dying sooner than this after its start is restarted only once
+  # this many seconds have passed, so a crashing worker does not spin.
+  MIN_PROCESS_UPTIME = 10
+
+  def __init__(self, run_worker, num_processes=None):
+    """Constructor.
+
+    Args:
+      run_worker: Called in every forked process with the index of the
+          process, the number of processes and how often the process was
+          restarted. Runs the worker and returns when it exits.
+      num_processes: The number of processes to run, Worker.processes by
+          default.
+    """
+    self.run_worker = run_worker
+    if num_processes is None:
+      num_processes = config_lib.CONFIG["Worker.processes"]
+
+    self.num_processes = max(1, num_processes)
+    # Pid -> index of the process.
+    self.children = {}
+    self.start_times = {}
+    self.restarts = [0] * self.num_processes
+
+  def _ConfigureProcess(self, index):
+    """Gives the forked process with the given index its own stats exports."""
+    overrides = {}
+    port = config_lib.CONFIG["Monitoring.http_port"]
+    if port:
+      overrides["Monitoring.http_port"] = str(port + index)
+
+    process_id = config_lib.CONFIG["StatsStore.process_id"] or "worker"
+    overrides["StatsStore.process_id"] = "%s_%d" % (process_id, index)
+
+    # Like the --parameter flag, global overrides survive the config being
+    # read again when the process initializes.
+    config_lib.CONFIG.global_override.update(overrides)
+    config_lib.CONFIG.FlushCache()
+
+  def _StartProcess(self, index):
+    """Forks the process with the given index."""
+    pid = os.fork()
+    if pid == 0:
+      exit_code = 0
+      try:
+        self._ConfigureProcess(index)
+        self.run_worker(index, self.num_processes, self.restarts[index])
+      except KeyboardInterrupt:
+        pass
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Worker process %d failed.", index)
+        exit_code = 1
+      finally:
+        # Never return into the supervisor loop.
+        os._exit(exit_code)  # pylint: disable=protected-access
+
+    logging.info("Started worker process %d of %d (pid %d).", index,
+                 self.num_processes, pid)
+    self.children[pid] = index
+    self.start_times[index] = time.time()
+
+  def _RestartProcess(self, index):
+    delay = self.start_times[index] + self.MIN_PROCESS_UPTIME - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+    self.restarts[index] += 1
+    self._StartProcess(index)
+
+  def Run(self):
+    """Starts the processes and restarts them when they die."""
+    for index in range(self.num_processes):
+      self._StartProcess(index)
+
+    try:
+      while self.children:
+        try:
+          pid, status = os.waitpid(-1, 0)
+        except OSError as e:
+          if e.errno == errno.EINTR:
+            continue
+          raise
+
+        index = self.children.pop(pid, None)
+        if index is None:
+          continue
+
+        logging.error("Worker process %d (pid %d) died with status %d, handing "
+                      "its shards to a new process.", index, pid, status)
+        self._RestartProcess(index)
+
+    except KeyboardInterrupt:
+      logging.info("Caught interrupt, stopping worker processes.")
+      self.Stop()
+
+  def Stop(self):
+    """Interrupts all the processes and waits for them to exit."""
+    for pid in self.children:
+      try:
+        os.kill(pid, signal.SIGINT)
+      except OSError:
+        pass
+
+    for pid in self.children.keys():
+      try:
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+
+    self.children = {}
+
+
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
 
@@ -364,3 +626,28 @@ class WorkerInit(registry.InitHook):
     stats.STATS.RegisterEventMetric(
         "worker_flow_processing_time", fields=[("flow", str)])
     stats.STATS.RegisterEventMetric("worker_time_to_retrieve_notifications")
+    stats.STATS.RegisterCounterMetric(
+        "worker_notification_shard_scans", fields=[("shard", str)])
+    stats.STATS.RegisterCounterMetric(
+        "worker_fair_share_dispatched", fields=[("share_class", str)])
+    stats.STATS.RegisterCounterMetric("worker_prefetched_flows")
+    stats.STATS.RegisterEventMetric("worker_prefetch_time")
+    stats.STATS.RegisterEventMetric(
+        "worker_notification_queueing_delay",
+        fields=[("share_class", str)],
+        docstring="Time flows waited between their notification and being "
+        "handed to a worker thread.",
+        units="SECONDS")
+    stats.STATS.RegisterGaugeMetric(
+        "worker_process_index",
+        int,
+        docstring="Index of this process when the worker runs several.")
+    stats.STATS.RegisterGaugeMetric(
+        "worker_process_notification_shards",
+        int,
+        fields=[("queue", str)],
+        docstring="Number of notification shards owned by this process.")
+    stats.STATS.RegisterGaugeMetric(
+        "worker_process_restarts",
+        int,
+        docstring="How often the process with this index was restarted.")
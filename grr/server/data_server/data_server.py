@@ -795,9 +795,13 @@ def Start(db,
       cmd.DELETE_ATTRIBUTES: (reqhandler_cls.SERVICE.DeleteAttributes, "w"),
       cmd.DELETE_SUBJECT: (reqhandler_cls.SERVICE.DeleteSubject, "w"),
       cmd.MULTI_SET: (reqhandler_cls.SERVICE.MultiSet, "w"),
+      cmd.CHECK_AND_MULTI_SET: (reqhandler_cls.SERVICE.CheckAndMultiSet, "w"),
+      cmd.MULTI_SUBJECT_MUTATE: (reqhandler_cls.SERVICE.MultiSubjectMutate,
+                                 "w"),
       cmd.MULTI_RESOLVE_PREFIX: (reqhandler_cls.SERVICE.MultiResolvePrefix,
                                  "r"),
       cmd.RESOLVE_MULTI: (reqhandler_cls.SERVICE.ResolveMulti, "r"),
+      cmd.RESOLVE_PREFIX_PAGE: (reqhandler_cls.SERVICE.ResolvePrefixPage, "r"),
       cmd.LOCK_SUBJECT: (reqhandler_cls.SERVICE.LockSubject, "w"),
       cmd.EXTEND_SUBJECT: (reqhandler_cls.SERVICE.ExtendSubject, "w"),
       cmd.UNLOCK_SUBJECT: (reqhandler_cls.SERVICE.UnlockSubject, "w"),
@@ -109,7 +109,18 @@ class DataStoreService(object):
   @RPCWrapper
   def MultiSet(self, request, unused_response):
     """Set multiple attributes for a given subject at once."""
+    values, to_delete = self._MultiSetArgs(request)
 
+    self.db.MultiSet(
+        request.subject[0],
+        values,
+        to_delete=to_delete,
+        sync=request.sync,
+        replace=False,
+        token=request.token)
+
+  def _MultiSetArgs(self, request):
+    """Converts a MULTI_SET request into MultiSet() values and to_delete."""
     values = {}
     to_delete = set()
 
@@ -125,12 +136,55 @@ class DataStoreService(object):
         values.setdefault(value.attribute, []).append(
             (value.value.GetValue(), timestamp))
 
-    self.db.MultiSet(
+    return values, to_delete
+
+  @RPCWrapper
+  def CheckAndMultiSet(self, request, response):
+    """Set attributes of a subject if others are unchanged."""
+    expected_values = {}
+    for value in request.expected_values:
+      expected = None
+      if value.HasField("value"):
+        expected = (value.value.GetValue(),
+                    self.FromTimestampSpec(value.timestamp))
+      expected_values[value.attribute] = expected
+
+    values, to_delete = self._MultiSetArgs(request)
+    response.applied = self.db.CheckAndMultiSet(
         request.subject[0],
+        expected_values,
         values,
         to_delete=to_delete,
+        token=request.token)
+
+  @RPCWrapper
+  def MultiSubjectMutate(self, request, unused_response):
+    """Apply a batch of mutations for many subjects at once."""
+    delete_subjects = []
+    delete_attributes = []
+    set_requests = []
+
+    mutation_type = rdf_data_store.DataStoreMutation.Type
+    for mutation in request.mutations:
+      mutation_request = mutation.request
+      subject = mutation_request.subject[0]
+      if mutation.type == mutation_type.DELETE_SUBJECT:
+        delete_subjects.append(subject)
+      elif mutation.type == mutation_type.DELETE_ATTRIBUTES:
+        start, end = self.FromTimestampSpec(mutation_request.timestamp)
+        attributes = [v.attribute for v in mutation_request.values]
+        delete_attributes.append((subject, attributes, start, end))
+      elif mutation.type == mutation_type.MULTI_SET:
+        values, to_delete = self._MultiSetArgs(mutation_request)
+        set_requests.append((subject, values, None, False, to_delete))
+      else:
+        raise data_store.Error("Unknown mutation type %s" % mutation.type)
+
+    self.db.MultiSubjectMutate(
+        delete_subjects=delete_subjects,
+        delete_attributes=delete_attributes,
+        set_requests=set_requests,
         sync=request.sync,
-        replace=False,
         token=request.token)
 
   @RPCWrapper
@@ -175,6 +229,29 @@ class DataStoreService(object):
           payload=[(utils.SmartStr(attribute), self._Encode(value), int(ts))
                    for (attribute, value, ts) in values])
 
+  @RPCWrapper
+  def ResolvePrefixPage(self, request, response):
+    """Resolve one page of attributes matching the prefixes of a subject."""
+    attribute_prefix = [utils.SmartUnicode(v.attribute) for v in request.values]
+
+    timestamp = self.FromTimestampSpec(request.timestamp)
+    subject = request.subject[0]
+
+    values, cursor = self.db.ResolvePrefixPage(
+        subject,
+        attribute_prefix,
+        timestamp=timestamp,
+        page_size=request.limit or None,
+        cursor=request.cursor or None,
+        token=request.token)
+
+    response.results.Append(
+        subject=subject,
+        payload=[(utils.SmartStr(attribute), self._Encode(value), int(ts))
+                 for (attribute, value, ts) in values])
+    if cursor:
+      response.cursor = cursor
+
   @RPCWrapper
   def ScanAttributes(self, request, response):
     subject_prefix = request.subject[0]
@@ -30,6 +30,8 @@ from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import key_utils
 from grr.lib import maintenance_utils
+from grr.lib import queue_manager
+from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import rekall_profile_server
 from grr.lib import repacking
@@ -270,6 +272,21 @@ parser_list_components = subparsers.add_parser(
     parents=[],
     help="Lists all available client components.")
 
+parser_set_queue_shards = subparsers.add_parser(
+    "set_queue_shards",
+    parents=[],
+    help="Change the number of notification shards of worker queues while "
+    "the workers are running.")
+
+parser_set_queue_shards.add_argument(
+    "shard_count", type=int, help="The new number of notification shards.")
+
+parser_set_queue_shards.add_argument(
+    "--queue",
+    default=[],
+    action="append",
+    help="The queues to change, all the worker queues by default.")
+
 
 def ImportConfig(filename, config):
   """Reads an old config file and imports keys and user accounts."""
@@ -871,6 +888,21 @@ def main(unused_argv):
   elif flags.FLAGS.subparser_name == "list_components":
     maintenance_utils.ListComponents(token=token)
 
+  elif flags.FLAGS.subparser_name == "set_queue_shards":
+    queue_names = flags.FLAGS.queue
+    if not queue_names:
+      queue_names = [queue.Basename() for queue in queues.WORKER_LIST]
+
+    manager = queue_manager.QueueManager(token=token)
+    for queue_name in queue_names:
+      layout = manager.SetShardCount(
+          rdfvalue.RDFURN(queue_name), flags.FLAGS.shard_count)
+      print "Queue %s now has %d notification shards." % (queue_name,
+                                                          layout.shard_count)
+      if layout.draining:
+        print "Shards %d to %d are read until they are empty." % (
+            layout.shard_count, layout.drain_shard_count - 1)
+
   elif flags.FLAGS.subparser_name == "set_var":
     config = config_lib.CONFIG
     print "Setting %s to %s" % (flags.FLAGS.var, flags.FLAGS.val)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Benchmarks data store implementations with GRR shaped workloads.
+
+One JSON record is written out per (implementation, workload) pair:
+
+  python -m grr.tools.data_store_benchmark --config server.yaml \
+      --benchmark_implementations SqliteDataStore,LmdbDataStore \
+      --benchmark_location /tmp/benchmark \
+      --benchmark_output results.jsonl
+"""
+
+
+import json
+import platform
+import time
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import access_control
+from grr.lib import config_lib
+from grr.lib import data_store_benchmark
+from grr.lib import flags
+from grr.lib import startup
+
+flags.DEFINE_list("benchmark_implementations", [],
+                  "Data store implementations to benchmark. Defaults to the "
+                  "configured Datastore.implementation.")
+
+flags.DEFINE_list("benchmark_workloads", [],
+                  "Workloads to run. Defaults to all known workloads.")
+
+flags.DEFINE_integer("benchmark_threads", 10,
+                     "Number of threads issuing operations concurrently.")
+
+flags.DEFINE_integer("benchmark_operations", 1000,
+                     "Number of operations per workload, split over all "
+                     "threads.")
+
+flags.DEFINE_integer("benchmark_seed", 0,
+                     "Seed for the random generators driving the workloads.")
+
+flags.DEFINE_string("benchmark_location", "",
+                    "If set, every implementation uses a fresh "
+                    "Datastore.location below this directory.")
+
+flags.DEFINE_string("benchmark_output", "",
+                    "Append JSON results to this file instead of printing "
+                    "them.")
+
+
+def main(unused_argv):
+  """Main."""
+  startup.Init()
+
+  token = access_control.ACLToken(username="GRRBenchmark", reason="Benchmark")
+  workloads = data_store_benchmark.GetWorkloads(
+      flags.FLAGS.benchmark_workloads)
+  implementations = (flags.FLAGS.benchmark_implementations or
+                     [config_lib.CONFIG["Datastore.implementation"]])
+
+  results = []
+  for implementation in implementations:
+    store = data_store_benchmark.OpenDataStore(
+        implementation, location=flags.FLAGS.benchmark_location)
+    runner = data_store_benchmark.BenchmarkRunner(
+        threads=flags.FLAGS.benchmark_threads,
+        operations=flags.FLAGS.benchmark_operations,
+        seed=flags.FLAGS.benchmark_seed,
+        token=token)
+    for workload_cls in workloads:
+      result = runner.RunWorkload(workload_cls)
+      result.update({
+          "implementation": implementation,
+          "seed": flags.FLAGS.benchmark_seed,
+          "time": time.time(),
+          "hostname": platform.node(),
+      })
+      results.append(result)
+    store.Flush()
+
+  lines = [json.dumps(result, sort_keys=True) for result in results]
+  if flags.FLAGS.benchmark_output:
+    with open(flags.FLAGS.benchmark_output, "ab") as fd:
+      for line in lines:
+        fd.write(line + "\n")
+  else:
+    for line in lines:
+      print line
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -14,14 +14,35 @@ from grr.lib import access_control
 from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import startup
+from grr.lib import stats
 from grr.lib import worker
 
 
+def RunWorkerProcess(index, num_processes, restarts):
+  """Runs a worker owning some notification shards in a forked process."""
+  startup.Init()
+  stats.STATS.SetGaugeValue("worker_process_index", index)
+  stats.STATS.SetGaugeValue("worker_process_restarts", restarts)
+
+  token = access_control.ACLToken(username="GRRWorker").SetUID()
+  worker_obj = worker.GRRWorker(
+      process_index=index, num_processes=num_processes, token=token)
+  worker_obj.Run()
+
+
 def main(unused_argv):
   """Main."""
   config_lib.CONFIG.AddContext("Worker Context",
                                "Context applied when running a worker.")
 
+  # Only the config is needed to decide how many processes to run. Everything
+  # else is initialized in the worker processes, after they were forked.
+  startup.AddConfigContext()
+  startup.ConfigInit()
+  if config_lib.CONFIG["Worker.processes"] > 1:
+    worker.WorkerSupervisor(RunWorkerProcess).Run()
+    return
+
   # Initialise flows
   startup.Init()
   token = access_control.ACLToken(username="GRRWorker").SetUID()
@@ -2,6 +2,8 @@
 """Tests for the worker."""
 
 
+import os
+import signal
 import threading
 import time
 
@@ -985,6 +987,138 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
       self.assertEqual(notification.first_queued, notification.timestamp)
       self.assertEqual(notification.last_status, 10)
 
+  def testWorkerOnlyScansOwnedNotificationShards(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 4}):
+      worker_obj = worker.GRRWorker(
+          queues=[queues.FLOWS],
+          process_index=1,
+          num_processes=2,
+          token=self.token)
+      all_shards = queue_manager.QueueManager(
+          token=self.token).GetAllNotificationShards(queues.FLOWS)
+
+      scanned = []
+
+      def GetNotificationsByPriority(_, queue, queue_shard=None):
+        _ = queue
+        scanned.append(queue_shard)
+        return {}
+
+      with utils.Stubber(queue_manager.QueueManager,
+                         "GetNotificationsByPriority",
+                         GetNotificationsByPriority):
+        for _ in range(4):
+          worker_obj.RunOnce()
+
+    self.assertEqual(scanned, [all_shards[1], all_shards[3]] * 2)
+
+  def testOnlyDispatchedFlowsArePrefetched(self):
+    worker_obj = worker.GRRWorker(queues=[queues.FLOWS], token=self.token)
+    notifications = [
+        rdf_flows.GrrNotification(session_id=rdfvalue.SessionID(
+            base="aff4:/flows", queue=queues.FLOWS, flow_name=str(i)))
+        for i in range(5)
+    ]
+    clock = [1000]
+    prefetched = []
+    dispatched = []
+
+    def PrefetchResponses(notifications, _):
+      prefetched.append([n.session_id for n in notifications])
+      # Reading the responses takes time.
+      clock[0] += 10
+      return {}
+
+    def AddTask(**kwargs):
+      dispatched.append(kwargs["args"][0].session_id)
+
+    with test_lib.ConfigOverrider({"Worker.prefetch_batch_size": 2}):
+      with utils.MultiStubber((worker_obj, "_PrefetchResponses",
+                               PrefetchResponses),
+                              (worker_obj.thread_pool, "AddTask", AddTask),
+                              (time, "time", lambda: clock[0])):
+        processed = worker_obj.ProcessMessages(
+            notifications, queue_manager.QueueManager(token=self.token),
+            time_limit=15)
+
+    session_ids = [n.session_id for n in notifications]
+    # The fifth flow is over the time limit, its responses are never read.
+    self.assertEqual(processed, 4)
+    self.assertEqual(prefetched, [session_ids[:2], session_ids[2:4]])
+    self.assertEqual(dispatched, session_ids[:4])
+
+  def testSupervisorRestartsDeadProcesses(self):
+    supervisor = worker.WorkerSupervisor(lambda *args: None, num_processes=2)
+    supervisor.MIN_PROCESS_UPTIME = 0
+
+    pids = iter([100, 101, 102])
+    # The first process dies, the supervisor is interrupted afterwards.
+    waits = iter([(100, 1), KeyboardInterrupt()])
+
+    def WaitPid(pid, _):
+      if pid != -1:
+        return pid, 0
+
+      result = next(waits)
+      if isinstance(result, Exception):
+        raise result
+      return result
+
+    with mock.patch.object(os, "fork", side_effect=lambda: next(pids)):
+      with mock.patch.object(os, "waitpid", side_effect=WaitPid):
+        with mock.patch.object(os, "kill") as kill:
+          supervisor.Run()
+
+    # The replacement of process 0 is stopped along with process 1.
+    self.assertEqual(sorted(call[0][0] for call in kill.call_args_list),
+                     [101, 102])
+    self.assertEqual(supervisor.restarts, [1, 0])
+
+  def testSupervisorForksProcessesWithTheirOwnStats(self):
+    results_path = os.path.join(self.temp_dir, "processes")
+
+    def ReadResults():
+      if not os.path.exists(results_path):
+        return []
+      with open(results_path, "rb") as fd:
+        return fd.read().splitlines()
+
+    def RunWorker(index, num_processes, restarts):
+      line = "%d %d %d %d %s\n" % (
+          index, num_processes, restarts,
+          config_lib.CONFIG["Monitoring.http_port"],
+          config_lib.CONFIG["StatsStore.process_id"])
+      fd = os.open(results_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+      os.write(fd, line)
+      os.close(fd)
+
+      # The first process dies. Once every process has started, its
+      # replacement interrupts the supervisor, which stops the others.
+      if index == 0 and not restarts:
+        return
+
+      if index == 0:
+        deadline = time.time() + 30
+        while len(ReadResults()) < 3 and time.time() < deadline:
+          time.sleep(0.1)
+        os.kill(os.getppid(), signal.SIGINT)
+
+      time.sleep(30)
+
+    supervisor = worker.WorkerSupervisor(RunWorker, num_processes=2)
+    supervisor.MIN_PROCESS_UPTIME = 0
+    with test_lib.ConfigOverrider({
+        "Monitoring.http_port": 4000,
+        "StatsStore.process_id": "test"
+    }):
+      supervisor.Run()
+
+    self.assertEqual(supervisor.children, {})
+    self.assertEqual(supervisor.restarts, [1, 0])
+    self.assertEqual(
+        sorted(ReadResults()),
+        ["0 2 0 4000 test_0", "0 2 1 4000 test_0", "1 2 0 4001 test_1"])
+
 
 def main(_):
   test_lib.main()